@@ -0,0 +1,192 @@
+# Import dependencies
+import os
+import pytest
+
+# Import internal dependencies
+from bench_inventory import add_block_device, write
+from pyluks.inventory import BlockInventory
+from pyluks.backends import RealBackend, SimulatedBackend
+from pyluks.cryptdev_registry import CryptdevRegistry
+from pyluks.block_tuning import BlockTuner, TuningError, get_profile, tuning_profiles, format_drift
+from pyluks.luksctl import LUKSCtl, run_all
+from pyluks.fastluks import device
+
+
+
+################################################################################
+# FIXTURES
+
+def read(path):
+    with open(path) as f:
+        return f.read().strip()
+
+
+@pytest.fixture
+def tuned_host(tmp_path):
+    """Fake sysfs tree of a host with:
+
+    * vdc, a disk with the mq-deadline, kyber and none schedulers, holding crypt (dm-0), opened by luksOpen;
+    * vdd1, a partition of vdd, holding the LVM volume dm-1, itself holding crypt1 (dm-2).
+
+    dm devices have no I/O scheduler, as bio-based device-mapper targets.
+    """
+    sysfs = str(tmp_path / 'sys')
+    disk_queue = {'scheduler': '[mq-deadline] kyber none', 'nr_requests': 64, 'read_ahead_kb': 128, 'rq_affinity': 1, 'add_random': 1}
+    dm_queue = {'scheduler': 'none', 'nr_requests': 128, 'read_ahead_kb': 128, 'rq_affinity': 1, 'add_random': 0}
+    vdc = add_block_device(sysfs, 'vdc', '252:32', 50 * 1024**3, queue=disk_queue)
+    add_block_device(sysfs, 'vdd', '252:48', 50 * 1024**3, queue=disk_queue)
+    vdd1 = add_block_device(sysfs, 'vdd1', '252:49', 50 * 1024**3 - 1024**2, parent='vdd')
+    devices = {}
+    for name, devnum, dm_name, slave_dir in (('dm-0', '253:0', 'crypt', vdc), ('dm-1', '253:1', 'vg-data', vdd1), ('dm-2', '253:2', 'crypt1', None)):
+        devices[name] = add_block_device(sysfs, name, devnum, 10 * 1024**3, virtual=True, queue=dm_queue,
+                                         dm__name=dm_name, bdi__max_ratio=100, bdi__min_ratio=0)
+        slave_dir = slave_dir or devices['dm-1']
+        os.symlink(slave_dir, os.path.join(devices[name], 'slaves', os.path.basename(slave_dir)))
+    return BlockInventory(sysfs_root=sysfs, dev_root=str(tmp_path / 'dev'), mountinfo_file=str(tmp_path / 'mountinfo'),
+                          swaps_file=str(tmp_path / 'swaps'))
+
+
+def queue_file(inventory, name, setting):
+    return os.path.join(inventory.sysfs_dir(name), 'queue', setting)
+
+
+def mount(inventory, devnum, mountpoint):
+    with open(inventory.mountinfo_file, 'a') as f:
+        f.write(f'30 1 {devnum} / {mountpoint} rw,relatime shared:1 - ext4 /dev/{devnum} rw\n')
+
+
+
+################################################################################
+# BENCHMARKS
+
+def test_apply_profile(benchmark, tuned_host):
+    """Applying the sequential profile after luksOpen: read-ahead and bdi on the dm device, the disk is left untouched."""
+    backend = RealBackend(inventory=tuned_host)
+    settings = get_profile('sequential')
+    result = benchmark(backend.tune_block_device, '/dev/mapper/crypt', settings)
+
+    assert all(values['error'] is None for values in result.values())
+    assert result['read_ahead_kb']['devices'] == ['dm-0'] and result['scheduler']['devices'] == []
+    assert read(queue_file(tuned_host, 'dm-0', 'read_ahead_kb')) == '4096'
+    assert read(os.path.join(tuned_host.sysfs_dir('dm-0'), 'bdi', 'max_ratio')) == '50'
+    assert read(queue_file(tuned_host, 'vdc', 'scheduler')) == '[mq-deadline] kyber none'
+    assert read(queue_file(tuned_host, 'vdc', 'nr_requests')) == '64'
+    assert read(queue_file(tuned_host, 'dm-0', 'nr_requests')) == '128' # Untouched, dm-crypt has no request queue
+    assert backend.block_tuning_drift('/dev/mapper/crypt', settings) == {}
+
+
+def test_tune_disks(tuned_host):
+    """With tune_disks, the request queue settings reach the disk under the dm device."""
+    backend = RealBackend(inventory=tuned_host)
+    settings = get_profile('sequential')
+    result = backend.tune_block_device('/dev/mapper/crypt', settings, tune_disks=True)
+    assert all(values['error'] is None for values in result.values())
+    assert result['scheduler']['devices'] == ['vdc'] and result['scheduler']['skipped'] == []
+    assert read(queue_file(tuned_host, 'vdc', 'scheduler')) == 'mq-deadline'
+    assert read(queue_file(tuned_host, 'vdc', 'nr_requests')) == '256'
+    assert backend.block_tuning_drift('/dev/mapper/crypt', settings, tune_disks=True) == {}
+
+
+def test_stacked_devices(tuned_host):
+    """crypt1 on LVM on a partition: the request queue settings reach the disk holding the partition, unless another
+    filesystem on that disk is mounted."""
+    tuner = BlockTuner(tuned_host, tune_disks=True)
+    result = tuner.apply('/dev/mapper/crypt1', {'nr_requests': 512, 'read_ahead_kb': 8192})
+    assert result['nr_requests']['devices'] == ['vdd'] and result['read_ahead_kb']['devices'] == ['dm-2']
+    assert read(queue_file(tuned_host, 'vdd', 'nr_requests')) == '512'
+    assert read(queue_file(tuned_host, 'dm-1', 'read_ahead_kb')) == '128'
+
+    mount(tuned_host, '253:2', '/export1') # The volume itself doesn't prevent the tuning
+    assert tuner.apply('/dev/mapper/crypt1', {'nr_requests': 256})['nr_requests']['devices'] == ['vdd']
+    add_block_device(tuned_host.sysfs_root, 'vdd2', '252:50', 1024**2, parent='vdd')
+    mount(tuned_host, '252:50', '/boot')
+    result = tuner.apply('/dev/mapper/crypt1', {'nr_requests': 128})
+    assert result['nr_requests'] == {'value': '128', 'devices': [], 'error': None, 'skipped': ['vdd']}
+    assert read(queue_file(tuned_host, 'vdd', 'nr_requests')) == '256'
+
+
+def test_drift(tuned_host):
+    """Settings changed after the open, e.g. by a udev rule, are reported."""
+    tuner = BlockTuner(tuned_host, tune_disks=True)
+    settings = get_profile('sequential')
+    tuner.apply('/dev/mapper/crypt', settings)
+    write(queue_file(tuned_host, 'dm-0', 'read_ahead_kb'), 128)
+    write(queue_file(tuned_host, 'vdc', 'scheduler'), 'mq-deadline kyber [none]')
+
+    drift = tuner.drift('/dev/mapper/crypt', settings)
+    assert drift == {'scheduler': {'expected': 'mq-deadline', 'actual': {'vdc': 'none'}},
+                     'read_ahead_kb': {'expected': '4096', 'actual': {'dm-0': '128'}}}
+    assert format_drift(drift) == 'scheduler: none on vdc, expected mq-deadline\nread_ahead_kb: 128 on dm-0, expected 4096'
+
+
+def test_refused_settings(tuned_host):
+    """A setting the kernel refuses is reported without stopping the other ones."""
+    os.remove(queue_file(tuned_host, 'vdc', 'nr_requests'))
+    os.makedirs(queue_file(tuned_host, 'vdc', 'nr_requests')) # Not writable
+    result = BlockTuner(tuned_host, tune_disks=True).apply('/dev/mapper/crypt', {'scheduler': 'bfq', 'nr_requests': 256, 'read_ahead_kb': 4096})
+    assert result['scheduler']['error'] == 'vdc: scheduler bfq not available'
+    assert result['nr_requests']['error'].startswith('vdc: ')
+    assert result['read_ahead_kb']['error'] is None
+    with pytest.raises(TuningError):
+        BlockTuner(tuned_host).apply('/dev/mapper/missing', {'read_ahead_kb': 4096})
+
+
+def test_luksctl_tuning(tuned_host, cryptdev_ini):
+    """luksctl open applies the recorded profile, verify-tuning reports the drift and tune records a new profile and
+    the tuning of the disks."""
+    registry = CryptdevRegistry(cryptdev_ini)
+    registry.add(dict(registry.get('crypt'), tuning_profile='sequential', tune_disks='true'))
+    with open(cryptdev_ini, 'a') as f:
+        f.write('\n[tuning:genomics]\nread_ahead_kb = 16384\nmax_ratio = 20\n')
+    backend = RealBackend(inventory=tuned_host)
+
+    luks = LUKSCtl(cryptdev_ini, backend=backend)
+    assert luks.open()['ok']
+    assert read(queue_file(tuned_host, 'dm-0', 'read_ahead_kb')) == '4096'
+    assert luks.check_tuning()['message'] == 'Block-layer tuning: [ OK ] (sequential)'
+
+    write(queue_file(tuned_host, 'vdc', 'nr_requests'), 64)
+    result = luks.check_tuning()
+    assert not result['ok'] and result['output'] == 'nr_requests: 64 on vdc, expected 256'
+
+    assert luks.tune('genomics', tune_disks=False)['ok']
+    assert CryptdevRegistry(cryptdev_ini).get('crypt')['tuning_profile'] == 'genomics'
+    assert CryptdevRegistry(cryptdev_ini).get('crypt')['tune_disks'] == 'false'
+    write(queue_file(tuned_host, 'vdc', 'nr_requests'), 32)
+    assert luks.check_tuning()['ok'] # The disk is not checked anymore
+    assert read(queue_file(tuned_host, 'dm-0', 'read_ahead_kb')) == '16384'
+    assert [result['ok'] for result in run_all(cryptdev_ini, 'verify-tuning', backend=backend)] == [True]
+    assert not luks.tune('missing')['ok']
+
+
+def test_fastluks_tuning(tmp_path):
+    """fastluks records the profile in the cryptdev .ini file and applies it after luksOpen, luksctl after a reboot."""
+    sim = SimulatedBackend(seed=0, luks_cryptdev_file=str(tmp_path / 'luks-cryptdev.ini'))
+    sim.add_device('/dev/vdb')
+    luks_device = device(device_name='/dev/vdb', cryptdev='crypt', mountpoint='/export', filesystem='ext4', backend=sim,
+                         tuning_profile='sequential')
+    luks_device.encrypt(luks_header_backup_file=str(tmp_path / 'luks-header.bck'), luks_cryptdev_file=sim.luks_cryptdev_file,
+                        passphrase_length=8, passphrase=None, save_passphrase_locally=False, use_vault=False,
+                        vault_url=None, wrapping_token=None, secret_path=None, user_key=None,
+                        state_file=str(tmp_path / 'fastluks-state.ini'))
+    luks_device.volume_setup(state_file=str(tmp_path / 'fastluks-state.ini'))
+    assert CryptdevRegistry(sim.luks_cryptdev_file).get('crypt')['tuning_profile'] == 'sequential'
+    assert sim.queue_settings['crypt'] == get_profile('sequential')
+
+    sim.reboot()
+    assert sim.luksctl('verify-tuning', 'luksctl')[2] == 1
+    assert sim.luksctl('open', 'luksctl', secret=sim.devices['/dev/vdb']['luks']['keyslots'][0])[2] == 0
+    assert sim.luksctl('verify-tuning', 'luksctl')[2] == 0
+
+
+def test_profiles(tmp_path):
+    """Profiles of the cryptdev .ini file are added to the built-in ones, unknown settings and profiles are refused."""
+    ini_file = tmp_path / 'luks-cryptdev.ini'
+    ini_file.write_text('[tuning:sequential]\nread_ahead_kb = 8192\n')
+    assert get_profile('sequential', str(ini_file)) == {'read_ahead_kb': '8192'}
+    assert set(tuning_profiles()) == {'sequential', 'random', 'balanced'}
+    with pytest.raises(TuningError):
+        get_profile('missing')
+    ini_file.write_text('[tuning:bad]\nread_ahead = 8192\n')
+    with pytest.raises(TuningError):
+        tuning_profiles(str(ini_file))
@@ -0,0 +1,142 @@
+# Import dependencies
+import json
+import socket
+import threading
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Import internal dependencies
+from pyluks.client import LuksctlClient, ClusterClient
+from pyluks.luksctl_api.loadgen import SimulatedAPIServer
+
+
+
+################################################################################
+# HELPERS
+
+class _BusyHandler(BaseHTTPRequestHandler):
+    """Answers 429 with a Retry-After header to the first requests, then the volume state."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests += 1
+        if self.server.requests <= self.server.busy:
+            code, body, headers = self.server.busy_status, b'', {'Retry-After': '0.05'}
+        else:
+            code, body, headers = 200, json.dumps({'volume_state': 'mounted'}).encode(), {'Content-Type': 'application/json'}
+        self.send_response(code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.do_GET()
+
+
+def refused_node():
+    """Returns a local address nothing listens on."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return f'127.0.0.1:{sock.getsockname()[1]}'
+
+
+
+################################################################################
+# FIXTURES
+
+@pytest.fixture(scope='module')
+def simulated_nodes():
+    """Three luksctl_api masters on simulated volumes, opened in 20 ms each, standing in for the cluster nodes."""
+    servers = [SimulatedAPIServer(volumes=1, latencies={'luks_open': 0.02}).start() for _ in range(3)]
+    try:
+        yield servers
+    finally:
+        for server in servers:
+            server.stop()
+
+
+
+################################################################################
+# BENCHMARKS
+
+def test_client_status_keepalive(benchmark, simulated_nodes):
+    """/status round trip on a kept-alive connection."""
+    with LuksctlClient(simulated_nodes[0].url) as client:
+        result = benchmark(client.status)
+    assert result.ok and result.volume_state in ('mounted', 'unmounted')
+
+
+def test_client_open(simulated_nodes):
+    """/open reads the passphrase from Vault and reports the mounted volume."""
+    server = simulated_nodes[0]
+    with LuksctlClient(server.url) as client:
+        result = client.open(**server.open_payload())
+        assert result.ok and result.mounted
+        assert client.status(cryptdev=server.cryptdevs[0]).mounted
+
+
+def test_client_retry_after():
+    """Requests rejected with 429 are retried after the Retry-After delay."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _BusyHandler)
+    server.requests, server.busy, server.busy_status = 0, 2, 429
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        with LuksctlClient(f'http://127.0.0.1:{server.server_port}', retries=2) as client:
+            result = client.status()
+            assert (result.mounted, result.attempts) == (True, 3)
+            server.requests, server.busy = 0, 5
+            result = client.status(retries=1)
+            assert (result.ok, result.status_code, result.attempts) == (False, 429, 2)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_client_open_retries():
+    """/open is retried after a 429 or a refused connection, not after a 503 which may follow the token read."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _BusyHandler)
+    server.requests, server.busy, server.busy_status = 0, 1, 429
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    payload = {'vault_url': 'https://vault:8200', 'vault_token': 'token', 'secret_root': 'secrets',
+               'secret_path': 'luks', 'secret_key': 'passphrase'}
+    try:
+        with LuksctlClient(f'http://127.0.0.1:{server.server_port}', retries=2, backoff=0.01) as client:
+            assert client.open(**payload).attempts == 2
+            server.requests, server.busy, server.busy_status = 0, 1, 503
+            result = client.open(**payload)
+            assert (result.ok, result.status_code, result.attempts) == (False, 503, 1)
+            server.requests = 0
+            assert client.status().attempts == 2
+    finally:
+        server.shutdown()
+        server.server_close()
+    with LuksctlClient(f'http://{refused_node()}', retries=2, backoff=0.01) as client:
+        assert client.open(**payload).attempts == 3
+
+
+def test_cluster_status_all(benchmark, simulated_nodes):
+    """Batch /status on every node, an unreachable node is reported in the results without failing the batch."""
+    nodes = [server.url.split('://', 1)[1] for server in simulated_nodes] + [refused_node()]
+    with ClusterClient(nodes, url_template='http://{node}', max_workers=8, retries=0) as cluster:
+        batch = benchmark(cluster.status_all)
+    assert batch.failed == nodes[-1:]
+    assert batch.summary['unreachable'] == 1 and sum(batch.summary.values()) == len(nodes)
+    assert batch.to_dict()['total_nodes'] == len(nodes)
+
+
+def test_cluster_open_all(simulated_nodes):
+    """Batch /open with per node Vault parameters."""
+    credentials = {server.url.split('://', 1)[1]: server.open_payload() for server in simulated_nodes}
+    with ClusterClient(list(credentials), url_template='http://{node}', max_workers=2) as cluster:
+        batch = cluster.open_all(credentials)
+    assert batch.ok and batch.summary == {'mounted': len(simulated_nodes)}
+
+    with ClusterClient(list(credentials) + ['missing'], url_template='http://{node}') as cluster:
+        batch = cluster.open_all(credentials, nodes=['missing'])
+    assert batch.failed == ['missing'] and batch.results['missing'].attempts == 0
@@ -0,0 +1,42 @@
+# Import internal dependencies
+from pyluks.luksctl import LUKSCtl
+from pyluks.cryptdev_registry import CryptdevRegistry
+from pyluks.luksctl_api.luksctl_run import read_api_config
+
+
+
+################################################################################
+# BENCHMARKS
+
+def test_read_api_config(benchmark, cryptdev_ini):
+    """Parsing of the luksctl_api section, done by every API request."""
+    api_config = benchmark(read_api_config, luks_cryptdev_file=cryptdev_ini, api_section='luksctl_api')
+    assert len(api_config['node_list']) == 200
+
+
+def test_luksctl_init(benchmark, cryptdev_ini):
+    """Parsing of the luks section, done by every luksctl invocation."""
+    luks = benchmark(LUKSCtl, cryptdev_ini)
+    assert luks.get_cryptdev() == 'crypt'
+
+
+def test_registry_lookup(benchmark, tmp_path):
+    """Lookups by mountpoint in a cryptdev registry holding 50 volumes."""
+    registry = CryptdevRegistry(str(tmp_path / 'luks-cryptdev.ini'))
+    for i in range(50):
+        registry.add({'cryptdev': f'crypt{i}', 'device': f'/dev/vd{i}', 'uuid': f'uuid-{i}', 'mountpoint': f'/data{i}'})
+
+    volume = benchmark(registry.lookup, '/data49')
+    assert volume['cryptdev'] == 'crypt49'
+
+
+def test_luksctl_init_multi_volume(benchmark, tmp_path):
+    """LUKSCtl instantiation for the last volume of a cryptdev .ini file holding 50 volumes."""
+    registry = CryptdevRegistry(str(tmp_path / 'luks-cryptdev.ini'))
+    for i in range(50):
+        registry.add({'cipher_algorithm': 'aes-xts-plain64', 'hash_algorithm': 'sha256', 'keysize': 256,
+                      'device': f'/dev/vd{i}', 'uuid': f'uuid-{i}', 'cryptdev': f'crypt{i}', 'mapper': f'/dev/mapper/crypt{i}',
+                      'mountpoint': f'/data{i}', 'filesystem': 'ext4', 'header_path': f'/etc/luks/luks-header-{i}.bck'})
+
+    luks = benchmark(LUKSCtl, registry.luks_cryptdev_file, cryptdev='crypt49')
+    assert luks.get_device() == '/dev/vd49'
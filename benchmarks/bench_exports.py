@@ -0,0 +1,34 @@
+# Import dependencies
+import pytest
+
+# Import internal dependencies
+from pyluks.luksctl_api.luksctl_run import write_exports_file
+
+
+
+################################################################################
+# BENCHMARKS
+
+@pytest.mark.parametrize('n_nodes', [10, 200, 2000])
+def test_write_exports_file(benchmark, tmp_path, n_nodes):
+    """write_exports_file on an empty exports file, for a growing number of worker nodes."""
+    exports_file = tmp_path / 'exports'
+    node_list = [f'10.{i // 65536}.{i // 256 % 256}.{i % 256}' for i in range(1, n_nodes + 1)]
+
+    def write_exports():
+        exports_file.write_text('# /etc/exports\n')
+        return write_exports_file(['/export', '/home'], node_list, exports_file=str(exports_file))
+
+    assert benchmark(write_exports)
+
+
+@pytest.mark.parametrize('n_nodes', [200, 2000])
+def test_write_exports_file_unchanged(benchmark, tmp_path, n_nodes):
+    """write_exports_file when every worker node is already exported: no write and no reload."""
+    exports_file = tmp_path / 'exports'
+    node_list = [f'192.168.{i // 256}.{i % 256}' for i in range(1, n_nodes + 1)]
+    # Hosts are scattered on purpose, so that no CIDR aggregation is possible
+    node_list = node_list[::2]
+    write_exports_file(['/export'], node_list, exports_file=str(exports_file))
+
+    assert not benchmark(write_exports_file, ['/export'], node_list, exports_file=str(exports_file))
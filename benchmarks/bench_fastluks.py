@@ -0,0 +1,50 @@
+# Import dependencies
+from pathlib import Path
+import pytest
+
+# Import internal dependencies
+from pyluks.fastluks import fastluks_lib
+from pyluks.fastluks import device
+
+# Import benchmark fixtures
+from conftest import FAKE_DEVICE
+
+
+
+################################################################################
+# FIXTURES
+
+@pytest.fixture
+def fake_host(monkeypatch):
+    """Makes the fake device look like a block device and the host like a supported distribution."""
+    is_block_device = Path.is_block_device
+    monkeypatch.setattr(Path, 'is_block_device',
+                        lambda self: str(self) == FAKE_DEVICE or is_block_device(self))
+    monkeypatch.setattr(fastluks_lib, 'DISTNAME', 'ubuntu')
+
+
+
+################################################################################
+# BENCHMARKS
+
+def test_device_encrypt(benchmark, fake_host, tmp_path):
+    """device.encrypt orchestration: volume checks, luksFormat, header backup, luksOpen, status and .ini file."""
+    luks_device = device(device_name=FAKE_DEVICE, cryptdev='crypt',
+                         mountpoint=str(tmp_path / 'export'), filesystem='ext4')
+    luks_cryptdev_file = str(tmp_path / 'luks-cryptdev.ini')
+
+    benchmark(luks_device.encrypt,
+              luks_header_backup_file=str(tmp_path / 'luks' / 'luks-header.bck'),
+              luks_cryptdev_file=luks_cryptdev_file,
+              passphrase_length=16, passphrase=None, save_passphrase_locally=False,
+              use_vault=False, vault_url=None, wrapping_token=None, secret_path=None, user_key=None,
+              state_file=str(tmp_path / 'fastluks-state.ini'))
+
+    assert fastluks_lib.read_ini_file(luks_cryptdev_file)['device'] == FAKE_DEVICE
+
+
+def test_device_volume_setup(benchmark, fake_host, tmp_path):
+    """device.volume_setup orchestration: mkfs and mount."""
+    luks_device = device(device_name=FAKE_DEVICE, cryptdev='crypt',
+                         mountpoint=str(tmp_path / 'export'), filesystem='ext4')
+    benchmark(luks_device.volume_setup, state_file=str(tmp_path / 'fastluks-state.ini'))
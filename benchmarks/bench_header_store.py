@@ -0,0 +1,39 @@
+# Import dependencies
+import pytest
+
+# Import internal dependencies
+from pyluks.backends import SimulatedBackend
+from pyluks.header_store import HeaderStore
+
+
+
+################################################################################
+# BENCHMARKS
+
+@pytest.fixture
+def luks_volumes():
+    """Simulated host with 100 LUKS volumes."""
+    sim = SimulatedBackend(seed=0)
+    for i in range(100):
+        sim.add_luks_device(f'/dev/vd{i}', luks_uuid=f'00000000-0000-4000-8000-{i:012d}', secret=f'secret{i}')
+    return sim
+
+
+def test_header_store_backup(benchmark, tmp_path, luks_volumes):
+    """HeaderStore.backup of 100 headers: hashing, gzip compression and atomic writes of blobs and indexes."""
+    def backup():
+        store = HeaderStore(str(tmp_path / 'store'), backend=luks_volumes)
+        return [store.backup(path) for path in luks_volumes.devices]
+
+    backups = benchmark.pedantic(backup, rounds=1)
+    assert all(b['compressed_size'] < b['size'] for b in backups)
+
+
+def test_header_store_verify(benchmark, tmp_path, luks_volumes):
+    """HeaderStore.verify of 100 headers against their latest backup, i.e. a fleet integrity check."""
+    store = HeaderStore(str(tmp_path / 'store'), backend=luks_volumes)
+    for path in luks_volumes.devices:
+        store.backup(path)
+
+    results = benchmark(lambda: [store.verify(path, dev['luks']['uuid']) for path, dev in luks_volumes.devices.items()])
+    assert all(results)
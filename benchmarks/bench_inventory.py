@@ -0,0 +1,144 @@
+# Import dependencies
+import os
+import pytest
+
+# Import internal dependencies
+from pyluks.inventory import BlockInventory, mkfs_options
+from pyluks.backends import RealBackend, SimulatedBackend
+from pyluks.fastluks import device, find_candidate_devices, discover_device, LUKSError
+
+
+
+################################################################################
+# FAKE SYSFS
+
+def write(path, content=''):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(f'{content}\n')
+
+
+def add_block_device(root, name, devnum, size, parent=None, virtual=False, queue=None, **attributes):
+    """Adds a device to a fake sysfs tree, with the /sys/class/block symlink pointing into /sys/devices
+    and, for whole disks, the /sys/block one, as the kernel does."""
+    if parent is not None:
+        device_dir = os.path.join(os.path.realpath(os.path.join(root, 'class', 'block', parent)), name)
+        write(os.path.join(device_dir, 'partition'), name[-1])
+    else:
+        bus = 'virtual/block' if virtual else 'pci0000:00/block'
+        device_dir = os.path.join(root, 'devices', bus, name)
+        os.makedirs(os.path.join(root, 'block'), exist_ok=True)
+        os.symlink(device_dir, os.path.join(root, 'block', name))
+        for key, value in dict({'rotational': 0, 'logical_block_size': 512, 'physical_block_size': 512,
+                                'minimum_io_size': 512, 'optimal_io_size': 0, 'discard_granularity': 512}, **(queue or {})).items():
+            write(os.path.join(device_dir, 'queue', key), value)
+        write(os.path.join(device_dir, 'removable'), attributes.pop('removable', 0))
+
+    write(os.path.join(device_dir, 'dev'), devnum)
+    write(os.path.join(device_dir, 'size'), size // 512)
+    write(os.path.join(device_dir, 'ro'), attributes.pop('ro', 0))
+    os.makedirs(os.path.join(device_dir, 'holders'), exist_ok=True)
+    os.makedirs(os.path.join(device_dir, 'slaves'), exist_ok=True)
+    for key, value in attributes.items():
+        write(os.path.join(device_dir, *key.split('__')), value)
+    os.makedirs(os.path.join(root, 'class', 'block'), exist_ok=True)
+    os.symlink(device_dir, os.path.join(root, 'class', 'block', name))
+    return device_dir
+
+
+@pytest.fixture
+def fake_host(tmp_path):
+    """Fake sysfs, mountinfo, swaps and /dev trees of a host with:
+
+    * vda, the system disk, with the root filesystem on vda1 and swap on vda2;
+    * vdb, an unused disk;
+    * vdc, a LUKS volume opened as crypt (dm-0) and mounted on /export;
+    * vdd, an unused disk on a RAID controller exposing a 64 KiB chunk and a 256 KiB stripe;
+    * sr0 and loop0, never proposed for encryption.
+    """
+    sysfs, dev = str(tmp_path / 'sys'), str(tmp_path / 'dev')
+    add_block_device(sysfs, 'vda', '252:0', 20 * 1024**3)
+    add_block_device(sysfs, 'vda1', '252:1', 18 * 1024**3, parent='vda')
+    add_block_device(sysfs, 'vda2', '252:2', 2 * 1024**3, parent='vda')
+    add_block_device(sysfs, 'vdb', '252:16', 100 * 1024**3, queue={'rotational': 1})
+    vdc = add_block_device(sysfs, 'vdc', '252:32', 50 * 1024**3)
+    dm0 = add_block_device(sysfs, 'dm-0', '253:0', 50 * 1024**3 - 2 * 1024**2, virtual=True,
+                           dm__name='crypt', dm__uuid='CRYPT-LUKS2-101de0a7e4f54d409829541a2b34c1bf-crypt')
+    os.symlink(dm0, os.path.join(vdc, 'holders', 'dm-0'))
+    os.symlink(vdc, os.path.join(dm0, 'slaves', 'vdc'))
+    add_block_device(sysfs, 'vdd', '252:48', 400 * 1024**3, queue={'minimum_io_size': 65536, 'optimal_io_size': 262144})
+    add_block_device(sysfs, 'sr0', '11:0', 1024**3, removable=1)
+    add_block_device(sysfs, 'loop0', '7:0', 1024**3, virtual=True)
+
+    write(str(tmp_path / 'mountinfo'),
+          '22 1 252:1 / / rw,relatime shared:1 - ext4 /dev/vda1 rw\n'
+          '23 22 0:5 / /dev rw,nosuid shared:2 - devtmpfs udev rw\n'
+          '40 22 253:0 / /export rw,relatime shared:20 - ext4 /dev/mapper/crypt rw\n'
+          '41 22 252:1 /srv/data /mnt/bind\\040dir rw,relatime shared:1 - ext4 /dev/vda1 rw')
+    write(str(tmp_path / 'swaps'),
+          'Filename\t\t\t\tType\t\tSize\t\tUsed\t\tPriority\n'
+          '/dev/vda2                               partition\t2097148\t\t0\t\t-2')
+
+    os.makedirs(dev)
+    for name, content in (('vdb', b'\x00' * 512), ('vdc', b'LUKS\xba\xbe\x00\x02'), ('vdd', b'\x00' * 512)):
+        with open(os.path.join(dev, name), 'wb') as f:
+            f.write(content)
+
+    return BlockInventory(sysfs_root=sysfs, mountinfo_file=str(tmp_path / 'mountinfo'),
+                          swaps_file=str(tmp_path / 'swaps'), dev_root=dev)
+
+
+
+################################################################################
+# BENCHMARKS
+
+def test_inventory_device(benchmark, fake_host):
+    """Description of a single device from sysfs, as done by the device checks instead of lsblk and df."""
+    vdd = benchmark(fake_host.device, '/dev/vdd')
+    assert vdd['type'] == 'disk' and vdd['size'] == 400 * 1024**3 and not vdd['rotational']
+    assert (vdd['minimum_io_size'], vdd['optimal_io_size']) == (65536, 262144)
+    assert mkfs_options('ext4', vdd) == ['-E', 'stride=16,stripe_width=64']
+    assert mkfs_options('xfs', vdd) == ['-d', 'su=65536,sw=4']
+
+
+def test_inventory_devices(benchmark, fake_host):
+    """Full inventory of the host, with holders, slaves, mounts and swaps."""
+    devices = {d['name']: d for d in benchmark(fake_host.devices)}
+
+    assert devices['vda1'] == dict(devices['vda1'], type='part', parent='vda', mountpoint='/', fstype='ext4')
+    assert devices['vda']['partitions'] == ['vda1', 'vda2'] and devices['vda2']['swap']
+    assert devices['vdb']['rotational'] and devices['vdb']['luks'] is False
+    assert devices['vdc']['holders'] == ['dm-0'] and devices['vdc']['luks'] is True
+    assert devices['dm-0'] == dict(devices['dm-0'], type='dm', path='/dev/mapper/crypt', slaves=['vdc'], mountpoint='/export')
+    assert [d['name'] for d in fake_host.candidates()] == ['vdb', 'vdd']
+
+
+def test_inventory_mount_source(benchmark, fake_host):
+    """RealBackend.mount_source from mountinfo, instead of a df | tail | cut pipeline."""
+    backend = RealBackend(inventory=fake_host)
+    assert benchmark(backend.mount_source, '/export') == '/dev/mapper/crypt'
+    assert fake_host.mount_info('/mnt/bind dir')['root'] == '/srv/data'
+    assert fake_host.device('/dev/mapper/crypt')['name'] == 'dm-0'
+
+
+def test_discover_device():
+    """Auto-discovery of the disk to encrypt on a simulated host, skipping LUKS, formatted and mapped disks."""
+    sim = SimulatedBackend(seed=0)
+    sim.add_luks_device('/dev/vdb', luks_uuid='101de0a7-e4f5-4d40-9829-541a2b34c1bf', secret='s3cret', filesystem='ext4')
+    sim.add_device('/dev/vdc')
+    assert discover_device(backend=sim) == '/dev/vdc'
+
+    sim.add_device('/dev/vdd')
+    assert [d['path'] for d in find_candidate_devices(backend=sim)] == ['/dev/vdc', '/dev/vdd']
+    with pytest.raises(LUKSError):
+        discover_device(backend=sim)
+
+
+def test_create_fs_topology(fake_host, monkeypatch):
+    """device.create_fs passes the stripe geometry of the mapped device to mkfs."""
+    backend = RealBackend(inventory=fake_host)
+    calls = []
+    monkeypatch.setattr(backend, 'mkfs', lambda filesystem, dev, logger=None, options=None, limits=None: calls.append(options) or ('', '', 0))
+    monkeypatch.setattr(backend, 'block_device', lambda path: fake_host.device('/dev/vdd'))
+    device('/dev/vdd', 'crypt', '/export', 'ext4', 'aes-xts-plain64', 256, 'sha256', backend=backend).create_fs()
+    assert calls == [['-E', 'stride=16,stripe_width=64']]
@@ -0,0 +1,162 @@
+# Import dependencies
+import os
+import time
+import threading
+import pytest
+
+# Import internal dependencies
+from pyluks import io_throttle
+from pyluks.backends import RealBackend, SimulatedBackend
+from pyluks.fastluks import device
+from pyluks.io_throttle import IOLimits, IOScope, IOThrottleError, RateLimiter, throttled_wipe, parse_limit, parse_ionice, native_thread_id
+
+
+
+################################################################################
+# HELPERS
+
+MiB = 1024**2
+
+
+class FakeClock:
+    """Virtual clock: sleeping advances the time instantly."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def image(tmp_path, size):
+    path = tmp_path / 'disk.img'
+    with open(path, 'wb') as f:
+        f.write(b'\xff' * size)
+    return str(path)
+
+
+################################################################################
+# BENCHMARKS
+
+def test_rate_limiter():
+    """Writes are paced to the bandwidth and IOPS limits, and a limit change applies from the next write."""
+    clock = FakeClock()
+    limits = IOLimits(bandwidth='10M', iops=None, limits_file=None)
+    limiter = RateLimiter(limits, clock=clock, sleep=clock.sleep)
+    for _ in range(100):
+        limiter.wait(MiB)
+    assert clock.now == pytest.approx(9.9, rel=0.01) # The first write is not delayed
+
+    limits.bandwidth, limits.iops = None, 50
+    start = clock.now
+    for _ in range(100):
+        limiter.wait(4096)
+    assert clock.now - start == pytest.approx(0.1 + 99 * 0.02) # The last 1 MiB write, then 50 writes per second
+
+
+def test_throttled_wipe(benchmark, tmp_path):
+    """In-process wipe of a 16 MiB image at 64 MiB/s: about 0.25 s, with the image zeroed as dd would do."""
+    path = image(tmp_path, 16 * MiB)
+    limits = IOLimits(bandwidth='64M', limits_file=None)
+    start = time.monotonic()
+    stdout, stderr, status = benchmark.pedantic(throttled_wipe, args=(path, limits), rounds=1, iterations=1)
+    assert time.monotonic() - start >= 0.2
+    assert status == 1 and 'No space left on device' in stderr # End of the device reached, as dd
+    with open(path, 'rb') as f:
+        assert f.read() == bytes(16 * MiB)
+    assert throttled_wipe(path, IOLimits(limits_file=None), size=MiB)[2] == 0
+    assert throttled_wipe(str(tmp_path / 'missing' / 'disk.img'), limits)[2] == 1
+    _, stderr, status = RealBackend().wipe(path, limits=IOLimits(bandwidth='1G', ionice='idle', limits_file=None))
+    assert status == 1 and 'No space left on device' in stderr
+
+
+def test_runtime_limit_change(tmp_path):
+    """A wipe started at 4 MiB/s speeds up once the limits file is changed, e.g. by 'fastluks --set-io-limits'."""
+    path = image(tmp_path, 32 * MiB)
+    limits_file = str(tmp_path / 'io-limits.json')
+    limits = IOLimits(bandwidth='4M', limits_file=limits_file, reload_interval=0.05)
+    result = []
+    thread = threading.Thread(target=lambda: result.append(throttled_wipe(path, limits)))
+    start = time.monotonic()
+    thread.start()
+    time.sleep(0.3)
+    IOLimits.write(limits_file, bandwidth='max')
+    thread.join(timeout=5)
+    assert not thread.is_alive() and time.monotonic() - start < 3 # 8 s at 4 MiB/s
+    assert limits.current() == (None, None)
+
+
+def test_stale_limits_file(tmp_path):
+    """A limits file written before the run is ignored."""
+    limits_file = str(tmp_path / 'io-limits.json')
+    IOLimits.write(limits_file, bandwidth='1M', iops=10)
+    time.sleep(0.01)
+    limits = IOLimits(bandwidth='100M', limits_file=limits_file, reload_interval=0)
+    assert limits.current() == (100 * MiB, None)
+
+
+def test_scope(tmp_path, monkeypatch):
+    """mkfs is run in a systemd scope with the write limits of the device, which follow the changes of the limits."""
+    calls = []
+    monkeypatch.setattr(io_throttle, 'run_argv', lambda args: calls.append(args) or ('', '', 0))
+    limits = IOLimits(bandwidth='50M', iops=200, limits_file=None, reload_interval=0.02)
+    scope = IOScope('/dev/mapper/crypt', limits, name='fastluks-test')
+    assert scope.command(['mkfs', '/dev/mapper/crypt']) == [
+        'systemd-run', '--scope', '--quiet', '--collect', '--unit=fastluks-test.scope',
+        '-p', f'IOWriteBandwidthMax=/dev/mapper/crypt {50 * MiB}', '-p', 'IOWriteIOPSMax=/dev/mapper/crypt 200',
+        'mkfs', '/dev/mapper/crypt']
+    with scope:
+        limits.bandwidth = None
+        time.sleep(0.2)
+    assert calls == [['systemctl', 'set-property', '--runtime', 'fastluks-test.scope',
+                      'IOWriteBandwidthMax=/dev/mapper/crypt infinity', 'IOWriteIOPSMax=/dev/mapper/crypt 200']]
+    assert scope._watcher is None
+    assert native_thread_id() == int(os.readlink('/proc/thread-self').rsplit('/', 1)[1])
+
+
+def test_mkfs_limits(tmp_path, monkeypatch):
+    """mkfs is run with ionice in a systemd scope, with ionice only without systemd or if the scope can't be started,
+    and the plan estimates follow the bandwidth limit."""
+    limits = IOLimits(bandwidth='50M', ionice='idle', limits_file=None)
+    assert limits.command(['mkfs', '-t', 'ext4', '/dev/mapper/crypt']) == ['ionice', '-c', '3', 'mkfs', '-t', 'ext4', '/dev/mapper/crypt']
+    log = tmp_path / 'systemd-run.log'
+    monkeypatch.setenv('FAKE_SYSTEMD_RUN_LOG', str(log))
+    monkeypatch.setattr(io_throttle, 'SYSTEMD_RUNTIME_DIR', str(tmp_path / 'missing'))
+    assert RealBackend().mkfs('ext4', '/dev/mapper/crypt', limits=limits)[2] == 0
+    assert not log.exists()
+
+    monkeypatch.setattr(io_throttle, 'SYSTEMD_RUNTIME_DIR', str(tmp_path))
+    assert RealBackend().mkfs('ext4', '/dev/mapper/crypt', limits=limits)[2] == 0
+    assert f'IOWriteBandwidthMax=/dev/mapper/crypt {50 * MiB}' in log.read_text().splitlines()
+    monkeypatch.setenv('FAKE_SYSTEMD_RUN_STATUS', '1')
+    assert RealBackend().mkfs('ext4', '/dev/mapper/crypt', limits=limits)[2] == 0
+    monkeypatch.setenv('FAKE_SYSTEMD_RUN_ERROR', "systemd-run: unrecognized option '--collect'")
+    assert RealBackend().mkfs('ext4', '/dev/mapper/crypt', limits=limits)[2] == 0
+    monkeypatch.delenv('FAKE_SYSTEMD_RUN_STATUS')
+    log.unlink()
+    monkeypatch.setenv('FAKE_SYSTEMD_RUN_VERSION', '219') # CentOS 7, without the I/O properties
+    assert not IOScope.available()
+    assert RealBackend().mkfs('ext4', '/dev/mapper/crypt', limits=limits)[2] == 0
+    assert not log.exists()
+
+    sim = SimulatedBackend(seed=0)
+    sim.add_device('/dev/vdb', size=100 * 1024**3)
+    kwargs = {'luks_header_backup_file': str(tmp_path / 'luks-header.bck'), 'luks_cryptdev_file': str(tmp_path / 'luks-cryptdev.ini'),
+              'state_file': str(tmp_path / 'fastluks-state.ini'), 'benchmark_cache': str(tmp_path / 'benchmarks.json')}
+    plans = [device(device_name='/dev/vdb', cryptdev='crypt', mountpoint='/export', filesystem='ext4', backend=sim,
+                    io_limits=io_limits).plan(**kwargs) for io_limits in (None, limits)]
+    wipe = [{step['phase']: step for step in plan['steps']}['wipe'] for plan in plans]
+    assert wipe[1]['estimated_seconds'] == pytest.approx((100 * 1024**3 - 16 * MiB) / (50 * MiB), rel=1e-3)
+    assert wipe[1]['estimated_seconds'] > wipe[0]['estimated_seconds'] and wipe[1]['resource'] == 'disk'
+
+
+def test_parse():
+    assert parse_limit('100M') == 100 * MiB and parse_limit('1.5GiB') == 3 * 512 * MiB and parse_limit('max') is None
+    assert parse_ionice('best-effort:7') == (2, 7) and parse_ionice('idle') == (3, None)
+    with pytest.raises(IOThrottleError):
+        parse_limit('fast')
+    with pytest.raises(IOThrottleError):
+        parse_ionice('best-effort:9')
@@ -0,0 +1,137 @@
+# Import dependencies
+import os
+import json
+import time
+import threading
+import pytest
+import requests
+from urllib.parse import urljoin
+
+# Import internal dependencies
+from pyluks.luksctl_api.jobs import JobManager, JobQueueFull, SUCCEEDED, FAILED, WORKER_EXITED
+from pyluks.luksctl_api.loadgen import SimulatedAPIServer
+from pyluks.luksctl_api.luksctl_run import master, write_api_config
+from pyluks.backends import SimulatedBackend
+
+
+
+################################################################################
+# HELPERS
+
+def wait_job(get, job_id, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = get(job_id)
+        if job['state'] in (SUCCEEDED, FAILED):
+            return job
+        time.sleep(0.02)
+    raise TimeoutError(job_id)
+
+
+
+################################################################################
+# BENCHMARKS
+
+def test_job_submit(benchmark, tmp_path):
+    """Submission of a background job, i.e. the latency of an asynchronous /open request before the 202."""
+    manager = JobManager(str(tmp_path), max_workers=4, max_pending=100000)
+    job = benchmark(manager.submit, 'open', lambda progress: {'volume_state': 'mounted'}, cryptdev='crypt0')
+    assert job['state'] == 'queued' and job['cryptdev'] == 'crypt0'
+    manager.shutdown()
+    assert manager.get(job['id'])['result'] == {'volume_state': 'mounted'}
+
+
+def test_job_progress(tmp_path):
+    """Phases are recorded with their duration, and visible while the job runs."""
+    manager = JobManager(str(tmp_path))
+    unlocking = threading.Event()
+    def open_job(progress):
+        progress('status')
+        time.sleep(0.05)
+        progress('unlock')
+        unlocking.set()
+        time.sleep(0.1)
+        return {'volume_state': 'mounted'}
+
+    job = manager.submit('open', open_job)
+    unlocking.wait()
+    assert manager.get(job['id'])['phase'] == 'unlock'
+    job = wait_job(manager.get, job['id'])
+    assert job['state'] == SUCCEEDED and [p['name'] for p in job['phases']] == ['status', 'unlock']
+    assert job['phases'][0]['duration'] >= 0.05 and job['phases'][1]['duration'] >= 0.1 and job['duration'] >= 0.15
+
+    failed = wait_job(manager.get, manager.submit('open', lambda progress: 1 / 0)['id'])
+    assert failed['state'] == FAILED and failed['error'] == 'division by zero'
+
+
+def test_job_queue_bounds(tmp_path):
+    """Jobs beyond the queue size are rejected, completed jobs are evicted after the TTL."""
+    manager = JobManager(str(tmp_path), max_workers=1, max_pending=2, ttl=0.2)
+    release = threading.Event()
+    first = manager.submit('open', lambda progress: release.wait())
+    manager.submit('open', lambda progress: None)
+    with pytest.raises(JobQueueFull):
+        manager.submit('open', lambda progress: None)
+    release.set()
+    manager.shutdown()
+
+    time.sleep(0.3)
+    assert manager.evict() == 2 and manager.get(first['id']) is None
+    assert manager.get('../../etc/passwd') is None
+
+
+def test_job_dead_worker(tmp_path):
+    """A job left running by an API worker that exited is reported as failed."""
+    manager = JobManager(str(tmp_path))
+    job_id = '0' * 32
+    with open(os.path.join(str(tmp_path), f'{job_id}.json'), 'w') as f:
+        json.dump({'id': job_id, 'state': 'running', 'pid': 2**22 + 1}, f)
+    assert manager.get(job_id)['state'] == FAILED
+
+    # Recorded as failed by the first worker recovering it, once
+    assert [job['id'] for job in manager.recover()] == [job_id]
+    assert manager.recover() == []
+    with open(os.path.join(str(tmp_path), f'{job_id}.json')) as f:
+        assert json.load(f)['error'] == WORKER_EXITED
+
+
+def test_master_recover_jobs(tmp_path, cryptdev_ini):
+    """An open interrupted after stopping the daemons, e.g. by a recycled worker, is failed and the daemons started."""
+    write_api_config(cryptdev_ini, env_path=str(tmp_path), daemons=['nfs-server'], node_list=[], exports_list=[],
+                     sudo_path='', single_flight_dir=str(tmp_path / 'single_flight'))
+    sim = SimulatedBackend(luks_cryptdev_file=cryptdev_ini)
+    master_node = master(luks_cryptdev_file=cryptdev_ini, api_section='luksctl_api', backend=sim)
+    jobs_dir = master_node.job_manager().jobs_dir
+    job_id = '1' * 32
+    with open(os.path.join(jobs_dir, f'{job_id}.json'), 'w') as f:
+        json.dump({'id': job_id, 'operation': 'open', 'cryptdev': None, 'state': 'running', 'phase': 'unlock',
+                   'pid': 2**22 + 1}, f)
+
+    assert [job['id'] for job in master_node.recover_jobs()] == [job_id]
+    assert sim.services['nfs-server'] == 'active'
+    assert master_node.job_manager().get(job_id)['state'] == FAILED
+
+
+def test_job_base_exception(tmp_path):
+    """A job interrupted by a BaseException, e.g. SystemExit, is recorded as failed instead of staying running."""
+    manager = JobManager(str(tmp_path))
+    def exit_job(progress):
+        raise SystemExit(1)
+    job = wait_job(manager.get, manager.submit('open', exit_job)['id'])
+    manager.shutdown()
+    assert job['state'] == FAILED and job['error'] == 'SystemExit'
+
+
+def test_api_async_open():
+    """Asynchronous /open: 202 right away, then the job reports the unlock phases and the volume state."""
+    with SimulatedAPIServer(volumes=2, latencies={'luks_open': 0.5}) as server:
+        start = time.monotonic()
+        response = requests.post(f'{server.url}/luksctl_api/v1.0/open', json=dict(server.open_payload(), cryptdev='crypt1', **{'async': True}), timeout=10)
+        accepted = time.monotonic() - start
+        assert response.status_code == 202 and accepted < 0.5
+        job_url = urljoin(server.url, response.headers['Location'])
+
+        job = wait_job(lambda _: requests.get(job_url, timeout=10).json(), response.json()['job_id'])
+        assert job['state'] == SUCCEEDED and job['result'] == {'volume_state': 'mounted'}
+        assert [p['name'] for p in job['phases']] == ['status', 'stop_daemons', 'read_passphrase', 'unlock', 'start_daemons']
+        assert requests.get(f'{server.url}/luksctl_api/v1.0/jobs/{"f" * 32}', timeout=10).status_code == 404
@@ -0,0 +1,59 @@
+# Import dependencies
+import pytest
+
+# Import internal dependencies
+from pyluks.vault_support import read_secret, write_secret_to_vault
+from pyluks.luksctl_api.loadgen import LocalVaultServer, SimulatedAPIServer, percentile, run_load
+
+
+
+################################################################################
+# FIXTURES
+
+@pytest.fixture(scope='module')
+def simulated_api():
+    """luksctl_api master on 10 simulated volumes, opened in 50 ms each, with a stand-in Vault."""
+    with SimulatedAPIServer(volumes=10, latencies={'luks_open': 0.05}) as server:
+        yield server
+
+
+
+################################################################################
+# BENCHMARKS
+
+def test_percentile():
+    """Nearest-rank percentiles used in the load test reports."""
+    values = list(range(1, 101))
+    assert [percentile(values, p) for p in (50, 95, 99, 100)] == [50, 95, 99, 100]
+    assert percentile([7], 99) == 7 and percentile([], 50) is None
+
+
+def test_local_vault_server():
+    """The stand-in Vault answers the hvac calls made by fastluks and by the luksctl_api master."""
+    vault = LocalVaultServer().start()
+    try:
+        write_secret_to_vault(vault.url, 'wrapping-token', 'luks', 'passphrase', 's3cret')
+        assert read_secret(vault.url, 'wrapping-token', 'secrets', 'luks', 'passphrase') == 's3cret'
+        with pytest.raises(Exception): # cas=0: the secret must not exist yet
+            write_secret_to_vault(vault.url, 'wrapping-token', 'luks', 'passphrase', 'other')
+    finally:
+        vault.stop()
+
+
+def test_loadgen_status_polling(benchmark, simulated_api):
+    """200 /status requests from 8 concurrent clients, over the 10 simulated volumes."""
+    report = benchmark.pedantic(run_load, args=(simulated_api.url,),
+                                kwargs={'concurrency': 8, 'requests': 200, 'cryptdevs': simulated_api.cryptdevs},
+                                rounds=1)
+    benchmark.extra_info.update({f'p{p}_ms': report['overall'][f'p{p}'] * 1000 for p in (50, 95, 99)})
+    assert report['overall']['requests'] == 200 and report['overall']['errors'] == 0
+
+
+def test_loadgen_unlock_storm(benchmark, simulated_api):
+    """Unlock storm: /open of the 10 simulated volumes, twice each, mixed with /status polling."""
+    report = benchmark.pedantic(run_load, args=(simulated_api.url,),
+                                kwargs={'mix': {'status': 4, 'open': 1}, 'concurrency': 10, 'requests': 100,
+                                        'open_payload': simulated_api.open_payload(), 'cryptdevs': simulated_api.cryptdevs},
+                                rounds=1)
+    benchmark.extra_info.update({f'open_p{p}_ms': report['endpoints']['open'][f'p{p}'] * 1000 for p in (50, 95, 99)})
+    assert report['endpoints']['open']['requests'] == 20 and report['overall']['errors'] == 0
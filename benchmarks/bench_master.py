@@ -0,0 +1,44 @@
+# Import internal dependencies
+from pyluks.luksctl_api import luksctl_run
+from pyluks.luksctl_api.luksctl_run import master
+
+
+
+################################################################################
+# BENCHMARKS
+
+def test_master_get_status(benchmark, cryptdev_ini):
+    """End to end /status: master instantiation, 'luksctl status' and response."""
+    def get_status():
+        return master(luks_cryptdev_file=cryptdev_ini).get_status()
+
+    assert benchmark(get_status) == {'volume_state': 'mounted'}
+
+
+def test_master_open(benchmark, cryptdev_ini, monkeypatch, tmp_path):
+    """End to end /open on a closed volume: status check, secret read, daemons stop/start and 'luksctl open'.
+    The Vault read is replaced by a local function returning the passphrase.
+    """
+    reads = []
+    monkeypatch.setattr(luksctl_run, 'read_secret', lambda **kwargs: reads.append(kwargs['wrapping_token']) or 's3cret')
+    # The status check reports the volume as closed, the open command succeeds and records the passphrase it got
+    secret_file = tmp_path / 'secret'
+    monkeypatch.setenv('FAKE_LUKSCTL_STATUS', '1')
+    monkeypatch.setenv('FAKE_LUKSCTL_OPEN_STATUS', '0')
+    monkeypatch.setenv('FAKE_LUKSCTL_SECRET_FILE', str(secret_file))
+    opens = []
+
+    def luks_open():
+        opens.append(None)
+        return master(luks_cryptdev_file=cryptdev_ini).open(vault_url='https://vault.example.org:8200',
+                                                            wrapping_token='token', secret_root='secrets',
+                                                            secret_path='path', secret_key='key')
+
+    assert benchmark(luks_open) == {'volume_state': 'mounted'}
+    assert len(reads) == len(opens) and reads[0] == 'token'
+    assert secret_file.read_text().strip() == 's3cret'
+
+    # The wrapping token is left unused if the volume is already mounted
+    monkeypatch.setenv('FAKE_LUKSCTL_STATUS', '0')
+    reads.clear()
+    assert luks_open() == {'volume_state': 'mounted'} and reads == []
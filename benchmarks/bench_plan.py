@@ -0,0 +1,101 @@
+# Import dependencies
+import json
+import pytest
+
+# Import internal dependencies
+from pyluks.inventory import BlockInventory
+from pyluks.backends import RealBackend, SimulatedBackend
+from pyluks.fastluks import device
+from pyluks.fastluks.plan import BenchmarkCache, probe_read_throughput, estimate_seconds, KDF_SECONDS
+
+# Import benchmark helpers
+from bench_inventory import add_block_device, write
+
+
+
+################################################################################
+# HELPERS
+
+def run_phases(plan):
+    return [step['phase'] for step in plan['steps'] if step['run']]
+
+
+def plan_kwargs(tmp_path):
+    return {'luks_header_backup_file': str(tmp_path / 'luks-header.bck'),
+            'luks_cryptdev_file': str(tmp_path / 'luks-cryptdev.ini'),
+            'state_file': str(tmp_path / 'fastluks-state.ini'),
+            'benchmark_cache': str(tmp_path / 'benchmarks.json')}
+
+
+
+################################################################################
+# BENCHMARKS
+
+def test_plan_simulated(benchmark, tmp_path):
+    """Plan of a new volume on a simulated host, then of the same volume once provisioned: nothing is left to run."""
+    sim = SimulatedBackend(seed=0)
+    sim.add_device('/dev/vdb', size=100 * 1024**3)
+    luks_device = device(device_name='/dev/vdb', cryptdev='crypt', mountpoint='/export', filesystem='ext4', backend=sim)
+
+    plan = luks_device.plan(**plan_kwargs(tmp_path))
+    assert plan['throughput']['cipher'] == {'bytes_per_second': sim.CIPHER_THROUGHPUT, 'source': 'probe'}
+    plan = benchmark(luks_device.plan, **plan_kwargs(tmp_path))
+    assert plan['error'] is None and plan['state']['encrypted'] is False
+    assert run_phases(plan) == ['check_volume', 'format', 'header_backup', 'open', 'cryptdev_file', 'filesystem', 'mount']
+    assert plan['throughput']['cipher']['source'] == 'cache'
+    assert sim.devices['/dev/vdb']['luks'] is None # Nothing changed
+    assert plan['estimated_seconds'] >= 2 * KDF_SECONDS
+
+    luks_device.encrypt(luks_header_backup_file=str(tmp_path / 'luks-header.bck'), luks_cryptdev_file=str(tmp_path / 'luks-cryptdev.ini'),
+                        passphrase_length=16, passphrase=None, save_passphrase_locally=False, use_vault=False, vault_url=None,
+                        wrapping_token=None, secret_path=None, user_key=None, state_file=str(tmp_path / 'fastluks-state.ini'))
+    luks_device.volume_setup(state_file=str(tmp_path / 'fastluks-state.ini'))
+    plan = luks_device.plan(**plan_kwargs(tmp_path))
+    assert run_phases(plan) == ['check_volume'] and plan['state']['mounted']
+
+    other = device(device_name='/dev/vdb', cryptdev='crypt', mountpoint='/export', filesystem='ext4', backend=sim)
+    assert other.plan(**dict(plan_kwargs(tmp_path), state_file=str(tmp_path / 'other-state.ini')))['error'] == 'Device is already encrypted'
+
+
+def test_plan_commands(tmp_path):
+    """With the real backend the plan lists the exact commands, with the mkfs options of the RAID geometry,
+    and uses the cached throughputs without probing."""
+    sysfs = str(tmp_path / 'sys')
+    add_block_device(sysfs, 'vdd', '252:48', 400 * 1024**3, queue={'minimum_io_size': 65536, 'optimal_io_size': 262144})
+    write(str(tmp_path / 'mountinfo'), '22 1 252:1 / / rw,relatime shared:1 - ext4 /dev/vda1 rw')
+    write(str(tmp_path / 'swaps'), 'Filename\tType\tSize\tUsed\tPriority')
+    backend = RealBackend(inventory=BlockInventory(sysfs_root=sysfs, mountinfo_file=str(tmp_path / 'mountinfo'),
+                                                   swaps_file=str(tmp_path / 'swaps'), dev_root=str(tmp_path / 'dev')))
+    cache = BenchmarkCache(str(tmp_path / 'benchmarks.json'))
+    cache.put('disk', f'vdd:{400 * 1024**3}', 200 * 1024**2)
+    cache.put('cipher', 'aes-xts-plain64:256', 100 * 1024**2)
+
+    luks_device = device(device_name='/dev/vdd', cryptdev='crypt', mountpoint=str(tmp_path / 'export'), filesystem='xfs', backend=backend)
+    plan = luks_device.plan(**plan_kwargs(tmp_path), probe=False)
+    steps = {step['phase']: step for step in plan['steps']}
+
+    assert ['cryptsetup', '-v', '--cipher', 'aes-xts-plain64', '--key-size', '256', '--hash', 'sha256', '--iter-time', '2000',
+            '--use-urandom', 'luksFormat', '/dev/vdd', '--batch-mode'] in steps['format']['commands']
+    assert steps['filesystem']['commands'] == [['mkfs', '-t', 'xfs', '-d', 'su=65536,sw=4', '/dev/mapper/crypt']]
+    assert {kind: value['source'] for kind, value in plan['throughput'].items()} == {'disk': 'cache', 'cipher': 'cache'}
+    assert steps['wipe']['run'] is False and steps['wipe']['resource'] == 'cpu'
+    assert steps['wipe']['estimated_seconds'] == pytest.approx((400 * 1024**3 - 16 * 1024**2) / (100 * 1024**2), rel=1e-3)
+    json.dumps(plan)
+
+
+def test_read_probe(benchmark, tmp_path):
+    """In-place read throughput probe on a 256 MiB file standing in for the device."""
+    image = tmp_path / 'disk.img'
+    with open(image, 'wb') as f:
+        f.truncate(256 * 1024**2)
+    throughput = benchmark(probe_read_throughput, RealBackend(), str(image), 256 * 1024**2)
+    assert throughput > 0
+    assert probe_read_throughput(RealBackend(), str(tmp_path / 'missing.img'), 256 * 1024**2) is None
+
+
+def test_estimates():
+    """Wipe and mkfs estimates scale with the device size and the slowest of disk and cipher."""
+    throughput = {'disk': {'bytes_per_second': 100 * 1024**2}, 'cipher': {'bytes_per_second': 1000 * 1024**2}}
+    small, large = (estimate_seconds('wipe', size, 'ext4', throughput) for size in (10 * 1024**3, 100 * 1024**3))
+    assert large == pytest.approx(10 * small, rel=0.01)
+    assert estimate_seconds('open', 10 * 1024**3, 'ext4', throughput) == KDF_SECONDS
@@ -0,0 +1,119 @@
+# Import dependencies
+import json
+import os
+import subprocess
+import sys
+import pytest
+
+# Import internal dependencies
+from pyluks.utilities import run_command, run_argv, add_command_hook, remove_command_hook
+from pyluks.backends import RealBackend
+from pyluks.profiler import CommandProfiler, command_verb, PROFILE_ENV, PROFILE_TRIGGER_ENV
+
+
+
+################################################################################
+# FIXTURES
+
+@pytest.fixture
+def profiler():
+    profiler = CommandProfiler().enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+
+
+
+################################################################################
+# BENCHMARKS
+
+def test_run_argv_profiled(benchmark, profiler):
+    """run_argv overhead with the profiler enabled, to be compared with test_run_argv_noop."""
+    _, _, status = benchmark(run_argv, ['true'])
+    assert status == 0
+    assert profiler.report()['true']['count'] >= 1
+
+
+def test_profile_unlock(profiler):
+    """Per-verb statistics of the commands run by the real backend on the fake toolchain."""
+    backend = RealBackend()
+    for _ in range(3):
+        backend.luks_open('/dev/vdb', 'crypt', secret='s3cret')
+    backend.luks_uuid('/dev/vdb')
+    backend.mount('/dev/mapper/crypt', '/export')
+    run_command('printf "s3cret\\n" | cryptsetup luksOpen /dev/vdb crypt')
+    run_argv(['missing-tool'])
+
+    report = profiler.report()
+    assert report['cryptsetup luksOpen']['count'] == 4 and report['cryptsetup luksOpen']['exit_codes'] == {'0': 4}
+    assert report['cryptsetup luksUUID']['stdout_bytes'] > 0
+    assert report['missing-tool']['exit_codes'] == {'127': 1}
+    assert sum(report['mount']['histogram'].values()) == 1 and report['mount']['p50'] is not None
+    assert 's3cret' not in json.dumps(report)
+    assert list(report)[0] == max(report, key=lambda verb: report[verb]['total_seconds'])
+    assert 'cryptsetup luksOpen' in profiler.format_report()
+
+
+def test_command_verb():
+    """Verbs of the commands run by pyluks."""
+    assert command_verb(['cryptsetup', '-v', '--cipher', 'aes-xts-plain64', '--key-size', '256', 'luksFormat', '/dev/vdb']) == 'cryptsetup luksFormat'
+    assert command_verb(['sudo', '-n', 'systemctl', 'stop', 'nfs-server']) == 'systemctl stop'
+    assert command_verb(['/usr/bin/luksctl', '--cryptdev', 'crypt', 'open']) == 'luksctl open'
+    assert command_verb(['mkfs', '-t', 'ext4', '/dev/mapper/crypt']) == 'mkfs'
+    assert command_verb('printf "x" | cryptsetup luksOpen /dev/vdb crypt') == 'cryptsetup luksOpen'
+
+
+def test_failing_hook():
+    """A failing hook doesn't fail the command, and removed hooks are not called."""
+    calls = []
+    def pre(cmd):
+        calls.append(cmd)
+        raise RuntimeError('hook failure')
+    hook = add_command_hook(pre=pre)
+    try:
+        assert run_argv(['true'])[2] == 0
+    finally:
+        remove_command_hook(hook)
+    run_argv(['true'])
+    assert calls == [['true']]
+
+
+def test_dump_at_exit(tmp_path):
+    """With PYLUKS_PROFILE set, the report of the process is dumped to the file at exit."""
+    dump_file = str(tmp_path / 'profile-{pid}.json')
+    script = ('from pyluks.profiler import profile_from_environment\n'
+              'from pyluks.utilities import run_argv\n'
+              'profile_from_environment()\n'
+              'run_argv(["cryptsetup", "luksUUID", "/dev/vdb"])\n')
+    subprocess.run([sys.executable, '-c', script], env={**os.environ, PROFILE_ENV: dump_file}, check=True)
+    dumps = list(tmp_path.glob('profile-*.json'))
+    assert len(dumps) == 1
+    dump = json.loads(dumps[0].read_text())
+    assert dumps[0].name == f'profile-{dump["pid"]}.json'
+    assert dump['commands']['cryptsetup luksUUID']['count'] == 1
+
+
+def test_dump_trigger(tmp_path):
+    """Touching the PYLUKS_PROFILE_TRIGGER file dumps the report of a forked worker, without any signal."""
+    dump_file, trigger = str(tmp_path / 'profile-{pid}.json'), tmp_path / 'dump'
+    script = ('import os, time\n'
+              'from pyluks.profiler import profile_from_environment\n'
+              'from pyluks.utilities import run_argv\n'
+              'profile_from_environment(dump_signal=None)\n'
+              'if os.fork() == 0:\n' # A worker of a preloaded app
+              '    run_argv(["cryptsetup", "luksUUID", "/dev/vdb"])\n'
+              '    dump = os.environ["PYLUKS_PROFILE"].format(pid=os.getpid())\n'
+              '    print(os.getpid(), flush=True)\n'
+              '    deadline = time.monotonic() + 10\n'
+              '    while not os.path.exists(dump) and time.monotonic() < deadline:\n'
+              '        time.sleep(0.05)\n'
+              '    os._exit(0 if os.path.exists(dump) else 1)\n'
+              'os.wait()\n')
+    process = subprocess.Popen([sys.executable, '-c', script], stdout=subprocess.PIPE, text=True,
+                               env={**os.environ, PROFILE_ENV: dump_file, PROFILE_TRIGGER_ENV: str(trigger)})
+    worker = int(process.stdout.readline())
+    trigger.touch()
+    process.communicate(timeout=30)
+    dump = json.loads((tmp_path / f'profile-{worker}.json').read_text())
+    assert dump['commands']['cryptsetup luksUUID']['count'] == 1
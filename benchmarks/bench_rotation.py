@@ -0,0 +1,167 @@
+# Import dependencies
+import os
+import time
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+
+# Import internal dependencies
+from pyluks.backends import SimulatedBackend
+from pyluks.cryptdev_registry import CryptdevRegistry
+from pyluks.vault_support import read_secret_version
+from pyluks.luksctl_api.loadgen import LocalVaultServer
+from pyluks.luksctl import KDF_MEMORY
+from pyluks.luksctl.rotation import KDFMemoryBudget, PassphraseRotation, RotationError, rotate_all, new_passphrase, active_key_slots
+
+
+
+################################################################################
+# HELPERS
+
+VOLUMES = 16
+MiB = 1024**2
+
+
+def simulated_volumes(tmp_path, volumes=VOLUMES, local_passphrase=False, latency=0.01):
+    """Registers LUKS volumes on a simulated host, each one with its passphrase in key slot 0."""
+    sim = SimulatedBackend(latencies={'luks_add_key': latency, 'luks_test_passphrase': latency, 'luks_kill_slot': latency}, seed=0)
+    registry = CryptdevRegistry(str(tmp_path / 'luks-cryptdev.ini'))
+    for i in range(volumes):
+        device, uuid = f'/dev/vd{i}', f'00000000-0000-0000-0000-{i:012d}'
+        sim.add_luks_device(device, uuid, f'passphrase-{i}')
+        registry.add({'cryptdev': f'crypt{i}', 'device': device, 'uuid': uuid, 'mountpoint': f'/export{i}',
+                      'filesystem': 'ext4', **({'passphrase': f'passphrase-{i}'} if local_passphrase else {})})
+    return sim, registry
+
+
+def keyslots(sim, device):
+    return [slot for slot, secret in enumerate(sim.devices[device]['luks']['keyslots']) if secret is not None]
+
+
+
+################################################################################
+# FIXTURES
+
+@pytest.fixture
+def vault():
+    server = LocalVaultServer().start()
+    try:
+        yield server
+    finally:
+        server.stop()
+
+
+def vault_options(server):
+    return {'vault_url': server.url, 'vault_token': 'token', 'secret_root': 'secrets',
+            'secret_path': 'luks/{cryptdev}', 'secret_key': 'passphrase'}
+
+
+
+################################################################################
+# BENCHMARKS
+
+def test_rotate_vault(benchmark, tmp_path, vault):
+    """Rotation of many volumes with the passphrases in Vault, with a budget of 4 unlocks of the current key slots
+    (1 GiB each, the worst case) and new key slots of 1 MiB."""
+    sim, registry = simulated_volumes(tmp_path)
+    for i in range(VOLUMES):
+        vault.put_secret('secrets', f'luks/crypt{i}', {'passphrase': f'passphrase-{i}', 'other': 'kept'})
+
+    results = benchmark.pedantic(rotate_all, args=(registry.luks_cryptdev_file,), rounds=1, iterations=1,
+                                 kwargs={'backend': sim, 'vault': vault_options(vault), 'memory_budget': 4 * KDF_MEMORY,
+                                         'pbkdf_memory': 1024, 'state_dir': str(tmp_path / 'rotation')})
+    assert all(result['ok'] for result in results), results
+    for i in range(VOLUMES):
+        data, version = read_secret_version(vault.url, 'token', 'secrets', f'luks/crypt{i}')
+        assert version == 2 and data['other'] == 'kept' and data['passphrase'] != f'passphrase-{i}'
+        assert keyslots(sim, f'/dev/vd{i}') == [1]
+        assert sim.devices[f'/dev/vd{i}']['luks']['keyslots'][1] == data['passphrase']
+    assert os.listdir(tmp_path / 'rotation') == [] # No passphrase left behind
+
+
+def test_rotate_resume(tmp_path):
+    """A rotation interrupted after the new key slot is added and stored is resumed, and the old key slot removed."""
+    sim, registry = simulated_volumes(tmp_path, volumes=2, local_passphrase=True, latency=0)
+    sim.inject_failure('luks_kill_slot')
+    options = {'backend': sim, 'state_dir': str(tmp_path / 'rotation'), 'memory_budget': 2 * MiB, 'pbkdf_memory': 1024}
+
+    results = rotate_all(registry.luks_cryptdev_file, cryptdevs=['crypt0'], **options)
+    assert not results[0]['ok'] and 'add_key,store,verify' in results[0]['message']
+    registry.reload()
+    new = registry.get('crypt0')['passphrase']
+    assert keyslots(sim, '/dev/vd0') == [0, 1] and new != 'passphrase-0'
+
+    results = rotate_all(registry.luks_cryptdev_file, **options)
+    assert all(result['ok'] for result in results), results
+    assert sim.calls['luks_add_key'] == 2 # The new passphrase of crypt0 is not added twice
+    registry.reload()
+    assert registry.get('crypt0')['passphrase'] == new and keyslots(sim, '/dev/vd0') == [1]
+    assert registry.get('crypt1')['passphrase'] != 'passphrase-1' and keyslots(sim, '/dev/vd1') == [1]
+
+
+def test_rotate_concurrent_change(tmp_path, vault):
+    """A Vault secret changed by someone else during the rotation is not overwritten."""
+    sim, registry = simulated_volumes(tmp_path, volumes=1, latency=0)
+    vault.put_secret('secrets', 'luks/crypt0', {'passphrase': 'passphrase-0'})
+    options = {'backend': sim, 'vault': vault_options(vault), 'state_dir': str(tmp_path / 'rotation')}
+
+    sim.inject_failure('luks_add_key')
+    assert not rotate_all(registry.luks_cryptdev_file, **options)[0]['ok']
+    vault.put_secret('secrets', 'luks/crypt0', {'passphrase': 'changed'})
+    result = rotate_all(registry.luks_cryptdev_file, **options)[0]
+    assert not result['ok'] and 'changed since the rotation started' in result['stderr']
+    assert read_secret_version(vault.url, 'token', 'secrets', 'luks/crypt0')[0] == {'passphrase': 'changed'}
+    assert keyslots(sim, '/dev/vd0') == [0] # The old key slot is kept
+
+
+def test_rotate_interrupted_before_store(tmp_path, monkeypatch):
+    """A rotation interrupted before the new passphrase is stored starts over, removing the key slot it added, and
+    never writes the passphrases to its state file."""
+    sim, registry = simulated_volumes(tmp_path, volumes=1, local_passphrase=True, latency=0)
+    options = {'backend': sim, 'state_dir': str(tmp_path / 'rotation')}
+
+    def interrupted(self, new):
+        raise RotationError('Interrupted.')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(PassphraseRotation, '_store', interrupted)
+        assert not rotate_all(registry.luks_cryptdev_file, **options)[0]['ok']
+    assert keyslots(sim, '/dev/vd0') == [0, 1]
+    state = (tmp_path / 'rotation' / '00000000-0000-0000-0000-000000000000.ini').read_text()
+    assert 'passphrase' not in state and sim.devices['/dev/vd0']['luks']['keyslots'][1] not in state
+
+    assert rotate_all(registry.luks_cryptdev_file, **options)[0]['ok']
+    registry.reload()
+    new = registry.get('crypt0')['passphrase']
+    assert keyslots(sim, '/dev/vd0') == [1] and sim.devices['/dev/vd0']['luks']['keyslots'][1] == new
+
+
+def test_rotate_shared_secret_path(tmp_path, vault):
+    """A secret path without placeholders is refused for several volumes before any device is modified."""
+    sim, registry = simulated_volumes(tmp_path, volumes=2, latency=0)
+    options = {'backend': sim, 'vault': dict(vault_options(vault), secret_path='luks/shared'), 'state_dir': str(tmp_path / 'rotation')}
+    with pytest.raises(RotationError):
+        rotate_all(registry.luks_cryptdev_file, **options)
+    assert 'luks_test_passphrase' not in sim.calls and keyslots(sim, '/dev/vd0') == [0]
+
+
+def test_active_key_slots():
+    """Active key slots are read from the luksDump output of LUKS1 and LUKS2 headers."""
+    luks1 = 'Key Slot 0: DISABLED\nKey Slot 1: ENABLED\n\tIterations:         \t1000\nKey Slot 2: DISABLED\n'
+    luks2 = ('Keyslots:\n  0: luks2\n\tKey:        512 bits\n\tPriority:   normal\n  3: luks2\n\tKey:        512 bits\n'
+             'Tokens:\nDigests:\n  0: pbkdf2\n')
+    assert active_key_slots(luks1) == {1} and active_key_slots(luks2) == {0, 3} and active_key_slots('') == set()
+
+
+def test_memory_budget():
+    """The budget bounds the memory reserved by concurrent operations."""
+    budget = KDFMemoryBudget(total=3 * MiB, per_operation=MiB)
+
+    def operation(_):
+        with budget.reserve():
+            time.sleep(0.005)
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(operation, range(64)))
+    assert budget.peak == 3 * MiB and budget.used == 0
+    assert KDFMemoryBudget(total=MiB // 2, per_operation=MiB).total == MiB # At least one operation runs
+    assert len(new_passphrase(48)) == 48 and new_passphrase().isalnum()
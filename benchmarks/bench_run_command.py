@@ -0,0 +1,52 @@
+# Import internal dependencies
+from pyluks.utilities import run_command, run_argv, TIMEOUT_STATUS
+from pyluks.backends import RealBackend
+
+
+
+################################################################################
+# BENCHMARKS
+
+def test_run_command_noop(benchmark):
+    """Fixed overhead of a run_command call: shell, fork/exec and output decoding."""
+    _, _, status = benchmark(run_command, 'true')
+    assert status == 0
+
+
+def test_run_command_cryptsetup_luksuuid(benchmark):
+    """run_command on a fake cryptsetup query, as done when writing the cryptdev .ini file."""
+    stdout, _, status = benchmark(run_command, 'cryptsetup luksUUID /dev/vdb')
+    assert status == 0
+    assert stdout.startswith('101de0a7')
+
+
+def test_run_command_pipeline(benchmark):
+    """run_command on a shell pipeline passing the passphrase with printf, as done before run_argv."""
+    _, _, status = benchmark(run_command, 'printf "s3cret\n" | cryptsetup luksOpen /dev/vdb crypt')
+    assert status == 0
+
+
+def test_run_argv_noop(benchmark):
+    """Fixed overhead of a run_argv call: fork/exec and output decoding, without a shell."""
+    _, _, status = benchmark(run_argv, ['true'])
+    assert status == 0
+
+
+def test_run_argv_cryptsetup_luksuuid(benchmark):
+    """run_argv on a fake cryptsetup query."""
+    stdout, _, status = benchmark(run_argv, ['cryptsetup', 'luksUUID', '/dev/vdb'])
+    assert status == 0
+    assert stdout.startswith('101de0a7')
+
+
+def test_run_argv_secret_stdin(benchmark):
+    """RealBackend.luks_open passing the passphrase on the stdin pipe of cryptsetup, as done by device.luksOpen."""
+    _, _, status = benchmark(RealBackend().luks_open, '/dev/vdb', 'crypt', secret='s3cret"; echo $HOME `id`')
+    assert status == 0
+
+
+def test_run_argv_timeout():
+    """Commands exceeding the timeout are killed and reported with exit code 124."""
+    _, stderr, status = run_argv(['sleep', '5'], timeout=0.1)
+    assert status == TIMEOUT_STATUS
+    assert 'timed out' in stderr
@@ -0,0 +1,69 @@
+# Import dependencies
+import sys
+import time
+import socket
+import subprocess
+import pytest
+import requests
+
+# Import internal dependencies
+from pyluks.luksctl_api import __path__ as luksctl_api_path_list
+from pyluks.luksctl_api.server_profiles import PROFILES, resolve_profile, write_gunicorn_config
+
+
+
+################################################################################
+# BENCHMARKS
+
+@pytest.mark.parametrize('cpus', [1, 4, 64])
+def test_profile_sizing(cpus):
+    """Workers follow the number of CPUs within the bounds of each profile."""
+    workers = {profile: resolve_profile(profile, cpu_count=cpus)['workers'] for profile in PROFILES}
+    assert workers == {'minimal': 1, 'balanced': max(2, min(cpus, 8)), 'high-concurrency': max(2, min(cpus, 32))}
+    assert resolve_profile('balanced', cpu_count=cpus, workers=3, preload_app=False, threads=None)['workers'] == 3
+    with pytest.raises(ValueError):
+        resolve_profile('balanced', worker_connections=100)
+
+
+def test_gunicorn_config(tmp_path):
+    """The generated file is a valid gunicorn configuration, with the certificate used only if it exists."""
+    from gunicorn.config import Config
+
+    config_file, cert_file = str(tmp_path / 'gunicorn.conf.py'), str(tmp_path / 'cert.pem')
+    settings = write_gunicorn_config(config_file, profile='high-concurrency', cpu_count=16, cert_file=cert_file,
+                                     key_file=str(tmp_path / 'key.pem'), keepalive=10)
+    namespace = {}
+    with open(config_file) as f:
+        exec(f.read(), namespace)
+    assert namespace['certfile'] is None and namespace['bind'] == '0.0.0.0:5000'
+
+    config = Config()
+    for name, value in settings.items():
+        config.set(name, value)
+    assert (config.worker_class_str, config.workers, config.threads, config.keepalive) == ('gthread', 16, 16, 10)
+
+
+def test_gunicorn_startup(benchmark, tmp_path):
+    """Time for gunicorn to serve the first request with the minimal profile."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    config_file = str(tmp_path / 'gunicorn.conf.py')
+    write_gunicorn_config(config_file, profile='minimal', bind=f'127.0.0.1:{port}', cert_file=str(tmp_path / 'cert.pem'),
+                          key_file=str(tmp_path / 'key.pem'))
+
+    def startup():
+        process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--config', config_file, 'app:master_app'],
+                                   cwd=luksctl_api_path_list[0], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            deadline = time.monotonic() + 30
+            while time.monotonic() < deadline:
+                try:
+                    return requests.get(f'http://127.0.0.1:{port}/luksctl_api/v1.0/missing', timeout=1).status_code
+                except requests.ConnectionError:
+                    time.sleep(0.05)
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+
+    assert benchmark.pedantic(startup, rounds=1) == 404
@@ -0,0 +1,123 @@
+# Import dependencies
+import os
+import pytest
+
+# Import internal dependencies
+from pyluks.backends import SimulatedBackend
+from pyluks.fastluks import device
+from pyluks.fastluks.state import RunState
+from pyluks.fastluks.fastluks_lib import LUKSError
+from pyluks.luksctl import run_all
+from pyluks.luksctl_api import luksctl_run
+from pyluks.luksctl_api.luksctl_run import master
+
+
+
+################################################################################
+# BENCHMARKS
+
+@pytest.mark.parametrize('n_volumes', [100, 1000])
+def test_simulated_provisioning(benchmark, tmp_path, n_volumes):
+    """device.encrypt and device.volume_setup for many virtual volumes on a simulated host, without latencies:
+    measures the pyluks orchestration overhead alone, including the persisted state of each run. Volumes are
+    registered 50 per cryptdev .ini file, as on hosts with dozens of encrypted volumes.
+    """
+    def provision():
+        sim = SimulatedBackend(seed=0)
+        for i in range(n_volumes):
+            sim.add_device(f'/dev/vd{i}')
+            luks_device = device(device_name=f'/dev/vd{i}', cryptdev=f'crypt{i}', mountpoint=f'/export/{i}',
+                                 filesystem='ext4', backend=sim)
+            luks_device.encrypt(luks_header_backup_file=f'/etc/luks/luks-header-{i}.bck',
+                                luks_cryptdev_file=str(tmp_path / f'luks-cryptdev-{i // 50}.ini'),
+                                passphrase_length=16, passphrase=None, save_passphrase_locally=False,
+                                use_vault=False, vault_url=None, wrapping_token=None, secret_path=None, user_key=None,
+                                state_file=str(tmp_path / f'fastluks-state-{i}.ini'))
+            luks_device.volume_setup(state_file=str(tmp_path / f'fastluks-state-{i}.ini'))
+        return sim
+
+    sim = benchmark.pedantic(provision, rounds=1)
+    assert len(sim.mounts) == n_volumes
+
+
+def test_simulated_master_open(benchmark, cryptdev_ini, monkeypatch):
+    """master.open on a simulated host after a reboot, with the whole luksctl open done in-process."""
+    sim = SimulatedBackend(luks_cryptdev_file=cryptdev_ini)
+    sim.add_luks_device('/dev/vdb', luks_uuid='101de0a7-e4f5-4d40-9829-541a2b34c1bf', secret='s3cret', filesystem='ext4')
+    monkeypatch.setattr(luksctl_run, 'read_secret', lambda **kwargs: 's3cret')
+
+    def luks_open():
+        sim.reboot()
+        return master(luks_cryptdev_file=cryptdev_ini, backend=sim).open(
+            vault_url='https://vault.example.org:8200', wrapping_token='token',
+            secret_root='secrets', secret_path='path', secret_key='key')
+
+    assert benchmark(luks_open) == {'volume_state': 'mounted'}
+
+
+def test_simulated_open_all(benchmark, tmp_path):
+    """luksctl open --all of 50 volumes after a reboot, with a 10 ms luksOpen and at most 8 concurrent KDF operations."""
+    luks_cryptdev_file = str(tmp_path / 'luks-cryptdev.ini')
+    sim = SimulatedBackend(seed=0)
+    for i in range(50):
+        sim.add_device(f'/dev/vd{i}')
+        luks_device = device(device_name=f'/dev/vd{i}', cryptdev=f'crypt{i}', mountpoint=f'/export/{i}',
+                             filesystem='ext4', backend=sim)
+        luks_device.encrypt(luks_header_backup_file=f'/etc/luks/luks-header-{i}.bck', luks_cryptdev_file=luks_cryptdev_file,
+                            passphrase_length=None, passphrase='passphrase', save_passphrase_locally=False,
+                            use_vault=False, vault_url=None, wrapping_token=None, secret_path=None, user_key=None,
+                            state_file=str(tmp_path / f'fastluks-state-{i}.ini'))
+        luks_device.volume_setup(state_file=str(tmp_path / f'fastluks-state-{i}.ini'))
+    sim.latencies['luks_open'] = 0.01
+
+    results = benchmark.pedantic(run_all, args=(luks_cryptdev_file, 'open'),
+                                 kwargs={'backend': sim, 'secret': 'passphrase', 'kdf_jobs': 8},
+                                 setup=sim.reboot, rounds=5)
+    assert all(result['ok'] for result in results)
+
+
+def test_simulated_resume(tmp_path):
+    """Interrupted fastluks runs: the passphrase is never written to the state file, a device formatted right before
+    the interruption is resumed, and one whose passphrase was lost before anything was stored is formatted again."""
+    sim = SimulatedBackend(seed=0)
+    sim.add_device('/dev/vdb')
+    state_file = str(tmp_path / 'fastluks-state.ini')
+    luks_device = device(device_name='/dev/vdb', cryptdev='crypt', mountpoint='/export', filesystem='ext4', backend=sim)
+    options = dict(luks_header_backup_file='/etc/luks/luks-header.bck', luks_cryptdev_file=str(tmp_path / 'luks-cryptdev.ini'),
+                   passphrase_length=16, passphrase=None, save_passphrase_locally=False, use_vault=False, vault_url=None,
+                   wrapping_token=None, secret_path=None, user_key=None, state_file=state_file)
+
+    sim.inject_failure('luks_header_backup')
+    with pytest.raises(LUKSError):
+        luks_device.encrypt(**options)
+    assert 'passphrase' not in RunState(state_file, '/dev/vdb').section
+    first_uuid = sim.devices['/dev/vdb']['luks']['uuid']
+
+    luks_device.encrypt(**options) # Random passphrase lost, nothing written yet: formatted again
+    luks_device.volume_setup(state_file=state_file)
+    assert sim.devices['/dev/vdb']['luks']['uuid'] != first_uuid and sim.mounts['/export'] == '/dev/mapper/crypt'
+
+    # luksFormat succeeded, but the run died before recording the format phase
+    luks_uuid = sim.devices['/dev/vdb']['luks']['uuid']
+    state = RunState(state_file, '/dev/vdb')
+    state.reset()
+    state.set(uuid=luks_uuid)
+    sim.reboot()
+    luks_device.encrypt(**dict(options, passphrase_length=None, passphrase=sim.devices['/dev/vdb']['luks']['keyslots'][0]))
+    assert sim.devices['/dev/vdb']['luks']['uuid'] == luks_uuid and RunState(state_file, '/dev/vdb').is_done('format')
+
+    # The passphrase is checked against the header before being stored, and ignored if a random one was generated
+    sim.add_device('/dev/vdc')
+    luks_device = device(device_name='/dev/vdc', cryptdev='crypt2', mountpoint='/export2', filesystem='ext4', backend=sim)
+    options = dict(options, state_file=str(tmp_path / 'fastluks-state-2.ini'), luks_cryptdev_file=str(tmp_path / 'luks-cryptdev-2.ini'),
+                   luks_header_backup_file='/etc/luks/luks-header-2.bck', passphrase_length=None, passphrase='passphrase',
+                   save_passphrase_locally=True)
+    sim.inject_failure('luks_header_backup')
+    with pytest.raises(LUKSError):
+        luks_device.encrypt(**options)
+    luks_uuid = sim.devices['/dev/vdc']['luks']['uuid']
+    with pytest.raises(LUKSError):
+        luks_device.encrypt(**dict(options, passphrase='wrong'))
+    assert not sim.is_block_device('/dev/mapper/crypt2') and not os.path.exists(options['luks_cryptdev_file'])
+    luks_device.encrypt(**dict(options, passphrase_length=16)) # -p ignored by luksFormat, nothing written yet
+    assert sim.devices['/dev/vdc']['luks']['uuid'] != luks_uuid and sim.devices['/dev/vdc']['luks']['keyslots'][0] != 'passphrase'
@@ -0,0 +1,131 @@
+# Import dependencies
+import time
+import threading
+import multiprocessing
+import pytest
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+# Import internal dependencies
+from pyluks.luksctl_api.single_flight import SingleFlight, TooManyWaiters, WaitTimeout
+from pyluks.luksctl_api.loadgen import SimulatedAPIServer
+
+
+
+################################################################################
+# HELPERS
+
+def storm(flight, key, callers, duration=0.2):
+    """Runs the same operation from many threads at once, returning the results and the number of actual runs."""
+    runs = []
+    def work():
+        runs.append(1)
+        time.sleep(duration)
+        return {'volume_state': 'mounted', 'run': len(runs)}
+
+    def call():
+        try:
+            return flight.run(key, work)
+        except TooManyWaiters as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=callers) as executor:
+        results = list(executor.map(lambda _: call(), range(callers)))
+    return results, len(runs)
+
+
+def _process_caller(state_dir, barrier, queue):
+    flight = SingleFlight(state_dir=state_dir)
+    def work():
+        time.sleep(0.3)
+        return {'pid': multiprocessing.current_process().pid}
+    barrier.wait()
+    queue.put(flight.run('open-crypt0', work))
+
+
+
+################################################################################
+# BENCHMARKS
+
+def test_single_flight_coalescing(benchmark, tmp_path):
+    """32 concurrent callers for the same volume: the operation runs once and its result is shared."""
+    def run():
+        flight = SingleFlight(state_dir=str(tmp_path / str(time.monotonic_ns())), max_waiters=64)
+        return storm(flight, 'open-crypt0', callers=32)
+
+    results, runs = benchmark.pedantic(run, rounds=3)
+    assert runs == 1
+    assert sorted(shared for _, shared in results) == [False] + [True] * 31
+    assert all(result == {'volume_state': 'mounted', 'run': 1} for result, _ in results)
+
+
+def test_single_flight_across_processes(tmp_path):
+    """Callers in different processes, e.g. gunicorn workers, share the result of the first one."""
+    context = multiprocessing.get_context('fork')
+    barrier, queue = context.Barrier(4), context.Queue()
+    processes = [context.Process(target=_process_caller, args=(str(tmp_path), barrier, queue)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    results = [queue.get(timeout=10) for _ in processes]
+    for process in processes:
+        process.join()
+    assert len({result['pid'] for result, _ in results}) == 1
+    assert sorted(shared for _, shared in results) == [False, True, True, True]
+
+
+def test_single_flight_backpressure(tmp_path):
+    """Callers beyond max_waiters are rejected with the duration of the last run as retry delay."""
+    flight = SingleFlight(state_dir=str(tmp_path), max_waiters=4, result_ttl=0)
+    flight.run('open-crypt0', lambda: time.sleep(1.2))
+    results, runs = storm(flight, 'open-crypt0', callers=12, duration=0.5)
+    rejected = [r for r in results if isinstance(r, TooManyWaiters)]
+    assert runs == 1 and len(rejected) == 12 - 1 - 4
+    assert all(e.retry_after == 2 for e in rejected)
+    assert flight.waiters('open-crypt0') == 0
+
+
+def test_single_flight_leader_failure(tmp_path):
+    """If the first caller fails, a waiting caller runs the operation again instead of sharing the failure."""
+    flight = SingleFlight(state_dir=str(tmp_path))
+    started, calls = threading.Event(), []
+    def failing():
+        calls.append('failing')
+        started.set()
+        time.sleep(0.2)
+        raise RuntimeError('vault unreachable')
+
+    def leader():
+        with pytest.raises(RuntimeError):
+            flight.run('open-crypt0', failing)
+
+    thread = threading.Thread(target=leader)
+    thread.start()
+    started.wait()
+    result = flight.run('open-crypt0', lambda: calls.append('retry') or {'volume_state': 'mounted'})
+    thread.join()
+    assert result == ({'volume_state': 'mounted'}, False) and calls == ['failing', 'retry']
+
+
+def test_single_flight_wait_timeout(tmp_path):
+    """A caller giving up on a slow operation gets the retry delay, so that the API can answer 503 with Retry-After."""
+    flight = SingleFlight(state_dir=str(tmp_path), wait_timeout=0.1)
+    started = threading.Event()
+    thread = threading.Thread(target=flight.run, args=('open-crypt0', lambda: started.set() or time.sleep(0.5)))
+    thread.start()
+    started.wait()
+    with pytest.raises(WaitTimeout) as e:
+        flight.run('open-crypt0', lambda: None)
+    thread.join()
+    assert isinstance(e.value, TimeoutError) and e.value.retry_after >= 1
+
+
+def test_api_open_coalescing():
+    """Concurrent /open requests for the same simulated volume all get the mounted state."""
+    with SimulatedAPIServer(volumes=1, latencies={'luks_open': 0.3}) as server:
+        def open_volume(_):
+            return requests.post(f'{server.url}/luksctl_api/v1.0/open', json=server.open_payload(), timeout=10)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            responses = list(executor.map(open_volume, range(8)))
+    assert [r.status_code for r in responses] == [200] * 8
+    assert all(r.json() == {'volume_state': 'mounted'} for r in responses)
@@ -0,0 +1,130 @@
+# Import dependencies
+import ssl
+import sys
+import time
+import socket
+import subprocess
+import pytest
+
+# Import internal dependencies
+from pyluks.luksctl_api import __path__ as luksctl_api_path_list
+from pyluks.luksctl_api.ssl_certificate import KEY_TYPES, generate_self_signed_cert, SharedServerContext
+from pyluks.luksctl_api.server_profiles import write_gunicorn_config
+
+
+
+################################################################################
+# HELPERS
+
+def memory_handshake(server_context, client_context, session=None):
+    """TLS handshake between a server and a client context through memory buffers, without sockets.
+    Returns the client SSLObject after the first application data has been received, with its session."""
+    server_in, server_out, client_in, client_out = (ssl.MemoryBIO() for _ in range(4))
+    server = server_context.wrap_bio(server_in, server_out, server_side=True)
+    client = client_context.wrap_bio(client_in, client_out, server_hostname='localhost', session=session)
+
+    def pump():
+        client_in.write(server_out.read())
+        server_in.write(client_out.read())
+
+    for peer in (client, server) * 4:
+        try:
+            peer.do_handshake()
+        except ssl.SSLWantReadError:
+            pass
+        pump()
+    server.write(b'x')
+    pump()
+    client.read(1) # Receives the TLS 1.3 session tickets too
+    return client
+
+
+def client_context(cert_file):
+    return ssl.create_default_context(cafile=cert_file)
+
+
+class _Conf:
+    """Subset of the gunicorn configuration read by SharedServerContext."""
+    def __init__(self, certfile, keyfile):
+        self.certfile, self.keyfile, self.ca_certs, self.ciphers = certfile, keyfile, None, None
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+
+################################################################################
+# BENCHMARKS
+
+@pytest.mark.parametrize('key_type', KEY_TYPES)
+def test_certificate_generation(benchmark, tmp_path, key_type):
+    """Generation of the self signed certificate of the API, done by luksctl_api --ssl."""
+    cert_file, key_file = str(tmp_path / 'cert.pem'), str(tmp_path / 'key.pem')
+    generated = benchmark.pedantic(generate_self_signed_cert, kwargs={'cert_file': cert_file, 'key_file': key_file,
+                                                                       'key_type': key_type, 'reuse': False}, rounds=1)
+    assert generated
+
+
+def test_certificate_reuse(benchmark, tmp_path):
+    """A valid certificate is reused, it's regenerated if the key type changes or if it's about to expire."""
+    cert_file, key_file = str(tmp_path / 'cert.pem'), str(tmp_path / 'key.pem')
+    assert generate_self_signed_cert(cert_file=cert_file, key_file=key_file)
+    assert not benchmark(generate_self_signed_cert, cert_file=cert_file, key_file=key_file)
+    assert generate_self_signed_cert(cert_file=cert_file, key_file=key_file, key_type='ed25519')
+    assert generate_self_signed_cert(cert_file=cert_file, key_file=key_file, key_type='ed25519', expiration_days=10, reuse=False)
+    assert generate_self_signed_cert(cert_file=cert_file, key_file=key_file, key_type='ed25519')
+    assert not generate_self_signed_cert(cert_file=cert_file, key_file=key_file, key_type='ed25519')
+
+
+@pytest.mark.parametrize('key_type', ['ecdsa-p256', 'rsa'])
+@pytest.mark.parametrize('resumed', [False, True], ids=['full', 'resumed'])
+def test_tls_handshake(benchmark, tmp_path, key_type, resumed):
+    """Server and client CPU time of a TLS handshake, full or resumed with a session ticket."""
+    cert_file, key_file = str(tmp_path / 'cert.pem'), str(tmp_path / 'key.pem')
+    generate_self_signed_cert(cert_file=cert_file, key_file=key_file, key_type=key_type)
+    server_context = SharedServerContext().get(_Conf(cert_file, key_file))
+    client = client_context(cert_file)
+    session = memory_handshake(server_context, client).session if resumed else None
+
+    result = benchmark(memory_handshake, server_context, client, session)
+    assert result.session_reused == resumed
+
+
+def test_gunicorn_session_resumption(tmp_path):
+    """With the generated configuration, clients resume their TLS session with any of the gunicorn workers."""
+    cert_file, key_file, config_file = str(tmp_path / 'cert.pem'), str(tmp_path / 'key.pem'), str(tmp_path / 'gunicorn.conf.py')
+    port = free_port()
+    generate_self_signed_cert(cert_file=cert_file, key_file=key_file)
+    write_gunicorn_config(config_file, profile='balanced', cpu_count=2, bind=f'127.0.0.1:{port}', cert_file=cert_file,
+                          key_file=key_file, max_requests=0)
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--config', config_file, 'app:master_app'],
+                               cwd=luksctl_api_path_list[0], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    context = client_context(cert_file)
+
+    def request(session=None):
+        with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+            with context.wrap_socket(sock, server_hostname='localhost', session=session) as tls:
+                tls.sendall(b'GET /luksctl_api/v1.0/missing HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+                while tls.recv(65536):
+                    pass
+                return tls.session, tls.session_reused
+
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                session, _ = request()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        reused = [request(session)[1] for _ in range(20)]
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+    assert all(reused)
@@ -0,0 +1,59 @@
+# Import dependencies
+import re
+import subprocess
+import sys
+import pytest
+
+
+
+################################################################################
+# VARIABLES
+
+ENTRY_MODULES = ['pyluks.fastluks', 'pyluks.luksctl', 'pyluks.luksctl_api.luksctl_run']
+
+# Run in a fresh interpreter: fails if importing the module created a logger, parsed the cryptdev .ini file
+# or read the distribution id
+NO_SIDE_EFFECTS = '''
+import logging, sys
+import {module}
+from pyluks import utilities
+assert not utilities._config_cache, 'cryptdev .ini file parsed at import time'
+for name in ('fastluks', 'luksctl', 'luksctl_api'):
+    assert not logging.getLogger(name).handlers, f'{{name}} logger created at import time'
+assert 'hvac' not in sys.modules, 'hvac imported at import time'
+'''
+
+
+
+################################################################################
+# HELPERS
+
+def import_time(module):
+    """Cumulative import time of a module in microseconds, as reported by 'python -X importtime'."""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          capture_output=True, text=True, check=True)
+    for line in proc.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| (\S+)$', line)
+        if match and match.group(2) == module:
+            return int(match.group(1))
+    raise AssertionError(f'{module} not found in the importtime output')
+
+
+
+################################################################################
+# BENCHMARKS
+
+@pytest.mark.parametrize('module', ENTRY_MODULES)
+def test_import_startup(benchmark, module):
+    """Interpreter start and import of a pyluks entry point in a fresh process, as paid by every CLI run
+    and gunicorn worker boot. The import time alone is reported in extra_info.
+    """
+    benchmark.extra_info['import_time_us'] = import_time(module)
+    benchmark.pedantic(subprocess.run, args=([sys.executable, '-c', f'import {module}'],), kwargs={'check': True},
+                       rounds=5, iterations=1)
+
+
+@pytest.mark.parametrize('module', ENTRY_MODULES)
+def test_import_has_no_side_effects(module):
+    """Importing an entry point doesn't create loggers or log files, parse the cryptdev .ini file or import hvac."""
+    subprocess.run([sys.executable, '-c', NO_SIDE_EFFECTS.format(module=module)], check=True)
@@ -0,0 +1,112 @@
+# Import dependencies
+import json
+import time
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+# Import internal dependencies
+from pyluks.luksctl_api.status_stream import StatusWatcher
+from pyluks.luksctl_api.loadgen import SimulatedAPIServer
+
+
+
+################################################################################
+# BENCHMARKS
+
+def test_status_watcher_fanout(benchmark, tmp_path):
+    """500 clients waiting for a change cost a single state computation per change."""
+    states = {'crypt0': 'unmounted', 'crypt1': 'unmounted'}
+    computed = []
+    def compute():
+        computed.append(1)
+        return dict(states)
+
+    watcher = StatusWatcher(compute, interval=60, mountinfo_file=str(tmp_path / 'missing'), uevents=False).start()
+    cursor = watcher.snapshot()['version']
+
+    def round_trip():
+        states['crypt0'] = 'mounted' if states['crypt0'] == 'unmounted' else 'unmounted'
+        computed.clear()
+        with ThreadPoolExecutor(max_workers=500) as executor:
+            waiting = [executor.submit(watcher.wait, cursor=watcher.version, timeout=10) for _ in range(500)]
+            time.sleep(0.2)
+            watcher.refresh()
+            return [w.result() for w in waiting]
+
+    snapshots = benchmark.pedantic(round_trip, rounds=3)
+    watcher.stop()
+    assert len(computed) == 1 and all(s['version'] == watcher.version > cursor for s in snapshots)
+    assert all(s['volumes']['crypt0']['volume_state'] == states['crypt0'] for s in snapshots)
+
+
+def test_status_watcher_filter(tmp_path):
+    """Clients waiting for a volume are not woken up by the changes of the others."""
+    states = {'crypt0': 'unmounted', 'crypt1': 'unmounted'}
+    watcher = StatusWatcher(lambda: dict(states), interval=60, mountinfo_file=str(tmp_path / 'missing'), uevents=False).start()
+    cursor = watcher.version
+
+    states['crypt1'] = 'mounted'
+    threading.Timer(0.1, watcher.refresh).start()
+    start = time.monotonic()
+    snapshot = watcher.wait(cursor=cursor, timeout=0.5, cryptdevs=['crypt0'])
+    assert time.monotonic() - start >= 0.5 and list(snapshot['volumes']) == ['crypt0']
+
+    states['crypt0'] = 'mounted'
+    watcher.notify() # Refreshed by the watcher thread
+    snapshot = watcher.wait(cursor=snapshot['version'], timeout=5, cryptdevs=['crypt0'])
+    watcher.stop()
+    assert snapshot['volumes']['crypt0']['volume_state'] == 'mounted'
+
+
+def test_api_status_stream():
+    """Long poll and server-sent events of /status/stream, woken up by an /open served by the API."""
+    with SimulatedAPIServer(volumes=2) as server:
+        stream_url = f'{server.url}/luksctl_api/v1.0/status/stream'
+        initial = requests.get(stream_url, timeout=10).json()
+        assert {c: v['volume_state'] for c, v in initial['volumes'].items()} == {'crypt0': 'unmounted', 'crypt1': 'unmounted'}
+
+        events, subscribed = [], threading.Event()
+        def listen():
+            with requests.get(stream_url, params={'cryptdev': 'crypt1'}, headers={'Accept': 'text/event-stream'},
+                              stream=True, timeout=10) as response:
+                for line in response.iter_lines(chunk_size=1, decode_unicode=True):
+                    if line.startswith('data: '):
+                        events.append(json.loads(line[len('data: '):]))
+                        subscribed.set()
+                        if len(events) == 2:
+                            return
+
+        listener = threading.Thread(target=listen)
+        listener.start()
+        subscribed.wait(timeout=10)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            long_poll = executor.submit(requests.get, stream_url, params={'cursor': initial['version'], 'cryptdev': 'crypt1'}, timeout=10)
+            time.sleep(0.2)
+            requests.post(f'{server.url}/luksctl_api/v1.0/open', json=dict(server.open_payload(), cryptdev='crypt1'), timeout=10)
+            changed = long_poll.result().json()
+        listener.join(timeout=10)
+
+    assert changed['version'] > initial['version'] and changed['volumes']['crypt1']['volume_state'] == 'mounted'
+    assert [(e['cryptdev'], e['volume_state']) for e in events] == [('crypt1', 'unmounted'), ('crypt1', 'mounted')]
+
+
+def test_api_status_stream_limits():
+    """Streams beyond max_streams are rejected with 503 and Retry-After, and a slot is freed when a stream closes."""
+    with SimulatedAPIServer(volumes=1) as server:
+        stream_url = f'{server.url}/luksctl_api/v1.0/status/stream'
+        sse = {'headers': {'Accept': 'text/event-stream'}, 'params': {'timeout': 0.1}, 'stream': True, 'timeout': 10}
+        streams = [requests.get(stream_url, **sse) for _ in range(2)]
+        assert [response.status_code for response in streams] == [200, 200]
+
+        rejected = requests.get(stream_url, **sse)
+        assert rejected.status_code == 503 and int(rejected.headers['Retry-After']) > 0
+        assert requests.get(stream_url, timeout=10).status_code == 200 # Not waiting, not counted
+
+        streams.pop().close()
+        deadline = time.monotonic() + 5
+        while requests.get(stream_url, params={'cursor': 0, 'timeout': 0.1}, timeout=10).status_code != 200:
+            assert time.monotonic() < deadline
+            time.sleep(0.1)
+        for response in streams:
+            response.close()
@@ -0,0 +1,58 @@
+# Import dependencies
+import os
+from configparser import ConfigParser
+import pytest
+
+
+
+################################################################################
+# VARIABLES
+
+FAKE_TOOLCHAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_toolchain')
+FAKE_BIN = os.path.join(FAKE_TOOLCHAIN, 'bin')
+FAKE_DEVICE = '/dev/vdb'
+
+
+
+################################################################################
+# FIXTURES
+
+@pytest.fixture(autouse=True)
+def fake_toolchain(monkeypatch):
+    """Puts the fake cryptsetup, dmsetup, mount, systemctl (and friends) executables first in PATH, so that
+    every command run by pyluks hits a stub instead of the real tool.
+    """
+    monkeypatch.setenv('PATH', f'{FAKE_BIN}{os.pathsep}{os.environ["PATH"]}')
+    monkeypatch.setenv('FAKE_DEVICE', FAKE_DEVICE)
+    return FAKE_BIN
+
+
+@pytest.fixture
+def cryptdev_ini(tmp_path):
+    """Writes a cryptdev .ini file with the luks, logs and luksctl_api sections, as written by fastluks
+    and the luksctl_api setup. The master runs the fake luksctl through 'env' instead of sudo.
+    """
+    config = ConfigParser()
+    config['luks'] = {'cipher_algorithm': 'aes-xts-plain64',
+                      'hash_algorithm': 'sha256',
+                      'keysize': '256',
+                      'device': FAKE_DEVICE,
+                      'uuid': '101de0a7-e4f5-4d40-9829-541a2b34c1bf',
+                      'cryptdev': 'crypt',
+                      'mapper': '/dev/mapper/crypt',
+                      'mountpoint': str(tmp_path / 'export'),
+                      'filesystem': 'ext4',
+                      'header_path': str(tmp_path / 'luks-header.bck')}
+    config['logs'] = {'fastluks': str(tmp_path / 'fastluks.log'),
+                      'luksctl': str(tmp_path / 'luksctl.log'),
+                      'luksctl_api': str(tmp_path / 'luksctl-api.log')}
+    config['luksctl_api'] = {'daemons': 'nfs-server,docker',
+                             'env_path': FAKE_TOOLCHAIN,
+                             'node_list': ','.join(f'10.0.{i // 256}.{i % 256}' for i in range(1, 201)),
+                             'exports_list': '/export',
+                             'sudo_path': 'env'}
+
+    ini_file = tmp_path / 'luks-cryptdev.ini'
+    with open(ini_file, 'w') as f:
+        config.write(f)
+    return str(ini_file)
@@ -1,4 +1,11 @@
 from .utilities import *
 from .vault_support import *
+from .backends import *
+from .header_store import *
+from .cryptdev_registry import *
+from .inventory import *
+from .io_throttle import *
+from .block_tuning import *
+from .profiler import *
 
 __version__ = '0.0.1'
\ No newline at end of file
@@ -0,0 +1,846 @@
+# Import dependencies
+import os
+import shutil
+import time
+import uuid
+import random
+import hashlib
+import shlex
+import copy
+import tempfile
+import threading
+from pathlib import Path
+
+# Import internal dependencies
+from .utilities import run_command, run_argv
+from .inventory import BlockInventory
+from .io_throttle import IOScope, SCOPE_FAILED, SYSTEMD_IO_VERSION, native_thread_id, throttled_wipe
+from .block_tuning import BlockTuner, TuningError
+
+
+
+################################################################################
+# VARIABLES
+
+# Marker for the commands run with the timeout of the backend
+_BACKEND_TIMEOUT = object()
+
+# PBKDF time spent by luksFormat, and by each unlock on a host of the same speed
+LUKS_ITER_TIME_MS = 2000
+
+
+
+################################################################################
+# BACKEND INTERFACE
+
+class Backend:
+    """Execution backend interface. Every interaction of pyluks with the host (cryptsetup, dmsetup, mount,
+    mkfs, systemctl and the luksctl command line tool) goes through a backend object, so that the device,
+    LUKSCtl and master classes can be run either on the real system or on a simulated host.
+
+    Methods running a command return a tuple containing stdout, stderr and exit code, as the run_argv
+    function does. The exit codes follow the ones of the corresponding command line tool. The mkfs and wipe
+    methods limit their writes to the given pyluks.io_throttle.IOLimits, if any. The block-layer tuning methods
+    behave as pyluks.block_tuning.BlockTuner.apply and BlockTuner.drift.
+    """
+
+    # Block devices and paths
+    def is_block_device(self, path): raise NotImplementedError
+    def is_dir(self, path): raise NotImplementedError
+    def is_mount(self, path): raise NotImplementedError
+    def mount_source(self, mountpoint): raise NotImplementedError
+    def makedirs(self, path): raise NotImplementedError
+    def which(self, program): raise NotImplementedError
+    def exists(self, path): raise NotImplementedError
+    def read_device(self, device, size, offset=0): raise NotImplementedError
+    def block_device(self, device): raise NotImplementedError
+    def block_devices(self): raise NotImplementedError
+
+    # Block-layer tuning
+    def tune_block_device(self, device, settings, logger=None, tune_disks=False): raise NotImplementedError
+    def block_tuning_drift(self, device, settings, tune_disks=False): raise NotImplementedError
+
+    # cryptsetup and dmsetup
+    def luks_format(self, device, secret, cipher_algorithm, keysize, hash_algorithm, logger=None, luks_uuid=None): raise NotImplementedError
+    def is_luks(self, device, logger=None): raise NotImplementedError
+    def luks_uuid(self, device, logger=None): raise NotImplementedError
+    def luks_dump(self, device, logger=None): raise NotImplementedError
+    def luks_header_backup(self, device, backup_file, logger=None): raise NotImplementedError
+    def luks_header_image(self, device, logger=None): raise NotImplementedError
+    def luks_open(self, device, name, secret=None, logger=None): raise NotImplementedError
+    def luks_add_key(self, device, secret, new_secret, key_slot=None, pbkdf_memory=None, logger=None): raise NotImplementedError
+    def luks_test_passphrase(self, device, secret, key_slot=None, logger=None): raise NotImplementedError
+    def luks_kill_slot(self, device, key_slot, secret, logger=None): raise NotImplementedError
+    def luks_close(self, name, logger=None): raise NotImplementedError
+    def luks_status(self, name, logger=None): raise NotImplementedError
+    def dmsetup_info(self, name, logger=None): raise NotImplementedError
+    def cipher_benchmark(self, cipher_algorithm, keysize, logger=None): raise NotImplementedError
+
+    # Filesystems
+    def fs_type(self, device): raise NotImplementedError
+    def mkfs(self, filesystem, device, logger=None, options=None, limits=None): raise NotImplementedError
+    def mount(self, source, mountpoint, logger=None): raise NotImplementedError
+    def umount(self, mountpoint, logger=None): raise NotImplementedError
+    def wipe(self, device, logger=None, limits=None): raise NotImplementedError
+
+    # Services and tools
+    def systemctl(self, action, unit, sudo_path='', logger=None): raise NotImplementedError
+    def luksctl(self, action, luksctl_cmd, sudo_path='', secret=None, cryptdev=None, logger=None): raise NotImplementedError
+    def run(self, cmd, logger=None): raise NotImplementedError
+
+    def dry_run(self, operation, *args, **kwargs):
+        """Returns the argument lists of the commands run by an operation, without running them, or None if the
+        backend doesn't run commands."""
+        return None
+
+
+
+################################################################################
+# REAL BACKEND
+
+class RealBackend(Backend):
+    """Backend running the command line tools on the host through the run_argv function: commands are executed
+    without a shell and passphrases are written to their stdin.
+    """
+
+
+    def __init__(self, timeout=None, env=None, inventory=None):
+        """Instantiate a RealBackend object.
+
+        :param timeout: Seconds after which a command is killed, except for the ones whose duration depends on
+            the size of the device (dd and mkfs), defaults to None (no timeout)
+        :type timeout: float, optional
+        :param env: Environment variables added to the ones of the current process for each command, defaults to None
+        :type env: dict, optional
+        :param inventory: Inventory used to describe block devices and mounts, defaults to a BlockInventory of the host
+        :type inventory: pyluks.inventory.BlockInventory, optional
+        """
+        self.timeout = timeout
+        self.env = env
+        self.inventory = inventory if inventory is not None else BlockInventory()
+
+    def _run(self, args, logger=None, input=None, timeout=_BACKEND_TIMEOUT):
+        timeout = self.timeout if timeout is _BACKEND_TIMEOUT else timeout
+        return run_argv(args, logger=logger, input=input, timeout=timeout, env=self.env)
+
+    @staticmethod
+    def _secret_input(secret):
+        # cryptsetup reads the passphrase up to the newline when stdin is not a terminal
+        return f'{secret}\n'
+
+    def is_block_device(self, path): return Path(path).is_block_device()
+    def is_dir(self, path): return os.path.isdir(path)
+    def is_mount(self, path): return os.path.ismount(path)
+    def makedirs(self, path): os.makedirs(path, exist_ok=True)
+    def which(self, program): return shutil.which(program) is not None
+    def exists(self, path): return os.path.exists(path)
+
+    def read_device(self, device, size, offset=0):
+        with open(device, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def mount_source(self, mountpoint):
+        mount = self.inventory.mount_info(mountpoint)
+        if mount is not None:
+            return mount['source']
+        # Not a mountpoint: source of the filesystem containing it, i.e. the first field of the last line of 'df -P'
+        stdout, _, _ = self._run(['df', '-P', mountpoint])
+        lines = stdout.strip().splitlines()
+        return lines[-1].split(' ')[0] if lines else ''
+
+    def block_device(self, device): return self.inventory.device(device)
+    def block_devices(self): return self.inventory.devices()
+
+    def tune_block_device(self, device, settings, logger=None, tune_disks=False):
+        return BlockTuner(self.inventory, tune_disks=tune_disks).apply(device, settings, logger=logger)
+
+    def block_tuning_drift(self, device, settings, tune_disks=False):
+        return BlockTuner(self.inventory, tune_disks=tune_disks).drift(device, settings)
+
+
+    def luks_format(self, device, secret, cipher_algorithm, keysize, hash_algorithm, logger=None, luks_uuid=None):
+        uuid_args = ['--uuid', luks_uuid] if luks_uuid else []
+        return self._run(['cryptsetup', '-v', '--cipher', cipher_algorithm, '--key-size', keysize, '--hash', hash_algorithm,
+                          '--iter-time', str(LUKS_ITER_TIME_MS), '--use-urandom', *uuid_args, 'luksFormat', device, '--batch-mode'],
+                         logger, input=self._secret_input(secret))
+
+    def is_luks(self, device, logger=None):
+        return self._run(['cryptsetup', 'isLuks', device], logger)
+
+    def luks_uuid(self, device, logger=None):
+        return self._run(['cryptsetup', 'luksUUID', device], logger)
+
+    def luks_dump(self, device, logger=None):
+        return self._run(['cryptsetup', 'luksDump', device], logger)
+
+    def luks_header_backup(self, device, backup_file, logger=None):
+        return self._run(['cryptsetup', 'luksHeaderBackup', '--header-backup-file', backup_file, device], logger)
+
+    def luks_header_image(self, device, logger=None):
+        # cryptsetup refuses to overwrite an existing backup file, so it's written in a new directory
+        tmp_dir = tempfile.mkdtemp(prefix='luks-header.')
+        try:
+            backup_file = os.path.join(tmp_dir, 'header.img')
+            _, stderr, status = self.luks_header_backup(device, backup_file, logger)
+            if status != 0:
+                return b'', stderr, status
+            with open(backup_file, 'rb') as f:
+                return f.read(), stderr, status
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def luks_open(self, device, name, secret=None, logger=None):
+        # Without a secret, cryptsetup reads the passphrase from the inherited stdin
+        if secret is None:
+            return self._run(['cryptsetup', 'luksOpen', device, name], logger, timeout=None)
+        return self._run(['cryptsetup', 'luksOpen', device, name], logger, input=self._secret_input(secret))
+
+    def luks_add_key(self, device, secret, new_secret, key_slot=None, pbkdf_memory=None, logger=None):
+        # cryptsetup reads an existing passphrase, then the new one, one per line
+        slot = ['--key-slot', str(key_slot)] if key_slot is not None else []
+        memory = ['--pbkdf-memory', str(pbkdf_memory)] if pbkdf_memory is not None else []
+        return self._run(['cryptsetup', '-v', 'luksAddKey', *slot, *memory, device], logger,
+                         input=self._secret_input(secret) + self._secret_input(new_secret))
+
+    def luks_test_passphrase(self, device, secret, key_slot=None, logger=None):
+        slot = ['--key-slot', str(key_slot)] if key_slot is not None else []
+        return self._run(['cryptsetup', '-v', 'open', '--test-passphrase', *slot, device], logger, input=self._secret_input(secret))
+
+    def luks_kill_slot(self, device, key_slot, secret, logger=None):
+        # The passphrase of a remaining key slot is required, so the last working slot can't be removed
+        return self._run(['cryptsetup', '-v', 'luksKillSlot', device, str(key_slot)], logger, input=self._secret_input(secret))
+
+    def luks_close(self, name, logger=None):
+        return self._run(['cryptsetup', 'close', name], logger)
+
+    def luks_status(self, name, logger=None):
+        return self._run(['cryptsetup', '-v', 'status', name], logger)
+
+    def dmsetup_info(self, name, logger=None):
+        return self._run(['dmsetup', 'info', f'/dev/mapper/{name}'], logger)
+
+    def cipher_benchmark(self, cipher_algorithm, keysize, logger=None):
+        return self._run(['cryptsetup', 'benchmark', '--cipher', cipher_algorithm, '--key-size', str(keysize)], logger)
+
+
+    def fs_type(self, device):
+        stdout, _, _ = self._run(['blkid', '-o', 'value', '-s', 'TYPE', device])
+        return stdout.strip()
+
+    def mkfs(self, filesystem, device, logger=None, options=None, limits=None):
+        args = ['mkfs', '-t', filesystem, *(options or []), device]
+        if limits is None:
+            return self._run(args, logger, timeout=None)
+        # mkfs is run with ionice in a systemd scope whose I/O limits follow the limits, or with ionice only
+        # if the host is not managed by a recent enough systemd or the scope can't be started
+        scope = IOScope(device, limits)
+        if not scope.available():
+            if logger is not None:
+                logger.warning('mkfs I/O limits not applied: systemd-run not available or older than '
+                               f'systemd {SYSTEMD_IO_VERSION}, only ionice is applied.')
+            return self._run(limits.command(args), logger, timeout=None)
+        stderr, status = scope.check()
+        if status != 0:
+            if logger is not None:
+                logger.warning(f'mkfs I/O limits not applied, only ionice is applied: {stderr.strip()}')
+            return self._run(limits.command(args), logger, timeout=None)
+        command = scope.command(limits.command(args))
+        with scope:
+            stdout, stderr, status = self._run(command, logger, timeout=None)
+        if status != 0 and stderr.startswith(SCOPE_FAILED):
+            if logger is not None:
+                logger.warning(f'mkfs I/O limits not applied, only ionice is applied: {stderr.strip()}')
+            return self._run(limits.command(args), logger, timeout=None)
+        return stdout, stderr, status
+
+    def mount(self, source, mountpoint, logger=None):
+        return self._run(['mount', source, mountpoint], logger)
+
+    def umount(self, mountpoint, logger=None):
+        return self._run(['umount', mountpoint], logger)
+
+    def wipe(self, device, logger=None, limits=None):
+        if limits is None:
+            return self._run(['dd', 'if=/dev/zero', f'of={device}', 'bs=1M', 'status=progress'], logger, timeout=None)
+        # Rate-limited writer, run in its own thread so that ionice changes the I/O priority of the writes only
+        result = []
+        def writer():
+            if limits.ionice is not None:
+                self._run(limits.command(['-p', str(native_thread_id())]), logger)
+            result.extend(throttled_wipe(device, limits))
+        thread = threading.Thread(target=writer, name='pyluks-wipe')
+        thread.start()
+        thread.join()
+        if logger is not None:
+            logger.debug(f'Throttled wipe of {device}\nStderr: {result[1]}\nStatus: {result[2]}')
+        return tuple(result)
+
+
+    def systemctl(self, action, unit, sudo_path='', logger=None):
+        return self._run([*shlex.split(sudo_path), 'systemctl', action, unit], logger)
+
+    def luksctl(self, action, luksctl_cmd, sudo_path='', secret=None, cryptdev=None, logger=None):
+        volume = ['--cryptdev', cryptdev] if cryptdev is not None else []
+        args = [*shlex.split(sudo_path), luksctl_cmd, *volume, action]
+        if secret is None:
+            return self._run(args, logger)
+        return self._run(args, logger, input=self._secret_input(secret))
+
+    def run(self, cmd, logger=None):
+        # Argument lists are run without a shell, strings through the shell for backward compatibility
+        if isinstance(cmd, str):
+            return run_command(cmd, logger)
+        return self._run(cmd, logger, timeout=None)
+
+    def dry_run(self, operation, *args, **kwargs):
+        # The operation is run on a copy of the backend recording the commands instead of running them
+        commands = []
+        def record(args, logger=None, input=None, timeout=_BACKEND_TIMEOUT):
+            commands.append([str(arg) for arg in args])
+            return '', '', 0
+        recorder = copy.copy(self)
+        recorder._run = record
+        getattr(recorder, operation)(*args, **kwargs)
+        return commands
+
+
+
+################################################################################
+# SIMULATED BACKEND
+
+class SimulatedBackend(Backend):
+    """In-memory simulated LUKS host. Block devices, LUKS headers, device-mapper mappings, filesystems, mounts
+    and systemd services are kept in dictionaries, so thousands of virtual volumes can be managed without
+    root or real disks.
+
+    Each operation (e.g. 'luks_format', 'luks_open', 'mount') can be given a latency, to emulate the cost of
+    the KDF or of a slow disk, and failures can be injected either on the next calls or with a probability.
+    """
+
+    HEADER_SIZE = 1024**2       # Size of the simulated LUKS header region, i.e. the payload offset
+    KEYSLOT_AREA_SIZE = 128 * 1024
+    CIPHER_THROUGHPUT = 2000 * 1024**2  # Bytes per second reported by the simulated cryptsetup benchmark
+    KEYSLOTS = 8                        # Key slots of a LUKS1 header
+
+    def __init__(self, latencies=None, failure_rates=None, seed=None, luks_cryptdev_file='/etc/luks/luks-cryptdev.ini'):
+        """Instantiate a simulated host with no block device.
+
+        :param latencies: Dictionary mapping operation names to their latency in seconds, defaults to None
+        :type latencies: dict, optional
+        :param failure_rates: Dictionary mapping operation names to their failure probability, defaults to None
+        :type failure_rates: dict, optional
+        :param seed: Seed for the random failures and the generated LUKS UUIDs, defaults to None
+        :type seed: int, optional
+        :param luks_cryptdev_file: Path to the cryptdev .ini file read by the simulated luksctl command, defaults to '/etc/luks/luks-cryptdev.ini'
+        :type luks_cryptdev_file: str, optional
+        """
+        self.latencies = dict(latencies or {})
+        self.failure_rates = dict(failure_rates or {})
+        self.luks_cryptdev_file = luks_cryptdev_file
+        self.random = random.Random(seed)
+
+        self.devices = {}        # device path -> {'size', 'luks', 'filesystem'}
+        self.mappings = {}       # cryptdev name -> device path
+        self.mounts = {}         # mountpoint -> source
+        self.directories = set()
+        self.services = {}       # unit -> 'active' or 'inactive'
+        self.header_backups = {} # backup file -> copy of the LUKS header
+        self.queue_settings = {} # cryptdev name -> block-layer settings of the mapped device
+        self.calls = {}          # operation -> number of calls
+
+        self._injected = {}      # operation -> list of (stdout, stderr, status)
+        self._lock = threading.RLock()
+
+
+    #____________________________________
+    # Simulation control
+    def add_device(self, path, size=10 * 1024**3):
+        """Adds an empty block device to the simulated host.
+
+        :param path: Device path, e.g. /dev/vdb
+        :type path: str
+        :param size: Device size in bytes, defaults to 10 GiB
+        :type size: int, optional
+        """
+        with self._lock:
+            self.devices[path] = {'size': size, 'luks': None, 'filesystem': None}
+
+    def add_luks_device(self, path, luks_uuid, secret, filesystem=None, size=10 * 1024**3):
+        """Adds a block device which is already LUKS formatted, e.g. to simulate a host after a reboot.
+
+        :param path: Device path, e.g. /dev/vdb
+        :type path: str
+        :param luks_uuid: UUID of the LUKS header.
+        :type luks_uuid: str
+        :param secret: Passphrase in the first keyslot.
+        :type secret: str
+        :param filesystem: Filesystem created on the mapped device, defaults to None
+        :type filesystem: str, optional
+        :param size: Device size in bytes, defaults to 10 GiB
+        :type size: int, optional
+        """
+        with self._lock:
+            self.devices[path] = {'size': size, 'filesystem': None,
+                                  'luks': {'uuid': luks_uuid, 'keyslots': [secret], 'cipher_algorithm': 'aes-xts-plain64',
+                                           'keysize': 256, 'hash_algorithm': 'sha256', 'filesystem': filesystem}}
+
+    def inject_failure(self, operation, status=1, stderr='Simulated failure.', count=1):
+        """Makes the next calls of an operation fail with the given exit code.
+
+        :param operation: Operation name, i.e. the backend method name (e.g. 'luks_open').
+        :type operation: str
+        :param status: Exit code returned by the failing calls, defaults to 1
+        :type status: int, optional
+        :param stderr: Stderr returned by the failing calls, defaults to 'Simulated failure.'
+        :type stderr: str, optional
+        :param count: Number of calls that fail, defaults to 1
+        :type count: int, optional
+        """
+        with self._lock:
+            self._injected.setdefault(operation, []).extend([('', stderr, status)] * count)
+
+    def reboot(self):
+        """Simulates a reboot: mappings are closed, volumes unmounted and services stopped."""
+        with self._lock:
+            self.mappings.clear()
+            self.queue_settings.clear()
+            self.mounts.clear()
+            for unit in self.services:
+                self.services[unit] = 'inactive'
+
+    def _simulate(self, operation):
+        """Counts the call, waits for the operation latency and returns the injected failure, if any."""
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            injected = self._injected.get(operation)
+            failure = injected.pop(0) if injected else None
+            if failure is None and self.random.random() < self.failure_rates.get(operation, 0):
+                failure = ('', 'Simulated random failure.', 1)
+
+        latency = self.latencies.get(operation, 0)
+        if latency:
+            time.sleep(latency)
+        return failure
+
+    def _resolve(self, device):
+        """Resolves /dev/disk/by-uuid/ paths to the simulated device path."""
+        if device.startswith('/dev/disk/by-uuid/'):
+            luks_uuid = os.path.basename(device)
+            for path, dev in self.devices.items():
+                if dev['luks'] and dev['luks']['uuid'] == luks_uuid:
+                    return path
+        return device
+
+    def _source(self, path):
+        """Returns the dictionary holding the filesystem of a device or of a mapped cryptdev."""
+        if path.startswith('/dev/mapper/'):
+            name = path[len('/dev/mapper/'):]
+            if name in self.mappings:
+                return self.devices[self.mappings[name]]['luks']
+            return None
+        return self.devices.get(self._resolve(path))
+
+    def _header_image(self, luks):
+        """Builds a deterministic LUKS1-like header image: a small header block, a pseudo-random area for
+        each keyslot and zero padding up to the payload offset, as found on a real device."""
+        header = (b'LUKS\xba\xbe\x00\x01' + luks['cipher_algorithm'].encode() + b'\x00' + luks['hash_algorithm'].encode()
+                  + b'\x00' + str(luks['keysize']).encode() + b'\x00' + luks['uuid'].encode()).ljust(4096, b'\x00')
+        # Random.randbytes equivalent, which needs Python 3.9
+        keyslots = b''.join(random.Random(hashlib.sha256(f'{luks["uuid"]}:{slot}:{secret}'.encode()).digest())
+                            .getrandbits(8 * self.KEYSLOT_AREA_SIZE).to_bytes(self.KEYSLOT_AREA_SIZE, 'little')
+                            for slot, secret in enumerate(luks['keyslots']))
+        return (header + keyslots).ljust(self.HEADER_SIZE, b'\x00')
+
+
+    #____________________________________
+    # Block devices and paths
+    def is_block_device(self, path):
+        with self._lock:
+            return self._source(path) is not None
+
+    def is_dir(self, path):
+        with self._lock:
+            return path in self.directories or path in self.mounts
+
+    def is_mount(self, path):
+        with self._lock:
+            return path in self.mounts
+
+    def mount_source(self, mountpoint):
+        with self._lock:
+            return self.mounts.get(mountpoint, '')
+
+    def makedirs(self, path):
+        with self._lock:
+            self.directories.add(path)
+
+    def block_device(self, device):
+        with self._lock:
+            path = self._resolve(device)
+            if path.startswith('/dev/mapper/'):
+                name = path[len('/dev/mapper/'):]
+                if name not in self.mappings:
+                    return None
+                return self._describe(path, self.devices[self.mappings[name]], dm_name=name)
+            if path not in self.devices:
+                return None
+            return self._describe(path, self.devices[path])
+
+    def block_devices(self):
+        with self._lock:
+            return ([self._describe(path, dev) for path, dev in self.devices.items()]
+                    + [self._describe(f'/dev/mapper/{name}', self.devices[path], dm_name=name) for name, path in self.mappings.items()])
+
+    def _describe(self, path, dev, dm_name=None):
+        """Describes a simulated block device as pyluks.inventory.BlockInventory.device does. Simulated disks
+        are non-rotational, with 512-byte sectors and no stripe geometry."""
+        holders = [name for name, source in self.mappings.items() if source == path] if dm_name is None else []
+        mountpoint = next((mp for mp, source in self.mounts.items() if source == path), None)
+        size = dev['size'] - self.HEADER_SIZE if dm_name is not None else dev['size']
+        return {'name': os.path.basename(path), 'path': path, 'devnum': '', 'type': 'dm' if dm_name else 'disk',
+                'parent': None, 'partitions': [], 'size': size, 'read_only': False, 'removable': False,
+                'rotational': False, 'logical_block_size': 512, 'physical_block_size': 512, 'minimum_io_size': 512,
+                'optimal_io_size': 0, 'discard_granularity': 0, 'holders': holders,
+                'slaves': [os.path.basename(self.mappings[dm_name])] if dm_name else [],
+                'dm_name': dm_name, 'dm_uuid': f'CRYPT-LUKS1-{dev["luks"]["uuid"].replace("-", "")}-{dm_name}' if dm_name else None,
+                'mountpoint': mountpoint, 'fstype': (dev['luks'] or {}).get('filesystem') if dm_name else dev['filesystem'],
+                'swap': False, 'luks': dev['luks'] is not None if dm_name is None else False}
+
+    def tune_block_device(self, device, settings, logger=None, tune_disks=False):
+        failure = self._simulate('tune_block_device')
+        if failure: raise TuningError(failure[1])
+        with self._lock:
+            name = self._mapping_name(device)
+            values = {setting: str(value).strip() for setting, value in settings.items()}
+            self.queue_settings.setdefault(name, {}).update(values)
+        return {setting: {'value': value, 'devices': [name], 'error': None, 'skipped': []} for setting, value in values.items()}
+
+    def block_tuning_drift(self, device, settings, tune_disks=False):
+        with self._lock:
+            name = self._mapping_name(device)
+            current = self.queue_settings.get(name, {})
+            return {setting: {'expected': str(value).strip(), 'actual': {name: current.get(setting)}}
+                    for setting, value in settings.items() if current.get(setting) != str(value).strip()}
+
+    def _mapping_name(self, device):
+        """Returns the cryptdev name of a mapped device, only mapped devices are tuned."""
+        name = device[len('/dev/mapper/'):] if device.startswith('/dev/mapper/') else device
+        if name not in self.mappings:
+            raise TuningError(f'Device {device} not found')
+        return name
+
+    def which(self, program):
+        return True
+
+    def exists(self, path):
+        with self._lock:
+            return path in self.directories or path in self.header_backups or self._source(path) is not None
+
+    def read_device(self, device, size, offset=0):
+        with self._lock:
+            dev = self.devices.get(self._resolve(device))
+            if dev is None:
+                raise FileNotFoundError(f'No such device: {device}')
+            image = self._header_image(dev['luks']) if dev['luks'] is not None else b''
+        # The data area after the header is not simulated and reads as zeros
+        return image[offset:offset + size].ljust(size, b'\x00')
+
+
+    #____________________________________
+    # cryptsetup and dmsetup
+    def luks_format(self, device, secret, cipher_algorithm, keysize, hash_algorithm, logger=None, luks_uuid=None):
+        failure = self._simulate('luks_format')
+        if failure: return failure
+        with self._lock:
+            dev = self.devices.get(device)
+            if dev is None:
+                return '', f'Device {device} does not exist or access denied.', 4
+            if any(self.mappings.get(name) == device for name in self.mappings):
+                return '', f'Cannot format device {device} which is still in use.', 5
+            luks_uuid = luks_uuid or str(uuid.UUID(int=self.random.getrandbits(128), version=4))
+            dev['luks'] = {'uuid': luks_uuid, 'keyslots': [secret], 'cipher_algorithm': cipher_algorithm,
+                           'keysize': keysize, 'hash_algorithm': hash_algorithm, 'filesystem': None}
+            dev['filesystem'] = None
+        return 'Key slot 0 created.\nCommand successful.\n', '', 0
+
+    def is_luks(self, device, logger=None):
+        failure = self._simulate('is_luks')
+        if failure: return failure
+        with self._lock:
+            dev = self.devices.get(self._resolve(device))
+            if dev is None or dev['luks'] is None:
+                return '', f'Device {device} is not a valid LUKS device.', 1
+        return '', '', 0
+
+    def luks_uuid(self, device, logger=None):
+        failure = self._simulate('luks_uuid')
+        if failure: return failure
+        with self._lock:
+            dev = self.devices.get(self._resolve(device))
+            if dev is None or dev['luks'] is None:
+                return '', f'Device {device} is not a valid LUKS device.', 1
+            return f'{dev["luks"]["uuid"]}\n', '', 0
+
+    def luks_dump(self, device, logger=None):
+        failure = self._simulate('luks_dump')
+        if failure: return failure
+        with self._lock:
+            dev = self.devices.get(self._resolve(device))
+            if dev is None or dev['luks'] is None:
+                return '', f'Device {device} is not a valid LUKS device.', 1
+            luks = dev['luks']
+            slots = ''.join(f'Key Slot {i}: {"DISABLED" if secret is None else "ENABLED"}\n' for i, secret in enumerate(luks['keyslots']))
+            return (f'LUKS header information for {device}\n\nVersion:       \t1\nCipher name:   \t{luks["cipher_algorithm"]}\n'
+                    f'Hash spec:     \t{luks["hash_algorithm"]}\nMK bits:       \t{luks["keysize"]}\nUUID:          \t{luks["uuid"]}\n\n{slots}'), '', 0
+
+    def luks_header_backup(self, device, backup_file, logger=None):
+        failure = self._simulate('luks_header_backup')
+        if failure: return failure
+        with self._lock:
+            dev = self.devices.get(self._resolve(device))
+            if dev is None or dev['luks'] is None:
+                return '', f'Device {device} is not a valid LUKS device.', 1
+            self.header_backups[backup_file] = dict(dev['luks'], keyslots=list(dev['luks']['keyslots']))
+        return 'Command successful.\n', '', 0
+
+    def luks_header_image(self, device, logger=None):
+        failure = self._simulate('luks_header_backup')
+        if failure: return (b'',) + failure[1:]
+        with self._lock:
+            dev = self.devices.get(self._resolve(device))
+            if dev is None or dev['luks'] is None:
+                return b'', f'Device {device} is not a valid LUKS device.', 1
+            return self._header_image(dev['luks']), '', 0
+
+    def luks_open(self, device, name, secret=None, logger=None):
+        failure = self._simulate('luks_open')
+        if failure: return failure
+        with self._lock:
+            path = self._resolve(device)
+            dev = self.devices.get(path)
+            if dev is None or dev['luks'] is None:
+                return '', f'Device {device} is not a valid LUKS device.', 1
+            if name in self.mappings:
+                return '', f'Device {name} already exists.', 5
+            if secret is None or secret not in dev['luks']['keyslots']:
+                return '', 'No key available with this passphrase.', 2
+            self.mappings[name] = path
+            slot = dev['luks']['keyslots'].index(secret)
+        return f'Key slot {slot} unlocked.\nCommand successful.\n', '', 0
+
+    def _luks_device(self, device):
+        dev = self.devices.get(self._resolve(device))
+        return dev['luks'] if dev is not None else None
+
+    def luks_add_key(self, device, secret, new_secret, key_slot=None, pbkdf_memory=None, logger=None):
+        failure = self._simulate('luks_add_key')
+        if failure: return failure
+        with self._lock:
+            luks = self._luks_device(device)
+            if luks is None:
+                return '', f'Device {device} is not a valid LUKS device.', 1
+            keyslots = luks['keyslots']
+            if secret is None or secret not in keyslots:
+                return '', 'No key available with this passphrase.', 2
+            free = [slot for slot in range(self.KEYSLOTS) if slot >= len(keyslots) or keyslots[slot] is None]
+            slot = key_slot if key_slot is not None else (free[0] if free else None)
+            if slot is None or slot not in free:
+                return '', 'All key slots full.' if slot is None else f'Key slot {slot} is full, please select another one.', 1
+            keyslots.extend([None] * (slot + 1 - len(keyslots)))
+            keyslots[slot] = new_secret
+        return f'Key slot {slot} created.\nCommand successful.\n', '', 0
+
+    def luks_test_passphrase(self, device, secret, key_slot=None, logger=None):
+        failure = self._simulate('luks_test_passphrase')
+        if failure: return failure
+        with self._lock:
+            luks = self._luks_device(device)
+            if luks is None:
+                return '', f'Device {device} is not a valid LUKS device.', 1
+            keyslots = luks['keyslots']
+            slots = [slot for slot, slot_secret in enumerate(keyslots) if secret is not None and slot_secret == secret
+                     and key_slot in (None, slot)]
+            if not slots:
+                return '', 'No key available with this passphrase.', 2
+        return f'Key slot {slots[0]} unlocked.\nCommand successful.\n', '', 0
+
+    def luks_kill_slot(self, device, key_slot, secret, logger=None):
+        failure = self._simulate('luks_kill_slot')
+        if failure: return failure
+        with self._lock:
+            luks = self._luks_device(device)
+            if luks is None:
+                return '', f'Device {device} is not a valid LUKS device.', 1
+            keyslots = luks['keyslots']
+            if key_slot >= len(keyslots) or keyslots[key_slot] is None:
+                return '', f'Keyslot {key_slot} is not active.', 1
+            if secret is None or secret not in keyslots[:key_slot] + keyslots[key_slot + 1:]:
+                return '', 'No key available with this passphrase.', 2
+            keyslots[key_slot] = None
+        return f'Key slot {key_slot} removed.\nCommand successful.\n', '', 0
+
+    def luks_close(self, name, logger=None):
+        failure = self._simulate('luks_close')
+        if failure: return failure
+        with self._lock:
+            if name not in self.mappings:
+                return '', f'Device {name} is not active.', 4
+            if f'/dev/mapper/{name}' in self.mounts.values():
+                return '', f'Device {name} is still in use.', 5
+            del self.mappings[name]
+            self.queue_settings.pop(name, None)
+        return '', '', 0
+
+    def luks_status(self, name, logger=None):
+        failure = self._simulate('luks_status')
+        if failure: return failure
+        with self._lock:
+            if name not in self.mappings:
+                return f'/dev/mapper/{name} is inactive.\n', '', 4
+            path = self.mappings[name]
+            luks = self.devices[path]['luks']
+            return (f'/dev/mapper/{name} is active.\n  type:    LUKS1\n  cipher:  {luks["cipher_algorithm"]}\n'
+                    f'  keysize: {luks["keysize"]} bits\n  device:  {path}\nCommand successful.\n'), '', 0
+
+    def dmsetup_info(self, name, logger=None):
+        failure = self._simulate('dmsetup_info')
+        if failure: return failure
+        with self._lock:
+            if name not in self.mappings:
+                return '', f'Device /dev/mapper/{name} not found\nCommand failed.\n', 1
+            luks_uuid = self.devices[self.mappings[name]]['luks']['uuid'].replace('-', '')
+            open_count = int(f'/dev/mapper/{name}' in self.mounts.values())
+            return (f'Name:              {name}\nState:             ACTIVE\nTables present:    LIVE\n'
+                    f'Open count:        {open_count}\nUUID: CRYPT-LUKS1-{luks_uuid}-{name}\n'), '', 0
+
+    def cipher_benchmark(self, cipher_algorithm, keysize, logger=None):
+        failure = self._simulate('cipher_benchmark')
+        if failure: return failure
+        throughput = self.CIPHER_THROUGHPUT / 1024**2
+        return (f'# Tests are approximate using memory only (no storage IO).\n'
+                f'#     Algorithm |       Key |      Encryption |      Decryption\n'
+                f'{cipher_algorithm:>15} {keysize:>9}b {throughput:>10.1f} MiB/s {throughput:>10.1f} MiB/s\n'), '', 0
+
+
+    #____________________________________
+    # Filesystems
+    def fs_type(self, device):
+        with self._lock:
+            source = self._source(device)
+            return (source or {}).get('filesystem') or ''
+
+    def mkfs(self, filesystem, device, logger=None, options=None, limits=None):
+        failure = self._simulate('mkfs')
+        if failure: return failure
+        with self._lock:
+            source = self._source(device)
+            if source is None:
+                return '', f'The file {device} does not exist and no size was specified.', 1
+            if device in self.mounts.values():
+                return '', f'{device} is mounted; will not make a filesystem here!', 1
+            source['filesystem'] = filesystem
+        return f'Creating filesystem with {filesystem}\n', '', 0
+
+    def mount(self, source, mountpoint, logger=None):
+        failure = self._simulate('mount')
+        if failure: return failure
+        with self._lock:
+            src = self._source(source)
+            if src is None:
+                return '', f'mount: {mountpoint}: special device {source} does not exist.', 32
+            if not src['filesystem']:
+                return '', f'mount: {mountpoint}: wrong fs type, bad option, bad superblock on {source}.', 32
+            if mountpoint in self.mounts:
+                return '', f'mount: {mountpoint}: {self.mounts[mountpoint]} already mounted on {mountpoint}.', 32
+            self.mounts[mountpoint] = source
+            self.directories.add(mountpoint)
+        return '', '', 0
+
+    def umount(self, mountpoint, logger=None):
+        failure = self._simulate('umount')
+        if failure: return failure
+        with self._lock:
+            if mountpoint not in self.mounts:
+                return '', f'umount: {mountpoint}: not mounted.', 32
+            del self.mounts[mountpoint]
+        return '', '', 0
+
+    def wipe(self, device, logger=None, limits=None):
+        failure = self._simulate('wipe')
+        if failure: return failure
+        with self._lock:
+            source = self._source(device)
+            if source is None:
+                return '', f"dd: failed to open '{device}': No such file or directory", 1
+            source['filesystem'] = None
+        return '', 'dd: error writing: No space left on device\n', 1
+
+
+    #____________________________________
+    # Services and tools
+    def systemctl(self, action, unit, sudo_path='', logger=None):
+        failure = self._simulate('systemctl')
+        if failure: return failure
+        with self._lock:
+            if action in ('start', 'restart'):
+                self.services[unit] = 'active'
+            elif action == 'stop':
+                self.services[unit] = 'inactive'
+            elif action == 'is-active':
+                state = self.services.get(unit, 'inactive')
+                return f'{state}\n', '', 0 if state == 'active' else 3
+        return '', '', 0
+
+    def luksctl(self, action, luksctl_cmd, sudo_path='', secret=None, cryptdev=None, logger=None):
+        """Simulates the luksctl command line tool on the simulated host, reading the encrypted device
+        information from the cryptdev .ini file in luks_cryptdev_file. The exit code is the one of luksctl.
+        """
+        failure = self._simulate('luksctl')
+        if failure: return failure
+
+        # Imported here since the luksctl subpackage depends on this module
+        from .luksctl import LUKSCtl, format_result
+        try:
+            luks = LUKSCtl(self.luks_cryptdev_file, backend=self, cryptdev=cryptdev)
+        except KeyError as e:
+            return '', f'[Error] {e.args[0]}', 1
+
+        actions = {'open': lambda: luks.open(secret=secret), 'close': luks.close, 'status': luks.status,
+                   'verify-header': luks.check_header, 'tune': luks.tune, 'verify-tuning': luks.check_tuning}
+        result = actions[action]()
+        return format_result(result), result['stderr'], result['status']
+
+    def run(self, cmd, logger=None):
+        self._simulate('run')
+        return '', '', 0
+
+
+
+################################################################################
+# DEFAULT BACKEND
+
+_default_backend = None
+
+
+def get_backend():
+    """Returns the default backend used by the device, LUKSCtl and master classes when no backend is
+    specified. A RealBackend is used unless a different one is set with the set_backend function.
+
+    :return: Default backend.
+    :rtype: Backend
+    """
+    global _default_backend
+    if _default_backend is None:
+        _default_backend = RealBackend()
+    return _default_backend
+
+
+def set_backend(backend):
+    """Sets the default backend used by the device, LUKSCtl and master classes.
+
+    :param backend: Backend object, e.g. a SimulatedBackend.
+    :type backend: Backend
+    """
+    global _default_backend
+    _default_backend = backend
@@ -0,0 +1,323 @@
+# Import dependencies
+import os
+from configparser import ConfigParser
+
+# Import internal dependencies
+from .inventory import BlockInventory
+
+
+
+################################################################################
+# VARIABLES
+
+# Settings of /sys/block/<dev>/queue, in the order they are applied: changing the scheduler resets nr_requests
+QUEUE_SETTINGS = ('scheduler', 'nr_requests', 'read_ahead_kb', 'max_sectors_kb', 'rq_affinity', 'nomerges', 'add_random')
+
+# Settings of the request queue. Bio-based device-mapper targets, such as dm-crypt, have no I/O scheduler and ignore
+# them, so they only apply to the underlying disks, which are tuned only if explicitly enabled (tune_disks)
+REQUEST_QUEUE_SETTINGS = ('scheduler', 'nr_requests', 'rq_affinity', 'nomerges', 'add_random')
+
+# Settings of the backing device (page cache writeback) in /sys/block/<dev>/bdi
+BDI_SETTINGS = ('min_ratio', 'max_ratio', 'strict_limit')
+
+# Section prefix of the tuning profiles defined in the cryptdev .ini file, e.g. [tuning:genomics]
+PROFILE_SECTION_PREFIX = 'tuning:'
+
+# Built-in tuning profiles
+TUNING_PROFILES = {
+    # Large sequential reads and writes, e.g. genomics pipelines streaming FASTQ and BAM files: a large read-ahead on
+    # the mapped device, deadline scheduling of the underlying disks, and at most half of the dirty page cache
+    # for the volume, so that a large write doesn't stall the other devices
+    'sequential': {'scheduler': 'mq-deadline', 'nr_requests': 256, 'read_ahead_kb': 4096, 'rq_affinity': 2,
+                   'add_random': 0, 'max_ratio': 50},
+    # Small random I/O, e.g. databases or many small files: no read-ahead beyond the kernel default and no scheduler
+    'random': {'scheduler': 'none', 'read_ahead_kb': 128, 'rq_affinity': 2, 'add_random': 0},
+    # Mixed workloads on shared hosts: a moderate read-ahead and the fair scheduling of the kernel defaults
+    'balanced': {'scheduler': 'mq-deadline', 'read_ahead_kb': 1024, 'rq_affinity': 1},
+}
+
+
+
+################################################################################
+# EXCEPTIONS
+
+class TuningError(Exception):
+    """Error raised when a tuning profile is invalid or the device is not found in sysfs."""
+
+
+
+################################################################################
+# FUNCTIONS
+
+def tuning_profiles(luks_cryptdev_file=None):
+    """Returns the available tuning profiles: the built-in ones (TUNING_PROFILES) and the ones defined in a
+    'tuning:<name>' section of the cryptdev .ini file, which take precedence, e.g.:
+
+    [tuning:genomics]
+    read_ahead_kb = 8192
+    scheduler = mq-deadline
+
+    :param luks_cryptdev_file: Path to the cryptdev .ini file, defaults to None (built-in profiles only)
+    :type luks_cryptdev_file: str, optional
+    :raises TuningError: Raises an error if a profile of the cryptdev .ini file has an unknown setting.
+    :return: Dictionary mapping the profile names to their settings.
+    :rtype: dict
+    """
+    profiles = {name: {setting: str(value) for setting, value in settings.items()} for name, settings in TUNING_PROFILES.items()}
+    if luks_cryptdev_file is None or not os.path.exists(luks_cryptdev_file):
+        return profiles
+
+    config = ConfigParser(interpolation=None)
+    config.read(luks_cryptdev_file)
+    for section in config.sections():
+        if not section.startswith(PROFILE_SECTION_PREFIX):
+            continue
+        settings = dict(config[section].items())
+        unknown = set(settings) - set(QUEUE_SETTINGS) - set(BDI_SETTINGS)
+        if unknown:
+            raise TuningError(f'Unknown settings in tuning profile {section[len(PROFILE_SECTION_PREFIX):]}: {", ".join(sorted(unknown))}')
+        profiles[section[len(PROFILE_SECTION_PREFIX):]] = settings
+    return profiles
+
+
+def get_profile(name, luks_cryptdev_file=None):
+    """Returns the settings of a tuning profile, see tuning_profiles.
+
+    :param name: Profile name, e.g. sequential.
+    :type name: str
+    :param luks_cryptdev_file: Path to the cryptdev .ini file holding the custom profiles, defaults to None
+    :type luks_cryptdev_file: str, optional
+    :raises TuningError: Raises an error if the profile doesn't exist.
+    :return: Dictionary mapping the sysfs settings to their values, as strings.
+    :rtype: dict
+    """
+    profiles = tuning_profiles(luks_cryptdev_file)
+    if name not in profiles:
+        raise TuningError(f'Unknown tuning profile {name}, available profiles: {", ".join(sorted(profiles))}')
+    return profiles[name]
+
+
+def format_drift(drift):
+    """Formats the drift returned by BlockTuner.drift, one line per setting and device,
+    e.g. 'read_ahead_kb: 128 on dm-0, expected 4096'."""
+    return '\n'.join(f'{setting}: {actual if actual is not None else "missing"} on {name}, expected {values["expected"]}'
+                     for setting, values in drift.items() for name, actual in values['actual'].items())
+
+
+
+################################################################################
+# BLOCK TUNER CLASS
+
+class BlockTuner:
+    """Applies the settings of a tuning profile to a block device through sysfs, typically to the device-mapper
+    device created by luksOpen. The queue settings are written to /sys/block/dm-N/queue and the bdi ones to
+    /sys/block/dm-N/bdi. If the device has no I/O scheduler, as dm-crypt devices, the request queue settings
+    (REQUEST_QUEUE_SETTINGS) only apply to the underlying disks, found following the slaves of the device (the parent
+    disk for partitions). Since changing them affects every user of the disks, they're skipped unless tune_disks
+    is set, and even then the disks backing other mounted filesystems or swaps are left untouched.
+
+    Settings are plain strings, as in sysfs. The sysfs root is the one of the inventory, so it can be pointed
+    to a fake tree, e.g. for tests.
+    """
+
+
+    def __init__(self, inventory=None, tune_disks=False):
+        """Instantiate a BlockTuner object.
+
+        :param inventory: Inventory used to find the devices in sysfs, defaults to a BlockInventory of the host
+        :type inventory: pyluks.inventory.BlockInventory, optional
+        :param tune_disks: If set to True, the request queue settings of a device without I/O scheduler are written
+            to its underlying disks, defaults to False
+        :type tune_disks: bool, optional
+        """
+        self.inventory = inventory if inventory is not None else BlockInventory()
+        self.tune_disks = tune_disks
+
+
+    #____________________________________
+    # sysfs
+    def _device_dir(self, device):
+        sysfs_dir = self.inventory.sysfs_dir(device)
+        if sysfs_dir is None:
+            raise TuningError(f'Device {device} not found in {self.inventory.sysfs_root}')
+        return sysfs_dir
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    @staticmethod
+    def _listdir(path):
+        try:
+            return sorted(os.listdir(path))
+        except OSError:
+            return []
+
+    def _schedulers(self, disk_dir):
+        """Returns the current scheduler of a disk and the available ones, from e.g. '[mq-deadline] kyber none', or
+        'none' for devices without I/O scheduler."""
+        available = (self._read(os.path.join(disk_dir, 'queue', 'scheduler')) or '').split()
+        current = next((name[1:-1] for name in available if name.startswith('[')), available[0] if len(available) == 1 else None)
+        return current, [name.strip('[]') for name in available]
+
+    def _disk_dir(self, sysfs_dir):
+        # Partitions share the queue of their disk
+        return os.path.dirname(sysfs_dir) if os.path.exists(os.path.join(sysfs_dir, 'partition')) else sysfs_dir
+
+    def _request_queue_dirs(self, sysfs_dir, seen=None):
+        """Returns the directories of the disks holding the request queues under a device: the device itself if it has
+        an I/O scheduler, otherwise its slaves, followed down stacked device-mapper devices (e.g. dm-crypt on LVM)."""
+        seen = set() if seen is None else seen
+        disk_dir = self._disk_dir(sysfs_dir)
+        if disk_dir in seen:
+            return []
+        seen.add(disk_dir)
+        slaves = self._listdir(os.path.join(sysfs_dir, 'slaves'))
+        if not slaves or set(self._schedulers(disk_dir)[1]) - {'none'}:
+            return [disk_dir]
+        dirs = []
+        for slave in slaves:
+            slave_dir = self.inventory.sysfs_dir(slave)
+            if slave_dir is not None:
+                dirs.extend(self._request_queue_dirs(slave_dir, seen))
+        return dirs
+
+    def _in_use(self, disk_dir, own):
+        """Checks if a disk, its partitions or the devices stacked on them, other than the ones in own, hold a mounted
+        filesystem or a swap."""
+        used = {mount['devnum'] for mount in self.inventory.mounts()}
+        used.update(self._read(os.path.join(self.inventory.sysfs_dir(name), 'dev')) for name in
+                    filter(None, (self.inventory.kernel_name(path) for path in self.inventory.swaps())))
+        stack, seen = [disk_dir], set()
+        while stack:
+            path = stack.pop()
+            name = os.path.basename(path)
+            if name in own or name in seen:
+                continue
+            seen.add(name)
+            if self._read(os.path.join(path, 'dev')) in used:
+                return True
+            stack.extend(os.path.join(path, part) for part in self._listdir(path)
+                         if os.path.exists(os.path.join(path, part, 'partition')))
+            stack.extend(filter(None, (self.inventory.sysfs_dir(holder) for holder in self._listdir(os.path.join(path, 'holders')))))
+        return False
+
+    def _request_queue_targets(self, sysfs_dir):
+        """Returns the directories the request queue settings of the device are written to, and the kernel names of
+        the underlying disks skipped since they back other mounted filesystems."""
+        dirs = self._request_queue_dirs(sysfs_dir)
+        if dirs == [self._disk_dir(sysfs_dir)]:
+            return dirs, [] # The device has its own request queue
+        if not self.tune_disks:
+            return [], []
+        own = {os.path.basename(sysfs_dir)}
+        skipped = [os.path.basename(disk_dir) for disk_dir in dirs if self._in_use(disk_dir, own)]
+        return [disk_dir for disk_dir in dirs if os.path.basename(disk_dir) not in skipped], skipped
+
+    def _targets(self, sysfs_dir, setting, request_queue_dirs=None):
+        """Returns the kernel names and sysfs paths a setting of the device is written to."""
+        if setting in BDI_SETTINGS:
+            return [(os.path.basename(sysfs_dir), os.path.join(sysfs_dir, 'bdi', setting))]
+        if setting not in QUEUE_SETTINGS:
+            raise TuningError(f'Unknown block device setting {setting}')
+        if setting in REQUEST_QUEUE_SETTINGS:
+            dirs = request_queue_dirs if request_queue_dirs is not None else self._request_queue_targets(sysfs_dir)[0]
+        else:
+            dirs = [self._disk_dir(sysfs_dir)]
+        return [(os.path.basename(disk_dir), os.path.join(disk_dir, 'queue', setting)) for disk_dir in dirs]
+
+    def _current(self, path, setting):
+        if setting == 'scheduler':
+            return self._schedulers(os.path.dirname(os.path.dirname(path)))[0]
+        return self._read(path)
+
+
+    #____________________________________
+    # Tuning
+    def apply(self, device, settings, logger=None):
+        """Writes the settings of a tuning profile. A setting the kernel refuses (e.g. a scheduler which is not
+        available or an nr_requests above the hardware queue depth) is reported and the other ones are still applied.
+        Request queue settings without any device to write them to, see BlockTuner, are skipped.
+
+        :param device: Device path, e.g. /dev/mapper/crypt, or kernel name.
+        :type device: str
+        :param settings: Dictionary mapping the settings to their values, as returned by get_profile.
+        :type settings: dict
+        :param logger: Logger, defaults to None
+        :type logger: logging.Logger, optional
+        :raises TuningError: Raises an error if the device is not found in sysfs or a setting is unknown.
+        :return: Dictionary mapping each setting to its value, the devices it was written to, the underlying disks
+            skipped since they back other mounted filesystems and the error, if any.
+        :rtype: dict
+        """
+        sysfs_dir = self._device_dir(device)
+        request_queue_dirs, skipped = self._request_queue_targets(sysfs_dir)
+        if skipped and logger is not None:
+            logger.warning(f'Request queue settings not applied to {", ".join(skipped)}: they back other mounted filesystems')
+        order = QUEUE_SETTINGS + BDI_SETTINGS
+        result = {}
+        for setting in sorted(settings, key=lambda setting: order.index(setting) if setting in order else len(order)):
+            value = str(settings[setting]).strip()
+            devices, errors = [], []
+            for name, path in self._targets(sysfs_dir, setting, request_queue_dirs):
+                if setting == 'scheduler' and value not in self._schedulers(os.path.dirname(os.path.dirname(path)))[1]:
+                    errors.append(f'{name}: scheduler {value} not available')
+                    continue
+                try:
+                    with open(path, 'w') as f:
+                        f.write(value)
+                    devices.append(name)
+                except OSError as e:
+                    errors.append(f'{name}: {e.strerror or e}')
+            result[setting] = {'value': value, 'devices': devices, 'error': '; '.join(errors) or None,
+                               'skipped': skipped if setting in REQUEST_QUEUE_SETTINGS else []}
+            if logger is not None:
+                if errors:
+                    logger.warning(f'{setting}={value} not applied to {device}: {"; ".join(errors)}')
+                elif devices:
+                    logger.debug(f'{setting}={value} applied to {", ".join(devices)}')
+                else:
+                    logger.debug(f'{setting}={value} skipped, {device} has no request queue and its disks are not tuned')
+        return result
+
+    def read(self, device, settings):
+        """Reads the current values of settings.
+
+        :param device: Device path, e.g. /dev/mapper/crypt, or kernel name.
+        :type device: str
+        :param settings: Setting names.
+        :type settings: list
+        :raises TuningError: Raises an error if the device is not found in sysfs or a setting is unknown.
+        :return: Dictionary mapping each setting to a dictionary of the values on each device it applies to
+            (None if the setting is missing), empty for the skipped settings, see BlockTuner.apply.
+        :rtype: dict
+        """
+        sysfs_dir = self._device_dir(device)
+        request_queue_dirs = self._request_queue_targets(sysfs_dir)[0]
+        return {setting: {name: self._current(path, setting) for name, path in self._targets(sysfs_dir, setting, request_queue_dirs)}
+                for setting in settings}
+
+    def drift(self, device, settings):
+        """Compares the current values with the settings of a tuning profile, e.g. after a udev rule or another tool
+        changed them, or after the device was opened without applying the profile.
+
+        :param device: Device path, e.g. /dev/mapper/crypt, or kernel name.
+        :type device: str
+        :param settings: Dictionary mapping the settings to their expected values, as returned by get_profile.
+        :type settings: dict
+        :raises TuningError: Raises an error if the device is not found in sysfs or a setting is unknown.
+        :return: Dictionary mapping each drifted setting to its expected value and to the differing values on each
+            device, empty if the device matches the profile.
+        :rtype: dict
+        """
+        drift = {}
+        for setting, values in self.read(device, settings).items():
+            expected = str(settings[setting]).strip()
+            actual = {name: value for name, value in values.items() if value != expected}
+            if actual:
+                drift[setting] = {'expected': expected, 'actual': actual}
+        return drift
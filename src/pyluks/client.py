@@ -0,0 +1,505 @@
+# Import dependencies
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+
+
+
+################################################################################
+# VARIABLES
+
+API_PREFIX = '/luksctl_api/v1.0'
+DEFAULT_PORT = 5000
+DEFAULT_TIMEOUT = (3.05, 30.0)  # Connect and read timeouts in seconds
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 0.2           # Seconds before the first retry, doubled at each retry
+MAX_RETRY_AFTER = 30.0          # Longest Retry-After delay honoured before retrying
+DEFAULT_MAX_WORKERS = 32
+DEFAULT_JOB_POLL_INTERVAL = 0.5
+
+# Statuses after which a request is retried: rate limited by the API or by a proxy, or temporarily unavailable
+RETRY_STATUSES = (429, 502, 503, 504)
+
+# Statuses after which a non idempotent request, e.g. /open, is retried: 429 is answered before the request is
+# processed, while a 502, 503 or 504 of a proxy may come after the API received it and consumed the wrapping token
+NON_IDEMPOTENT_RETRY_STATUSES = (429,)
+
+
+
+################################################################################
+# EXCEPTIONS
+
+class ClientError(Exception):
+    """Raised when a request to the luksctl API fails after the retries, e.g. the node can't be reached or
+    the API answers with an error status."""
+
+    def __init__(self, message, status_code=None, attempts=1):
+        super().__init__(message)
+        self.status_code = status_code
+        self.attempts = attempts
+
+
+
+################################################################################
+# RESPONSES
+
+class VolumeStatus:
+    """Volume state returned by the /status and /open endpoints of a node.
+
+    :ivar node: Node address, or the base URL of the API
+    :ivar volume_state: 'mounted', 'unmounted', 'unavailable' or, if the request failed, 'unreachable'
+    :ivar status_code: HTTP status of the response, None if no response was received
+    :ivar latency: Seconds taken by the request, retries included
+    :ivar attempts: Number of requests sent
+    :ivar error: Error message if the request failed, otherwise None
+    :ivar output: stdout of the luksctl command, for the 'unavailable' state
+    :ivar stderr: stderr of the luksctl command, for the 'unavailable' state
+    """
+
+    def __init__(self, node, volume_state, status_code=None, latency=None, attempts=1, error=None, output=None, stderr=None):
+        self.node = node
+        self.volume_state = volume_state
+        self.status_code = status_code
+        self.latency = latency
+        self.attempts = attempts
+        self.error = error
+        self.output = output
+        self.stderr = stderr
+
+    @property
+    def mounted(self): return self.volume_state == 'mounted'
+
+    @property
+    def ok(self): return self.error is None
+
+    def to_dict(self):
+        return {name: value for name, value in vars(self).items() if value is not None}
+
+    def __repr__(self):
+        return f'VolumeStatus(node={self.node!r}, volume_state={self.volume_state!r}, latency={self.latency!r})'
+
+
+class BatchResult:
+    """Results of a batch operation on many nodes, with a summary of the volume states.
+
+    :ivar results: VolumeStatus of each node, by node, in the order of the nodes
+    :ivar elapsed: Seconds taken by the whole batch
+    """
+
+    def __init__(self, results, elapsed):
+        self.results = results
+        self.elapsed = elapsed
+
+    @property
+    def summary(self):
+        """Number of nodes in each volume state."""
+        summary = {}
+        for result in self.results.values():
+            summary[result.volume_state] = summary.get(result.volume_state, 0) + 1
+        return summary
+
+    @property
+    def failed(self):
+        """Nodes whose request failed."""
+        return [node for node, result in self.results.items() if not result.ok]
+
+    @property
+    def ok(self): return not self.failed
+
+    def to_dict(self):
+        return {'nodes': {node: result.to_dict() for node, result in self.results.items()},
+                'summary': self.summary,
+                'failed': self.failed,
+                'total_nodes': len(self.results),
+                'elapsed_ms': round(self.elapsed * 1000, 3)}
+
+    def __repr__(self):
+        return f'BatchResult(summary={self.summary!r}, elapsed={self.elapsed:.3f})'
+
+
+
+################################################################################
+# FUNCTIONS
+
+def make_session(pool_size=DEFAULT_MAX_WORKERS, verify=False):
+    """Returns a requests.Session keeping up to pool_size connections alive for each node and to pool_size
+    nodes, so that consecutive requests reuse the TCP connections and TLS sessions. Retries are handled by
+    the clients, not by the connection pool.
+
+    The API uses self signed certificates by default, so the InsecureRequestWarning is silenced when a session not
+    verifying them is created. urllib3.disable_warnings silences it for the whole process, including the Vault
+    client: warnings.catch_warnings can't scope it, since it changes the process-wide filters and the requests are
+    sent by concurrent threads.
+
+    :param pool_size: Maximum number of connections kept, defaults to 32
+    :type pool_size: int, optional
+    :param verify: TLS certificate verification, True, False or the path of a CA bundle, defaults to False
+    :type verify: bool or str, optional
+    :return: Session with keep-alive connection pools.
+    :rtype: requests.Session
+    """
+    if verify is False:
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.verify = verify
+    return session
+
+
+def _retry_delay(response, attempt, backoff):
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), MAX_RETRY_AFTER)
+        except ValueError:
+            pass
+    return backoff * 2 ** attempt
+
+
+def _not_sent(error):
+    """Returns True if a connection error was raised before the connection was established, e.g. connection refused
+    or connect timeout, so that the request was never received by the API."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    reason = getattr(reason, 'reason', reason) # urllib3 MaxRetryError wrapping the cause
+    # NewConnectionError, raised when the connection is refused, is a subclass of ConnectTimeoutError
+    return isinstance(reason, urllib3.exceptions.ConnectTimeoutError)
+
+
+
+################################################################################
+# CLIENT CLASSES
+
+class LuksctlClient:
+    """Client of the luksctl API of a node. Requests are sent on a keep-alive connection pool, with per-call
+    timeouts and retries: /status requests are retried on any connection error, /open requests only if they
+    could not be sent, since the wrapping token is consumed once the request has been received. Requests
+    rejected with 429 are retried after the Retry-After delay, as well as /status requests answered with
+    502, 503 or 504.
+    """
+
+
+    def __init__(self, base_url, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF,
+                 verify=False, session=None, node=None):
+        """Instantiate a LuksctlClient object.
+
+        :param base_url: URL of the API, e.g. 'https://10.0.0.2:5000'
+        :type base_url: str
+        :param timeout: Timeout in seconds, or (connect, read) timeouts, defaults to (3.05, 30.0)
+        :type timeout: float or tuple, optional
+        :param retries: Number of retries of a failed request, defaults to 2
+        :type retries: int, optional
+        :param backoff: Seconds before the first retry, doubled at each retry, defaults to 0.2
+        :type backoff: float, optional
+        :param verify: TLS certificate verification, True, False or the path of a CA bundle, defaults to False
+        :type verify: bool or str, optional
+        :param session: Session used for the requests, e.g. shared by many clients, defaults to a new one
+        :type session: requests.Session, optional
+        :param node: Node name reported in the responses, defaults to base_url
+        :type node: str, optional
+        """
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.node = node if node is not None else self.base_url
+        self._own_session = session is None
+        self.session = session if session is not None else make_session(pool_size=4, verify=verify)
+
+
+    def close(self):
+        if self._own_session:
+            self.session.close()
+
+    def __enter__(self): return self
+    def __exit__(self, *exc_info): self.close()
+
+
+    #____________________________________
+    # Requests
+    def request(self, method, path, timeout=None, retries=None, idempotent=True, **kwargs):
+        """Sends a request to the API, retrying it if it fails.
+
+        :param method: HTTP method, e.g. 'GET'
+        :type method: str
+        :param path: Path relative to the API prefix, e.g. '/status'
+        :type path: str
+        :param timeout: Timeout of this request, defaults to the timeout of the client
+        :type timeout: float or tuple, optional
+        :param retries: Retries of this request, defaults to the retries of the client
+        :type retries: int, optional
+        :param idempotent: If set to False, the request is retried only if it could not be sent or was rejected
+                           with 429, defaults to True
+        :type idempotent: bool, optional
+        :raises ClientError: Raises an error if the request fails after the retries.
+        :return: Tuple containing the response, the seconds taken and the number of requests sent.
+        :rtype: tuple
+        """
+        timeout = timeout if timeout is not None else self.timeout
+        retries = retries if retries is not None else self.retries
+        url = f'{self.base_url}{API_PREFIX}{path}'
+
+        start = time.monotonic()
+        for attempt in range(retries + 1):
+            response = None
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+            except requests.ConnectionError as e:
+                # Connection refused or reset, the request may have been received only if the connection was established
+                error, retriable = e, idempotent or _not_sent(e)
+            except requests.RequestException as e:
+                error, retriable = e, idempotent
+            else:
+                if response.status_code not in (RETRY_STATUSES if idempotent else NON_IDEMPOTENT_RETRY_STATUSES):
+                    return response, time.monotonic() - start, attempt + 1
+                error = ClientError(f'{method} {url} returned {response.status_code}', status_code=response.status_code)
+                retriable = True
+
+            if not retriable or attempt == retries:
+                break
+            time.sleep(_retry_delay(response, attempt, self.backoff))
+
+        if isinstance(error, ClientError):
+            error.attempts = attempt + 1
+            raise error
+        raise ClientError(f'{method} {url} failed: {error}', attempts=attempt + 1) from error
+
+    def _volume_status(self, response, latency, attempts):
+        if response.status_code >= 400:
+            return VolumeStatus(self.node, 'unreachable', status_code=response.status_code, latency=latency, attempts=attempts,
+                                error=f'HTTP {response.status_code}')
+        try:
+            body = response.json()
+        except ValueError:
+            return VolumeStatus(self.node, 'unreachable', status_code=response.status_code, latency=latency, attempts=attempts,
+                                error='Invalid JSON response')
+        return VolumeStatus(self.node, body.get('volume_state', 'unavailable'), status_code=response.status_code, latency=latency,
+                            attempts=attempts, output=body.get('output'), stderr=body.get('stderr'))
+
+    def _failed(self, error, start):
+        return VolumeStatus(self.node, 'unreachable', status_code=getattr(error, 'status_code', None),
+                            latency=time.monotonic() - start, attempts=error.attempts, error=str(error))
+
+
+    #____________________________________
+    # Endpoints
+    def status(self, cryptdev=None, timeout=None, retries=None):
+        """Returns the state of a volume of the node. Failures are reported in the result, not raised.
+
+        :param cryptdev: Cryptdev name, LUKS UUID, device or mountpoint of the volume, defaults to the default volume
+        :type cryptdev: str, optional
+        :param timeout: Timeout of this request, defaults to the timeout of the client
+        :type timeout: float or tuple, optional
+        :param retries: Retries of this request, defaults to the retries of the client
+        :type retries: int, optional
+        :return: The volume state, 'unreachable' if the request failed.
+        :rtype: pyluks.client.VolumeStatus
+        """
+        start = time.monotonic()
+        params = {'cryptdev': cryptdev} if cryptdev is not None else None
+        try:
+            return self._volume_status(*self.request('GET', '/status', timeout=timeout, retries=retries, params=params))
+        except ClientError as e:
+            return self._failed(e, start)
+
+    def open(self, vault_url, vault_token, secret_root, secret_path, secret_key, cryptdev=None, timeout=None, retries=None):
+        """Opens a volume of the node with the passphrase stored in Vault. Failures are reported in the result, not raised.
+
+        :param vault_url: URL to Vault server
+        :type vault_url: str
+        :param vault_token: Wrapping token used to read the passphrase from Vault
+        :type vault_token: str
+        :param secret_root: Vault root in which secrets are stored, e.g. 'secrets'
+        :type secret_root: str
+        :param secret_path: Vault path in which the passphrase is stored.
+        :type secret_path: str
+        :param secret_key: Vault key associated to the passphrase.
+        :type secret_key: str
+        :param cryptdev: Cryptdev name, LUKS UUID, device or mountpoint of the volume, defaults to the default volume
+        :type cryptdev: str, optional
+        :return: The volume state after the open, 'unreachable' if the request failed.
+        :rtype: pyluks.client.VolumeStatus
+        """
+        start = time.monotonic()
+        payload = {'vault_url': vault_url, 'vault_token': vault_token, 'secret_root': secret_root,
+                   'secret_path': secret_path, 'secret_key': secret_key}
+        if cryptdev is not None:
+            payload['cryptdev'] = cryptdev
+        try:
+            return self._volume_status(*self.request('POST', '/open', timeout=timeout, retries=retries, idempotent=False, json=payload))
+        except ClientError as e:
+            return self._failed(e, start)
+
+    def open_async(self, vault_url, vault_token, secret_root, secret_path, secret_key, cryptdev=None, timeout=None, retries=None):
+        """Submits the open of a volume as an asynchronous job of the node, refer to LuksctlClient.open.
+
+        :raises ClientError: Raises an error if the job can't be submitted.
+        :return: Job id.
+        :rtype: str
+        """
+        payload = {'vault_url': vault_url, 'vault_token': vault_token, 'secret_root': secret_root,
+                   'secret_path': secret_path, 'secret_key': secret_key, 'async': True}
+        if cryptdev is not None:
+            payload['cryptdev'] = cryptdev
+        response, _, _ = self.request('POST', '/open', timeout=timeout, retries=retries, idempotent=False, json=payload)
+        if response.status_code != 202:
+            raise ClientError(f'Asynchronous open returned {response.status_code}', status_code=response.status_code)
+        return response.json()['job_id']
+
+    def job(self, job_id, timeout=None, retries=None):
+        """Returns the record of an asynchronous job of the node.
+
+        :raises ClientError: Raises an error if the job doesn't exist or the request fails.
+        :return: Job record, with its state, phases and result.
+        :rtype: dict
+        """
+        response, _, _ = self.request('GET', f'/jobs/{job_id}', timeout=timeout, retries=retries)
+        if response.status_code != 200:
+            raise ClientError(f'Job {job_id} returned {response.status_code}', status_code=response.status_code)
+        return response.json()
+
+    def wait_job(self, job_id, timeout=600.0, poll_interval=DEFAULT_JOB_POLL_INTERVAL):
+        """Polls an asynchronous job until it completes.
+
+        :param job_id: Job id, as returned by LuksctlClient.open_async
+        :type job_id: str
+        :param timeout: Maximum seconds to wait, defaults to 600.0
+        :type timeout: float, optional
+        :raises TimeoutError: Raises an error if the job doesn't complete in time.
+        :return: Job record of the completed job.
+        :rtype: dict
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.job(job_id)
+            if job['state'] in ('succeeded', 'failed'):
+                return job
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'Job {job_id} not completed after {timeout} seconds.')
+            time.sleep(poll_interval)
+
+    def wait_status_change(self, cursor=None, cryptdev=None, wait=30.0):
+        """Long polls the status stream of the node, returning when a volume state changes after cursor.
+
+        :param cursor: Version returned by the previous call, defaults to None, i.e. return the current states
+        :type cursor: int, optional
+        :param cryptdev: Volume to watch, defaults to all the volumes
+        :type cryptdev: str, optional
+        :param wait: Maximum seconds the API waits for a change, defaults to 30.0
+        :type wait: float, optional
+        :raises ClientError: Raises an error if the request fails.
+        :return: Dictionary containing the version, to be passed as next cursor, and the volume states.
+        :rtype: dict
+        """
+        params = {'timeout': wait}
+        if cursor is not None:
+            params['cursor'] = cursor
+        if cryptdev is not None:
+            params['cryptdev'] = cryptdev
+        connect_timeout = self.timeout[0] if isinstance(self.timeout, tuple) else self.timeout
+        response, _, _ = self.request('GET', '/status/stream', timeout=(connect_timeout, wait + 10), params=params)
+        if response.status_code != 200:
+            raise ClientError(f'Status stream returned {response.status_code}', status_code=response.status_code)
+        return response.json()
+
+
+
+class ClusterClient:
+    """Client of the luksctl API of many nodes, sharing a keep-alive connection pool. Batch operations run the
+    requests concurrently on at most max_workers threads and aggregate the results in a BatchResult.
+    """
+
+
+    def __init__(self, nodes, url_template=f'https://{{node}}:{DEFAULT_PORT}', max_workers=DEFAULT_MAX_WORKERS,
+                 timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, verify=False):
+        """Instantiate a ClusterClient object.
+
+        :param nodes: Node addresses, duplicates are ignored.
+        :type nodes: list
+        :param url_template: URL of the API of each node, where '{node}' is replaced by the node address, defaults to 'https://{node}:5000'
+        :type url_template: str, optional
+        :param max_workers: Maximum number of concurrent requests, defaults to 32
+        :type max_workers: int, optional
+        :param timeout: Timeout of each request, refer to LuksctlClient, defaults to (3.05, 30.0)
+        :type timeout: float or tuple, optional
+        :param retries: Number of retries of a failed request, defaults to 2
+        :type retries: int, optional
+        :param backoff: Seconds before the first retry, doubled at each retry, defaults to 0.2
+        :type backoff: float, optional
+        :param verify: TLS certificate verification, True, False or the path of a CA bundle, defaults to False
+        :type verify: bool or str, optional
+        """
+        self.nodes = [node for node in dict.fromkeys(nodes) if node]
+        self.max_workers = max_workers
+        # A pool per node, each keeping the connections of up to max_workers concurrent requests
+        self.session = make_session(pool_size=max(max_workers, len(self.nodes), 1), verify=verify)
+        self.clients = {node: LuksctlClient(url_template.format(node=node), timeout=timeout, retries=retries, backoff=backoff,
+                                            session=self.session, node=node)
+                        for node in self.nodes}
+
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self): return self
+    def __exit__(self, *exc_info): self.close()
+
+    def client(self, node):
+        """Returns the LuksctlClient of a node."""
+        return self.clients[node]
+
+
+    def map(self, function, nodes=None):
+        """Calls function(client) for the client of each node concurrently, on at most max_workers threads.
+
+        :param function: Function called with the LuksctlClient of each node, returning a VolumeStatus.
+        :type function: function
+        :param nodes: Nodes to run the function on, defaults to all the nodes
+        :type nodes: list, optional
+        :return: The results of each node.
+        :rtype: pyluks.client.BatchResult
+        """
+        nodes = self.nodes if nodes is None else nodes
+        start = time.monotonic()
+        if nodes:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(nodes))) as executor:
+                results = dict(zip(nodes, executor.map(lambda node: function(self.clients[node]), nodes)))
+        else:
+            results = {}
+        return BatchResult(results, time.monotonic() - start)
+
+    def status_all(self, cryptdev=None, nodes=None, timeout=None, retries=None):
+        """Returns the state of a volume of every node, refer to LuksctlClient.status.
+
+        :return: The volume state of each node.
+        :rtype: pyluks.client.BatchResult
+        """
+        return self.map(lambda client: client.status(cryptdev=cryptdev, timeout=timeout, retries=retries), nodes=nodes)
+
+    def open_all(self, credentials, cryptdev=None, nodes=None, timeout=None, retries=None):
+        """Opens a volume on every node, refer to LuksctlClient.open. Each node needs its own wrapping token,
+        so the Vault parameters are given per node.
+
+        :param credentials: Function returning, for a node, a dictionary with the vault_url, vault_token, secret_root,
+                            secret_path and secret_key arguments of LuksctlClient.open; or a dictionary of such dictionaries by node.
+        :type credentials: function or dict
+        :param cryptdev: Cryptdev name, LUKS UUID, device or mountpoint of the volume, defaults to the default volume
+        :type cryptdev: str, optional
+        :return: The volume state of each node after the open, nodes without Vault parameters are reported as failed
+                 without sending a request.
+        :rtype: pyluks.client.BatchResult
+        """
+        get_credentials = credentials.get if isinstance(credentials, dict) else credentials
+
+        def open_node(client):
+            node_credentials = get_credentials(client.node)
+            if node_credentials is None:
+                return VolumeStatus(client.node, 'unreachable', latency=0.0, attempts=0, error='No Vault parameters for the node')
+            return client.open(cryptdev=cryptdev, timeout=timeout, retries=retries, **node_credentials)
+
+        return self.map(open_node, nodes=nodes)
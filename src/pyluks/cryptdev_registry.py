@@ -0,0 +1,232 @@
+# Import dependencies
+import os
+import io
+import fcntl
+from contextlib import contextmanager
+from configparser import ConfigParser
+
+# Import internal dependencies
+from .utilities import write_file_atomically, DEFAULT_CRYPTDEV_FILE
+
+
+
+################################################################################
+# VARIABLES
+
+# The first volume is stored in the 'luks' section, as in the single-volume cryptdev .ini file,
+# the others in a 'luks:<cryptdev>' section each.
+DEFAULT_VOLUME_SECTION = 'luks'
+VOLUME_SECTION_PREFIX = 'luks:'
+
+
+
+################################################################################
+# EXCEPTIONS
+
+class RegistryError(Exception):
+    """Error raised when a volume can't be added to the cryptdev registry."""
+
+
+
+################################################################################
+# CRYPTDEV REGISTRY CLASS
+
+class CryptdevRegistry:
+    """Registry of the encrypted volumes of a host, stored in the cryptdev .ini file. Volumes are indexed by
+    cryptdev name, LUKS UUID, device path and mountpoint, so each lookup is a dictionary access.
+
+    Single-volume cryptdev .ini files, with only the 'luks' section, are read as a registry with one volume and
+    are written unchanged as long as no other volume is added. Changes are applied to the file under an exclusive
+    lock: the file is read again, only the sections of the affected volumes are modified and the file is atomically
+    replaced, so that the other sections (e.g. logs and luksctl_api) and concurrent changes are preserved.
+    """
+
+
+    def __init__(self, luks_cryptdev_file=DEFAULT_CRYPTDEV_FILE):
+        """Instantiate a CryptdevRegistry object, loading the volumes from the cryptdev .ini file if it exists.
+
+        :param luks_cryptdev_file: Path to the cryptdev .ini file, defaults to '/etc/luks/luks-cryptdev.ini'
+        :type luks_cryptdev_file: str, optional
+        """
+        self.luks_cryptdev_file = luks_cryptdev_file
+        self._load(self._read())
+
+
+    #____________________________________
+    # Loading and indexing
+    def _read(self):
+        config = ConfigParser(interpolation=None)
+        if os.path.exists(self.luks_cryptdev_file):
+            config.read(self.luks_cryptdev_file)
+        return config
+
+    def _load(self, config):
+        """Builds the indexes from the volume sections of the configuration."""
+        self._volumes = {}   # cryptdev -> volume
+        self._sections = {}  # cryptdev -> section name
+        self._by_uuid = {}
+        self._by_device = {}
+        self._by_mountpoint = {}
+        self._default = None
+        self._config = config
+
+        for section in config.sections():
+            if section != DEFAULT_VOLUME_SECTION and not section.startswith(VOLUME_SECTION_PREFIX):
+                continue
+            volume = dict(config[section].items())
+            cryptdev = volume.get('cryptdev') or section[len(VOLUME_SECTION_PREFIX):]
+            self._volumes[cryptdev] = volume
+            self._sections[cryptdev] = section
+            for index, key in ((self._by_uuid, 'uuid'), (self._by_device, 'device')):
+                if volume.get(key):
+                    index[volume[key]] = cryptdev
+            if volume.get('mountpoint'):
+                self._by_mountpoint[os.path.normpath(volume['mountpoint'])] = cryptdev
+            if section == DEFAULT_VOLUME_SECTION or self._default is None:
+                self._default = cryptdev
+
+    def reload(self):
+        """Reads the volumes from the cryptdev .ini file again."""
+        self._load(self._read())
+
+
+    #____________________________________
+    # Lookups
+    def __len__(self): return len(self._volumes)
+    def __iter__(self): return iter(self.volumes())
+    def __contains__(self, cryptdev): return cryptdev in self._volumes
+
+    def names(self):
+        """Returns the cryptdev names of the registered volumes, the default one first."""
+        return sorted(self._volumes, key=lambda cryptdev: cryptdev != self._default)
+
+    def volumes(self):
+        """Returns the registered volumes, the default one first."""
+        return [dict(self._volumes[cryptdev]) for cryptdev in self.names()]
+
+    def get(self, cryptdev=None):
+        """Returns a volume by cryptdev name.
+
+        :param cryptdev: Cryptdev name, defaults to the default volume, i.e. the one in the 'luks' section
+        :type cryptdev: str, optional
+        :raises KeyError: Raises an error if the volume is not registered.
+        :return: Dictionary containing the information of the volume, e.g. device, uuid, mountpoint.
+        :rtype: dict
+        """
+        if cryptdev is None:
+            cryptdev = self._default
+        if cryptdev not in self._volumes:
+            raise KeyError(f'Volume {cryptdev} not found in {self.luks_cryptdev_file}')
+        return dict(self._volumes[cryptdev])
+
+    def by_uuid(self, luks_uuid): return self.get(self._by_uuid[luks_uuid])
+    def by_device(self, device): return self.get(self._by_device[device])
+    def by_mountpoint(self, mountpoint): return self.get(self._by_mountpoint[os.path.normpath(mountpoint)])
+
+    def lookup(self, key=None):
+        """Returns a volume given any of its identifiers: cryptdev name, mapper path, LUKS UUID, device path
+        or mountpoint.
+
+        :param key: Volume identifier, defaults to the default volume
+        :type key: str, optional
+        :raises KeyError: Raises an error if no volume matches the identifier.
+        :return: Dictionary containing the information of the volume.
+        :rtype: dict
+        """
+        if key is None or key in self._volumes:
+            return self.get(key)
+        if key.startswith('/dev/mapper/'):
+            return self.get(key[len('/dev/mapper/'):])
+        for index in (self._by_uuid, self._by_device):
+            if key in index:
+                return self.get(index[key])
+        if os.path.normpath(key) in self._by_mountpoint:
+            return self.get(self._by_mountpoint[os.path.normpath(key)])
+        raise KeyError(f'Volume {key} not found in {self.luks_cryptdev_file}')
+
+
+    #____________________________________
+    # Changes
+    @contextmanager
+    def _locked_config(self):
+        """Yields the configuration read again under an exclusive lock, then atomically writes it and updates the indexes."""
+        directory = os.path.dirname(os.path.abspath(self.luks_cryptdev_file))
+        os.makedirs(directory, exist_ok=True)
+        lock_path = os.path.join(directory, f'.{os.path.basename(self.luks_cryptdev_file)}.lock')
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                config = self._read()
+                yield config
+                content = io.StringIO()
+                config.write(content)
+                write_file_atomically(self.luks_cryptdev_file, content.getvalue())
+                self._load(config)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def add(self, volume):
+        """Adds a volume to the registry, or replaces the volume with the same cryptdev name. Stale volumes
+        registered on the same device or with the same LUKS UUID are removed.
+
+        :param volume: Dictionary containing the information of the volume, at least cryptdev, device, uuid and mountpoint.
+        :type volume: dict
+        :raises RegistryError: Raises an error if the mountpoint is used by another volume.
+        """
+        volume = {key: str(value) for key, value in volume.items() if value is not None}
+        cryptdev = volume['cryptdev']
+
+        with self._locked_config() as config:
+            self._load(config)
+
+            owner = self._by_mountpoint.get(os.path.normpath(volume.get('mountpoint', '')))
+            if owner is not None and owner != cryptdev and self._volumes[owner].get('device') != volume.get('device'):
+                raise RegistryError(f'Mountpoint {volume["mountpoint"]} is already used by volume {owner}')
+
+            stale = {self._by_device.get(volume.get('device')), self._by_uuid.get(volume.get('uuid')), owner} - {None, cryptdev}
+            for name in stale:
+                config.remove_section(self._sections[name])
+
+            if cryptdev in self._sections:
+                section = self._sections[cryptdev]
+            elif not config.has_section(DEFAULT_VOLUME_SECTION):
+                section = DEFAULT_VOLUME_SECTION # First volume, written as in a single-volume cryptdev .ini file
+            else:
+                section = VOLUME_SECTION_PREFIX + cryptdev
+            config.remove_section(section)
+            config[section] = volume
+
+    def remove(self, cryptdev):
+        """Removes a volume from the registry. If it's the default volume, the next one becomes the default.
+
+        :param cryptdev: Cryptdev name.
+        :type cryptdev: str
+        :raises KeyError: Raises an error if the volume is not registered.
+        """
+        with self._locked_config() as config:
+            self._load(config)
+            if cryptdev not in self._sections:
+                raise KeyError(f'Volume {cryptdev} not found in {self.luks_cryptdev_file}')
+            config.remove_section(self._sections[cryptdev])
+            if self._sections[cryptdev] == DEFAULT_VOLUME_SECTION:
+                following = [name for name in self.names() if name != cryptdev]
+                if following:
+                    config[DEFAULT_VOLUME_SECTION] = dict(config[self._sections[following[0]]].items())
+                    config.remove_section(self._sections[following[0]])
+
+    def set_defaults(self, section, values):
+        """Adds the missing keys of a non-volume section, e.g. logs, without changing the existing ones.
+
+        :param section: Section name.
+        :type section: str
+        :param values: Dictionary containing the default values.
+        :type values: dict
+        """
+        if self._config.has_section(section) and all(self._config.has_option(section, key) for key in values):
+            return # Already set when the registry was last read or written
+        with self._locked_config() as config:
+            if not config.has_section(section):
+                config.add_section(section)
+            for key, value in values.items():
+                if not config.has_option(section, key):
+                    config[section][key] = str(value)
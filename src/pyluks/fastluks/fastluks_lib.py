@@ -3,15 +3,23 @@ import random
 from string import ascii_letters, digits, ascii_lowercase
 import os
 import sys
-from pathlib import Path
 from datetime import datetime
-import re
+import tempfile
+import threading
+import uuid
 import distro
-from configparser import ConfigParser
+from concurrent.futures import ThreadPoolExecutor
 
 # Import internal dependencies
-from ..utilities import run_command, create_logger, DEFAULT_LOGFILES
-from ..vault_support import write_secret_to_vault
+from ..utilities import LazyLogger, DEFAULT_LOGFILES
+from ..vault_support import write_secret_to_vault, read_secret
+from ..backends import get_backend
+from ..header_store import HeaderStore, HeaderStoreError
+from ..cryptdev_registry import CryptdevRegistry, RegistryError
+from ..inventory import is_candidate, mkfs_options
+from ..block_tuning import TuningError, get_profile
+from .state import RunState, DEFAULT_STATE_FILE
+from .plan import BenchmarkCache, DEFAULT_BENCHMARK_CACHE, RESOURCES, measure_throughput, estimate_seconds, wipe_resource
 
 
 
@@ -22,6 +30,20 @@ alphanum = ascii_letters + digits
 #now = datetime.now().strftime('-%b-%d-%y-%H%M%S')
 # Get Distribution
 # Ubuntu, centos, rocky currently supported
+DISTNAME = None # Read on first use
+
+def get_distname():
+    """Returns the distribution id, e.g. ubuntu, read with distro.id() on the first call.
+
+    :return: Distribution id.
+    :rtype: str
+    """
+    global DISTNAME
+    if DISTNAME is None:
+        DISTNAME = distro.id()
+    return DISTNAME
+
+
 def check_distro(function):
     """Decorator function to check that the wrapped function is run on Ubuntu or CentOS.
 
@@ -31,12 +53,10 @@ def check_distro(function):
     :return: Wrapper function
     :rtype: function
     """
-    global DISTNAME
-    DISTNAME = distro.id()
     def wrapper_function(*args, **kwargs):
-        if DISTNAME not in ['ubuntu','centos','rocky']:
+        if get_distname() not in ['ubuntu','centos','rocky']:
             raise Exception('Distribution not supported: Ubuntu, CentOS 7, and RockyLinux 9 currently supported')
-        return function()
+        return function(*args, **kwargs)
     return wrapper_function
 
 
@@ -46,10 +66,10 @@ def check_distro(function):
 
 LOGGER_NAME = 'fastluks'
 
-# Instantiate the logger
-fastluks_logger = create_logger(luks_cryptdev_file='/etc/luks/luks-cryptdev.ini',
-                                logger_name=LOGGER_NAME,
-                                loggers_section='logs')
+# The logger is created on first use, not at import time
+fastluks_logger = LazyLogger(luks_cryptdev_file='/etc/luks/luks-cryptdev.ini',
+                             logger_name=LOGGER_NAME,
+                             loggers_section='logs')
 
 
 
@@ -75,41 +95,59 @@ def create_random_cryptdev_name(n=8):
 
 
 @check_distro
-def install_cryptsetup(logger=None):
+def install_cryptsetup(logger=None, backend=None):
     """Install the cryptsetup command line tool, used to interface with dm-crypt for creating,
     accessing and managing encrypted devices. It uses either apt or yum depending on the Linux distribution.
 
     :param logger: Logger object used to log information about the installation of cryptsetup, defaults to None
     :type logger: logging.Logger, optional
+    :param backend: Execution backend used to run the package manager, defaults to the backend returned by pyluks.backends.get_backend
+    :type backend: pyluks.backends.Backend, optional
     """
-    if DISTNAME == 'ubuntu':
+    backend = backend if backend is not None else get_backend()
+    if get_distname() == 'ubuntu':
         fastluks_logger.info('Distribution: Ubuntu. Using apt.')
-        run_command('apt-get install -y cryptsetup pv', logger)
+        backend.run(['apt-get', 'install', '-y', 'cryptsetup', 'pv'], logger)
     else:
         fastluks_logger.info('Distribution: CentOS or RockyLinux. Using yum.')
-        run_command('yum install -y cryptsetup-luks pv', logger)
+        backend.run(['yum', 'install', '-y', 'cryptsetup-luks', 'pv'], logger)
 
 
 @check_distro
-def check_cryptsetup():
-    """Checks if the dm-crypt module and cryptsetup are installed.
+def install_dmsetup(logger=None, backend=None):
+    """Install the dmsetup command line tool. It uses either apt or yum depending on the Linux distribution.
+
+    :param logger: Logger object used to log information about the installation of dmsetup, defaults to None
+    :type logger: logging.Logger, optional
+    :param backend: Execution backend used to run the package manager, defaults to the backend returned by pyluks.backends.get_backend
+    :type backend: pyluks.backends.Backend, optional
     """
+    backend = backend if backend is not None else get_backend()
+    if get_distname() == 'ubuntu':
+        backend.run(['apt-get', 'install', '-y', 'dmsetup'], logger)
+    else:
+        backend.run(['yum', 'install', '-y', 'device-mapper'], logger)
+
+
+def check_cryptsetup(backend=None):
+    """Checks if the dm-crypt module and cryptsetup are installed. Missing tools are installed on supported
+    distributions only.
+
+    :param backend: Execution backend on which the tools are looked for, defaults to the backend returned by pyluks.backends.get_backend
+    :type backend: pyluks.backends.Backend, optional
+    """
+    backend = backend if backend is not None else get_backend()
     fastluks_logger.info('Check if the required applications are installed...')
     
-    _, _, dmsetup_status = run_command('type -P dmsetup &>/dev/null')
-    if dmsetup_status != 0:
+    if not backend.which('dmsetup'):
         fastluks_logger.info('dmsetup is not installed. Installing...')
-        if DISTNAME == 'ubuntu':
-            run_command('apt-get install -y dmsetup')
-        else:
-            run_command('yum install -y device-mapper')
+        install_dmsetup(logger=fastluks_logger, backend=backend)
     else:
         fastluks_logger.info('dmsetup is already installed.')
     
-    _, _, cryptsetup_status = run_command('type -P cryptsetup &>/dev/null')
-    if cryptsetup_status != 0:
+    if not backend.which('cryptsetup'):
         fastluks_logger.info('cryptsetup is not installed. Installing...')
-        install_cryptsetup(logger=fastluks_logger)
+        install_cryptsetup(logger=fastluks_logger, backend=backend)
         fastluks_logger.info('cryptsetup installed.')
     else:
         fastluks_logger.info('cryptsetup is already installed.')
@@ -152,19 +190,63 @@ def end_volume_setup_procedure(SUCCESS_FILE):
     fastluks_logger.info('SUCCESSFUL.')
 
 
-def read_ini_file(cryptdev_ini_file):
-    """Reads the cryptdev .ini file. Returns a dictionary containing the information of the encrypted
+def read_ini_file(cryptdev_ini_file, cryptdev=None):
+    """Reads the cryptdev .ini file. Returns a dictionary containing the information of an encrypted
     device written in the .ini file.
 
     :param cryptdev_ini_file: Path to the cryptdev .ini file
     :type cryptdev_ini_file: str
+    :param cryptdev: Cryptdev name, LUKS UUID, device or mountpoint of the volume, defaults to the volume in the 'luks' section
+    :type cryptdev: str, optional
+    :raises KeyError: Raises an error if the volume is not found in the .ini file.
     :return: Dictionary containing informations about the encrypted device in key-value pairs
     :rtype: dict
     """
-    config = ConfigParser()
-    config.read_file(open(cryptdev_ini_file))
-    luks_section = config['luks']
-    return {key:luks_section[key] for key in luks_section}
+    if not os.path.exists(cryptdev_ini_file):
+        raise FileNotFoundError(f'Cryptdev ini file {cryptdev_ini_file} missing.')
+    return CryptdevRegistry(cryptdev_ini_file).lookup(cryptdev)
+
+
+#____________________________________
+# Device discovery
+def find_candidate_devices(backend=None):
+    """Lists the unused whole disks which can be encrypted: the candidates found in the block device inventory
+    (see pyluks.inventory.is_candidate) without a LUKS header or a filesystem.
+
+    :param backend: Execution backend used to describe the block devices, defaults to the backend returned by pyluks.backends.get_backend
+    :type backend: pyluks.backends.Backend, optional
+    :return: List of dictionaries describing the candidate disks, as returned by pyluks.inventory.BlockInventory.device
+    :rtype: list
+    """
+    backend = backend if backend is not None else get_backend()
+    candidates = []
+    for block_device in backend.block_devices():
+        if not is_candidate(block_device):
+            continue
+        if block_device['luks'] is None: # Signature not readable, ask cryptsetup
+            block_device['luks'] = backend.is_luks(block_device['path'])[2] == 0
+        if block_device['luks'] or backend.fs_type(block_device['path']):
+            continue
+        candidates.append(block_device)
+    return candidates
+
+
+def discover_device(backend=None):
+    """Returns the path of the disk to be encrypted when it's not specified, i.e. the only candidate
+    returned by find_candidate_devices.
+
+    :param backend: Execution backend used to describe the block devices, defaults to the backend returned by pyluks.backends.get_backend
+    :type backend: pyluks.backends.Backend, optional
+    :raises LUKSError: Raises an error if there isn't exactly one candidate disk.
+    :return: Device path, e.g. /dev/vdb
+    :rtype: str
+    """
+    candidates = find_candidate_devices(backend)
+    if len(candidates) != 1:
+        found = ', '.join(candidate['path'] for candidate in candidates) or 'none'
+        raise LUKSError(f'Unable to choose the device to encrypt, unused disks found: {found}. Please specify the device.')
+    fastluks_logger.info(f'Device discovered: {candidates[0]["path"]}')
+    return candidates[0]['path']
 
 
 
@@ -177,7 +259,8 @@ class device:
 
 
     def __init__(self, device_name, cryptdev, mountpoint, filesystem,
-                 cipher_algorithm='aes-xts-plain64', keysize=256, hash_algorithm='sha256'):
+                 cipher_algorithm='aes-xts-plain64', keysize=256, hash_algorithm='sha256', backend=None, io_limits=None,
+                 tuning_profile=None, tune_disks=False):
         """Instantiate a device object
 
         :param device_name: Name of the volume, e.g. /dev/vdb
@@ -194,6 +277,17 @@ class device:
         :type keysize: int
         :param hash_algorithm: Hash algorithm used for key derivaiton, e.g. sha256
         :type hash_algorithm: int
+        :param backend: Execution backend used to manage the device, defaults to the backend returned by pyluks.backends.get_backend
+        :type backend: pyluks.backends.Backend, optional
+        :param io_limits: Bandwidth, IOPS and ionice limits of the wipe and of mkfs, defaults to None (no limit)
+        :type io_limits: pyluks.io_throttle.IOLimits, optional
+        :param tuning_profile: Block-layer tuning profile applied to the mapped device after luksOpen and recorded in the
+            cryptdev .ini file, see pyluks.block_tuning, defaults to None (kernel defaults)
+        :type tuning_profile: str, optional
+        :param tune_disks: If set to True, the request queue settings of the profile are also written to the disks under
+            the mapped device, except the ones backing other mounted filesystems, and recorded in the cryptdev .ini file,
+            defaults to False
+        :type tune_disks: bool, optional
         """
         self.device_name = device_name
         self.cryptdev = cryptdev
@@ -202,6 +296,10 @@ class device:
         self.cipher_algorithm = cipher_algorithm
         self.keysize = keysize
         self.hash_algorithm = hash_algorithm
+        self.backend = backend if backend is not None else get_backend()
+        self.io_limits = io_limits
+        self.tuning_profile = tuning_profile
+        self.tune_disks = tune_disks
 
     def check_vol(self):
         """Checks if the mountpoint already has a volume mounted to it and if the device_name
@@ -213,23 +311,23 @@ class device:
         fastluks_logger.debug('Checking storage volume.')
 
         # Check if a volume is already mounted to mountpoint
-        if os.path.ismount(self.mountpoint):
-            mounted_device, _, _ = run_command(f'df -P {self.mountpoint} | tail -1 | cut -d" " -f 1')
+        if self.backend.is_mount(self.mountpoint):
+            mounted_device = self.backend.mount_source(self.mountpoint)
             fastluks_logger.debug(f'Device name: {mounted_device}')
 
         else:
             # Check if device_name is a volume
-            if Path(self.device_name).is_block_device():
+            if self.backend.is_block_device(self.device_name):
                 fastluks_logger.debug(f'External volume on {self.device_name}. Using it for encryption.')
-                if not os.path.isdir(self.mountpoint):
+                if not self.backend.is_dir(self.mountpoint):
                     fastluks_logger.debug(f'Creating {self.mountpoint}')
-                    os.makedirs(self.mountpoint, exist_ok=True)
+                    self.backend.makedirs(self.mountpoint)
                     fastluks_logger.debug(f'Device name: {self.device_name}')
                     fastluks_logger.debug(f'Mountpoint: {self.mountpoint}')
             else:
                 fastluks_logger.error('Device not mounted, exiting! Please check logfile:')
                 fastluks_logger.error(f'No device mounted to {self.mountpoint}')
-                run_command('df -h', logger=fastluks_logger)
+                self.backend.run(['df', '-h'], logger=fastluks_logger)
                 raise LUKSError('Volume checks not satisfied') # unlock and terminate process
 
 
@@ -240,10 +338,10 @@ class device:
         :rtype: bool
         """
         fastluks_logger.debug('Checking if the volume is already encrypted.')
-        devices, _, _ = run_command('lsblk -p -o NAME,FSTYPE')
-        if re.search(f'{self.device_name}\s+crypto_LUKS', devices):
-                fastluks_logger.debug('The volume is already encrypted')
-                return True
+        _, _, status = self.backend.is_luks(self.device_name)
+        if status == 0:
+            fastluks_logger.debug('The volume is already encrypted')
+            return True
         else:
             return False
 
@@ -252,16 +350,18 @@ class device:
         """Unmount the device
         """
         fastluks_logger.debug('Umounting device.')
-        run_command(f'umount {self.mountpoint}', logger=fastluks_logger)
+        self.backend.umount(self.mountpoint, logger=fastluks_logger)
         fastluks_logger.debug(f'{self.device_name} umounted, ready for encryption!')
 
 
-    def luksFormat(self, s3cret):
+    def luksFormat(self, s3cret, luks_uuid=None):
         """Sets up a the device in LUKS encryption mode: sets up the LUKS device header and encrypts
         the passphrase with the indidcated cryptographic options. 
 
         :param s3cret: Passphrase for the encrypted volume.
         :type s3cret: str
+        :param luks_uuid: UUID given to the LUKS header, defaults to None (generated by cryptsetup)
+        :type luks_uuid: str, optional
         :param cipher_algorithm: Algorithm for the encryption, e.g. aes-xts-plain64
         :type cipher_algorithm: str
         :param keysize: Key-size for the cipher algorithm, e.g. 256
@@ -271,7 +371,8 @@ class device:
         :return: A tuple containing stdout, stderr and status of the cryptsetup luksFormat command.
         :rtype: tuple
         """
-        return run_command(f'printf "{s3cret}\n" | cryptsetup -v --cipher {self.cipher_algorithm} --key-size {self.keysize} --hash {self.hash_algorithm} --iter-time 2000 --use-urandom luksFormat {self.device_name} --batch-mode')
+        return self.backend.luks_format(self.device_name, s3cret, self.cipher_algorithm, self.keysize, self.hash_algorithm,
+                                        luks_uuid=luks_uuid)
 
 
     def luksHeaderBackup(self, luks_header_backup_file):
@@ -283,7 +384,7 @@ class device:
         :return: A tuple containing stdout, stderr and status of the cryptsetup luksFormat command.
         :rtype: tuple
         """
-        return run_command(f'cryptsetup luksHeaderBackup --header-backup-file {luks_header_backup_file} {self.device_name}')
+        return self.backend.luks_header_backup(self.device_name, luks_header_backup_file)
 
 
     def luksOpen(self, s3cret):
@@ -294,7 +395,7 @@ class device:
         :return: A tuple containing stdout, stderr and status of the cryptsetup luksOpen command 
         :rtype: tuple
         """
-        return run_command(f'printf "{s3cret}\n" | cryptsetup luksOpen {self.device_name} {self.cryptdev}')
+        return self.backend.luks_open(self.device_name, self.cryptdev, secret=s3cret)
 
 
     def info(self):
@@ -348,32 +449,89 @@ class device:
         :rtype: str or bool
         """
         fastluks_logger.info('Start the encryption procedure.')
-        fastluks_logger.debug(f'Using {self.cipher_algorithm} algorithm to luksformat the volume.')
-        fastluks_logger.debug('Start cryptsetup')
-        self.info()
-        fastluks_logger.debug('Cryptsetup full command:')
-        fastluks_logger.debug(f'cryptsetup -v --cipher {self.cipher_algorithm} --key-size {self.keysize} --hash {self.hash_algorithm} --iter-time 2000 --use-urandom --verify-passphrase luksFormat {device} --batch-mode')
+        s3cret = self.new_secret(passphrase_length, passphrase)
 
-        if passphrase_length == None:
-            if passphrase == None:
-                fastluks_logger.error("Missing passphrase!")
-                raise LUKSError('Device setup procedure failed.') # unlock and exit
-            s3cret = passphrase
-        else:
-            s3cret = create_random_secret(passphrase_length)
-        
         # Start encryption procedure
-        self.luksFormat(s3cret)
+        self.format_device(s3cret)
 
         # Write the secret to vault
         if use_vault:
-            write_secret_to_vault(vault_url, wrapping_token, secret_path, user_key, s3cret)
-            fastluks_logger.info('Passphrase stored in Vault')
+            self.store_secret(s3cret, vault_url, wrapping_token, secret_path, user_key)
 
         # Backup LUKS header
+        self.backup_header(luks_header_backup_file)
+
+        return s3cret
+
+
+    def new_secret(self, passphrase_length, passphrase):
+        """Returns the specified passphrase, or a random one of the specified length if passphrase_length is set.
+
+        :param passphrase_length: Lenght of the passphrase to be generated.
+        :type passphrase_length: int
+        :param passphrase: Specified passphrase to be used for device encryption.
+        :type passphrase: str
+        :raises LUKSError: Raises an error if neither the passphrase nor its length are specified.
+        :return: The passphrase
+        :rtype: str
+        """
+        if passphrase_length == None:
+            if passphrase == None:
+                fastluks_logger.error("Missing passphrase!")
+                raise LUKSError('Device setup procedure failed.') # unlock and exit
+            return passphrase
+        return create_random_secret(passphrase_length)
+
+
+    def format_device(self, s3cret, luks_uuid=None):
+        """Logs the cryptographic options and sets up the device in LUKS encryption mode with the device.luksFormat method.
+
+        :param s3cret: Passphrase for the encrypted volume.
+        :type s3cret: str
+        :param luks_uuid: UUID given to the LUKS header, defaults to None (generated by cryptsetup)
+        :type luks_uuid: str, optional
+        :raises LUKSError: Raises an error if luksFormat fails.
+        """
+        fastluks_logger.debug(f'Using {self.cipher_algorithm} algorithm to luksformat the volume.')
+        fastluks_logger.debug('Start cryptsetup')
+        self.info()
+        fastluks_logger.debug('Cryptsetup full command:')
+        fastluks_logger.debug(f'cryptsetup -v --cipher {self.cipher_algorithm} --key-size {self.keysize} --hash {self.hash_algorithm} --iter-time 2000 --use-urandom --verify-passphrase luksFormat {self.device_name} --batch-mode')
+
+        _, _, luksFormat_ec = self.luksFormat(s3cret, luks_uuid)
+        if luksFormat_ec != 0:
+            fastluks_logger.error(f'Command cryptsetup luksFormat failed with exit code {luksFormat_ec}!')
+            raise LUKSError('Device setup procedure failed.') # unlock and exit
+
+
+    def store_secret(self, s3cret, vault_url, wrapping_token, secret_path, user_key):
+        """Stores the passphrase to HashiCorp Vault with the write_secret_to_vault function.
+
+        :param s3cret: Passphrase for the encrypted volume.
+        :type s3cret: str
+        :param vault_url: URL of Vault server. 
+        :type vault_url: str
+        :param wrapping_token: Wrapping token used to write the passphrase on Vault.
+        :type wrapping_token: str
+        :param secret_path: Vault path in which the passphrase is stored.
+        :type secret_path: str
+        :param user_key: Vault key associated to the passphrase.
+        :type user_key: str
+        """
+        write_secret_to_vault(vault_url, wrapping_token, secret_path, user_key, s3cret)
+        fastluks_logger.info('Passphrase stored in Vault')
+
+
+    def backup_header(self, luks_header_backup_file):
+        """Stores the header backup with the device.luksHeaderBackup method, creating its directory if needed.
+
+        :param luks_header_backup_file: File in which the header and keyslot area are stored.
+        :type luks_header_backup_file: str
+        :raises LUKSError: Raises an error if luksHeaderBackup fails.
+        """
         luks_header_backup_dir = os.path.dirname(luks_header_backup_file)
-        if not os.path.isdir(luks_header_backup_dir):
-            os.mkdir(luks_header_backup_dir)
+        if not self.backend.is_dir(luks_header_backup_dir):
+            self.backend.makedirs(luks_header_backup_dir)
         _, _, luksHeaderBackup_ec = self.luksHeaderBackup(luks_header_backup_file)
 
         if luksHeaderBackup_ec != 0:
@@ -389,17 +547,37 @@ class device:
                 fastluks_logger.error('Bad passphrase. Please try again.')
             raise LUKSError('Device setup procedure failed.') # unlock and exit
 
-        return s3cret
 
-    def open_device(self, s3cret):
-        """Opens and mounts the encrypted device.
+    def store_header(self, header_store, luks_uuid):
+        """Adds the header of the device to a versioned, compressed header store.
+
+        :param header_store: Header store in which the backup is added.
+        :type header_store: pyluks.header_store.HeaderStore
+        :param luks_uuid: UUID of the LUKS header.
+        :type luks_uuid: str
+        :raises LUKSError: Raises an error if the header can't be read.
+        """
+        try:
+            backup = header_store.backup(self.device_name, luks_uuid=luks_uuid, logger=fastluks_logger)
+        except HeaderStoreError as e:
+            fastluks_logger.error(str(e))
+            raise LUKSError('Device setup procedure failed.') # unlock and exit
+        fastluks_logger.info(f'Header of {self.device_name} stored in {header_store.path(luks_uuid, backup["digest"])} '
+                             f'({backup["compressed_size"]} bytes, {backup["size"]} uncompressed)')
+
+
+    def open_device(self, s3cret, luks_cryptdev_file=None):
+        """Opens and mounts the encrypted device. Once the mapping is created, the tuning profile of the device, if any,
+        is applied to it with the device.tune method.
 
         :param s3cret: Passphrase to open the encrypted device.
         :type s3cret: str
+        :param luks_cryptdev_file: Path to the cryptdev .ini file holding the custom tuning profiles, defaults to None
+        :type luks_cryptdev_file: str, optional
         :return: False if any error occur (e.g. if the passphrase is wrong or if the crypt device already exists) 
         :rtype: bool, optional
         """
-        if not Path(f'/dev/mapper/{self.cryptdev}').is_block_device():
+        if not self.backend.is_block_device(f'/dev/mapper/{self.cryptdev}'):
             fastluks_logger.info(f'Opening LUKS volume and mapping it to /dev/mapper/{self.cryptdev}')
             _, _, openec = self.luksOpen(s3cret)
             
@@ -412,24 +590,47 @@ class device:
                     fastluks_logger.error('Unable to luksOpen device.')
                     fastluks_logger.error(f'/dev/mapper/{self.cryptdev} already exists.')
                     fastluks_logger.error(f'Mounting {self.device_name} to {self.mountpoint} again.')
-                    run_command(f'mount {self.device_name} {self.mountpoint}', logger=fastluks_logger)
+                    self.backend.mount(self.device_name, self.mountpoint, logger=fastluks_logger)
                     raise LUKSError('luksOpen failed, mapping not created.') # unlock and exit
+            if self.tuning_profile:
+                self.tune(luks_cryptdev_file)
         else:
             fastluks_logger.info(f'LUKS volume already opened and mapped to /dev/mapper/{self.cryptdev}')
 
 
+    def tune(self, luks_cryptdev_file=None):
+        """Applies the tuning profile of the device to the mapped device, see pyluks.block_tuning.BlockTuner.apply.
+        Settings which can't be applied are logged, they don't stop the procedure.
+
+        :param luks_cryptdev_file: Path to the cryptdev .ini file holding the custom tuning profiles, defaults to None
+        :type luks_cryptdev_file: str, optional
+        """
+        fastluks_logger.info(f'Applying tuning profile {self.tuning_profile} to /dev/mapper/{self.cryptdev}')
+        try:
+            settings = get_profile(self.tuning_profile, luks_cryptdev_file)
+            result = self.backend.tune_block_device(f'/dev/mapper/{self.cryptdev}', settings, logger=fastluks_logger,
+                                                    tune_disks=self.tune_disks)
+        except TuningError as e:
+            fastluks_logger.error(f'Tuning profile {self.tuning_profile} not applied: {e}')
+            return
+        if any(values['error'] for values in result.values()):
+            fastluks_logger.warning(f'Tuning profile {self.tuning_profile} partially applied to /dev/mapper/{self.cryptdev}.')
+
+
     def encryption_status(self):
         """Checks cryptdevice status, with the command cryptsetup status. It logs stdout, stderr
         and status to the logfile.
         """
         fastluks_logger.debug(f'Check {self.cryptdev} status with cryptsetup status')
-        run_command(f'cryptsetup -v status {self.cryptdev}', logger=fastluks_logger)
+        self.backend.luks_status(self.cryptdev, logger=fastluks_logger)
 
 
     def create_cryptdev_ini_file(self, luks_cryptdev_file, luks_header_backup_file,
-                                 save_passphrase_locally, s3cret):
-        """Creates the cryptdev .ini file containing information of the encrypted device under the 'luks' section.
-        It also stores the default paths for the log files of fastluks, luksctl and luksctl_api subpackages in the 'logs' section.
+                                 save_passphrase_locally, s3cret, luks_uuid=None, header_store=None):
+        """Registers the encrypted device in the cryptdev .ini file, see pyluks.cryptdev_registry.CryptdevRegistry.
+        The first device is stored in the 'luks' section, other devices in a 'luks:<cryptdev>' section each, and only the
+        section of this device is changed. It also stores the default paths for the log files of fastluks, luksctl and
+        luksctl_api subpackages in the 'logs' section, unless they are already set.
         After creating the ini file, it logs the output of 'dmsetup info' and 'cryptsetup luksDump' commands.
 
         :param luks_cryptdev_file: Path to the cryptdev .ini file.
@@ -446,51 +647,63 @@ class device:
         :type save_passphrase_locally: bool
         :param s3cret: Passphrase to open the encrypted device, written in the .ini file only if `save_passphrase_locally` is set to True
         :type s3cret: str
+        :param luks_uuid: UUID of the LUKS header, if already known. Otherwise it's read with cryptsetup luksUUID, defaults to None
+        :type luks_uuid: str, optional
+        :param header_store: Header store holding the header backups. If specified, header_path points to the latest backup in the store, defaults to None
+        :type header_store: pyluks.header_store.HeaderStore, optional
         """
-        luksUUID, _, _ = run_command(f'cryptsetup luksUUID {self.device_name}')
-        luksUUID = luksUUID.rstrip()
-
-        with open(luks_cryptdev_file, 'w') as f:
-            config = ConfigParser()
-            config.add_section('luks')
-            config_luks = config['luks']
-            config_luks['cipher_algorithm'] = self.cipher_algorithm
-            config_luks['hash_algorithm'] = self.hash_algorithm
-            config_luks['keysize'] = str(self.keysize)
-            config_luks['device'] = self.device_name
-            config_luks['uuid'] = luksUUID
-            config_luks['cryptdev'] = self.cryptdev
-            config_luks['mapper'] = f'/dev/mapper/{self.cryptdev}'
-            config_luks['mountpoint'] = self.mountpoint
-            config_luks['filesystem'] = self.filesystem
+        if luks_uuid is None:
+            luks_uuid, _, _ = self.backend.luks_uuid(self.device_name)
+        luksUUID = luks_uuid.rstrip()
+
+        config_luks = {}
+        config_luks['cipher_algorithm'] = self.cipher_algorithm
+        config_luks['hash_algorithm'] = self.hash_algorithm
+        config_luks['keysize'] = str(self.keysize)
+        config_luks['device'] = self.device_name
+        config_luks['uuid'] = luksUUID
+        config_luks['cryptdev'] = self.cryptdev
+        config_luks['mapper'] = f'/dev/mapper/{self.cryptdev}'
+        config_luks['mountpoint'] = self.mountpoint
+        config_luks['filesystem'] = self.filesystem
+        if self.tuning_profile:
+            config_luks['tuning_profile'] = self.tuning_profile
+        if self.tune_disks:
+            config_luks['tune_disks'] = 'true'
+        if header_store is not None:
+            config_luks['header_store'] = header_store.store_dir
+            config_luks['header_path'] = header_store.path(luksUUID, header_store.latest(luksUUID)['digest'])
+        else:
             config_luks['header_path'] = f'{luks_header_backup_file}'
+        if save_passphrase_locally:
+            config_luks['passphrase'] = s3cret
+
+        registry = CryptdevRegistry(luks_cryptdev_file)
+        try:
+            registry.add(config_luks)
+        except RegistryError as e:
+            fastluks_logger.error(str(e))
+            raise LUKSError('Device setup procedure failed.')
+        registry.set_defaults('logs', DEFAULT_LOGFILES)
+
+        if save_passphrase_locally:
+            fastluks_logger.info(f'Device informations and key have been saved in {luks_cryptdev_file}')
+        else:
+            fastluks_logger.info(f'Device informations have been saved in {luks_cryptdev_file}')
 
-            config.add_section('logs')
-            config_logs = config['logs']
-            for name,logfile in DEFAULT_LOGFILES.items():
-                config_logs[name] = logfile
-
-            if save_passphrase_locally:
-                config_luks['passphrase'] = s3cret
-                config.write(f)
-                fastluks_logger.info(f'Device informations and key have been saved in {luks_cryptdev_file}')
-            else:
-                config.write(f)
-                fastluks_logger.info(f'Device informations have been saved in {luks_cryptdev_file}')
-
-        run_command(f'dmsetup info /dev/mapper/{self.cryptdev}', logger=fastluks_logger)
-        run_command(f'cryptsetup luksDump {self.device_name}', logger=fastluks_logger)
+        self.backend.dmsetup_info(self.cryptdev, logger=fastluks_logger)
+        self.backend.luks_dump(self.device_name, logger=fastluks_logger)
 
 
     def wipe_data(self):
         """Paranoid mode function: it wipes the disk by overwriting the entire drive with random data.
-        It may take some time.
+        It may take some time. The writes are limited by the io_limits of the device, if any.
         """
         fastluks_logger.info('Paranoid mode selected. Wiping disk')
         fastluks_logger.info('Wiping disk data by overwriting the entire drive with random data.')
         fastluks_logger.info('This might take time depending on the size & your machine!')
         
-        run_command(f'dd if=/dev/zero of=/dev/mapper/{self.cryptdev} bs=1M status=progress')
+        self.backend.wipe(f'/dev/mapper/{self.cryptdev}', logger=fastluks_logger, limits=self.io_limits)
         
         fastluks_logger.info(f'Block file /dev/mapper/{self.cryptdev} created.')
         fastluks_logger.info('Wiping done.')
@@ -503,7 +716,15 @@ class device:
         """
         fastluks_logger.info('Creating filesystem.')
         fastluks_logger.debug(f'Creating {self.filesystem} filesystem on /dev/mapper/{self.cryptdev}')
-        _, _, mkfs_ec = run_command(f'mkfs -t {self.filesystem} /dev/mapper/{self.cryptdev}', logger=fastluks_logger)
+
+        # The mapped device inherits the I/O topology of the underlying one
+        topology = self.backend.block_device(f'/dev/mapper/{self.cryptdev}') or self.backend.block_device(self.device_name)
+        options = mkfs_options(self.filesystem, topology)
+        if options:
+            fastluks_logger.debug(f'mkfs options from the device topology: {" ".join(options)}')
+
+        _, _, mkfs_ec = self.backend.mkfs(self.filesystem, f'/dev/mapper/{self.cryptdev}', logger=fastluks_logger, options=options,
+                                          limits=self.io_limits)
         if mkfs_ec != 0:
             fastluks_logger.error(f'While creating {self.filesystem} filesystem. Please check logs.')
             fastluks_logger.error('Command mkfs failed!')
@@ -515,41 +736,159 @@ class device:
         """
         fastluks_logger.info('Mounting encrypted device.')
         fastluks_logger.debug(f'Mounting /dev/mapper/{self.cryptdev} to {self.mountpoint}')
-        run_command(f'mount /dev/mapper/{self.cryptdev} {self.mountpoint}', logger=fastluks_logger)
-        run_command('df -Hv', logger=fastluks_logger)
+        self.backend.mount(f'/dev/mapper/{self.cryptdev}', self.mountpoint, logger=fastluks_logger)
+        self.backend.run(['df', '-Hv'], logger=fastluks_logger)
+
+
+    def run_phase(self, state, phase, is_done, run):
+        """Runs a phase of the fastluks state machine, unless the on-disk state shows it's already completed.
+        The phase is recorded as completed in the state file once it has been run or found completed.
+
+        :param state: State of the fastluks run on the device.
+        :type state: pyluks.fastluks.state.RunState
+        :param phase: Phase name, see pyluks.fastluks.state.PHASES
+        :type phase: str
+        :param is_done: Function returning True if the phase is already completed.
+        :type is_done: function
+        :param run: Function performing the phase.
+        :type run: function
+        """
+        if is_done():
+            fastluks_logger.info(f'Phase {phase} already completed, skipping.')
+        else:
+            fastluks_logger.debug(f'Starting phase {phase}.')
+            run()
+        state.mark_done(phase)
+
+
+    def run_phases(self, state, phases, pipelined=False):
+        """Runs a sequence of phases with the device.run_phase method. In pipelined mode, the phases must be
+        independent from each other: the ones to be run are started concurrently and the procedure waits for
+        all of them to finish. Each successful phase is recorded as completed, then the first error (if any) is raised,
+        so nothing is reported as successful until every phase has finished.
+
+        :param state: State of the fastluks run on the device.
+        :type state: pyluks.fastluks.state.RunState
+        :param phases: List of (phase, is_done, run) tuples, see device.run_phase
+        :type phases: list
+        :param pipelined: If set to True, the phases are run concurrently, defaults to False
+        :type pipelined: bool, optional
+        """
+        if not pipelined:
+            for phase, is_done, run in phases:
+                self.run_phase(state, phase, is_done, run)
+            return
+
+        pending = []
+        for phase, is_done, run in phases:
+            if is_done():
+                fastluks_logger.info(f'Phase {phase} already completed, skipping.')
+                state.mark_done(phase)
+            else:
+                pending.append((phase, run))
+        if not pending:
+            return
+
+        fastluks_logger.debug(f'Starting phases {", ".join(phase for phase, _ in pending)} concurrently.')
+        with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+            futures = [(phase, executor.submit(run)) for phase, run in pending]
+
+        errors = []
+        for phase, future in futures:
+            error = future.exception()
+            if error is None:
+                state.mark_done(phase)
+            else:
+                fastluks_logger.error(f'Phase {phase} failed: {error}')
+                errors.append(error)
+        if errors:
+            raise errors[0]
+
+
+    def resume_secret(self, state, passphrase_length, passphrase, use_vault, vault_url, wrapping_token, secret_path, user_key):
+        """Returns the passphrase needed to resume an interrupted fastluks run, which is never saved in the state file:
+        the specified one, if it was used to format the device (passphrase_length not set, as in device.new_secret) or,
+        if the vault phase was completed, the one read back from Vault with a new wrapping token. The passphrase is
+        checked against the LUKS header before any phase stores it.
+
+        :param state: State of the fastluks run on the device.
+        :type state: pyluks.fastluks.state.RunState
+        :param passphrase_length: Length of the generated passphrase, if the device was formatted with a random one.
+        :type passphrase_length: int
+        :param passphrase: Specified passphrase.
+        :type passphrase: str
+        :param use_vault: If set to True, the passphrase is stored to HashiCorp Vault.
+        :type use_vault: bool
+        :param vault_url: URL of Vault server.
+        :type vault_url: str
+        :param wrapping_token: Wrapping token used to read the passphrase from Vault.
+        :type wrapping_token: str
+        :param secret_path: Vault path in which the passphrase is stored.
+        :type secret_path: str
+        :param user_key: Vault key associated to the passphrase.
+        :type user_key: str
+        :raises LUKSError: Raises an error if no passphrase is available or if it doesn't open the LUKS header.
+        :return: The passphrase
+        :rtype: str
+        """
+        if passphrase_length is None and passphrase is not None:
+            s3cret = passphrase
+        elif use_vault and state.is_done('vault'):
+            if not wrapping_token:
+                raise LUKSError('Missing wrapping token to read the passphrase from Vault and resume the procedure.')
+            fastluks_logger.info(f'Reading the passphrase of {self.device_name} from Vault to resume the procedure.')
+            s3cret = read_secret(vault_url, wrapping_token, 'secrets', secret_path, user_key)
+        else:
+            fastluks_logger.error(f'The passphrase of the interrupted run on {self.device_name} is not available.')
+            raise LUKSError('Missing passphrase to resume the procedure, please specify it.')
+
+        _, stderr, status = self.backend.luks_test_passphrase(self.device_name, s3cret)
+        if status != 0:
+            fastluks_logger.error(f'The passphrase does not open the LUKS header of {self.device_name}: {stderr.strip()}')
+            raise LUKSError('Wrong passphrase to resume the procedure.')
+        return s3cret
+
+
+    def cryptdev_file_written(self, luks_cryptdev_file, luks_uuid):
+        """Checks if the cryptdev .ini file registers the device with the specified LUKS UUID."""
+        try:
+            ini = CryptdevRegistry(luks_cryptdev_file).get(self.cryptdev)
+        except KeyError:
+            return False
+        return ini.get('uuid') == luks_uuid and ini.get('device') == self.device_name
 
 
     def encrypt(self, luks_header_backup_file, luks_cryptdev_file,
                 passphrase_length, passphrase, save_passphrase_locally,
-                use_vault, vault_url, wrapping_token, secret_path, user_key):
-        """Performs the encryption workflow with the following steps:
-
-        * Creates the lock file with the lock function.
-        * Creates a random name for the cryptdevice with the create_random_cryptdev_name function.
-        * Checks the device volume with the device.check_vol method.
-        * Checks if the volume is encrypted with the device.is_encrypted method, if it's not starts the encryption.
-        * Encryption procedure:
-            * Unmount the volume with the device.umount_vol method
-            * Performs the device setup workflow for encryption with the device.setup_device method.
-            * Unlocks and exits if the setup procedure failed.
-        * Opens the successfully encrypted device with the device.open_device method, unlocks and exits if it fails.
-        * Checks the encryption status with the device.encryption_status method.
-        * Creates the cryptdev .ini file with the device information with the device.create_cryptdev_ini_file method.
-        * Ends the encryption procedure with the end_encrypt_procedure function.
-        * Unlocks and exits.
+                use_vault, vault_url, wrapping_token, secret_path, user_key,
+                state_file=DEFAULT_STATE_FILE, pipelined=False, header_store_dir=None):
+        """Performs the encryption workflow as a state machine persisted in the state file. Each phase
+        checks the on-disk state before running, so that a run interrupted by a failure can be resumed
+        from the first incomplete phase:
+
+        * Checks that cryptsetup and dmsetup are installed and checks the device volume with the device.check_vol method.
+        * format: if the volume is not encrypted, unmounts it and sets up the LUKS header with the device.format_device method.
+          The LUKS UUID is chosen and recorded in the state file before luksFormat, so that a device formatted by an
+          interrupted run is recognised. If the volume is already encrypted with another UUID, the procedure stops.
+          The passphrase is never written to the state file: a resumed run uses the specified passphrase, if
+          `passphrase_length` is not set, or reads it back from Vault, with a new wrapping token, once the vault phase
+          is completed, and checks it against the LUKS header. If neither is available and
+          nothing can have been written to the volume yet (vault and filesystem phases not completed, mapping closed),
+          the volume is formatted again with a new passphrase.
+        * vault: stores the passphrase to HashiCorp Vault if `use_vault` is set to True.
+        * header_backup: stores the header backup with the device.backup_header method, unless the backup file exists.
+          If `header_store_dir` is specified, the header is added to the header store with the device.store_header method instead,
+          unless the store already holds a backup of the header.
+        * open: opens the device with the device.open_device method, unless the mapping already exists, and applies
+          the tuning profile of the device, if any.
+        * cryptdev_file: checks the encryption status and writes the cryptdev .ini file, unless it already describes the device.
+
+        In pipelined mode, the vault, header_backup and open phases are run concurrently once the device is formatted,
+        taking the Vault round trip and the header backup off the critical path. The cryptdev_file phase starts only
+        after all of them have succeeded.
 
-        :param cipher_algorithm: Algorithm for the encryption, e.g. aes-xts-plain64
-        :type cipher_algorithm: str
-        :param keysize: Key-size for the cipher algorithm, e.g. 256
-        :type keysize: int
-        :param hash_algorithm: Hash algorithm used for the key derivation, e.g. sha256
-        :type hash_algorithm: str
         :param luks_header_backup_file: File in which the header and keyslot area are stored.
         :type luks_header_backup_file: str
-        :param LOCKFILE: Path to the lockfile.
-        :type LOCKFILE: str
-        :param SUCCESS_FILE: Path to the encryption success file.
-        :type SUCCESS_FILE: str
         :param luks_cryptdev_file: Path to the cryptdev .ini file.
         :type luks_cryptdev_file: str
         :param passphrase_length: Length of the passphrase to be generated.
@@ -568,43 +907,231 @@ class device:
         :type secret_path: str
         :param user_key: Vault key associated to the passphrase.
         :type user_key: str
+        :param state_file: Path to the file in which the state of the run is persisted, defaults to '/etc/luks/fastluks-state.ini'
+        :type state_file: str, optional
+        :param pipelined: If set to True, the independent post-format phases are run concurrently, defaults to False
+        :type pipelined: bool, optional
+        :param header_store_dir: Directory of the compressed, versioned header store, see pyluks.header_store.HeaderStore. Defaults to None
+        :type header_store_dir: str, optional
         """
         
-        cryptdev = create_random_cryptdev_name() # Assign random name to cryptdev
-
-        check_cryptsetup() # Check that cryptsetup and dmsetup are installed
+        check_cryptsetup(backend=self.backend) # Check that cryptsetup and dmsetup are installed
 
         self.check_vol() # Check which virtual volume is mounted to mountpoint, unlock and exit if it's not mounted
 
-        if not self.is_encrypted(): # Check if the volume is encrypted, if it's not start the encryption procedure
+        state = RunState(state_file, self.device_name)
+        mapper = f'/dev/mapper/{self.cryptdev}'
+
+        resumed = self.is_encrypted()
+        if resumed: # Resume only devices formatted by a previous fastluks run
+            luks_uuid = self.backend.luks_uuid(self.device_name)[0].strip()
+            if state.get('uuid') != luks_uuid:
+                raise LUKSError('Device is already encrypted')
+            fastluks_logger.info(f'Phase format already completed, resuming the procedure on {self.device_name}.')
+            state.mark_done('format') # luksFormat may have succeeded right before the interruption
+            specified = passphrase_length is None and passphrase is not None # Used by luksFormat, see device.new_secret
+            if (not specified and not (use_vault and state.is_done('vault')) and not state.is_done('filesystem')
+                    and not self.backend.is_block_device(mapper)):
+                fastluks_logger.warning(f'The passphrase of the interrupted run is not available and {self.device_name} '
+                                        'holds no data yet, formatting it again.')
+                resumed = False
+
+        if not resumed:
+            state.reset()
             self.umount_vol()
-            s3cret = self.setup_device(luks_header_backup_file, passphrase_length, passphrase,
-                                       use_vault, vault_url, wrapping_token, secret_path, user_key)
+            new_s3cret = self.new_secret(passphrase_length, passphrase)
+            state.set(uuid=str(uuid.uuid4())) # Recorded before formatting, the device is recognised if the run is interrupted
+            luks_uuid = state.get('uuid')
+            self.format_device(new_s3cret, luks_uuid)
+            state.mark_done('format')
+
+        if header_store_dir:
+            header_store = HeaderStore(header_store_dir, backend=self.backend)
+            header_backup_phase = ('header_backup',
+                                   lambda: state.is_done('header_backup') and header_store.latest(luks_uuid) is not None,
+                                   lambda: self.store_header(header_store, luks_uuid))
         else:
-            raise LUKSError('Device is already encrypted')
-
-        self.open_device(s3cret) # Create mapping
-
-        self.encryption_status() # Check status
+            header_store = None
+            header_backup_phase = ('header_backup',
+                                   lambda: state.is_done('header_backup') and self.backend.exists(luks_header_backup_file),
+                                   lambda: self.backup_header(luks_header_backup_file))
+
+        # The passphrase is needed only by the phases that have to be run. When resuming, it's read once, even if the
+        # phases needing it run concurrently, since a wrapping token can be used only once
+        secret_lock = threading.Lock()
+        secrets = [] if resumed else [new_s3cret]
+        def s3cret():
+            with secret_lock:
+                if not secrets:
+                    secrets.append(self.resume_secret(state, passphrase_length, passphrase, use_vault, vault_url, wrapping_token, secret_path, user_key))
+                return secrets[0]
+
+        # Once the device is formatted, the Vault write, the header backup and the mapping are independent
+        self.run_phases(state, [
+            ('vault',
+             lambda: not use_vault or state.is_done('vault'),
+             lambda: self.store_secret(s3cret(), vault_url, wrapping_token, secret_path, user_key)),
+            header_backup_phase,
+            ('open',
+             lambda: self.backend.is_block_device(f'/dev/mapper/{self.cryptdev}'),
+             lambda: self.open_device(s3cret(), luks_cryptdev_file)), # Create mapping
+        ], pipelined=pipelined)
+
+        def write_cryptdev_file():
+            self.encryption_status() # Check status
+            self.create_cryptdev_ini_file(luks_cryptdev_file, luks_header_backup_file, save_passphrase_locally,
+                                          s3cret() if save_passphrase_locally else None, luks_uuid=luks_uuid,
+                                          header_store=header_store) # Create ini file
+
+        self.run_phase(state, 'cryptdev_file',
+                       is_done=lambda: state.is_done('cryptdev_file') and self.cryptdev_file_written(luks_cryptdev_file, luks_uuid),
+                       run=write_cryptdev_file)
+
+
+    def volume_setup(self, state_file=DEFAULT_STATE_FILE):
+        """Performs the setup workflow for the encrypted volume, as a continuation of the device.encrypt state machine:
+
+        * filesystem: creates the encrypted volume filesystem with the device.create_fs method, unless a filesystem is
+          already present on the mapped device.
+        * mount: mounts the encrypted volume, unless it's already mounted to the mountpoint.
+
+        :param state_file: Path to the file in which the state of the run is persisted, defaults to '/etc/luks/fastluks-state.ini'
+        :type state_file: str, optional
+        """
+        
+        state = RunState(state_file, self.device_name)
+        mapper = f'/dev/mapper/{self.cryptdev}'
 
-        self.create_cryptdev_ini_file(luks_cryptdev_file, luks_header_backup_file, save_passphrase_locally, s3cret) # Create ini file
+        self.run_phase(state, 'filesystem',
+                       is_done=lambda: bool(self.backend.fs_type(mapper)),
+                       run=self.create_fs) # Create filesystem
 
+        self.run_phase(state, 'mount',
+                       is_done=lambda: self.backend.is_mount(self.mountpoint) and self.backend.mount_source(self.mountpoint) == mapper,
+                       run=self.mount_vol) # Mount volume
 
-    def volume_setup(self):
-        """Performs the setup workflow for the encrypted volume with the following steps:
 
-        * Creates a lockfile with the lock function.
-        * Creates the encrypted volume filesystem with the device.create_fs method. Unlocks and exits if it fails.
-        * Mounts the encrypted volume.
-        * Creates the setup success file with the end_volume_setup_procedure function.
-        * Unlocks
+    def plan(self, luks_header_backup_file, luks_cryptdev_file, use_vault=False, state_file=DEFAULT_STATE_FILE,
+             header_store_dir=None, benchmark_cache=DEFAULT_BENCHMARK_CACHE, probe=True):
+        """Returns the plan of the device.encrypt and device.volume_setup workflows without changing anything on
+        the host: the device description and state, and for each phase whether it would run (phases found
+        completed are skipped as in the real run), the commands it would run and its estimated duration.
+        Durations are estimated from the disk and cipher throughputs, see pyluks.fastluks.plan.measure_throughput.
+        The paranoid wipe (device.wipe_data), not part of the workflows, is listed with run set to False.
 
-        :param LOCKFILE: Path to the lockfile.
-        :type LOCKFILE: str
-        :param SUCCESS_FILE: Path to the volume setup success file.
-        :type SUCCESS_FILE: str
+        :param luks_header_backup_file: File in which the header and keyslot area would be stored.
+        :type luks_header_backup_file: str
+        :param luks_cryptdev_file: Path to the cryptdev .ini file.
+        :type luks_cryptdev_file: str
+        :param use_vault: If set to True, the passphrase would be stored to HashiCorp Vault, defaults to False
+        :type use_vault: bool, optional
+        :param state_file: Path to the file in which the state of the run is persisted, defaults to '/etc/luks/fastluks-state.ini'
+        :type state_file: str, optional
+        :param header_store_dir: Directory of the header store, see device.encrypt, defaults to None
+        :type header_store_dir: str, optional
+        :param benchmark_cache: Path to the cache of the measured throughputs, or None to disable it, defaults to '/etc/luks/fastluks-benchmarks.json'
+        :type benchmark_cache: str, optional
+        :param probe: If set to False, throughputs missing from the cache are not probed, defaults to True
+        :type probe: bool, optional
+        :return: Dictionary containing the device, state, throughput, steps, error and estimated_seconds keys.
+        :rtype: dict
         """
-        
-        self.create_fs() # Create filesystem
-
-        self.mount_vol() # Mount volume
+        mapper = f'/dev/mapper/{self.cryptdev}'
+        block_device = self.backend.block_device(self.device_name)
+        if block_device is None:
+            block_device = {'name': os.path.basename(self.device_name), 'path': self.device_name, 'size': 0, 'rotational': False}
+        size = block_device['size']
+        run_state = RunState(state_file, self.device_name) # Read only, the state file is not written
+
+        encrypted = self.is_encrypted()
+        luks_uuid = self.backend.luks_uuid(self.device_name)[0].strip() if encrypted else None
+        mapped = self.backend.is_block_device(mapper)
+        mounted = self.backend.is_mount(self.mountpoint)
+        mount_source = self.backend.mount_source(self.mountpoint) if mounted else None
+        resumed = encrypted and run_state.get('uuid') == luks_uuid
+
+        error = None
+        if not mounted and not self.backend.is_block_device(self.device_name):
+            error = f'No device mounted to {self.mountpoint} and {self.device_name} is not a block device.'
+        elif encrypted and not resumed:
+            error = 'Device is already encrypted'
+
+        if header_store_dir:
+            header_store = HeaderStore(header_store_dir, backend=self.backend)
+            header_done = run_state.is_done('header_backup') and luks_uuid is not None and header_store.latest(luks_uuid) is not None
+            header_call = ('luks_header_backup', self.device_name, os.path.join(tempfile.gettempdir(), 'luks-header.XXXXXX', 'header.img'))
+        else:
+            header_done = run_state.is_done('header_backup') and self.backend.exists(luks_header_backup_file)
+            header_call = ('luks_header_backup', self.device_name, luks_header_backup_file)
+
+        topology = (self.backend.block_device(mapper) if mapped else None) or block_device
+        missing_tools = [tool for tool in ('dmsetup', 'cryptsetup') if not self.backend.which(tool)]
+        cache = BenchmarkCache(benchmark_cache) if benchmark_cache else None
+        throughput = measure_throughput(self.backend, block_device, self.cipher_algorithm, self.keysize, cache=cache, probe=probe)
+        fs_type = self.backend.fs_type(mapper) if mapped else ''
+
+        def commands(*calls):
+            # Commands of a sequence of (operation, *args) backend calls, None if the backend doesn't run commands
+            planned = [self.backend.dry_run(*call) for call in calls]
+            return None if None in planned else [command for call_commands in planned for command in call_commands]
+
+        # (phase, run, reason if skipped, commands)
+        phases = [
+            ('install_tools', bool(missing_tools), 'cryptsetup and dmsetup installed',
+             None),
+            ('check_volume', True, None,
+             None),
+            ('format', not encrypted, 'already completed',
+             commands(('umount', self.mountpoint),
+                      ('luks_format', self.device_name, '', self.cipher_algorithm, self.keysize, self.hash_algorithm),
+                      ('luks_uuid', self.device_name))),
+            ('vault', use_vault and not run_state.is_done('vault'), 'already completed' if use_vault else 'Vault not used',
+             None),
+            ('header_backup', not header_done, 'already completed',
+             commands(header_call)),
+            ('open', not mapped, 'already completed',
+             commands(('luks_open', self.device_name, self.cryptdev, ''))),
+            ('cryptdev_file', not (run_state.is_done('cryptdev_file') and luks_uuid is not None
+                                   and self.cryptdev_file_written(luks_cryptdev_file, luks_uuid)), 'already completed',
+             commands(('luks_status', self.cryptdev), ('dmsetup_info', self.cryptdev), ('luks_dump', self.device_name))),
+            ('wipe', False, 'paranoid wipe not requested',
+             commands(('wipe', mapper))),
+            ('filesystem', not fs_type, 'already completed',
+             commands(('mkfs', self.filesystem, mapper, None, mkfs_options(self.filesystem, topology)))),
+            ('mount', not (mounted and mount_source == mapper), 'already completed',
+             commands(('mount', mapper, self.mountpoint))),
+        ]
+
+        # The wipe and mkfs writes are capped by the bandwidth limit, if any
+        limited = throughput
+        if self.io_limits is not None and self.io_limits.bandwidth:
+            disk = throughput['disk']
+            limited = dict(throughput, disk=dict(disk, bytes_per_second=min(disk['bytes_per_second'], self.io_limits.bandwidth)))
+
+        steps = []
+        for phase, run, reason, phase_commands in phases:
+            step = {'phase': phase, 'run': run,
+                    'resource': wipe_resource(limited) if phase == 'wipe' else RESOURCES[phase],
+                    'commands': phase_commands,
+                    'estimated_seconds': estimate_seconds(phase, size, self.filesystem,
+                                                          limited if phase in ('wipe', 'filesystem') else throughput)}
+            if not run:
+                step['reason'] = reason
+            steps.append(step)
+
+        return {'device': block_device,
+                'cryptdev': self.cryptdev,
+                'mountpoint': self.mountpoint,
+                'filesystem': self.filesystem,
+                'cipher_algorithm': self.cipher_algorithm,
+                'keysize': self.keysize,
+                'hash_algorithm': self.hash_algorithm,
+                'tuning_profile': self.tuning_profile,
+                'tune_disks': self.tune_disks,
+                'state': {'encrypted': encrypted, 'luks_uuid': luks_uuid, 'mapped': mapped, 'mounted': mounted,
+                          'mount_source': mount_source, 'filesystem': fs_type or None,
+                          'completed_phases': run_state.completed_phases()},
+                'throughput': throughput,
+                'steps': steps,
+                'error': error,
+                'estimated_seconds': round(sum(step['estimated_seconds'] for step in steps if step['run']), 3) if error is None else None}
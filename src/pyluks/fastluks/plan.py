@@ -0,0 +1,238 @@
+# Import dependencies
+import re
+import json
+import time
+
+# Import internal dependencies
+from ..utilities import write_file_atomically
+from ..backends import LUKS_ITER_TIME_MS
+
+
+
+################################################################################
+# VARIABLES
+
+DEFAULT_BENCHMARK_CACHE = '/etc/luks/fastluks-benchmarks.json'
+DEFAULT_CACHE_MAX_AGE = 30 * 24 * 3600 # Cached results older than 30 days are probed again
+
+# Read probe: PROBE_CHUNKS reads of PROBE_CHUNK_SIZE bytes spread over the device, stopped after PROBE_MAX_SECONDS
+PROBE_CHUNK_SIZE = 4 * 1024**2
+PROBE_CHUNKS = 16
+PROBE_MAX_SECONDS = 3.0
+
+# Throughputs in bytes per second used when they can't be probed nor read from the cache
+DEFAULT_DISK_THROUGHPUT = {'rotational': 150 * 1000**2, 'solid_state': 500 * 1000**2}
+DEFAULT_CIPHER_THROUGHPUT = 1000 * 1024**2
+
+# LUKS2 header and keyslot area written by luksFormat and copied by luksHeaderBackup
+LUKS_HEADER_SIZE = 16 * 1024**2
+
+# Seconds taken by the luksFormat and luksOpen key derivation, as set by --iter-time
+KDF_SECONDS = LUKS_ITER_TIME_MS / 1000
+
+# Fixed durations in seconds of the phases which don't depend on the device
+FIXED_SECONDS = {'install_tools': 60.0, 'check_volume': 0.1, 'vault': 0.5, 'cryptdev_file': 0.3, 'mount': 0.2}
+
+# mkfs writes the filesystem metadata only (inode tables are initialized lazily by ext4): a fraction of the
+# device plus a fixed cost. Coarse figures, meant to size maintenance windows.
+MKFS_METADATA_RATIO = {'ext2': 0.002, 'ext3': 0.002, 'ext4': 0.001, 'xfs': 0.0002}
+MKFS_SECONDS = 1.0
+
+# Main resource used by each phase, so that a scheduler can tell which jobs contend when run in parallel
+RESOURCES = {'install_tools': 'network', 'check_volume': None, 'format': 'cpu', 'vault': 'network',
+             'header_backup': 'disk', 'open': 'cpu', 'cryptdev_file': None, 'wipe': 'disk', 'filesystem': 'disk',
+             'mount': 'disk'}
+
+
+
+################################################################################
+# BENCHMARK CACHE CLASS
+
+class BenchmarkCache:
+    """Per-host cache of the throughputs measured by the planning probes, stored as JSON:
+
+    {"disk": {"<kernel name>:<size>": {"bytes_per_second": ..., "measured": <epoch>}},
+     "cipher": {"<cipher>:<key size>": {"bytes_per_second": ..., "measured": <epoch>}}}
+
+    The cache can also be filled with the results of a longer benchmark run, e.g. fio, in the same format.
+    """
+
+
+    def __init__(self, cache_file=DEFAULT_BENCHMARK_CACHE, max_age=DEFAULT_CACHE_MAX_AGE):
+        """Instantiate a BenchmarkCache object, loading the cache file if it exists and is valid.
+
+        :param cache_file: Path to the cache file, defaults to '/etc/luks/fastluks-benchmarks.json'
+        :type cache_file: str, optional
+        :param max_age: Seconds after which a cached result is ignored, defaults to 30 days
+        :type max_age: float, optional
+        """
+        self.cache_file = cache_file
+        self.max_age = max_age
+        try:
+            with open(cache_file) as f:
+                self.results = json.load(f)
+        except (OSError, ValueError):
+            self.results = {}
+
+
+    def get(self, kind, key):
+        """Returns a cached throughput in bytes per second, or None if it's missing or too old.
+
+        :param kind: Result kind, 'disk' or 'cipher'
+        :type kind: str
+        :param key: Result key, see BenchmarkCache.
+        :type key: str
+        """
+        result = self.results.get(kind, {}).get(key)
+        if not isinstance(result, dict) or time.time() - result.get('measured', 0) > self.max_age:
+            return None
+        return result.get('bytes_per_second')
+
+    def put(self, kind, key, bytes_per_second):
+        """Stores a throughput in the cache and saves the cache file. The cache is left unsaved if the file
+        can't be written, e.g. when planning as a user other than root."""
+        self.results.setdefault(kind, {})[key] = {'bytes_per_second': bytes_per_second, 'measured': time.time()}
+        try:
+            write_file_atomically(self.cache_file, json.dumps(self.results, indent=2, sort_keys=True))
+        except OSError:
+            pass
+
+
+
+################################################################################
+# PROBES
+
+def probe_read_throughput(backend, device, size, chunk_size=PROBE_CHUNK_SIZE, chunks=PROBE_CHUNKS, max_seconds=PROBE_MAX_SECONDS):
+    """Measures the sequential read throughput of a device with a few reads spread over it, skipping the
+    LUKS header region. The device is only read, so the probe can run on a device in use.
+
+    :param backend: Execution backend used to read the device.
+    :type backend: pyluks.backends.Backend
+    :param device: Device path, e.g. /dev/vdb
+    :type device: str
+    :param size: Device size in bytes.
+    :type size: int
+    :return: Throughput in bytes per second, or None if the device can't be read.
+    :rtype: float
+    """
+    span = size - LUKS_HEADER_SIZE - chunk_size
+    if span <= 0:
+        return None
+    offsets = [LUKS_HEADER_SIZE + (span * i // max(chunks - 1, 1)) // 4096 * 4096 for i in range(chunks)]
+
+    read_bytes, start = 0, time.monotonic()
+    try:
+        for offset in offsets:
+            read_bytes += len(backend.read_device(device, chunk_size, offset=offset))
+            if time.monotonic() - start > max_seconds:
+                break
+    except OSError:
+        return None
+    elapsed = time.monotonic() - start
+    return read_bytes / elapsed if read_bytes and elapsed > 0 else None
+
+
+def probe_cipher_throughput(backend, cipher_algorithm, keysize):
+    """Measures the in-memory encryption throughput of the cipher with cryptsetup benchmark.
+
+    :param backend: Execution backend used to run cryptsetup.
+    :type backend: pyluks.backends.Backend
+    :param cipher_algorithm: Cipher algorithm, e.g. aes-xts-plain64
+    :type cipher_algorithm: str
+    :param keysize: Key size in bits, e.g. 256
+    :type keysize: int
+    :return: Throughput in bytes per second, or None if the benchmark fails.
+    :rtype: float
+    """
+    try:
+        stdout, _, status = backend.cipher_benchmark(cipher_algorithm, keysize)
+    except OSError:
+        return None
+    match = re.search(r'([\d.]+)\s*MiB/s\s+[\d.]+\s*MiB/s', stdout or '')
+    if status != 0 or match is None:
+        return None
+    return float(match.group(1)) * 1024**2
+
+
+def measure_throughput(backend, block_device, cipher_algorithm, keysize, cache=None, probe=True):
+    """Returns the disk and cipher throughputs used to estimate the phase durations, each taken from the
+    cache, from a probe (saved in the cache) or from the defaults, in this order.
+
+    :param backend: Execution backend used by the probes.
+    :type backend: pyluks.backends.Backend
+    :param block_device: Dictionary describing the device, as returned by pyluks.inventory.BlockInventory.device
+    :type block_device: dict
+    :param cipher_algorithm: Cipher algorithm, e.g. aes-xts-plain64
+    :type cipher_algorithm: str
+    :param keysize: Key size in bits, e.g. 256
+    :type keysize: int
+    :param cache: Cache of the measured throughputs, defaults to None (no cache)
+    :type cache: pyluks.fastluks.plan.BenchmarkCache, optional
+    :param probe: If set to False, missing results are not probed, defaults to True
+    :type probe: bool, optional
+    :return: Dictionary containing, for 'disk' and 'cipher', the bytes_per_second and their source ('cache', 'probe' or 'default').
+    :rtype: dict
+    """
+    probes = {
+        'disk': (f'{block_device["name"]}:{block_device["size"]}',
+                 lambda: probe_read_throughput(backend, block_device['path'], block_device['size']),
+                 DEFAULT_DISK_THROUGHPUT['rotational' if block_device.get('rotational') else 'solid_state']),
+        'cipher': (f'{cipher_algorithm}:{keysize}',
+                   lambda: probe_cipher_throughput(backend, cipher_algorithm, keysize),
+                   DEFAULT_CIPHER_THROUGHPUT),
+    }
+
+    throughput = {}
+    for kind, (key, run_probe, default) in probes.items():
+        value, source = (cache.get(kind, key), 'cache') if cache is not None else (None, None)
+        if value is None and probe:
+            value, source = run_probe(), 'probe'
+            if value is not None and cache is not None:
+                cache.put(kind, key, value)
+        if value is None:
+            value, source = default, 'default'
+        throughput[kind] = {'bytes_per_second': round(value), 'source': source}
+    return throughput
+
+
+
+################################################################################
+# ESTIMATES
+
+def estimate_seconds(phase, size, filesystem, throughput):
+    """Estimates the duration of a fastluks phase on a device. Writes are assumed as fast as the probed reads,
+    and data written through dm-crypt as fast as the slowest of the disk and the cipher.
+
+    :param phase: Phase name, e.g. 'format', 'wipe' or 'filesystem'
+    :type phase: str
+    :param size: Device size in bytes.
+    :type size: int
+    :param filesystem: Filesystem created on the device, e.g. ext4
+    :type filesystem: str
+    :param throughput: Throughputs, as returned by measure_throughput.
+    :type throughput: dict
+    :return: Estimated duration in seconds.
+    :rtype: float
+    """
+    disk = throughput['disk']['bytes_per_second']
+    encrypted = min(disk, throughput['cipher']['bytes_per_second'])
+    payload = max(size - LUKS_HEADER_SIZE, 0)
+
+    if phase == 'format':
+        seconds = KDF_SECONDS + LUKS_HEADER_SIZE / disk
+    elif phase == 'open':
+        seconds = KDF_SECONDS
+    elif phase == 'header_backup':
+        seconds = LUKS_HEADER_SIZE / disk
+    elif phase == 'wipe':
+        seconds = payload / encrypted
+    elif phase == 'filesystem':
+        seconds = MKFS_SECONDS + payload * MKFS_METADATA_RATIO.get(filesystem, MKFS_METADATA_RATIO['ext4']) / encrypted
+    else:
+        seconds = FIXED_SECONDS.get(phase, 0.0)
+    return round(seconds, 3)
+
+
+def wipe_resource(throughput):
+    """Returns the resource bounding the wipe: 'cpu' if the cipher is slower than the disk, otherwise 'disk'."""
+    return 'cpu' if throughput['cipher']['bytes_per_second'] < throughput['disk']['bytes_per_second'] else 'disk'
@@ -0,0 +1,108 @@
+# Import dependencies
+import os
+import io
+from configparser import ConfigParser
+
+# Import internal dependencies
+from ..utilities import write_file_atomically
+
+
+
+################################################################################
+# VARIABLES
+
+DEFAULT_STATE_FILE = '/etc/luks/fastluks-state.ini'
+
+# Phases of a fastluks run, in execution order
+ENCRYPT_PHASES = ['format', 'vault', 'header_backup', 'open', 'cryptdev_file']
+VOLUME_SETUP_PHASES = ['filesystem', 'mount']
+PHASES = ENCRYPT_PHASES + VOLUME_SETUP_PHASES
+
+
+
+################################################################################
+# RUN STATE CLASS
+
+class RunState:
+    """Persisted state of a fastluks run on a device. It records the completed phases and the LUKS UUID of the
+    formatted device. Passphrases are never stored in it. The state of each device is stored in its own section
+    of the state file, which is readable by root only.
+    """
+
+
+    def __init__(self, state_file, device_name):
+        """Instantiate a RunState object, loading the state of the device from the state file if it exists.
+
+        :param state_file: Path to the state file, e.g. /etc/luks/fastluks-state.ini
+        :type state_file: str
+        :param device_name: Name of the volume, e.g. /dev/vdb
+        :type device_name: str
+        """
+        self.state_file = state_file
+        self.device_name = device_name
+
+        self.config = ConfigParser(interpolation=None)
+        if os.path.exists(state_file):
+            self.config.read(state_file)
+        if not self.config.has_section(device_name):
+            self.config.add_section(device_name)
+        self.section = self.config[device_name]
+
+
+    def get(self, key, default=None): return self.section.get(key, default)
+
+    def completed_phases(self):
+        """Returns the list of completed phases."""
+        return [phase for phase in self.section.get('completed', '').split(',') if phase]
+
+    def is_done(self, phase):
+        """Checks if a phase has been completed in a previous run.
+
+        :param phase: Phase name, see PHASES.
+        :type phase: str
+        :return: True if the phase has been recorded as completed, otherwise False.
+        :rtype: bool
+        """
+        return phase in self.completed_phases()
+
+
+    def set(self, **values):
+        """Stores the given key-value pairs and saves the state file."""
+        for key, value in values.items():
+            self.section[key] = str(value)
+        self.save()
+
+    def unset(self, *keys):
+        """Removes the given keys and saves the state file."""
+        for key in keys:
+            self.section.pop(key, None)
+        self.save()
+
+    def mark_done(self, phase, **values):
+        """Records a phase as completed, together with the given key-value pairs, and saves the state file.
+
+        :param phase: Phase name, see PHASES.
+        :type phase: str
+        """
+        completed = self.completed_phases()
+        if phase in completed and not values:
+            return # Nothing to save
+        if phase not in completed:
+            completed.append(phase)
+        values['completed'] = ','.join(completed)
+        self.set(**values)
+
+    def reset(self):
+        """Forgets every completed phase of the device, e.g. when it's formatted again."""
+        self.section.clear()
+        self.save()
+
+
+    def save(self):
+        """Atomically writes the state file with 600 permissions."""
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_file)), exist_ok=True)
+        content = io.StringIO()
+        self.config.write(content)
+        if os.path.exists(self.state_file):
+            os.chmod(self.state_file, 0o600)
+        write_file_atomically(self.state_file, content.getvalue(), mode=0o600)
@@ -0,0 +1,235 @@
+# Import dependencies
+import os
+import io
+import gzip
+import hashlib
+from datetime import datetime
+from configparser import ConfigParser
+
+# Import internal dependencies
+from .utilities import write_file_atomically
+from .backends import get_backend
+
+
+
+################################################################################
+# VARIABLES
+
+DEFAULT_HEADER_STORE = '/etc/luks/header-store'
+INDEX_FILE = 'index.ini'
+BLOB_SUFFIX = '.img.gz'
+READ_CHUNK_SIZE = 1024**2
+
+
+
+################################################################################
+# EXCEPTIONS
+
+class HeaderStoreError(Exception):
+    """Error raised when a header backup is missing or corrupted."""
+
+
+
+################################################################################
+# HEADER STORE CLASS
+
+class HeaderStore:
+    """Versioned store of LUKS header backups. Each backup is the image produced by 'cryptsetup luksHeaderBackup',
+    compressed with gzip and stored under the LUKS UUID of the device with its sha256 digest as name:
+
+    <store_dir>/<luks_uuid>/<sha256>.img.gz
+    <store_dir>/<luks_uuid>/index.ini
+
+    Identical headers are stored once. The index lists the versions of the header from the oldest to the latest,
+    with their creation date, size and compressed size. Since the header image is a verbatim copy of the
+    beginning of the device, the header on the device can be verified by hashing the same region, without cryptsetup.
+    """
+
+
+    def __init__(self, store_dir=DEFAULT_HEADER_STORE, backend=None, compresslevel=6):
+        """Instantiate a HeaderStore object.
+
+        :param store_dir: Directory of the store, defaults to '/etc/luks/header-store'
+        :type store_dir: str, optional
+        :param backend: Execution backend used to read the headers, defaults to the backend returned by pyluks.backends.get_backend
+        :type backend: pyluks.backends.Backend, optional
+        :param compresslevel: gzip compression level of the stored backups, defaults to 6
+        :type compresslevel: int, optional
+        """
+        self.store_dir = store_dir
+        self.backend = backend if backend is not None else get_backend()
+        self.compresslevel = compresslevel
+
+
+    #____________________________________
+    # Paths and index
+    def path(self, luks_uuid, digest):
+        """Returns the path of a stored backup."""
+        return os.path.join(self.store_dir, luks_uuid, digest + BLOB_SUFFIX)
+
+    def _compress(self, image):
+        # mtime is fixed so that the same header always gives the same blob, gzip.compress only takes it on Python 3.8+
+        content = io.BytesIO()
+        with gzip.GzipFile(fileobj=content, mode='wb', compresslevel=self.compresslevel, mtime=0) as f:
+            f.write(image)
+        return content.getvalue()
+
+    def _read_index(self, luks_uuid):
+        index = ConfigParser(interpolation=None)
+        index.read(os.path.join(self.store_dir, luks_uuid, INDEX_FILE))
+        return index
+
+    def _write_index(self, luks_uuid, index):
+        content = io.StringIO()
+        index.write(content)
+        write_file_atomically(os.path.join(self.store_dir, luks_uuid, INDEX_FILE), content.getvalue(), mode=0o600)
+
+    def versions(self, luks_uuid):
+        """Lists the stored backups of a LUKS header, from the oldest to the latest.
+
+        :param luks_uuid: UUID of the LUKS header.
+        :type luks_uuid: str
+        :return: List of dictionaries with the digest, created, size and compressed_size keys.
+        :rtype: list
+        """
+        index = self._read_index(luks_uuid)
+        return [{'digest': digest,
+                 'created': index[digest]['created'],
+                 'size': int(index[digest]['size']),
+                 'compressed_size': int(index[digest]['compressed_size'])} for digest in index.sections()]
+
+    def latest(self, luks_uuid):
+        """Returns the latest backup of a LUKS header, as listed by HeaderStore.versions, or None if there is none."""
+        versions = self.versions(luks_uuid)
+        return versions[-1] if versions else None
+
+
+    #____________________________________
+    # Backup and restore
+    def add(self, luks_uuid, image):
+        """Stores a header image as the latest version of the LUKS header. If the same image is already stored,
+        it's not written again and it becomes the latest version.
+
+        :param luks_uuid: UUID of the LUKS header.
+        :type luks_uuid: str
+        :param image: Header image, as produced by 'cryptsetup luksHeaderBackup'.
+        :type image: bytes
+        :return: Dictionary describing the stored backup, as listed by HeaderStore.versions
+        :rtype: dict
+        """
+        digest = hashlib.sha256(image).hexdigest()
+        blob_path = self.path(luks_uuid, digest)
+        os.makedirs(os.path.dirname(blob_path), mode=0o700, exist_ok=True)
+
+        if not os.path.exists(blob_path):
+            write_file_atomically(blob_path, self._compress(image), mode=0o600)
+
+        index = self._read_index(luks_uuid)
+        index.remove_section(digest) # Moved to the end of the index
+        index[digest] = {'created': datetime.now().isoformat(timespec='seconds'),
+                         'size': str(len(image)),
+                         'compressed_size': str(os.path.getsize(blob_path))}
+        self._write_index(luks_uuid, index)
+        return self.latest(luks_uuid)
+
+    def backup(self, device_name, luks_uuid=None, logger=None):
+        """Reads the header of a device with 'cryptsetup luksHeaderBackup' and adds it to the store.
+
+        :param device_name: Name of the device, e.g. /dev/vdb
+        :type device_name: str
+        :param luks_uuid: UUID of the LUKS header, if already known. Otherwise it's read with cryptsetup luksUUID, defaults to None
+        :type luks_uuid: str, optional
+        :param logger: logging.Logger object used by the backend, defaults to None
+        :type logger: logging.Logger, optional
+        :raises HeaderStoreError: Raises an error if the header can't be read.
+        :return: Dictionary describing the stored backup, as listed by HeaderStore.versions
+        :rtype: dict
+        """
+        if luks_uuid is None:
+            luks_uuid = self.backend.luks_uuid(device_name, logger=logger)[0].strip()
+        image, stderr, status = self.backend.luks_header_image(device_name, logger=logger)
+        if status != 0:
+            raise HeaderStoreError(f'Unable to read the LUKS header of {device_name}: {stderr}')
+        return self.add(luks_uuid, image)
+
+    def read(self, luks_uuid, digest=None):
+        """Decompresses a stored backup, checking its digest.
+
+        :param luks_uuid: UUID of the LUKS header.
+        :type luks_uuid: str
+        :param digest: Digest of the backup, defaults to the latest one
+        :type digest: str, optional
+        :raises HeaderStoreError: Raises an error if the backup is missing or corrupted.
+        :return: Header image.
+        :rtype: bytes
+        """
+        if digest is None:
+            latest = self.latest(luks_uuid)
+            if latest is None:
+                raise HeaderStoreError(f'No header backup stored for {luks_uuid}.')
+            digest = latest['digest']
+
+        try:
+            with open(self.path(luks_uuid, digest), 'rb') as f:
+                image = gzip.decompress(f.read())
+        except (OSError, EOFError) as e:
+            raise HeaderStoreError(f'Unable to read header backup {digest} of {luks_uuid}: {e}')
+
+        if hashlib.sha256(image).hexdigest() != digest:
+            raise HeaderStoreError(f'Header backup {digest} of {luks_uuid} is corrupted.')
+        return image
+
+    def extract(self, luks_uuid, backup_file, digest=None):
+        """Writes a stored backup uncompressed, e.g. to restore it with 'cryptsetup luksHeaderRestore'.
+
+        :param luks_uuid: UUID of the LUKS header.
+        :type luks_uuid: str
+        :param backup_file: Path of the uncompressed header image.
+        :type backup_file: str
+        :param digest: Digest of the backup, defaults to the latest one
+        :type digest: str, optional
+        """
+        write_file_atomically(backup_file, self.read(luks_uuid, digest), mode=0o600)
+
+    def prune(self, luks_uuid, keep=5):
+        """Removes the oldest backups of a LUKS header, keeping the latest ones.
+
+        :param luks_uuid: UUID of the LUKS header.
+        :type luks_uuid: str
+        :param keep: Number of backups to keep, defaults to 5
+        :type keep: int, optional
+        :return: List of the removed digests.
+        :rtype: list
+        """
+        index = self._read_index(luks_uuid)
+        removed = index.sections()[:-keep] if keep > 0 else index.sections()
+        for digest in removed:
+            index.remove_section(digest)
+        self._write_index(luks_uuid, index) # The index is updated first, so it never lists a missing blob
+        for digest in removed:
+            os.remove(self.path(luks_uuid, digest))
+        return removed
+
+
+    #____________________________________
+    # Verification
+    def verify(self, device_name, luks_uuid):
+        """Checks that the header on the device matches the latest backup. The region of the device covered
+        by the backup is hashed in chunks and compared with its digest, without calling cryptsetup.
+
+        :param device_name: Name of the device, e.g. /dev/vdb
+        :type device_name: str
+        :param luks_uuid: UUID of the LUKS header.
+        :type luks_uuid: str
+        :raises HeaderStoreError: Raises an error if no backup is stored for the LUKS header.
+        :return: True if the header on the device matches the latest backup, otherwise False.
+        :rtype: bool
+        """
+        latest = self.latest(luks_uuid)
+        if latest is None:
+            raise HeaderStoreError(f'No header backup stored for {luks_uuid}.')
+
+        sha256 = hashlib.sha256()
+        for offset in range(0, latest['size'], READ_CHUNK_SIZE):
+            sha256.update(self.backend.read_device(device_name, min(READ_CHUNK_SIZE, latest['size'] - offset), offset))
+        return sha256.hexdigest() == latest['digest']
@@ -0,0 +1,335 @@
+# Import dependencies
+import os
+import re
+
+
+
+################################################################################
+# VARIABLES
+
+SYSFS_ROOT = '/sys'
+MOUNTINFO_FILE = '/proc/self/mountinfo'
+SWAPS_FILE = '/proc/swaps'
+DEV_ROOT = '/dev'
+
+LUKS_MAGIC = b'LUKS\xba\xbe'
+
+# sysfs reports sizes in 512-byte sectors, whatever the logical block size of the device
+SECTOR_SIZE = 512
+
+# Devices never proposed for encryption: RAM disks, loop devices, optical drives, zram and network block devices
+EXCLUDED_PREFIXES = ('ram', 'loop', 'sr', 'zram', 'nbd', 'fd')
+
+
+
+################################################################################
+# FUNCTIONS
+
+def unescape_mount_field(field):
+    """Decodes the octal escapes (e.g. \\040 for a space) used in /proc/self/mountinfo and /proc/swaps."""
+    return re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), field)
+
+
+def is_candidate(block_device):
+    """Checks if a block device, as described by BlockInventory.device, is an unused whole disk which can be
+    encrypted: not read-only or removable, without partitions, holders (e.g. dm-crypt, LVM, md) or mounts and
+    not used as swap. Disks with a LUKS signature are excluded when the signature could be read.
+
+    :param block_device: Dictionary describing the block device.
+    :type block_device: dict
+    :return: True if the device is a candidate for encryption, otherwise False.
+    :rtype: bool
+    """
+    return (block_device['type'] == 'disk'
+            and not block_device['name'].startswith(EXCLUDED_PREFIXES)
+            and block_device['size'] > 0
+            and not block_device['read_only']
+            and not block_device['removable']
+            and not block_device['partitions']
+            and not block_device['holders']
+            and not block_device['mountpoint']
+            and not block_device['swap']
+            and block_device['luks'] is not True)
+
+
+def mkfs_options(filesystem, topology):
+    """Returns the mkfs options aligning the filesystem to the I/O topology of the device, i.e. to the
+    RAID chunk (minimum I/O size) and stripe (optimal I/O size) reported by the kernel.
+
+    :param filesystem: Filesystem type, e.g. ext4 or xfs.
+    :type filesystem: str
+    :param topology: Dictionary describing the block device, as returned by BlockInventory.device
+    :type topology: dict
+    :return: List of mkfs arguments, empty if the device has no stripe geometry.
+    :rtype: list
+    """
+    if not topology:
+        return []
+    minimum_io = topology.get('minimum_io_size') or 0
+    optimal_io = topology.get('optimal_io_size') or 0
+    if minimum_io <= 0 or optimal_io <= minimum_io or optimal_io % minimum_io:
+        return [] # Not striped, mkfs defaults are fine
+
+    if filesystem in ('ext2', 'ext3', 'ext4'):
+        block_size = 4096
+        if minimum_io % block_size:
+            return []
+        return ['-E', f'stride={minimum_io // block_size},stripe_width={optimal_io // block_size}']
+    if filesystem == 'xfs':
+        return ['-d', f'su={minimum_io},sw={optimal_io // minimum_io}']
+    return []
+
+
+
+################################################################################
+# BLOCK DEVICE INVENTORY CLASS
+
+class BlockInventory:
+    """Inventory of the block devices of the host, read from sysfs and from the mount table of the kernel
+    without running lsblk, blkid or df. Each device is described by a dictionary with the following keys:
+
+    name, path, devnum (major:minor), type (disk, part or dm), parent, partitions, size (bytes), read_only,
+    removable, rotational, logical_block_size, physical_block_size, minimum_io_size, optimal_io_size,
+    discard_granularity, holders, slaves, dm_name, dm_uuid, mountpoint, fstype, swap and luks (True or False
+    if the LUKS signature could be read, otherwise None).
+
+    The sysfs, mountinfo, swaps and /dev paths can be pointed to a fake tree, e.g. for tests.
+    """
+
+
+    def __init__(self, sysfs_root=SYSFS_ROOT, mountinfo_file=MOUNTINFO_FILE, swaps_file=SWAPS_FILE, dev_root=DEV_ROOT):
+        """Instantiate a BlockInventory object.
+
+        :param sysfs_root: Path to sysfs, defaults to '/sys'
+        :type sysfs_root: str, optional
+        :param mountinfo_file: Path to the mountinfo file, defaults to '/proc/self/mountinfo'
+        :type mountinfo_file: str, optional
+        :param swaps_file: Path to the swaps file, defaults to '/proc/swaps'
+        :type swaps_file: str, optional
+        :param dev_root: Directory of the device nodes, used to read the LUKS signature, defaults to '/dev'
+        :type dev_root: str, optional
+        """
+        self.sysfs_root = sysfs_root
+        self.mountinfo_file = mountinfo_file
+        self.swaps_file = swaps_file
+        self.dev_root = dev_root
+
+
+    #____________________________________
+    # sysfs
+    @staticmethod
+    def _read(path, default=None):
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except OSError:
+            return default
+
+    def _read_int(self, path, default=0):
+        value = self._read(path)
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return default
+
+    @staticmethod
+    def _listdir(path):
+        try:
+            return sorted(os.listdir(path))
+        except OSError:
+            return []
+
+    def _class_dir(self, name):
+        return os.path.join(self.sysfs_root, 'class', 'block', name)
+
+    def names(self):
+        """Lists the kernel names of the block devices, e.g. vda, vda1 and dm-0, from /sys/class/block.
+        If it's missing, the disks of /sys/block and their partitions are listed instead.
+        """
+        names = self._listdir(os.path.join(self.sysfs_root, 'class', 'block'))
+        if names:
+            return names
+        block_dir = os.path.join(self.sysfs_root, 'block')
+        for disk in self._listdir(block_dir):
+            names.append(disk)
+            names.extend(part for part in self._listdir(os.path.join(block_dir, disk))
+                         if os.path.exists(os.path.join(block_dir, disk, part, 'partition')))
+        return names
+
+    def _sysfs_dir(self, name):
+        path = self._class_dir(name)
+        if os.path.exists(path):
+            return os.path.realpath(path)
+        path = os.path.join(self.sysfs_root, 'block', name)
+        if os.path.exists(path):
+            return path
+        for disk in self._listdir(os.path.join(self.sysfs_root, 'block')): # Partition without /sys/class/block
+            path = os.path.join(self.sysfs_root, 'block', disk, name)
+            if os.path.exists(os.path.join(path, 'partition')):
+                return path
+        return None
+
+    def kernel_name(self, device):
+        """Returns the kernel name of a device given its path, e.g. vdb for /dev/vdb and dm-0 for /dev/mapper/crypt.
+
+        :param device: Device path or kernel name.
+        :type device: str
+        :return: Kernel name, or None if the device is not found in sysfs.
+        :rtype: str
+        """
+        name = device
+        for dev_root in (self.dev_root, DEV_ROOT):
+            if device.startswith(dev_root.rstrip('/') + '/'):
+                name = device[len(dev_root.rstrip('/')) + 1:]
+                break
+        if name.startswith('mapper/'):
+            dm_name = name[len('mapper/'):]
+            for candidate in self.names():
+                if candidate.startswith('dm-') and self._read(os.path.join(self._class_dir(candidate), 'dm', 'name')) == dm_name:
+                    return candidate
+            return None
+        return name if self._sysfs_dir(name) is not None else None
+
+    def sysfs_dir(self, device):
+        """Returns the sysfs directory of a device, e.g. /sys/devices/virtual/block/dm-0 for /dev/mapper/crypt.
+
+        :param device: Device path or kernel name.
+        :type device: str
+        :return: Path of the directory, or None if the device is not found in sysfs.
+        :rtype: str
+        """
+        name = self.kernel_name(device)
+        return self._sysfs_dir(name) if name is not None else None
+
+
+    #____________________________________
+    # Mounts and swaps
+    def mounts(self):
+        """Parses the mount table of the kernel.
+
+        :return: List of dictionaries with the devnum, root, mountpoint, fstype and source keys.
+        :rtype: list
+        """
+        mounts = []
+        try:
+            with open(self.mountinfo_file) as f:
+                for line in f:
+                    fields = line.split()
+                    separator = fields.index('-')
+                    mounts.append({'devnum': fields[2],
+                                   'root': unescape_mount_field(fields[3]),
+                                   'mountpoint': unescape_mount_field(fields[4]),
+                                   'fstype': fields[separator + 1],
+                                   'source': unescape_mount_field(fields[separator + 2])})
+        except OSError:
+            pass
+        return mounts
+
+    def mount_info(self, mountpoint):
+        """Returns the mount on a mountpoint, as listed by BlockInventory.mounts, or None if nothing is mounted.
+        With stacked mounts, the last one is returned since it's the visible one.
+        """
+        mountpoint = os.path.normpath(mountpoint)
+        found = None
+        for mount in self.mounts():
+            if mount['mountpoint'] == mountpoint:
+                found = mount
+        return found
+
+    def swaps(self):
+        """Returns the set of paths used as swap."""
+        swaps = set()
+        try:
+            with open(self.swaps_file) as f:
+                next(f, None) # Header
+                for line in f:
+                    if line.strip():
+                        swaps.add(unescape_mount_field(line.split()[0]))
+        except OSError:
+            pass
+        return swaps
+
+
+    #____________________________________
+    # Devices
+    def has_luks_signature(self, name):
+        """Reads the LUKS magic at the beginning of the device.
+
+        :return: True or False, or None if the device can't be read (e.g. without root privileges).
+        :rtype: bool
+        """
+        try:
+            with open(os.path.join(self.dev_root, name), 'rb') as f:
+                return f.read(len(LUKS_MAGIC)) == LUKS_MAGIC
+        except OSError:
+            return None
+
+    def device(self, device, mounts=None, swaps=None):
+        """Describes a block device.
+
+        :param device: Device path (e.g. /dev/vdb or /dev/mapper/crypt) or kernel name (e.g. vdb).
+        :type device: str
+        :param mounts: Mount table, as returned by BlockInventory.mounts, read if not given, defaults to None
+        :type mounts: list, optional
+        :param swaps: Swap paths, as returned by BlockInventory.swaps, read if not given, defaults to None
+        :type swaps: set, optional
+        :return: Dictionary describing the block device, or None if it's not found in sysfs.
+        :rtype: dict
+        """
+        name = self.kernel_name(device)
+        sysfs_dir = self._sysfs_dir(name) if name is not None else None
+        if sysfs_dir is None:
+            return None
+        mounts = self.mounts() if mounts is None else mounts
+        swaps = self.swaps() if swaps is None else swaps
+
+        partition = os.path.exists(os.path.join(sysfs_dir, 'partition'))
+        parent_dir = os.path.dirname(sysfs_dir) if partition else sysfs_dir
+        dm_name = self._read(os.path.join(sysfs_dir, 'dm', 'name'))
+        devnum = self._read(os.path.join(sysfs_dir, 'dev'), '')
+        path = os.path.join(DEV_ROOT, 'mapper', dm_name) if dm_name else os.path.join(DEV_ROOT, name)
+        mount = next((m for m in mounts if m['devnum'] == devnum and m['root'] == '/'), None) if devnum else None
+
+        queue = os.path.join(parent_dir, 'queue')
+        return {'name': name,
+                'path': path,
+                'devnum': devnum,
+                'type': 'part' if partition else 'dm' if dm_name is not None else 'disk',
+                'parent': os.path.basename(parent_dir) if partition else None,
+                'partitions': [] if partition else [entry for entry in self._listdir(sysfs_dir)
+                                                    if os.path.exists(os.path.join(sysfs_dir, entry, 'partition'))],
+                'size': self._read_int(os.path.join(sysfs_dir, 'size')) * SECTOR_SIZE,
+                'read_only': self._read_int(os.path.join(sysfs_dir, 'ro')) == 1,
+                'removable': self._read_int(os.path.join(parent_dir, 'removable')) == 1,
+                'rotational': self._read_int(os.path.join(queue, 'rotational')) == 1,
+                'logical_block_size': self._read_int(os.path.join(queue, 'logical_block_size'), SECTOR_SIZE),
+                'physical_block_size': self._read_int(os.path.join(queue, 'physical_block_size'), SECTOR_SIZE),
+                'minimum_io_size': self._read_int(os.path.join(queue, 'minimum_io_size'), SECTOR_SIZE),
+                'optimal_io_size': self._read_int(os.path.join(queue, 'optimal_io_size')),
+                'discard_granularity': self._read_int(os.path.join(queue, 'discard_granularity')),
+                'holders': self._listdir(os.path.join(sysfs_dir, 'holders')),
+                'slaves': self._listdir(os.path.join(sysfs_dir, 'slaves')),
+                'dm_name': dm_name,
+                'dm_uuid': self._read(os.path.join(sysfs_dir, 'dm', 'uuid')),
+                'mountpoint': mount['mountpoint'] if mount else None,
+                'fstype': mount['fstype'] if mount else None,
+                'swap': path in swaps or os.path.join(DEV_ROOT, name) in swaps,
+                'luks': self.has_luks_signature(name)}
+
+    def devices(self):
+        """Describes all the block devices of the host, see BlockInventory.device.
+
+        :return: List of dictionaries describing the block devices.
+        :rtype: list
+        """
+        mounts, swaps = self.mounts(), self.swaps()
+        return [device for device in (self.device(name, mounts=mounts, swaps=swaps) for name in self.names())
+                if device is not None]
+
+    def candidates(self):
+        """Lists the unused whole disks which can be encrypted, see is_candidate.
+
+        :return: List of dictionaries describing the candidate disks.
+        :rtype: list
+        """
+        return [device for device in self.devices() if is_candidate(device)]
@@ -0,0 +1,381 @@
+# Import dependencies
+import os
+import re
+import mmap
+import json
+import time
+import errno
+import shutil
+import threading
+
+# Import internal dependencies
+from .utilities import write_file_atomically, run_argv
+
+
+
+################################################################################
+# VARIABLES
+
+DEFAULT_IO_LIMITS_FILE = '/run/fastluks-io-limits.json'
+
+# Directory existing only if systemd manages the host
+SYSTEMD_RUNTIME_DIR = '/run/systemd/system'
+
+# Message of systemd-run when the scope can't be started, e.g. without the io controller, before the command is run
+SCOPE_FAILED = 'Failed to start transient scope unit'
+
+# First systemd version with the IOWriteBandwidthMax and IOWriteIOPSMax properties and the --collect option of
+# systemd-run, e.g. CentOS 7 ships systemd 219
+SYSTEMD_IO_VERSION = 236
+
+# ionice scheduling classes, as accepted by 'ionice -c'
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+# Size of the writes of the throttled wipe, and bytes written between two flushes when O_DIRECT is not available
+WIPE_CHUNK_SIZE = 1024**2
+WIPE_SYNC_INTERVAL = 64 * 1024**2
+
+# Seconds between two checks of the limits file
+RELOAD_INTERVAL = 1.0
+
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3, 't': 1024**4}
+
+
+
+################################################################################
+# EXCEPTIONS
+
+class IOThrottleError(Exception):
+    """Error raised when the I/O limits are invalid."""
+
+
+
+################################################################################
+# FUNCTIONS
+
+def parse_limit(value):
+    """Parses a bandwidth or IOPS limit, e.g. '50M' (bytes per second, binary units), '500' or 'max' (no limit).
+
+    :param value: Limit, as a number or a string with an optional k, M, G or T suffix.
+    :type value: str or int
+    :raises IOThrottleError: Raises an error if the limit can't be parsed.
+    :return: The limit, or None if unlimited.
+    :rtype: int
+    """
+    if value is None or isinstance(value, int):
+        return value or None
+    if str(value).strip().lower() in ('max', 'none', ''):
+        return None
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*', str(value), re.IGNORECASE)
+    if match is None:
+        raise IOThrottleError(f'Invalid I/O limit: {value}')
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()]) or None
+
+
+def parse_ionice(value):
+    """Parses an ionice setting, e.g. 'idle', 'best-effort:7' or 'realtime:0'.
+
+    :param value: ionice class name, optionally followed by ':' and the priority level (0-7).
+    :type value: str
+    :raises IOThrottleError: Raises an error if the class or the level is invalid.
+    :return: Tuple containing the class number and the priority level (None for the idle class or if not given), or None.
+    :rtype: tuple
+    """
+    if value is None:
+        return None
+    name, _, level = value.partition(':')
+    if name not in IONICE_CLASSES or (level and not (level.isdigit() and int(level) <= 7)):
+        raise IOThrottleError(f'Invalid ionice setting: {value}')
+    return IONICE_CLASSES[name], int(level) if level and name != 'idle' else None
+
+
+def native_thread_id():
+    """Returns the kernel id of the calling thread, e.g. for 'ionice -p': threading.get_native_id on Python 3.8+,
+    otherwise read from /proc/thread-self."""
+    if hasattr(threading, 'get_native_id'):
+        return threading.get_native_id()
+    return int(os.readlink('/proc/thread-self').rsplit('/', 1)[1])
+
+
+
+################################################################################
+# IO LIMITS CLASS
+
+class IOLimits:
+    """Bandwidth and IOPS limits, and ionice class, of the heavy I/O phases of fastluks (wipe and mkfs).
+    The limits can be changed while a phase runs by writing the limits file, e.g. with 'fastluks --set-io-limits'
+    or IOLimits.write: it's checked every second, and only its changes made after the IOLimits object was
+    created are applied, so a file left by a previous run is ignored.
+    """
+
+
+    def __init__(self, bandwidth=None, iops=None, ionice=None, limits_file=DEFAULT_IO_LIMITS_FILE,
+                 reload_interval=RELOAD_INTERVAL):
+        """Instantiate an IOLimits object.
+
+        :param bandwidth: Write bandwidth limit in bytes per second, or as accepted by parse_limit, defaults to None (no limit)
+        :type bandwidth: int or str, optional
+        :param iops: Write operations per second limit, defaults to None (no limit)
+        :type iops: int or str, optional
+        :param ionice: ionice setting, as accepted by parse_ionice, e.g. 'idle', defaults to None
+        :type ionice: str, optional
+        :param limits_file: File read to change the limits at runtime, defaults to '/run/fastluks-io-limits.json'
+        :type limits_file: str, optional
+        :param reload_interval: Seconds between two checks of the limits file, defaults to 1
+        :type reload_interval: float, optional
+        """
+        self.bandwidth = parse_limit(bandwidth)
+        self.iops = parse_limit(iops)
+        self.ionice = parse_ionice(ionice)
+        self.limits_file = limits_file
+        self.reload_interval = reload_interval
+        self._mtime = int(time.time() * 1e9)
+        self._checked = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'<IOLimits bandwidth={self.bandwidth} iops={self.iops} ionice={self.ionice}>'
+
+
+    @staticmethod
+    def write(limits_file=DEFAULT_IO_LIMITS_FILE, bandwidth=None, iops=None):
+        """Writes the limits file, changing the limits of a running phase.
+
+        :param limits_file: Limits file, defaults to '/run/fastluks-io-limits.json'
+        :type limits_file: str, optional
+        :param bandwidth: Write bandwidth limit, as accepted by parse_limit, defaults to None (no limit)
+        :type bandwidth: int or str, optional
+        :param iops: Write operations per second limit, defaults to None (no limit)
+        :type iops: int or str, optional
+        """
+        limits = {'bandwidth': parse_limit(bandwidth), 'iops': parse_limit(iops)}
+        write_file_atomically(limits_file, json.dumps(limits) + '\n')
+
+    def current(self):
+        """Returns the current limits, reloading the limits file if it changed.
+
+        :return: Tuple containing the bandwidth and the IOPS limits, None if unlimited.
+        :rtype: tuple
+        """
+        with self._lock:
+            if self.limits_file is not None and time.monotonic() - self._checked >= self.reload_interval:
+                self._checked = time.monotonic()
+                self._reload()
+            return self.bandwidth, self.iops
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.limits_file).st_mtime_ns
+            if mtime <= self._mtime:
+                return
+            with open(self.limits_file) as f:
+                limits = json.load(f)
+            self.bandwidth, self.iops = parse_limit(limits.get('bandwidth')), parse_limit(limits.get('iops'))
+            self._mtime = mtime
+        except (OSError, ValueError, AttributeError, IOThrottleError):
+            pass # Missing or partially written file: the current limits are kept
+
+
+    def command(self, args):
+        """Returns a command prefixed with ionice, if an ionice class is set."""
+        if self.ionice is None:
+            return list(args)
+        ionice_class, level = self.ionice
+        return ['ionice', '-c', str(ionice_class), *(['-n', str(level)] if level is not None else []), *args]
+
+
+
+################################################################################
+# RATE LIMITER CLASS
+
+class RateLimiter:
+    """Paces a sequence of writes to the current bandwidth and IOPS limits. A change of the limits applies
+    from the next write.
+    """
+
+
+    def __init__(self, limits, clock=time.monotonic, sleep=time.sleep):
+        self.limits = limits
+        self.clock = clock
+        self.sleep = sleep
+        self._next = clock()
+
+    def wait(self, size):
+        """Waits until a write of the given size in bytes is allowed."""
+        bandwidth, iops = self.limits.current()
+        delay = max(size / bandwidth if bandwidth else 0, 1 / iops if iops else 0)
+        now = self.clock()
+        start = max(self._next, now - delay) # No credit is accumulated while idle, beyond one write
+        self._next = start + delay
+        if start > now:
+            self.sleep(start - now)
+
+
+def throttled_wipe(device, limits, size=None, chunk_size=WIPE_CHUNK_SIZE):
+    """Overwrites a device with zeros at the rate allowed by the limits, as 'dd if=/dev/zero' would do.
+    Writes bypass the page cache with O_DIRECT when the device supports it, otherwise the written data is flushed
+    regularly, so that the limits apply to the device and not to the page cache.
+
+    :param device: Device path, e.g. /dev/mapper/crypt
+    :type device: str
+    :param limits: Limits of the writes.
+    :type limits: pyluks.io_throttle.IOLimits
+    :param size: Bytes to write, defaults to the size of the device
+    :type size: int, optional
+    :param chunk_size: Size of each write, a multiple of 4096, defaults to 1 MiB
+    :type chunk_size: int, optional
+    :return: Tuple containing stdout, stderr and exit code, as dd: the exit code is 1 and stderr reports
+        'No space left on device' once the end of the device is reached.
+    :rtype: tuple
+    """
+    try:
+        try:
+            fd, direct = os.open(device, os.O_WRONLY | getattr(os, 'O_DIRECT', 0)), hasattr(os, 'O_DIRECT')
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            fd, direct = os.open(device, os.O_WRONLY), False # e.g. tmpfs files
+    except OSError as e:
+        return '', f"dd: failed to open '{device}': {e.strerror}\n", 1
+
+    buffer = mmap.mmap(-1, chunk_size) # Page aligned and zeroed, as required by O_DIRECT
+    limiter = RateLimiter(limits)
+    written, unsynced, status, stderr = 0, 0, 0, ''
+    try:
+        end = size if size is not None else os.lseek(fd, 0, os.SEEK_END)
+        os.lseek(fd, 0, os.SEEK_SET)
+        while written < end:
+            length = min(chunk_size, end - written)
+            limiter.wait(length)
+            try:
+                count = os.write(fd, buffer if length == chunk_size else memoryview(buffer)[:length])
+            except OSError as e:
+                if e.errno == errno.EINVAL and direct: # Unaligned tail
+                    os.close(fd)
+                    fd, direct = os.open(device, os.O_WRONLY), False
+                    os.lseek(fd, written, os.SEEK_SET)
+                    continue
+                raise
+            written += count
+            unsynced += count
+            if not direct and unsynced >= WIPE_SYNC_INTERVAL:
+                os.fdatasync(fd)
+                unsynced = 0
+        if not direct:
+            os.fdatasync(fd)
+        if size is None:
+            status, stderr = 1, 'dd: error writing: No space left on device\n'
+    except OSError as e:
+        status, stderr = 1, f'dd: error writing \'{device}\': {e.strerror}\n'
+    finally:
+        os.close(fd)
+        buffer.close()
+    return '', stderr + f'{written} bytes copied\n', status
+
+
+
+################################################################################
+# SYSTEMD SCOPE CLASS
+
+class IOScope:
+    """Transient systemd scope unit applying the write limits of a device to a command, e.g. mkfs, through the
+    IOWriteBandwidthMax and IOWriteIOPSMax properties. The command is run with 'systemd-run --scope', so its cgroup
+    is created by systemd in the hierarchy it manages and removed with the scope once the command exits. While
+    the command runs, the properties of the scope follow the changes of the limits, with
+    'systemctl set-property --runtime'.
+    """
+
+
+    def __init__(self, device, limits, name=None):
+        """Instantiate an IOScope object.
+
+        :param device: Block device whose writes are limited, e.g. /dev/mapper/crypt
+        :type device: str
+        :param limits: Limits applied to the device.
+        :type limits: pyluks.io_throttle.IOLimits
+        :param name: Scope unit name, without the .scope suffix, defaults to pyluks-io-<pid>
+        :type name: str, optional
+        """
+        self.device = device
+        self.limits = limits
+        self.name = name or f'pyluks-io-{os.getpid()}'
+        self.unit = f'{self.name}.scope'
+        self._applied = None
+        self._stop = threading.Event()
+        self._watcher = None
+
+    @staticmethod
+    def version():
+        """Returns the version of systemd-run, e.g. 219, or None if it can't be read."""
+        stdout, _, status = run_argv(['systemd-run', '--version'])
+        match = re.match(r'systemd (\d+)', stdout)
+        return int(match.group(1)) if status == 0 and match else None
+
+    @classmethod
+    def available(cls):
+        """Checks if systemd manages the host, as sd_booted(3) does, and if systemd-run is installed and recent
+        enough to set I/O limits.
+        """
+        if not os.path.isdir(SYSTEMD_RUNTIME_DIR) or shutil.which('systemd-run') is None:
+            return False
+        version = cls.version()
+        return version is not None and version >= SYSTEMD_IO_VERSION
+
+    def check(self):
+        """Starts a scope with the current limits running 'true', so that a failure of systemd-run, e.g. a refused
+        property, is found before the command is run.
+
+        :return: Tuple with the stderr of systemd-run and its exit status.
+        :rtype: tuple
+        """
+        options = [option for prop in self.properties() for option in ('-p', prop)]
+        _, stderr, status = run_argv(['systemd-run', '--scope', '--quiet', '--collect', f'--unit={self.name}-check.scope',
+                                      *options, 'true'])
+        return stderr, status
+
+
+    def properties(self):
+        """Returns the unit properties of the current limits, 'infinity' if unlimited."""
+        bandwidth, iops = self.limits.current()
+        return [f'IOWriteBandwidthMax={self.device} {bandwidth or "infinity"}',
+                f'IOWriteIOPSMax={self.device} {iops or "infinity"}']
+
+    def command(self, args):
+        """Returns a command run in the scope, with the current limits."""
+        self._applied = self.properties()
+        options = [option for prop in self._applied for option in ('-p', prop)]
+        return ['systemd-run', '--scope', '--quiet', '--collect', f'--unit={self.unit}', *options, *args]
+
+    def apply(self):
+        """Sets the current limits on the running scope, if they changed."""
+        properties = self.properties()
+        if properties != self._applied:
+            _, _, status = run_argv(['systemctl', 'set-property', '--runtime', self.unit, *properties])
+            if status == 0: # Otherwise the scope is not started yet, or already stopped
+                self._applied = properties
+
+
+    def follow(self):
+        """Starts following the limits, until IOScope.stop is called.
+
+        :return: The IOScope object.
+        :rtype: pyluks.io_throttle.IOScope
+        """
+        self._stop.clear()
+        self._watcher = threading.Thread(target=self._follow, name='pyluks-io-scope', daemon=True)
+        self._watcher.start()
+        return self
+
+    def _follow(self):
+        while not self._stop.wait(self.limits.reload_interval):
+            self.apply()
+
+    def stop(self):
+        """Stops following the limits."""
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
+
+    def __enter__(self): return self.follow()
+    def __exit__(self, *exc): self.stop()
@@ -1,9 +1,14 @@
 # import dependencies
-import os, sys
-from configparser import ConfigParser
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # Import internal dependencies
-from ..utilities import run_command, create_logger
+from ..utilities import LazyLogger
+from ..backends import get_backend
+from ..header_store import HeaderStore, HeaderStoreError
+from ..cryptdev_registry import CryptdevRegistry
+from ..block_tuning import TuningError, get_profile, format_drift
 
 
 
@@ -12,10 +17,135 @@ from ..utilities import run_command, create_logger
 
 LOGGER_NAME = 'luksctl'
 
-# Instantiate the logger
-luksctl_logger = create_logger(luks_cryptdev_file='/etc/luks/luks-cryptdev.ini',
-                               logger_name=LOGGER_NAME,
-                               loggers_section='logs')
+# The logger is created on first use, not at import time
+luksctl_logger = LazyLogger(luks_cryptdev_file='/etc/luks/luks-cryptdev.ini',
+                            logger_name=LOGGER_NAME,
+                            loggers_section='logs')
+
+
+
+################################################################################
+# VARIABLES
+
+# Memory used by a single KDF operation in the worst case, i.e. the maximum Argon2 memory cost of LUKS2
+KDF_MEMORY = 1024**3
+
+
+
+################################################################################
+# FUNCTIONS
+
+def available_memory():
+    """Returns the memory available for new processes, read from /proc/meminfo.
+
+    :return: Available memory in bytes, or None if it can't be read.
+    :rtype: int
+    """
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def default_kdf_jobs():
+    """Returns the default number of concurrent KDF operations (luksOpen), bounded by the available memory
+    (one KDF_MEMORY per operation) and by the number of CPUs.
+
+    :return: Number of concurrent KDF operations, at least 1.
+    :rtype: int
+    """
+    cpus = os.cpu_count() or 1
+    available = available_memory()
+    if available is None:
+        return 1
+    return max(1, min(cpus, available // KDF_MEMORY))
+
+
+def volume_result(cryptdev, action, status, message, output='', stderr=''):
+    """Builds the result of a luksctl action on a volume.
+
+    :param cryptdev: Cryptdev name of the volume.
+    :type cryptdev: str
+    :param action: Action performed on the volume, i.e. open, close, status, verify-header, tune or verify-tuning.
+    :type action: str
+    :param status: Exit code of the action, 0 on success.
+    :type status: int
+    :param message: Result line printed by luksctl, e.g. 'Encrypted volume: [ OK ]'
+    :type message: str
+    :param output: Output of the commands run by the action, e.g. 'dmsetup info', defaults to ''
+    :type output: str, optional
+    :param stderr: Error output of the failed command, defaults to ''
+    :type stderr: str, optional
+    :return: Dictionary with the cryptdev, action, ok, status, message, output and stderr keys.
+    :rtype: dict
+    """
+    return {'cryptdev': cryptdev, 'action': action, 'ok': status == 0, 'status': status,
+            'message': message, 'output': output, 'stderr': stderr}
+
+
+def format_result(result, prefix=False):
+    """Formats the result of a luksctl action as printed by the luksctl command.
+
+    :param result: Result of the action, as returned by the volume_result function.
+    :type result: dict
+    :param prefix: If set to True, each line is prefixed by the cryptdev name, defaults to False
+    :type prefix: bool, optional
+    :return: The output of the action, if any, followed by the result message.
+    :rtype: str
+    """
+    lines = ([result['output'].rstrip('\n'), ''] if result['output'] else []) + [result['message']]
+    lines = '\n'.join(lines).split('\n')
+    if prefix:
+        lines = [f'{result["cryptdev"]}: {line}' for line in lines]
+    return '\n'.join(lines) + '\n'
+
+
+def print_result(result, prefix=False):
+    """Prints the result of a luksctl action, formatted by the format_result function."""
+    print(format_result(result, prefix=prefix), end='')
+
+
+def run_all(config_file, action, backend=None, secret=None, jobs=None, kdf_jobs=None, tuning_profile=None, tune_disks=None):
+    """Performs an action on every volume registered in the cryptdev .ini file concurrently.
+
+    :param config_file: Path to the cryptdev .ini file.
+    :type config_file: str
+    :param action: Action to be performed, i.e. open, close, status, verify-header, tune or verify-tuning.
+    :type action: str
+    :param backend: Execution backend used to manage the devices, defaults to the backend returned by pyluks.backends.get_backend
+    :type backend: pyluks.backends.Backend, optional
+    :param secret: Passphrase used to open the volumes, defaults to None
+    :type secret: str, optional
+    :param jobs: Maximum number of volumes processed concurrently, defaults to the number of volumes
+    :type jobs: int, optional
+    :param kdf_jobs: Maximum number of concurrent luksOpen, to bound the memory used by the KDF, defaults to default_kdf_jobs()
+    :type kdf_jobs: int, optional
+    :param tuning_profile: Tuning profile applied and recorded by the tune action, defaults to the recorded profile of each volume
+    :type tuning_profile: str, optional
+    :param tune_disks: Whether the tune action also tunes the underlying disks, recorded for each volume, defaults to the recorded setting of each volume
+    :type tune_disks: bool, optional
+    :return: List of results, as returned by the volume_result function, in the order of the registry.
+    :rtype: list
+    """
+    registry = CryptdevRegistry(config_file)
+    volumes = [LUKSCtl(config_file, backend=backend, cryptdev=cryptdev, registry=registry) for cryptdev in registry.names()]
+    if not volumes:
+        return []
+
+    kdf_semaphore = threading.BoundedSemaphore(kdf_jobs or default_kdf_jobs())
+    functions = {'open': lambda luks: luks.open(secret=secret, kdf_semaphore=kdf_semaphore),
+                 'close': lambda luks: luks.close(),
+                 'status': lambda luks: luks.status(),
+                 'verify-header': lambda luks: luks.check_header(),
+                 'tune': lambda luks: luks.tune(profile=tuning_profile, tune_disks=tune_disks),
+                 'verify-tuning': lambda luks: luks.check_tuning()}
+
+    with ThreadPoolExecutor(max_workers=min(jobs or len(volumes), len(volumes))) as executor:
+        return list(executor.map(functions[action], volumes))
 
 
 
@@ -24,22 +154,29 @@ luksctl_logger = create_logger(luks_cryptdev_file='/etc/luks/luks-cryptdev.ini',
 
 class LUKSCtl:
     """Class that provides functions to manage a LUKS encrypted device. It reads the encrypted device information
-    from the cryptdev .ini file.
+    from the cryptdev .ini file, which may hold several volumes.
     """
 
 
-    def __init__(self, config_file):
+    def __init__(self, config_file, backend=None, cryptdev=None, registry=None):
         """Instantiate a LUKSCtl object.
 
         :param config_file: Path to the cryptdev .ini file.
         :type config_file: str
+        :param backend: Execution backend used to manage the device, defaults to the backend returned by pyluks.backends.get_backend
+        :type backend: pyluks.backends.Backend, optional
+        :param cryptdev: Cryptdev name, LUKS UUID, device or mountpoint of the volume, defaults to the volume in the 'luks' section
+        :type cryptdev: str, optional
+        :param registry: Registry already loaded from config_file, to avoid reading it again for each volume, defaults to None
+        :type registry: pyluks.cryptdev_registry.CryptdevRegistry, optional
         """
 
         self.config_file = config_file
+        self.backend = backend if backend is not None else get_backend()
 
-        config = ConfigParser()
-        config.read(config_file)
-        luks_config = config['luks']
+        if registry is None:
+            registry = CryptdevRegistry(config_file)
+        luks_config = registry.lookup(cryptdev)
 
         self.cipher_algorithm = luks_config['cipher_algorithm']
         self.hash_algorithm = luks_config['hash_algorithm']
@@ -50,6 +187,9 @@ class LUKSCtl:
         self.mapper = luks_config['mapper']
         self.mountpoint = luks_config['mountpoint']
         self.filesystem = luks_config['filesystem']
+        self.header_store = luks_config.get('header_store')
+        self.tuning_profile = luks_config.get('tuning_profile')
+        self.tune_disks = luks_config.get('tune_disks', '').lower() in ('1', 'true', 'yes')
 
 
     def get_cipher_algorithm(self): return self.cipher_algorithm
@@ -81,57 +221,270 @@ class LUKSCtl:
         :rtype: int
         """
 
-        _, _, status = run_command(f'dmsetup info /dev/mapper/{self.cryptdev}')
+        _, _, status = self.backend.dmsetup_info(self.cryptdev)
         return status
-  
 
-    def display_dmsetup_info(self):
-        """Displays the cryptdevice status. It prints the device information, followed by 'Encrypted volume: [ OK ]'
-        if the device is correctly setup and open, otherwise it prints 'Encrypted volume: [ FAIL ]'.
+
+    def status(self):
+        """Checks the cryptdevice status with 'dmsetup info'.
+
+        :return: Result of the action, as returned by the volume_result function. The output contains the device
+                 information if the device is correctly setup and open.
+        :rtype: dict
         """
 
-        stdOutValue, stdErrValue, status = run_command(f'dmsetup info /dev/mapper/{self.cryptdev}')
+        stdOutValue, stdErrValue, status = self.backend.dmsetup_info(self.cryptdev)
 
         if str(status) == '0':
-            print(stdOutValue)
-            print('Encrypted volume: [ OK ]')
-            sys.exit(0)
+            return volume_result(self.cryptdev, 'status', 0, 'Encrypted volume: [ OK ]', output=stdOutValue)
         else:
             luksctl_logger.debug(f'[luksctl] {stdErrValue}')
-            print('Encrypted volume: [ FAIL ]')
-            sys.exit(1)
-    
+            return volume_result(self.cryptdev, 'status', 1, 'Encrypted volume: [ FAIL ]', stderr=stdErrValue)
 
-    def luksopen_device(self):
-        """Opens the cryptdevice, mounts it and call the LUKSCtl.display_dmsetup_info method. It prints
-        'Encrypted volume mount: [ FAIL ]' if the mount command returns an error.
+
+    def open(self, secret=None, kdf_semaphore=None):
+        """Opens the cryptdevice and mounts it, unless it's already mounted, then checks its status. The tuning profile
+        recorded in the cryptdev .ini file, if any, is applied to the mapped device before mounting it.
+
+        :param secret: Passphrase of the device. If not specified, cryptsetup reads it from stdin, defaults to None
+        :type secret: str, optional
+        :param kdf_semaphore: Semaphore held during luksOpen, to limit the number of concurrent KDF operations, defaults to None
+        :type kdf_semaphore: threading.Semaphore, optional
+        :return: Result of the action, as returned by the volume_result function.
+        :rtype: dict
         """
 
-        run_command(f'cryptsetup luksOpen /dev/disk/by-uuid/{self.uuid} {self.cryptdev}')
-    
-        _, _, status = run_command(f'mount /dev/mapper/{self.cryptdev} {self.mountpoint}')
-    
+        mapper = f'/dev/mapper/{self.cryptdev}'
+        if self.backend.is_mount(self.mountpoint) and self.backend.mount_source(self.mountpoint) == mapper:
+            return dict(self.status(), action='open')
+
+        if kdf_semaphore is not None:
+            with kdf_semaphore:
+                _, stderr, status = self.backend.luks_open(f'/dev/disk/by-uuid/{self.uuid}', self.cryptdev, secret=secret)
+        else:
+            _, stderr, status = self.backend.luks_open(f'/dev/disk/by-uuid/{self.uuid}', self.cryptdev, secret=secret)
+        if status == 5:
+            luksctl_logger.debug(f'[luksctl] {stderr}') # Already open, only the mount is missing
+        elif status != 0:
+            luksctl_logger.debug(f'[luksctl] {stderr}')
+            return volume_result(self.cryptdev, 'open', 1, 'Encrypted volume mount: [ FAIL ]', stderr=stderr)
+
+        if self.tuning_profile:
+            try:
+                self.apply_tuning()
+            except TuningError:
+                pass # Logged by apply_tuning, the volume is still mounted
+
+        _, stderr, status = self.backend.mount(mapper, self.mountpoint)
+
         if str(status) == '0':
-            self.display_dmsetup_info()
+            return dict(self.status(), action='open')
         else:
-            print('Encrypted volume mount: [ FAIL ]')
-            sys.exit(1)
-    
+            return volume_result(self.cryptdev, 'open', 1, 'Encrypted volume mount: [ FAIL ]', stderr=stderr)
 
-    def luksclose_device(self):
-        """Unmounts, closes the cryptdevice and calls the LUKSCtl.dmsetup_info method. It prints
-        'Encrypted volume umount: [ OK ]' if the cryptdevice is correctly closed, 'Encrypted volume umount [ FAIL ]'
-        otherwise.
+
+    def close(self):
+        """Unmounts and closes the cryptdevice, then checks that it's closed with 'dmsetup info'.
+
+        :return: Result of the action, as returned by the volume_result function.
+        :rtype: dict
         """
 
-        run_command(f'umount {self.mountpoint}') # Unmount device
+        self.backend.umount(self.mountpoint) # Unmount device
 
-        run_command(f'cryptsetup close {self.cryptdev}') # Close device
+        _, stderr, _ = self.backend.luks_close(self.cryptdev) # Close device
 
         # if dmsetup_setup fails (status 1) the volume has been correctly closed
         if str(self.dmsetup_info()) == '0':
-            print('Encrypted volume umount: [ FAIL ]')
-            sys.exit(1)
+            return volume_result(self.cryptdev, 'close', 1, 'Encrypted volume umount: [ FAIL ]', stderr=stderr)
         else:
-            print('Encrypted volume umount: [ OK ]')
-            sys.exit(0)
+            return volume_result(self.cryptdev, 'close', 0, 'Encrypted volume umount: [ OK ]')
+
+
+    def check_header(self):
+        """Checks the LUKS header on the device against its latest backup in the header store, hashing the header
+        region of the device without calling cryptsetup.
+
+        :return: Result of the action, as returned by the volume_result function.
+        :rtype: dict
+        """
+
+        if self.header_store is None:
+            return volume_result(self.cryptdev, 'verify-header', 1, 'LUKS header: [ FAIL ] (no header store configured)')
+
+        try:
+            header_ok = HeaderStore(self.header_store, backend=self.backend).verify(self.device, self.uuid)
+        except (HeaderStoreError, OSError) as e:
+            luksctl_logger.debug(f'[luksctl] {e}')
+            return volume_result(self.cryptdev, 'verify-header', 1, 'LUKS header: [ FAIL ]', stderr=str(e))
+
+        if header_ok:
+            return volume_result(self.cryptdev, 'verify-header', 0, 'LUKS header: [ OK ]')
+        else:
+            return volume_result(self.cryptdev, 'verify-header', 1, 'LUKS header: [ FAIL ]')
+
+
+    def apply_tuning(self, profile=None, tune_disks=None):
+        """Applies a tuning profile to the mapped device, see pyluks.block_tuning.BlockTuner.apply.
+
+        :param profile: Tuning profile name, defaults to the profile recorded in the cryptdev .ini file
+        :type profile: str, optional
+        :param tune_disks: Whether the request queue settings are also written to the underlying disks, defaults to the
+            tune_disks setting recorded in the cryptdev .ini file
+        :type tune_disks: bool, optional
+        :raises TuningError: Raises an error if the profile doesn't exist or the device is not mapped.
+        :return: Error messages of the settings which were not applied, empty on success.
+        :rtype: list
+        """
+        profile = profile or self.tuning_profile
+        tune_disks = self.tune_disks if tune_disks is None else tune_disks
+        try:
+            settings = get_profile(profile, self.config_file)
+            result = self.backend.tune_block_device(f'/dev/mapper/{self.cryptdev}', settings, logger=luksctl_logger,
+                                                    tune_disks=tune_disks)
+        except TuningError as e:
+            luksctl_logger.warning(f'[luksctl] Tuning profile {profile} not applied to {self.cryptdev}: {e}')
+            raise
+        errors = [f'{setting}={values["value"]}: {values["error"]}' for setting, values in result.items() if values['error']]
+        if errors:
+            luksctl_logger.warning(f'[luksctl] Tuning profile {profile} partially applied to {self.cryptdev}: {"; ".join(errors)}')
+        return errors
+
+
+    def tune(self, profile=None, tune_disks=None):
+        """Applies a tuning profile to the mapped device. If a different profile or tune_disks setting is specified,
+        it's recorded in the cryptdev .ini file and applied after each open from then on.
+
+        :param profile: Tuning profile name, defaults to the profile recorded in the cryptdev .ini file
+        :type profile: str, optional
+        :param tune_disks: Whether the request queue settings are also written to the underlying disks, see
+            pyluks.block_tuning.BlockTuner, defaults to the tune_disks setting recorded in the cryptdev .ini file
+        :type tune_disks: bool, optional
+        :return: Result of the action, as returned by the volume_result function.
+        :rtype: dict
+        """
+        profile = profile or self.tuning_profile
+        if not profile:
+            return volume_result(self.cryptdev, 'tune', 1, 'Block-layer tuning: [ FAIL ] (no tuning profile configured)')
+
+        try:
+            errors = self.apply_tuning(profile, tune_disks)
+        except TuningError as e:
+            return volume_result(self.cryptdev, 'tune', 1, 'Block-layer tuning: [ FAIL ]', stderr=str(e))
+
+        tune_disks = self.tune_disks if tune_disks is None else tune_disks
+        if profile != self.tuning_profile or tune_disks != self.tune_disks:
+            registry = CryptdevRegistry(self.config_file)
+            registry.add(dict(registry.get(self.cryptdev), tuning_profile=profile, tune_disks=str(tune_disks).lower()))
+            self.tuning_profile, self.tune_disks = profile, tune_disks
+
+        if errors:
+            return volume_result(self.cryptdev, 'tune', 1, f'Block-layer tuning: [ FAIL ] ({profile})', stderr='\n'.join(errors))
+        return volume_result(self.cryptdev, 'tune', 0, f'Block-layer tuning: [ OK ] ({profile})')
+
+
+    def check_tuning(self):
+        """Checks that the settings of the mapped device (and of the underlying disks, for the request queue ones, if
+        tune_disks is recorded) still match the recorded tuning profile.
+
+        :return: Result of the action, as returned by the volume_result function. The output lists the drifted
+                 settings, e.g. 'read_ahead_kb: 128 on dm-0, expected 4096'.
+        :rtype: dict
+        """
+
+        if not self.tuning_profile:
+            return volume_result(self.cryptdev, 'verify-tuning', 1, 'Block-layer tuning: [ FAIL ] (no tuning profile configured)')
+
+        try:
+            settings = get_profile(self.tuning_profile, self.config_file)
+            drift = self.backend.block_tuning_drift(f'/dev/mapper/{self.cryptdev}', settings, tune_disks=self.tune_disks)
+        except TuningError as e:
+            luksctl_logger.debug(f'[luksctl] {e}')
+            return volume_result(self.cryptdev, 'verify-tuning', 1, 'Block-layer tuning: [ FAIL ]', stderr=str(e))
+
+        if drift:
+            return volume_result(self.cryptdev, 'verify-tuning', 1, f'Block-layer tuning: [ FAIL ] ({self.tuning_profile})',
+                                 output=format_drift(drift))
+        return volume_result(self.cryptdev, 'verify-tuning', 0, f'Block-layer tuning: [ OK ] ({self.tuning_profile})')
+
+
+    def display_dmsetup_info(self):
+        """Displays the cryptdevice status. It prints the device information, followed by 'Encrypted volume: [ OK ]'
+        if the device is correctly setup and open, otherwise it prints 'Encrypted volume: [ FAIL ]'.
+
+        :return: Exit code, 0 if the device is open.
+        :rtype: int
+        """
+
+        result = self.status()
+        print_result(result)
+        return result['status']
+    
+
+    def luksopen_device(self):
+        """Opens the cryptdevice, mounts it and displays its status as the LUKSCtl.display_dmsetup_info method.
+        It prints 'Encrypted volume mount: [ FAIL ]' if the mount command returns an error.
+
+        :return: Exit code, 0 if the device is open and mounted.
+        :rtype: int
+        """
+
+        result = self.open()
+        print_result(result)
+        return result['status']
+    
+
+    def luksclose_device(self):
+        """Unmounts and closes the cryptdevice. It prints 'Encrypted volume umount: [ OK ]' if the cryptdevice is
+        correctly closed, 'Encrypted volume umount [ FAIL ]' otherwise.
+
+        :return: Exit code, 0 if the device is closed.
+        :rtype: int
+        """
+
+        result = self.close()
+        print_result(result)
+        return result['status']
+
+
+    def verify_header(self):
+        """Checks the LUKS header with the LUKSCtl.check_header method. It prints 'LUKS header: [ OK ]' if it
+        matches the latest backup, 'LUKS header: [ FAIL ]' otherwise.
+
+        :return: Exit code, 0 if the header matches the latest backup.
+        :rtype: int
+        """
+
+        result = self.check_header()
+        print_result(result)
+        return result['status']
+
+
+    def tune_device(self, profile=None, tune_disks=None):
+        """Applies a tuning profile with the LUKSCtl.tune method and prints the result.
+
+        :param profile: Tuning profile name, defaults to the profile recorded in the cryptdev .ini file
+        :type profile: str, optional
+        :param tune_disks: Whether the underlying disks are also tuned, defaults to the recorded setting
+        :type tune_disks: bool, optional
+        :return: Exit code, 0 if every setting of the profile was applied.
+        :rtype: int
+        """
+
+        result = self.tune(profile, tune_disks)
+        print_result(result)
+        return result['status']
+
+
+    def verify_tuning(self):
+        """Checks the block-layer settings with the LUKSCtl.check_tuning method. It prints the drifted settings, if any,
+        followed by 'Block-layer tuning: [ OK ]' if the device matches its tuning profile, 'Block-layer tuning: [ FAIL ]'
+        otherwise.
+
+        :return: Exit code, 0 if the device matches its tuning profile.
+        :rtype: int
+        """
+
+        result = self.check_tuning()
+        print_result(result)
+        return result['status']
@@ -0,0 +1,422 @@
+# Import dependencies
+import os
+import re
+import secrets
+import threading
+from string import ascii_letters, digits
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# Import internal dependencies
+from ..backends import get_backend
+from ..header_store import HeaderStore, HeaderStoreError
+from ..cryptdev_registry import CryptdevRegistry
+from ..vault_support import read_secret_version, update_secret
+from ..fastluks.state import RunState
+from .luksctl_lib import luksctl_logger, volume_result, available_memory, KDF_MEMORY
+
+
+
+################################################################################
+# VARIABLES
+
+DEFAULT_ROTATION_STATE_DIR = '/etc/luks/rotation'
+DEFAULT_PASSPHRASE_LENGTH = 32
+
+# Phases of a passphrase rotation, in execution order
+ROTATION_PHASES = ['add_key', 'store', 'verify', 'kill_slot', 'header_backup']
+
+
+
+################################################################################
+# EXCEPTIONS
+
+class RotationError(Exception):
+    """Error raised when a passphrase rotation can't be started or completed."""
+
+
+
+################################################################################
+# FUNCTIONS
+
+def new_passphrase(length=DEFAULT_PASSPHRASE_LENGTH):
+    """Generates a random alphanumeric passphrase with a cryptographically secure generator.
+
+    :param length: Passphrase length, defaults to 32
+    :type length: int, optional
+    :return: The passphrase.
+    :rtype: str
+    """
+    alphabet = ascii_letters + digits
+    return ''.join(secrets.choice(alphabet) for _ in range(length))
+
+
+def _key_slot(stdout):
+    """Returns the key slot reported by cryptsetup -v, e.g. 'Key slot 1 created.', or None."""
+    match = re.search(r'Key slot (\d+) (?:created|unlocked)', stdout or '')
+    return int(match.group(1)) if match else None
+
+
+def active_key_slots(dump):
+    """Returns the active key slots listed by cryptsetup luksDump: 'Key Slot 0: ENABLED' lines for LUKS1, entries of
+    the 'Keyslots:' section for LUKS2.
+
+    :param dump: Output of cryptsetup luksDump.
+    :type dump: str
+    :return: Set of the active key slots.
+    :rtype: set
+    """
+    if re.search(r'^Key Slot \d+:', dump, re.MULTILINE):
+        return {int(slot) for slot in re.findall(r'^Key Slot (\d+): ENABLED', dump, re.MULTILINE)}
+    section = re.search(r'^Keyslots:\n((?:[ \t]+.*\n?)*)', dump, re.MULTILINE)
+    return {int(slot) for slot in re.findall(r'^  (\d+): ', section.group(1), re.MULTILINE)} if section else set()
+
+
+def check_secret_path(secret_path, volumes):
+    """Checks that a Vault secret path template gives a distinct secret to each volume.
+
+    :param secret_path: Secret path, with the {cryptdev} and {uuid} placeholders replaced for each volume.
+    :type secret_path: str
+    :param volumes: Volumes as registered in the cryptdev .ini file.
+    :type volumes: list
+    :raises RotationError: Raises an error if volumes share a secret or the path has an unknown placeholder.
+    """
+    try:
+        paths = [secret_path.format(**volume) for volume in volumes]
+    except (KeyError, IndexError, ValueError) as e:
+        raise RotationError(f'Invalid Vault secret path {secret_path}: {e}')
+    if len(set(paths)) < len(paths):
+        raise RotationError(f'Vault secret path {secret_path} is the same for several volumes, '
+                            'use the {cryptdev} or {uuid} placeholders.')
+
+
+
+################################################################################
+# MEMORY BUDGET CLASS
+
+class KDFMemoryBudget:
+    """Memory budget shared by concurrent KDF operations. Each luksAddKey, luksKillSlot or passphrase test
+    reserves the memory its key derivation may use, and waits while the budget is exhausted, so that many volumes
+    can be processed concurrently without running the host out of memory.
+    """
+
+
+    def __init__(self, total=None, per_operation=KDF_MEMORY):
+        """Instantiate a KDFMemoryBudget object.
+
+        :param total: Memory in bytes shared by the KDF operations, defaults to the available memory
+        :type total: int, optional
+        :param per_operation: Memory in bytes reserved by each KDF operation, defaults to 1 GiB, the maximum Argon2 memory cost of LUKS2
+        :type per_operation: int, optional
+        """
+        self.per_operation = per_operation
+        total = total if total is not None else available_memory() or per_operation
+        self.total = max(total, per_operation) # At least one operation can run
+        self.used = 0
+        self.peak = 0
+        self._condition = threading.Condition()
+
+
+    @contextmanager
+    def reserve(self, amount=None):
+        """Reserves memory for the duration of a KDF operation, waiting until enough memory is free.
+
+        :param amount: Memory in bytes, defaults to per_operation
+        :type amount: int, optional
+        """
+        amount = min(amount if amount is not None else self.per_operation, self.total)
+        with self._condition:
+            self._condition.wait_for(lambda: self.used + amount <= self.total)
+            self.used += amount
+            self.peak = max(self.peak, self.used)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.used -= amount
+                self._condition.notify_all()
+
+
+
+################################################################################
+# PASSPHRASE ROTATION CLASS
+
+class PassphraseRotation:
+    """Rotation of the passphrase of a volume. The new passphrase is added to a free key slot before the old
+    one is removed, so the volume can be opened at any point with the stored passphrase:
+
+    * add_key: generates the new passphrase and adds it to a free key slot with luksAddKey.
+    * store: writes the new passphrase to Vault with check-and-set against the version read at the start, and to the
+      cryptdev .ini file if the passphrase is saved there.
+    * verify: checks that the new passphrase opens the new key slot and that the stored passphrase is the new one.
+    * kill_slot: removes the key slot of the old passphrase with luksKillSlot, authenticated by the new passphrase.
+    * header_backup: adds the new header to the header store of the volume, if any.
+
+    The progress is persisted in a state file per volume, readable by root only, so that an interrupted rotation
+    is resumed. Passphrases are never written to it: when resuming, the stored passphrase tells whether the new one
+    was stored. If it opens a new key slot, the rotation continues from the first incomplete phase; if it still opens
+    the old key slot, the key slots added by the interrupted rotation, whose passphrase is lost, are removed and the
+    rotation starts over. The state file is removed once the rotation is completed.
+    """
+
+
+    def __init__(self, volume, backend=None, budget=None, vault=None, registry=None,
+                 passphrase_length=DEFAULT_PASSPHRASE_LENGTH, pbkdf_memory=None, state_dir=DEFAULT_ROTATION_STATE_DIR):
+        """Instantiate a PassphraseRotation object.
+
+        :param volume: Volume as registered in the cryptdev .ini file, see pyluks.cryptdev_registry.CryptdevRegistry.get
+        :type volume: dict
+        :param backend: Execution backend used to manage the device, defaults to the backend returned by pyluks.backends.get_backend
+        :type backend: pyluks.backends.Backend, optional
+        :param budget: Memory budget shared with the other rotations, defaults to a budget of the available memory
+        :type budget: pyluks.luksctl.rotation.KDFMemoryBudget, optional
+        :param vault: Vault location of the passphrase, with the vault_url, vault_token, secret_root, secret_path and secret_key keys, defaults to None
+        :type vault: dict, optional
+        :param registry: Registry of the volume, required if the passphrase is saved in it, defaults to None
+        :type registry: pyluks.cryptdev_registry.CryptdevRegistry, optional
+        :param passphrase_length: Length of the new passphrase, defaults to 32
+        :type passphrase_length: int, optional
+        :param pbkdf_memory: Argon2 memory cost in KiB of the new key slot, defaults to the cryptsetup default
+        :type pbkdf_memory: int, optional
+        :param state_dir: Directory of the rotation state files, defaults to '/etc/luks/rotation'
+        :type state_dir: str, optional
+        """
+        self.volume = volume
+        self.cryptdev = volume['cryptdev']
+        self.device = volume['device']
+        self.backend = backend if backend is not None else get_backend()
+        self.budget = budget if budget is not None else KDFMemoryBudget()
+        self.vault = vault
+        self.registry = registry
+        self.passphrase_length = passphrase_length
+        self.pbkdf_memory = pbkdf_memory
+        self.state = RunState(os.path.join(state_dir, f'{volume["uuid"]}.ini'), self.device)
+        self.old_passphrase = None
+        self.new_passphrase = None
+
+        # Memory reserved by the KDF of the new key slot, and by the ones of existing key slots (worst case)
+        self.new_slot_memory = pbkdf_memory * 1024 if pbkdf_memory is not None else self.budget.per_operation
+
+
+    #____________________________________
+    # Passphrase storage
+    def _read_stored(self):
+        """Returns the stored passphrase and the Vault version, None without Vault."""
+        if self.vault is not None:
+            data, version = read_secret_version(self.vault['vault_url'], self.vault['vault_token'],
+                                                self.vault['secret_root'], self.vault['secret_path'])
+            return data.get(self.vault['secret_key']), version
+        return self.registry.get(self.cryptdev).get('passphrase'), None
+
+    def _store(self, new):
+        if self.vault is not None:
+            data, version = read_secret_version(self.vault['vault_url'], self.vault['vault_token'],
+                                                self.vault['secret_root'], self.vault['secret_path'])
+            if data.get(self.vault['secret_key']) != new:
+                if version != int(self.state.get('vault_version')):
+                    raise self._changed(version)
+                update_secret(self.vault['vault_url'], self.vault['vault_token'], self.vault['secret_root'],
+                              self.vault['secret_path'], dict(data, **{self.vault['secret_key']: new}),
+                              cas=int(self.state.get('vault_version')))
+        if 'passphrase' in self.volume:
+            self.registry.add(dict(self.registry.get(self.cryptdev), passphrase=new))
+
+    def _stored(self, new):
+        """Checks that every storage holds the new passphrase."""
+        if self.vault is not None:
+            data, _ = read_secret_version(self.vault['vault_url'], self.vault['vault_token'],
+                                          self.vault['secret_root'], self.vault['secret_path'])
+            if data.get(self.vault['secret_key']) != new:
+                return False
+        if 'passphrase' in self.volume:
+            return self.registry.get(self.cryptdev).get('passphrase') == new
+        return True
+
+    def _changed(self, version):
+        return RotationError(f'Vault secret {self.vault["secret_path"]} changed since the rotation started '
+                             f'(version {version}, expected {self.state.get("vault_version")}).')
+
+
+    #____________________________________
+    # Key slots
+    def test_passphrase(self, secret, key_slot=None, memory=None):
+        """Returns the key slot opened by a passphrase, or None, reserving the KDF memory during the test."""
+        with self.budget.reserve(memory):
+            stdout, _, status = self.backend.luks_test_passphrase(self.device, secret, key_slot=key_slot)
+        return _key_slot(stdout) if _key_slot(stdout) is not None else key_slot if status == 0 else None
+
+    def active_slots(self):
+        """Returns the active key slots of the device, read from its header with luksDump."""
+        stdout, stderr, status = self.backend.luks_dump(self.device)
+        if status != 0:
+            raise RotationError(f'luksDump failed with exit code {status}: {stderr.strip()}')
+        return active_key_slots(stdout)
+
+    def _phase(self, phase, is_done, run):
+        if is_done():
+            luksctl_logger.debug(f'[luksctl] {self.cryptdev}: rotation phase {phase} already completed, skipping.')
+        else:
+            luksctl_logger.debug(f'[luksctl] {self.cryptdev}: starting rotation phase {phase}.')
+            run()
+        self.state.mark_done(phase)
+
+    def _start(self):
+        """Reads the current passphrase and generates the new one, or resumes an interrupted rotation."""
+        if 'passphrase' not in self.volume and self.vault is None:
+            raise RotationError('The new passphrase can be stored neither in Vault nor in the cryptdev .ini file.')
+        if self.state.get('old_passphrase') is not None or self.state.get('new_passphrase') is not None:
+            self.state.unset('old_passphrase', 'new_passphrase') # Written by earlier versions
+        stored, version = self._read_stored()
+        slot = self.test_passphrase(stored) if stored is not None else None
+
+        if self.state.get('old_slot') is not None:
+            old_slot = int(self.state.get('old_slot'))
+            if slot is None:
+                if version is not None and self.state.get('vault_version') is not None and version != int(self.state.get('vault_version')):
+                    raise self._changed(version)
+                raise RotationError('The stored passphrase does not open the volume.')
+            if slot != old_slot:
+                luksctl_logger.info(f'[luksctl] Resuming the passphrase rotation of {self.cryptdev}.')
+                self.new_passphrase = stored
+                self.state.set(new_slot=slot)
+                return
+            # The new passphrase was not stored: the key slots added by the interrupted rotation can't be opened anymore
+            for orphan in sorted(self.active_slots() - {int(s) for s in self.state.get('active_slots', '').split(',') if s}):
+                luksctl_logger.info(f'[luksctl] {self.cryptdev}: removing key slot {orphan} of an interrupted rotation.')
+                with self.budget.reserve():
+                    _, stderr, status = self.backend.luks_kill_slot(self.device, orphan, stored)
+                if status != 0:
+                    raise RotationError(f'luksKillSlot of key slot {orphan} failed with exit code {status}: {stderr.strip()}')
+            self.state.reset()
+
+        if stored is None:
+            raise RotationError('Current passphrase not available.')
+        if slot is None:
+            raise RotationError('The current passphrase does not open the volume.')
+        self.old_passphrase, self.new_passphrase = stored, new_passphrase(self.passphrase_length)
+        self.state.set(old_slot=slot, active_slots=','.join(str(s) for s in sorted(self.active_slots())),
+                       **({'vault_version': version} if version is not None else {}))
+
+
+    def add_key(self):
+        """Adds the new passphrase to a free key slot, unlocking the old key slot."""
+        with self.budget.reserve(max(self.budget.per_operation, self.new_slot_memory)):
+            stdout, stderr, status = self.backend.luks_add_key(self.device, self.old_passphrase, self.new_passphrase,
+                                                               pbkdf_memory=self.pbkdf_memory)
+        if status != 0:
+            raise RotationError(f'luksAddKey failed with exit code {status}: {stderr.strip()}')
+        if _key_slot(stdout) is not None:
+            self.state.set(new_slot=_key_slot(stdout))
+
+    def kill_slot(self):
+        """Removes the key slot of the old passphrase, authenticated by the new passphrase."""
+        old_slot = int(self.state.get('old_slot'))
+        with self.budget.reserve(self.new_slot_memory):
+            _, stderr, status = self.backend.luks_kill_slot(self.device, old_slot, self.new_passphrase)
+        if status != 0:
+            raise RotationError(f'luksKillSlot of key slot {old_slot} failed with exit code {status}: {stderr.strip()}')
+
+    def verify(self):
+        """Checks that the new passphrase opens the new key slot and that it's the stored one."""
+        new = self.new_passphrase
+        new_slot = self.state.get('new_slot')
+        if self.test_passphrase(new, key_slot=int(new_slot) if new_slot else None, memory=self.new_slot_memory) is None:
+            raise RotationError('The new passphrase does not open the volume.')
+        if not self._stored(new):
+            raise RotationError('The stored passphrase is not the new one.')
+
+    def backup_header(self):
+        """Adds the header with the new key slot to the header store of the volume."""
+        try:
+            HeaderStore(self.volume['header_store'], backend=self.backend).backup(self.device, luks_uuid=self.volume['uuid'])
+        except HeaderStoreError as e:
+            raise RotationError(str(e))
+
+
+    #____________________________________
+    # Rotation
+    def run(self):
+        """Rotates the passphrase of the volume, resuming an interrupted rotation if any.
+
+        :return: Result of the rotation, as returned by the pyluks.luksctl.volume_result function.
+        :rtype: dict
+        """
+        try:
+            self._start()
+            new = self.new_passphrase
+
+            def added():
+                if self.state.get('new_slot') is None:
+                    slot = self.test_passphrase(new, memory=self.new_slot_memory)
+                    if slot is None:
+                        return False
+                    self.state.set(new_slot=slot)
+                return True
+
+            self._phase('add_key', added, self.add_key)
+            self._phase('store', lambda: self._stored(new), lambda: self._store(new))
+            self._phase('verify', lambda: self.state.is_done('verify'), self.verify)
+            self._phase('kill_slot',
+                        lambda: self.state.is_done('kill_slot') or int(self.state.get('old_slot')) not in self.active_slots(),
+                        self.kill_slot)
+            self._phase('header_backup',
+                        lambda: self.state.is_done('header_backup') or not self.volume.get('header_store'),
+                        self.backup_header)
+        except Exception as e:
+            luksctl_logger.error(f'[luksctl] Passphrase rotation of {self.cryptdev} failed: {e}')
+            completed = ','.join(self.state.completed_phases()) or 'none'
+            return volume_result(self.cryptdev, 'rotate', 1, f'Passphrase rotation: [ FAIL ] (completed phases: {completed})',
+                                 stderr=str(e))
+
+        message = f'Passphrase rotation: [ OK ] (key slot {self.state.get("old_slot")} -> {self.state.get("new_slot")})'
+        os.remove(self.state.state_file)
+        luksctl_logger.info(f'[luksctl] Passphrase of {self.cryptdev} rotated.')
+        return volume_result(self.cryptdev, 'rotate', 0, message)
+
+
+
+def rotate_all(config_file, backend=None, cryptdevs=None, jobs=None, memory_budget=None, vault=None,
+               passphrase_length=DEFAULT_PASSPHRASE_LENGTH, pbkdf_memory=None, state_dir=DEFAULT_ROTATION_STATE_DIR):
+    """Rotates the passphrase of the volumes registered in the cryptdev .ini file concurrently, see PassphraseRotation.
+    The KDF operations of all the volumes share a single memory budget.
+
+    :param config_file: Path to the cryptdev .ini file.
+    :type config_file: str
+    :param backend: Execution backend used to manage the devices, defaults to the backend returned by pyluks.backends.get_backend
+    :type backend: pyluks.backends.Backend, optional
+    :param cryptdevs: Volumes to rotate, defaults to every registered volume
+    :type cryptdevs: list, optional
+    :param jobs: Maximum number of volumes processed concurrently, defaults to the number of volumes
+    :type jobs: int, optional
+    :param memory_budget: Memory in bytes shared by the concurrent KDF operations, defaults to the available memory
+    :type memory_budget: int, optional
+    :param vault: Vault location of the passphrases, with the vault_url, vault_token, secret_root, secret_path and secret_key keys.
+                  The secret path can contain the {cryptdev} and {uuid} placeholders, replaced for each volume, and must
+                  give a distinct secret to each volume. Defaults to None
+    :type vault: dict, optional
+    :param passphrase_length: Length of the new passphrases, defaults to 32
+    :type passphrase_length: int, optional
+    :param pbkdf_memory: Argon2 memory cost in KiB of the new key slots, defaults to the cryptsetup default
+    :type pbkdf_memory: int, optional
+    :param state_dir: Directory of the rotation state files, defaults to '/etc/luks/rotation'
+    :type state_dir: str, optional
+    :raises RotationError: Raises an error, before any device is modified, if the Vault secret path is shared by several volumes.
+    :return: List of results, as returned by the pyluks.luksctl.volume_result function, in the order of the volumes.
+    :rtype: list
+    """
+    registry = CryptdevRegistry(config_file)
+    volumes = [registry.lookup(cryptdev) for cryptdev in (cryptdevs or registry.names())]
+    if not volumes:
+        return []
+    if vault is not None:
+        check_secret_path(vault['secret_path'], volumes)
+
+    budget = KDFMemoryBudget(total=memory_budget)
+    def rotation(volume):
+        volume_vault = dict(vault, secret_path=vault['secret_path'].format(**volume)) if vault is not None else None
+        return PassphraseRotation(volume, backend=backend, budget=budget, vault=volume_vault, registry=registry,
+                                  passphrase_length=passphrase_length, pbkdf_memory=pbkdf_memory,
+                                  state_dir=state_dir).run()
+
+    with ThreadPoolExecutor(max_workers=min(jobs or len(volumes), len(volumes))) as executor:
+        return list(executor.map(rotation, volumes))
@@ -0,0 +1,174 @@
+# Import dependencies
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+# Import internal dependencies
+from ..client import make_session
+
+
+
+################################################################################
+# VARIABLES
+
+DEFAULT_NODE_STATUS_URL = 'https://{node}:5000/luksctl_api/v1.0/status'
+DEFAULT_PROBE_TIMEOUT = 2.0
+DEFAULT_PROBE_WORKERS = 32
+DEFAULT_CACHE_TTL = 10.0
+
+# Connections kept for each node by the shared session, whatever the number of probe workers of the callers
+SESSION_POOL_SIZE = 32
+
+# Per-process state shared by the API requests served by the same worker. _cache_lock only guards _cache and
+# _inflight, the probes run without holding it
+_session = None
+_session_lock = threading.Lock()
+_cache = {}
+_inflight = {}
+_cache_lock = threading.Lock()
+
+
+
+################################################################################
+# FUNCTIONS
+
+def _get_session():
+    """Returns the requests.Session shared by the probes of this process, so that connections to the
+    nodes are kept alive between cluster status requests. The pool keeps SESSION_POOL_SIZE connections and
+    the certificates of the nodes are not verified, see pyluks.client.make_session.
+
+    :return: Shared session.
+    :rtype: requests.Session
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = make_session(SESSION_POOL_SIZE)
+    return _session
+
+
+def probe_node(node, status_url=DEFAULT_NODE_STATUS_URL, timeout=DEFAULT_PROBE_TIMEOUT, session=None):
+    """Sends a GET request to the status endpoint of a node and measures its latency.
+
+    :param node: IP address or hostname of the node.
+    :type node: str
+    :param status_url: URL template of the node status endpoint, where '{node}' is replaced by the node address,
+                       defaults to 'https://{node}:5000/luksctl_api/v1.0/status'
+    :type status_url: str, optional
+    :param timeout: Connect and read timeout in seconds, defaults to 2.0
+    :type timeout: float, optional
+    :param session: Session used for the request, defaults to the shared session of this process
+    :type session: requests.Session, optional
+    :return: Dictionary containing the node volume_state and the probe latency in milliseconds. If the node
+             can't be reached, the volume_state is 'unreachable' and the error is reported.
+    :rtype: dict
+    """
+    if session is None:
+        session = _get_session()
+
+    start = time.monotonic()
+    try:
+        response = session.get(status_url.format(node=node), timeout=(timeout, timeout))
+        response.raise_for_status()
+        result = {'volume_state': response.json().get('volume_state', 'unavailable')}
+    except (requests.RequestException, ValueError) as e:
+        result = {'volume_state': 'unreachable', 'error': str(e)}
+    result['latency_ms'] = round((time.monotonic() - start) * 1000, 3)
+
+    return result
+
+
+def probe_cluster(node_list, status_url=DEFAULT_NODE_STATUS_URL, timeout=DEFAULT_PROBE_TIMEOUT,
+                  max_workers=DEFAULT_PROBE_WORKERS):
+    """Probes the status endpoint of every node concurrently, using a bounded pool of threads.
+
+    :param node_list: List containing IPs of the nodes.
+    :type node_list: list
+    :param status_url: URL template of the node status endpoint, defaults to 'https://{node}:5000/luksctl_api/v1.0/status'
+    :type status_url: str, optional
+    :param timeout: Connect and read timeout in seconds for each probe, defaults to 2.0
+    :type timeout: float, optional
+    :param max_workers: Maximum number of concurrent probes, defaults to 32
+    :type max_workers: int, optional
+    :return: Consolidated document with per-node state and latency, a summary of the states and the total elapsed time.
+    :rtype: dict
+    """
+    nodes = [node for node in dict.fromkeys(node_list) if node]
+    session = _get_session()
+
+    start = time.monotonic()
+    if nodes:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(nodes))) as executor:
+            results = executor.map(lambda node: probe_node(node, status_url, timeout, session), nodes)
+            node_states = dict(zip(nodes, results))
+    else:
+        node_states = {}
+    elapsed = time.monotonic() - start
+
+    summary = {}
+    for result in node_states.values():
+        summary[result['volume_state']] = summary.get(result['volume_state'], 0) + 1
+
+    return {'nodes': node_states,
+            'summary': summary,
+            'total_nodes': len(nodes),
+            'elapsed_ms': round(elapsed * 1000, 3),
+            'timestamp': time.time()}
+
+
+def get_cluster_status(node_list, status_url=DEFAULT_NODE_STATUS_URL, timeout=DEFAULT_PROBE_TIMEOUT,
+                       max_workers=DEFAULT_PROBE_WORKERS, cache_ttl=DEFAULT_CACHE_TTL):
+    """Returns the cluster status computed with the probe_cluster function, caching it for cache_ttl seconds.
+    Concurrent requests arriving while the cache is expired wait for a single probe round instead of
+    probing the nodes again.
+
+    :param node_list: List containing IPs of the nodes.
+    :type node_list: list
+    :param status_url: URL template of the node status endpoint, defaults to 'https://{node}:5000/luksctl_api/v1.0/status'
+    :type status_url: str, optional
+    :param timeout: Connect and read timeout in seconds for each probe, defaults to 2.0
+    :type timeout: float, optional
+    :param max_workers: Maximum number of concurrent probes, defaults to 32
+    :type max_workers: int, optional
+    :param cache_ttl: Seconds for which the cluster status is cached, defaults to 10.0
+    :type cache_ttl: float, optional
+    :return: Consolidated cluster status, see probe_cluster, with the 'cached' and 'age_ms' keys added.
+    :rtype: dict
+    """
+    key = (tuple(node_list), status_url)
+
+    while True:
+        with _cache_lock:
+            entry = _cache.get(key)
+            if entry is not None and time.monotonic() - entry[0] <= cache_ttl:
+                cached = True
+                break
+            probing = _inflight.get(key)
+            if probing is None:
+                probing = _inflight[key] = threading.Event()
+                break
+        # Another request is probing the same nodes: wait for its round, then read the cache again
+        probing.wait()
+
+    if not cached:
+        try:
+            status = probe_cluster(node_list, status_url=status_url, timeout=timeout, max_workers=max_workers)
+            entry = (time.monotonic(), status)
+            with _cache_lock:
+                _cache[key] = entry
+        finally:
+            with _cache_lock:
+                del _inflight[key]
+            probing.set()
+
+    response = dict(entry[1])
+    response['cached'] = cached
+    response['age_ms'] = round((time.monotonic() - entry[0]) * 1000, 3)
+    return response
+
+
+def clear_cache():
+    """Empties the cluster status cache."""
+    with _cache_lock:
+        _cache.clear()
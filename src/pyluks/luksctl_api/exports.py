@@ -0,0 +1,274 @@
+# Import dependencies
+import os
+import ipaddress
+from fnmatch import fnmatchcase
+
+# Import internal dependencies
+from ..utilities import run_argv, write_file_atomically
+
+
+
+################################################################################
+# VARIABLES
+
+EXPORTS_FILE = '/etc/exports'
+DEFAULT_EXPORT_OPTIONS = 'rw,sync,no_root_squash'
+
+
+
+################################################################################
+# FUNCTIONS
+
+#____________________________________
+# Parsing
+def _logical_lines(text):
+    """Joins the backslash-continued lines of an exports file.
+
+    :param text: Content of the exports file.
+    :type text: str
+    :return: List of logical lines, without trailing newlines.
+    :rtype: list
+    """
+    lines = []
+    buffer = ''
+    for line in text.splitlines():
+        if line.endswith('\\'):
+            buffer += line[:-1] + ' '
+            continue
+        lines.append(buffer + line)
+        buffer = ''
+    if buffer:
+        lines.append(buffer.rstrip())
+    return lines
+
+
+def parse_exports_line(line):
+    """Parses a single exports entry into the exported directory and its clients.
+
+    :param line: Logical line of the exports file, e.g. '/export 10.0.0.2(rw,sync)'.
+    :type line: str
+    :return: Tuple containing the export directory and a dict mapping each client to its options,
+             or None if the line is blank or a comment.
+    :rtype: tuple or None
+    """
+    stripped = line.strip()
+    if not stripped or stripped.startswith('#'):
+        return None
+
+    fields = stripped.split()
+    export_dir = fields[0]
+    clients = {}
+    for field in fields[1:]:
+        if '(' in field and field.endswith(')'):
+            client, options = field[:-1].split('(', 1)
+        else:
+            client, options = field, ''
+        # A bare '(options)' field sets the default options for the world
+        clients[client or '*'] = options
+    return export_dir, clients
+
+
+def read_exports(exports_file=EXPORTS_FILE):
+    """Reads the exports file once and returns its logical lines and parsed entries.
+
+    :param exports_file: Path to the exports file, defaults to '/etc/exports'
+    :type exports_file: str, optional
+    :return: Tuple containing the list of logical lines and a list of parsed entries (None for comments and blank lines).
+    :rtype: tuple
+    """
+    if os.path.exists(exports_file):
+        with open(exports_file, 'r') as f:
+            lines = _logical_lines(f.read())
+    else:
+        lines = []
+    return lines, [parse_exports_line(line) for line in lines]
+
+
+#____________________________________
+# Client aggregation
+def _as_network(client):
+    """Returns the client as an ip_network object, or None if it's a hostname, wildcard or netgroup."""
+    try:
+        return ipaddress.ip_network(client, strict=False)
+    except ValueError:
+        return None
+
+
+def _format_network(network):
+    """Formats a network as a plain address for single hosts or with the prefix length otherwise."""
+    if network.prefixlen == network.max_prefixlen:
+        return str(network.network_address)
+    return str(network)
+
+
+def aggregate_clients(clients):
+    """Reduces a list of NFS clients to the smallest equivalent list. Adjacent IP addresses and networks
+    are collapsed into CIDR blocks (only when the block is exactly covered, so no extra host is granted access)
+    and hostnames matched by a wildcard in the same list are dropped. If the '*' wildcard is present,
+    it's the only client returned.
+
+    :param clients: List of clients, i.e. IP addresses, CIDR networks, hostnames, wildcards or @netgroups.
+    :type clients: list
+    :return: Sorted list of aggregated clients.
+    :rtype: list
+    """
+    clients = {client.strip() for client in clients if client and client.strip()}
+    if '*' in clients:
+        return ['*']
+
+    networks = {4: [], 6: []}
+    names = set()
+    for client in clients:
+        network = _as_network(client)
+        if network is None:
+            names.add(client)
+        else:
+            networks[network.version].append(network)
+
+    wildcards = {name for name in names if any(c in name for c in '*?[')}
+    names = {name for name in names
+             if name in wildcards or not any(fnmatchcase(name, pattern) for pattern in wildcards)}
+
+    aggregated = []
+    for version in (4, 6):
+        aggregated.extend(_format_network(n) for n in ipaddress.collapse_addresses(networks[version]))
+    return aggregated + sorted(names)
+
+
+def client_covered(client, existing_clients):
+    """Checks if a client is already granted access by one of the existing clients, either by an exact
+    match, by a network containing it or by a matching wildcard.
+
+    :param client: Client to be checked.
+    :type client: str
+    :param existing_clients: Clients already present for the export directory.
+    :type existing_clients: iterable
+    :return: True if the client is covered by the existing clients, otherwise False.
+    :rtype: bool
+    """
+    if client in existing_clients or '*' in existing_clients:
+        return True
+
+    network = _as_network(client)
+    for existing in existing_clients:
+        existing_network = _as_network(existing)
+        if network is not None and existing_network is not None:
+            if network.version == existing_network.version and network.subnet_of(existing_network):
+                return True
+        elif network is None and existing_network is None and fnmatchcase(client, existing):
+            return True
+    return False
+
+
+#____________________________________
+# Merge and write
+def _format_exports_line(export_dir, clients):
+    """Formats an exports entry from the export directory and a dict mapping clients to options."""
+    fields = [f'{client}({options})' if options else client for client, options in clients.items()]
+    return ' '.join([export_dir] + fields)
+
+
+def merge_exports(lines, entries, exports_list, node_list, options=DEFAULT_EXPORT_OPTIONS, aggregate=True):
+    """Merges the desired export/client pairs with the parsed exports file. Each export directory ends up
+    on a single line: clients already granted access are kept untouched, missing ones are added with the
+    specified options. Comments and unrelated entries are preserved.
+
+    :param lines: Logical lines of the exports file, as returned by read_exports.
+    :type lines: list
+    :param entries: Parsed entries of the exports file, as returned by read_exports.
+    :type entries: list
+    :param exports_list: List containing the directories to be exported with nfs.
+    :type exports_list: list
+    :param node_list: List containing IPs (or networks, hostnames) of the worker nodes.
+    :type node_list: list
+    :param options: Export options for the added clients, defaults to 'rw,sync,no_root_squash'
+    :type options: str, optional
+    :param aggregate: If set to True, clients are aggregated with the aggregate_clients function, defaults to True
+    :type aggregate: bool, optional
+    :return: Tuple containing the new list of lines and a boolean which is True if something changed.
+    :rtype: tuple
+    """
+    exports_list = [export_dir for export_dir in dict.fromkeys(exports_list) if export_dir]
+    if aggregate:
+        node_list = aggregate_clients(node_list)
+    else:
+        node_list = [node for node in dict.fromkeys(node_list) if node]
+
+    # Index existing clients by export directory
+    existing = {}
+    for entry in entries:
+        if entry is not None:
+            existing.setdefault(entry[0], {}).update(entry[1])
+
+    missing = {}
+    for export_dir in exports_list:
+        clients = existing.get(export_dir, {})
+        new_clients = [node for node in node_list if not client_covered(node, clients)]
+        if new_clients:
+            missing[export_dir] = new_clients
+
+    if not missing:
+        return lines, False
+
+    new_lines = []
+    written = set()
+    for line, entry in zip(lines, entries):
+        if entry is None or entry[0] not in missing:
+            new_lines.append(line)
+        elif entry[0] not in written:
+            # Rewrite the first line of the export directory with all of its clients
+            clients = dict(existing[entry[0]])
+            clients.update((node, options) for node in missing[entry[0]])
+            new_lines.append(_format_exports_line(entry[0], clients))
+            written.add(entry[0])
+        # Later duplicated lines of the same directory have been merged into the first one
+
+    for export_dir, new_clients in missing.items():
+        if export_dir not in written:
+            new_lines.append(_format_exports_line(export_dir, {node: options for node in new_clients}))
+
+    return new_lines, True
+
+
+def update_exports(exports_list, node_list, exports_file=EXPORTS_FILE, options=DEFAULT_EXPORT_OPTIONS,
+                   aggregate=True, reload=True, logger=None):
+    """Adds the export directories for each worker node to the exports file. The file is parsed once, the
+    missing export/client pairs are merged and the file is atomically replaced. 'exportfs -ra' is run once
+    and only if the file has changed.
+
+    :param exports_list: List containing the directories to be exported with nfs.
+    :type exports_list: list
+    :param node_list: List containing IPs of the worker nodes.
+    :type node_list: list
+    :param exports_file: Path to the exports file, defaults to '/etc/exports'
+    :type exports_file: str, optional
+    :param options: Export options for the added clients, defaults to 'rw,sync,no_root_squash'
+    :type options: str, optional
+    :param aggregate: If set to True, worker nodes are aggregated in CIDR blocks when possible, defaults to True
+    :type aggregate: bool, optional
+    :param reload: If set to True, 'exportfs -ra' is run when the exports file changes, defaults to True
+    :type reload: bool, optional
+    :param logger: logging.Logger object used to log the changes, defaults to None
+    :type logger: logging.Logger, optional
+    :return: True if the exports file has been changed, otherwise False.
+    :rtype: bool
+    """
+    lines, entries = read_exports(exports_file)
+    new_lines, changed = merge_exports(lines, entries, exports_list, node_list,
+                                       options=options, aggregate=aggregate)
+
+    if not changed:
+        if logger != None:
+            logger.debug(f'{exports_file} already up to date.')
+        return False
+
+    write_file_atomically(exports_file, '\n'.join(new_lines) + '\n')
+    if logger != None:
+        logger.debug(f'{exports_file} updated.')
+
+    if reload:
+        _, stderr, status = run_argv(['exportfs', '-ra'], logger)
+        if status != 0 and logger != None:
+            logger.error(f'exportfs -ra failed with exit code {status}: {stderr}')
+
+    return True
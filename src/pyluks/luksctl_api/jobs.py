@@ -0,0 +1,285 @@
+# Import dependencies
+import os
+import json
+import fcntl
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Import internal dependencies
+from ..utilities import write_file_atomically
+from .single_flight import pid_alive
+
+
+
+################################################################################
+# VARIABLES
+
+DEFAULT_JOB_WORKERS = 4
+DEFAULT_JOB_QUEUE_SIZE = 64
+DEFAULT_JOB_TTL = 3600.0       # Seconds for which a completed job can be queried
+DEFAULT_RETRY_AFTER = 5
+EVICT_INTERVAL = 60.0          # Minimum seconds between two evictions of the completed jobs by a process
+
+WORKER_EXITED = 'The API worker running the job exited.'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+
+
+################################################################################
+# EXCEPTIONS
+
+class JobQueueFull(Exception):
+    """Raised when a job is submitted while the queue of the process is full.
+    The retry_after attribute holds the seconds after which the request should be retried."""
+
+    def __init__(self, retry_after=DEFAULT_RETRY_AFTER):
+        super().__init__(f'Job queue full, retry after {retry_after} seconds.')
+        self.retry_after = retry_after
+
+
+
+################################################################################
+# FUNCTIONS
+
+def _is_job_id(job_id):
+    try:
+        return uuid.UUID(hex=job_id).hex == job_id
+    except ValueError:
+        return False
+
+
+
+################################################################################
+# JOB MANAGER CLASS
+
+class JobManager:
+    """Runs long operations, e.g. volume open, in background on a bounded thread pool and records their progress
+    in a JSON file per job in jobs_dir, so that a job submitted to a gunicorn worker can be queried from any other.
+    Each record holds the job state (queued, running, succeeded or failed), the current phase, the start time
+    and duration of each phase, the result or the error. Completed jobs are removed ttl seconds after they finish;
+    jobs left running by a worker that exited, e.g. recycled by gunicorn after max_requests or killed after its
+    timeout, are reported as failed and recorded as such by JobManager.recover.
+    """
+
+
+    def __init__(self, jobs_dir, max_workers=DEFAULT_JOB_WORKERS, max_pending=DEFAULT_JOB_QUEUE_SIZE, ttl=DEFAULT_JOB_TTL):
+        """Instantiate a JobManager object. The thread pool is created on the first submitted job.
+
+        :param jobs_dir: Directory of the job files.
+        :type jobs_dir: str
+        :param max_workers: Maximum number of jobs run concurrently by the process, defaults to 4
+        :type max_workers: int, optional
+        :param max_pending: Maximum number of queued and running jobs in the process, defaults to 64
+        :type max_pending: int, optional
+        :param ttl: Seconds for which a completed job is kept, defaults to 3600.0
+        :type ttl: float, optional
+        """
+        self.jobs_dir = jobs_dir
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self._executor = None
+        self._pending = 0
+        self._last_evict = None
+        self._lock = threading.Lock()
+        os.makedirs(self.jobs_dir, mode=0o700, exist_ok=True)
+
+
+    #____________________________________
+    # Job files
+    def _path(self, job_id):
+        return os.path.join(self.jobs_dir, f'{job_id}.json')
+
+    def _write(self, job):
+        write_file_atomically(self._path(job['id']), json.dumps(job), mode=0o600)
+
+    def get(self, job_id):
+        """Returns a job record. The completed jobs older than ttl are evicted first, at most every EVICT_INTERVAL seconds.
+
+        :param job_id: Job id, as returned by JobManager.submit
+        :type job_id: str
+        :return: Dictionary describing the job, None if the job doesn't exist or has been evicted.
+        :rtype: dict
+        """
+        self._evict_periodically()
+        return self._load(job_id)
+
+    def _load(self, job_id):
+        if not _is_job_id(job_id):
+            return None
+        try:
+            with open(self._path(job_id)) as f:
+                job = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if job['state'] in (QUEUED, RUNNING) and not pid_alive(job['pid']):
+            job.update(state=FAILED, error=WORKER_EXITED)
+        return job
+
+    def evict(self):
+        """Removes the files of the jobs completed more than ttl seconds ago. The modification time of
+        the file is used, since completed jobs are not written anymore.
+
+        :return: Number of removed jobs.
+        :rtype: int
+        """
+        removed = 0
+        deadline = time.time() - self.ttl
+        with os.scandir(self.jobs_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    if entry.stat().st_mtime >= deadline:
+                        continue
+                    job = self._load(entry.name[:-len('.json')])
+                    if job is None or job['state'] in (SUCCEEDED, FAILED):
+                        os.remove(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def _evict_periodically(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._last_evict is not None and now - self._last_evict < EVICT_INTERVAL:
+                return
+            self._last_evict = now
+        self.evict()
+
+    def recover(self):
+        """Records the jobs left queued or running by API workers that exited as failed in their job files, so that
+        they don't look in progress until they are evicted. Meant to be called when a worker starts: workers
+        recovering concurrently are serialized by a lock file, so that each job is recovered once.
+
+        :return: List of the recovered jobs, as they were recorded when their worker exited.
+        :rtype: list
+        """
+        recovered = []
+        with open(os.path.join(self.jobs_dir, '.recover.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            for name in sorted(os.listdir(self.jobs_dir)):
+                if not name.endswith('.json'):
+                    continue
+                try:
+                    with open(os.path.join(self.jobs_dir, name)) as f:
+                        job = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                if job.get('state') in (QUEUED, RUNNING) and not pid_alive(job['pid']):
+                    recovered.append(dict(job))
+                    job.update(state=FAILED, error=WORKER_EXITED, finished=time.time())
+                    self._write(job)
+        return recovered
+
+
+    #____________________________________
+    # Run
+    def submit(self, operation, function, **info):
+        """Queues a job and returns its record right away. The function is called with a progress argument,
+        a function to be called with the name of each phase as it starts.
+
+        :param operation: Name of the operation, e.g. 'open'
+        :type operation: str
+        :param function: Operation, called as function(progress). Its result must be JSON serializable.
+        :type function: function
+        :param info: Additional fields stored in the job record, e.g. the cryptdev.
+        :raises JobQueueFull: Raises an error if max_pending jobs are already queued or running in the process.
+        :return: Dictionary describing the job.
+        :rtype: dict
+        """
+        self._evict_periodically()
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise JobQueueFull()
+            self._pending += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='luksctl_api-job')
+
+        job = dict(info, id=uuid.uuid4().hex, operation=operation, state=QUEUED, phase=None, phases=[],
+                   pid=os.getpid(), submitted=time.time(), started=None, finished=None, duration=None,
+                   result=None, error=None)
+        self._write(job)
+        snapshot = dict(job, phases=[])
+        try:
+            self._executor.submit(self._run, job, function)
+        except RuntimeError:
+            with self._lock:
+                self._pending -= 1
+            raise
+        return snapshot
+
+    def _run(self, job, function):
+        start = time.monotonic()
+        phase_start = [start]
+
+        def progress(phase):
+            now = time.monotonic()
+            if job['phases']:
+                job['phases'][-1]['duration'] = now - phase_start[0]
+            phase_start[0] = now
+            job['phase'] = phase
+            job['phases'].append({'name': phase, 'started': time.time(), 'duration': None})
+            self._write(job)
+
+        job.update(state=RUNNING, started=time.time())
+        self._write(job)
+        try:
+            result = function(progress)
+        except Exception as e:
+            job.update(state=FAILED, error=str(e) or type(e).__name__)
+        except BaseException as e:
+            # e.g. SystemExit or KeyboardInterrupt: recorded as failed, not left running, then propagated
+            job.update(state=FAILED, error=type(e).__name__)
+            raise
+        else:
+            job.update(state=SUCCEEDED, result=result)
+        finally:
+            if job['phases']:
+                job['phases'][-1]['duration'] = time.monotonic() - phase_start[0]
+            job.update(finished=time.time(), duration=time.monotonic() - start)
+            self._write(job)
+            with self._lock:
+                self._pending -= 1
+
+
+    def shutdown(self, wait=True):
+        """Stops the thread pool, waiting for the running jobs if wait is True."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+
+################################################################################
+# PROCESS-WIDE MANAGERS
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+def get_job_manager(jobs_dir, max_workers=DEFAULT_JOB_WORKERS, max_pending=DEFAULT_JOB_QUEUE_SIZE, ttl=DEFAULT_JOB_TTL):
+    """Returns the JobManager of the process for jobs_dir, creating it on first use. The manager is shared
+    by the requests served by the process, so that the number of background jobs stays bounded; managers
+    inherited from a parent process, e.g. the gunicorn master with preload, are not reused after fork.
+
+    :param jobs_dir: Directory of the job files.
+    :type jobs_dir: str
+    :return: The JobManager of the process.
+    :rtype: pyluks.luksctl_api.jobs.JobManager
+    """
+    key = (os.getpid(), jobs_dir)
+    with _managers_lock:
+        manager = _managers.get(key)
+        if manager is None:
+            manager = _managers[key] = JobManager(jobs_dir, max_workers=max_workers, max_pending=max_pending, ttl=ttl)
+        else:
+            manager.max_pending, manager.ttl = max_pending, ttl
+        return manager
@@ -0,0 +1,399 @@
+# Import dependencies
+import os
+import json
+import time
+import uuid
+import shutil
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+
+################################################################################
+# VARIABLES
+
+STATUS_PATH = '/luksctl_api/v1.0/status'
+OPEN_PATH = '/luksctl_api/v1.0/open'
+
+DEFAULT_MIX = {'status': 1}
+DEFAULT_SECRET = 's3cret'
+
+PERCENTILES = (50, 95, 99)
+
+
+
+################################################################################
+# LOCAL VAULT SERVER
+
+class _VaultHandler(BaseHTTPRequestHandler):
+    """Answers the HashiCorp Vault API calls made by hvac in pyluks.vault_support: wrapped token unwrap,
+    token lookup and revocation, KV version 2 reads and check-and-set writes."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass # Keep the load generator output clean
+
+    def _reply(self, code, body=None):
+        payload = json.dumps(body).encode() if body is not None else b''
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _kv_path(self):
+        # /v1/<mount>/data/<path>
+        parts = self.path.split('?')[0].strip('/').split('/', 3)
+        if len(parts) == 4 and parts[0] == 'v1' and parts[2] == 'data':
+            return parts[1], parts[3]
+        return None
+
+    def do_GET(self):
+        vault = self.server.vault
+        vault.wait()
+        if self.path.startswith('/v1/auth/token/lookup-self'):
+            return self._reply(200, {'data': {'id': self.headers.get('X-Vault-Token'), 'ttl': 3600}})
+        kv_path = self._kv_path()
+        with vault.lock:
+            entry = vault.secrets.get(kv_path) if kv_path else None
+        if entry is None:
+            return self._reply(404, {'errors': []})
+        return self._reply(200, {'data': {'data': entry['data'], 'metadata': {'version': entry['version']}}})
+
+    def do_POST(self):
+        vault = self.server.vault
+        vault.wait()
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+
+        if self.path.startswith('/v1/sys/wrapping/unwrap'):
+            with vault.lock:
+                vault.unwrapped += 1
+            return self._reply(200, {'auth': {'client_token': f's.{uuid.uuid4().hex}', 'lease_duration': 3600}})
+        if self.path.startswith('/v1/auth/token/revoke-self'):
+            return self._reply(204)
+
+        kv_path = self._kv_path()
+        if kv_path is None:
+            return self._reply(404, {'errors': []})
+        with vault.lock:
+            entry = vault.secrets.get(kv_path)
+            version = entry['version'] if entry else 0
+            cas = body.get('options', {}).get('cas')
+            if cas is not None and int(cas) != version:
+                return self._reply(400, {'errors': ['check-and-set parameter did not match the current version']})
+            vault.secrets[kv_path] = {'data': body.get('data', {}), 'version': version + 1}
+        return self._reply(200, {'data': {'version': version + 1}})
+
+
+class LocalVaultServer:
+    """Stand-in HashiCorp Vault server, serving on localhost the API used by pyluks to store and read the
+    passphrases: any wrapping token is accepted and secrets are kept in memory. A latency can be added to
+    each request to emulate a remote Vault.
+    """
+
+
+    def __init__(self, latency=0, host='127.0.0.1', port=0):
+        """Instantiate a LocalVaultServer object. The server is started with LocalVaultServer.start.
+
+        :param latency: Seconds waited before answering each request, defaults to 0
+        :type latency: float, optional
+        :param host: Listening address, defaults to '127.0.0.1'
+        :type host: str, optional
+        :param port: Listening port, defaults to 0 (any free port)
+        :type port: int, optional
+        """
+        self.latency = latency
+        self.secrets = {} # (mount point, path) -> {'data', 'version'}
+        self.unwrapped = 0
+        self.lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _VaultHandler)
+        self._server.daemon_threads = True
+        self._server.vault = self
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def put_secret(self, secret_root, secret_path, data):
+        """Stores a secret, as done by fastluks when the volume is encrypted."""
+        with self.lock:
+            version = self.secrets.get((secret_root, secret_path), {}).get('version', 0)
+            self.secrets[(secret_root, secret_path)] = {'data': dict(data), 'version': version + 1}
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+
+################################################################################
+# SIMULATED API SERVER
+
+def _serve_simulated(connection, volumes, latencies, vault_latency, reboot_interval, work_dir):
+    """Runs the luksctl_api master app on a SimulatedBackend with a LocalVaultServer, in a child process.
+    The URLs of the API and of Vault are sent back through the connection."""
+    # Imported here: the child configures the default backend and the app before serving
+    import logging
+    from werkzeug.serving import make_server
+    from ..backends import SimulatedBackend, set_backend
+    from ..cryptdev_registry import CryptdevRegistry
+    from .luksctl_run import write_api_config
+    from .luksctl_api_master import app
+
+    luks_cryptdev_file = os.path.join(work_dir, 'luks-cryptdev.ini')
+    sim = SimulatedBackend(latencies=latencies, seed=0, luks_cryptdev_file=luks_cryptdev_file)
+    registry = CryptdevRegistry(luks_cryptdev_file)
+    for i in range(volumes):
+        luks_uuid = str(uuid.UUID(int=i + 1))
+        sim.add_luks_device(f'/dev/vd{i}', luks_uuid=luks_uuid, secret=DEFAULT_SECRET, filesystem='ext4')
+        registry.add({'cipher_algorithm': 'aes-xts-plain64', 'hash_algorithm': 'sha256', 'keysize': 256,
+                      'device': f'/dev/vd{i}', 'uuid': luks_uuid, 'cryptdev': f'crypt{i}',
+                      'mapper': f'/dev/mapper/crypt{i}', 'mountpoint': f'/export/vol{i}', 'filesystem': 'ext4'})
+    registry.set_defaults('logs', {name: os.path.join(work_dir, f'{name}.log') for name in ('fastluks', 'luksctl', 'luksctl_api')})
+    write_api_config(luks_cryptdev_file, env_path=work_dir, daemons=['nfs-server'], node_list=[], exports_list=[],
+                     sudo_path='', single_flight_dir=os.path.join(work_dir, 'single_flight'))
+
+    set_backend(sim)
+    app.config['LUKS_CRYPTDEV_FILE'] = luks_cryptdev_file
+
+    vault = LocalVaultServer(latency=vault_latency).start()
+    vault.put_secret('secrets', 'luks', {'passphrase': DEFAULT_SECRET})
+
+    if reboot_interval:
+        def reboot():
+            while True:
+                time.sleep(reboot_interval)
+                sim.reboot()
+        threading.Thread(target=reboot, daemon=True).start()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR) # No access log line per request
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    connection.send({'url': f'http://127.0.0.1:{server.server_port}', 'vault_url': vault.url,
+                     'cryptdevs': [f'crypt{i}' for i in range(volumes)]})
+    server.serve_forever()
+
+
+class SimulatedAPIServer:
+    """luksctl_api master served in a separate process on a SimulatedBackend holding LUKS volumes, with a
+    LocalVaultServer holding their passphrase, so that the API can be load tested on a single machine without
+    real disks, systemd or Vault. The volumes are unmounted every reboot_interval seconds, if set, to emulate
+    a cluster reboot and make the next /open requests unlock them again.
+    """
+
+
+    def __init__(self, volumes=1, latencies=None, vault_latency=0, reboot_interval=None):
+        """Instantiate a SimulatedAPIServer object. The server is started with SimulatedAPIServer.start.
+
+        :param volumes: Number of simulated LUKS volumes, named crypt0, crypt1, ..., defaults to 1
+        :type volumes: int, optional
+        :param latencies: Latencies of the simulated operations, see pyluks.backends.SimulatedBackend, defaults to None
+        :type latencies: dict, optional
+        :param vault_latency: Latency of each Vault request in seconds, defaults to 0
+        :type vault_latency: float, optional
+        :param reboot_interval: Seconds between simulated reboots, defaults to None (no reboot)
+        :type reboot_interval: float, optional
+        """
+        self.volumes = volumes
+        self.latencies = dict(latencies or {})
+        self.vault_latency = vault_latency
+        self.reboot_interval = reboot_interval
+        self.url = self.vault_url = None
+        self.cryptdevs = []
+        self._process = None
+        self._work_dir = None
+
+    def open_payload(self):
+        """Returns the /open request body reading the passphrase from the local Vault."""
+        return {'vault_url': self.vault_url, 'vault_token': 'wrapping-token', 'secret_root': 'secrets',
+                'secret_path': 'luks', 'secret_key': 'passphrase'}
+
+    def start(self, timeout=30):
+        self._work_dir = tempfile.mkdtemp(prefix='luksctl-api-bench.')
+        context = multiprocessing.get_context('fork')
+        parent, child = context.Pipe()
+        self._process = context.Process(target=_serve_simulated, daemon=True,
+                                        args=(child, self.volumes, self.latencies, self.vault_latency,
+                                              self.reboot_interval, self._work_dir))
+        self._process.start()
+        if not parent.poll(timeout):
+            self.stop()
+            raise RuntimeError('The simulated luksctl_api server did not start.')
+        info = parent.recv()
+        self.url, self.vault_url, self.cryptdevs = info['url'], info['vault_url'], info['cryptdevs']
+        return self
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+        if self._work_dir is not None:
+            shutil.rmtree(self._work_dir, ignore_errors=True)
+            self._work_dir = None
+
+    def __enter__(self): return self.start()
+    def __exit__(self, *exc_info): self.stop()
+
+
+
+################################################################################
+# LOAD GENERATOR
+
+def percentile(sorted_values, p):
+    """Returns the p-th percentile of a sorted list with the nearest-rank method, None if the list is empty."""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * p // 100)) # ceil(len * p / 100)
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(latencies, errors, statuses):
+    """Summarizes the latencies, in seconds, of a set of requests."""
+    latencies = sorted(latencies)
+    summary = {'requests': len(latencies), 'errors': errors, 'statuses': dict(statuses),
+               'mean': sum(latencies) / len(latencies) if latencies else None,
+               'max': latencies[-1] if latencies else None}
+    for p in PERCENTILES:
+        summary[f'p{p}'] = percentile(latencies, p)
+    return summary
+
+
+def parse_mix(mix):
+    """Parses a request mix such as 'status=9,open=1' into a dictionary of weights."""
+    weights = {}
+    for item in mix.split(','):
+        endpoint, _, weight = item.partition('=')
+        if endpoint.strip() not in ('status', 'open'):
+            raise ValueError(f'Unknown endpoint in request mix: {endpoint}')
+        weights[endpoint.strip()] = int(weight or 1)
+    return weights
+
+
+def run_load(url, mix=None, concurrency=8, rate=None, requests=None, duration=10, open_payload=None,
+             cryptdevs=None, timeout=30, verify=False):
+    """Sends /status and /open requests to a luksctl_api server from concurrent clients and measures their latency.
+    Requests are interleaved according to the weights of the mix, e.g. {'status': 9, 'open': 1}, and spread
+    over the cryptdevs round-robin. If a rate is set, requests are sent on a fixed schedule and the latency is
+    measured from the scheduled time, so that queueing delays caused by a slow server are not hidden.
+
+    :param url: Base URL of the server, e.g. https://10.0.0.1:5000
+    :type url: str
+    :param mix: Weights of the status and open endpoints, defaults to {'status': 1}
+    :type mix: dict, optional
+    :param concurrency: Number of concurrent clients, defaults to 8
+    :type concurrency: int, optional
+    :param rate: Requests per second over all the clients, defaults to None (as fast as possible)
+    :type rate: float, optional
+    :param requests: Number of requests to send, defaults to None (limited by duration)
+    :type requests: int, optional
+    :param duration: Seconds after which no more requests are sent, defaults to 10
+    :type duration: float, optional
+    :param open_payload: Body of the /open requests, i.e. the Vault information, defaults to None
+    :type open_payload: dict, optional
+    :param cryptdevs: Volumes addressed by the requests, defaults to None (the default volume)
+    :type cryptdevs: list, optional
+    :param timeout: Timeout of each request in seconds, defaults to 30
+    :type timeout: float, optional
+    :param verify: Verify the TLS certificate of the server, defaults to False
+    :type verify: bool, optional
+    :return: Dictionary with the overall and per endpoint summaries, see summarize, and the throughput.
+    :rtype: dict
+    """
+    import requests as http # Imported here as the rest of the module, used by the server, doesn't need it
+    import urllib3
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    mix = dict(mix or DEFAULT_MIX)
+    if 'open' in mix and open_payload is None:
+        raise ValueError('open_payload is needed to send /open requests.')
+    schedule = [(endpoint, rank) for endpoint, weight in mix.items() for rank in range(weight)]
+    cryptdevs = list(cryptdevs or [None])
+
+    results = {endpoint: {'latencies': [], 'errors': 0, 'statuses': {}} for endpoint in mix}
+    results_lock = threading.Lock()
+    counter = iter(range(requests if requests is not None else 2**62))
+    counter_lock = threading.Lock()
+    local = threading.local()
+    start = time.monotonic()
+    deadline = start + duration if duration is not None else None
+
+    def client():
+        local.session = http.Session()
+        while True:
+            with counter_lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            scheduled = start + i / rate if rate else time.monotonic()
+            if deadline is not None and scheduled >= deadline:
+                return
+            if scheduled > time.monotonic():
+                time.sleep(scheduled - time.monotonic())
+
+            # Each endpoint goes through all the cryptdevs, whatever the mix
+            endpoint, rank = schedule[i % len(schedule)]
+            cryptdev = cryptdevs[((i // len(schedule)) * mix[endpoint] + rank) % len(cryptdevs)]
+            try:
+                if endpoint == 'status':
+                    params = {'cryptdev': cryptdev} if cryptdev else None
+                    response = local.session.get(url + STATUS_PATH, params=params, timeout=timeout, verify=verify)
+                else:
+                    body = dict(open_payload, cryptdev=cryptdev) if cryptdev else open_payload
+                    response = local.session.post(url + OPEN_PATH, json=body, timeout=timeout, verify=verify)
+                status, failed = response.status_code, response.status_code >= 400
+            except http.RequestException as e:
+                status, failed = type(e).__name__, True
+            latency = time.monotonic() - scheduled
+
+            with results_lock:
+                result = results[endpoint]
+                result['latencies'].append(latency)
+                result['errors'] += failed
+                result['statuses'][status] = result['statuses'].get(status, 0) + 1
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(client) for _ in range(concurrency)]:
+            future.result()
+    elapsed = time.monotonic() - start
+
+    all_latencies = [latency for result in results.values() for latency in result['latencies']]
+    all_statuses = {}
+    for result in results.values():
+        for status, count in result['statuses'].items():
+            all_statuses[status] = all_statuses.get(status, 0) + count
+
+    report = {'url': url, 'concurrency': concurrency, 'rate': rate, 'elapsed': elapsed,
+              'throughput': len(all_latencies) / elapsed if elapsed else 0.0,
+              'overall': summarize(all_latencies, sum(r['errors'] for r in results.values()), all_statuses),
+              'endpoints': {endpoint: summarize(r['latencies'], r['errors'], r['statuses']) for endpoint, r in results.items()}}
+    return report
+
+
+def format_report(report):
+    """Formats a report returned by run_load as a table, with latencies in milliseconds."""
+    ms = lambda value: f'{value * 1000:.1f}' if value is not None else '-'
+    lines = [f'Target: {report["url"]}  concurrency: {report["concurrency"]}  rate: {report["rate"] or "max"}',
+             f'Elapsed: {report["elapsed"]:.2f} s  throughput: {report["throughput"]:.1f} req/s',
+             '',
+             f'{"endpoint":<10}{"requests":>10}{"errors":>8}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}']
+    for name, summary in list(report['endpoints'].items()) + [('all', report['overall'])]:
+        lines.append(f'{name:<10}{summary["requests"]:>10}{summary["errors"]:>8}{ms(summary["p50"]):>10}'
+                     f'{ms(summary["p95"]):>10}{ms(summary["p99"]):>10}{ms(summary["max"]):>10}')
+    statuses = ', '.join(f'{status}: {count}' for status, count in sorted(report['overall']['statuses'].items(), key=str))
+    lines.append('')
+    lines.append(f'Responses: {statuses}')
+    return '\n'.join(lines)
@@ -1,12 +1,18 @@
 # Import dependencies
-from flask import Flask, request, abort, jsonify
+from flask import Flask, Response, request, abort, jsonify, url_for, stream_with_context
 import json
 import os
+import time
 import logging
 from configparser import ConfigParser
 
 # Import internal dependencies
 from .luksctl_run import master, api_logger
+from .single_flight import TooManyWaiters, WaitTimeout
+from .jobs import JobQueueFull
+from .status_stream import DEFAULT_STREAM_TIMEOUT, MAX_STREAM_TIMEOUT, acquire_stream, release_stream
+from ..cryptdev_registry import CryptdevRegistry
+from ..profiler import profile_from_environment
 
 
 
@@ -15,23 +21,45 @@ from .luksctl_run import master, api_logger
 
 app = Flask(__name__)
 
+# Cryptdev .ini file read by the API functions, can be changed e.g. to serve a simulated host
+app.config['LUKS_CRYPTDEV_FILE'] = '/etc/luks/luks-cryptdev.ini'
+
+# Profiling of the commands run by the worker, enabled by the PYLUKS_PROFILE environment variable of the service.
+# gunicorn reserves SIGUSR2 and resets the signal handlers of its workers, so the report is dumped on demand by
+# touching the PYLUKS_PROFILE_TRIGGER file instead
+profile_from_environment(dump_signal=None)
+
 def instantiate_master_node():
     """Instantiate the master_node object needed by the API functions.
 
     :return: A master object which attributes are retrieved from the cryptdev .ini file.
     :rtype: pyluks.luksctl_api.luksctl_run.master
     """
-    master_node = master(luks_cryptdev_file='/etc/luks/luks-cryptdev.ini', api_section='luksctl_api')
+    master_node = master(luks_cryptdev_file=app.config['LUKS_CRYPTDEV_FILE'], api_section='luksctl_api')
     return master_node
 
 
 
+@app.before_first_request
+def recover_jobs():
+    """Runs the master.recover_jobs method when the worker serves its first request, so that the jobs interrupted
+    by a worker that exited, e.g. recycled by gunicorn, are recorded as failed and the daemons are not left stopped.
+    Errors are logged, they don't fail the request."""
+
+    try:
+        instantiate_master_node().recover_jobs()
+    except Exception:
+        api_logger.exception('Unable to recover the interrupted jobs')
+
+
+
 ################################################################################
 # FUNCTIONS
 
 @app.route('/luksctl_api/v1.0/status', methods=['GET'])
 def get_status():
-    """Runs the master.get_status method on a GET request.
+    """Runs the master.get_status method on a GET request. The volume can be selected with the cryptdev
+    query parameter (cryptdev name, LUKS UUID, device or mountpoint), otherwise the default volume is used.
 
     :return: Output from the master.get_status method.
     :rtype: str
@@ -39,7 +67,91 @@ def get_status():
 
     master_node = instantiate_master_node()
     
-    response = master_node.get_status()
+    response = master_node.get_status(cryptdev=request.args.get('cryptdev'))
+
+    return jsonify(response)
+
+
+@app.route('/luksctl_api/v1.0/status/stream', methods=['GET'])
+def get_status_stream():
+    """Streams the volume_state changes of the volumes of the host, as computed by the StatusWatcher shared by
+    the requests served by the API worker. The volumes can be selected with the cryptdev query parameter.
+
+    * If the request accepts text/event-stream, changes are sent as server-sent events, one volume_state event
+      per changed volume, with the watcher version as event id. The stream is closed after stream_lifetime
+      seconds; a client reconnecting with the Last-Event-ID header receives only the changes it missed.
+    * Otherwise, the request is a long poll: the volume states are returned right away without the cursor
+      query parameter, else when a volume changes after the cursor version or after timeout seconds.
+
+    Streams and waiting long polls hold a thread of the worker: beyond max_streams of them, the request is
+    rejected with 503 and a Retry-After header.
+
+    :return: Event stream, or the version and the volume states.
+    :rtype: str
+    """
+
+    master_node = instantiate_master_node()
+    watcher = master_node.status_watcher()
+
+    cryptdevs = None
+    if request.args.get('cryptdev'):
+        try:
+            volume = CryptdevRegistry(master_node.luks_cryptdev_file).lookup(request.args['cryptdev'])
+        except KeyError:
+            abort(404)
+        cryptdevs = [volume.get('cryptdev')]
+
+    try:
+        cursor = request.headers.get('Last-Event-ID') or request.args.get('cursor')
+        cursor = int(cursor) if cursor is not None else None
+        timeout = min(float(request.args.get('timeout', DEFAULT_STREAM_TIMEOUT)), MAX_STREAM_TIMEOUT)
+    except ValueError:
+        abort(400)
+
+    stream = request.accept_mimetypes.best == 'text/event-stream'
+    if (stream or cursor is not None) and not acquire_stream(master_node.max_streams):
+        api_logger.warning(f'Too many status streams, {master_node.max_streams} already open')
+        return jsonify({'error': 'too many streams'}), 503, {'Retry-After': str(int(DEFAULT_STREAM_TIMEOUT))}
+
+    if stream:
+        deadline = time.monotonic() + master_node.stream_lifetime
+        def events(cursor):
+            while time.monotonic() < deadline:
+                snapshot = watcher.wait(cursor=cursor, timeout=min(timeout, max(0, deadline - time.monotonic())),
+                                        cryptdevs=cryptdevs)
+                changed = {c: v for c, v in snapshot['volumes'].items() if cursor is None or v['version'] > cursor}
+                for cryptdev, volume in changed.items():
+                    data = json.dumps({'cryptdev': cryptdev, 'volume_state': volume['volume_state'], 'changed': volume['changed']})
+                    yield f'id: {snapshot["version"]}\nevent: volume_state\ndata: {data}\n\n'
+                if not changed:
+                    yield ': keep-alive\n\n'
+                cursor = snapshot['version']
+
+        response = Response(stream_with_context(events(cursor)), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        # Called when the stream ends or the client disconnects, even before the first event
+        response.call_on_close(release_stream)
+        return response
+
+    if cursor is None:
+        return jsonify(watcher.wait(cursor=cursor, timeout=timeout, cryptdevs=cryptdevs))
+    try:
+        return jsonify(watcher.wait(cursor=cursor, timeout=timeout, cryptdevs=cryptdevs))
+    finally:
+        release_stream()
+
+
+@app.route('/luksctl_api/v1.0/cluster/status', methods=['GET'])
+def get_cluster_status():
+    """Runs the master.get_cluster_status method on a GET request.
+
+    :return: Output from the master.get_cluster_status method.
+    :rtype: str
+    """
+
+    master_node = instantiate_master_node()
+
+    response = master_node.get_cluster_status()
 
     return jsonify(response)
 
@@ -47,7 +159,12 @@ def get_status():
 @app.route('/luksctl_api/v1.0/open', methods=['POST'])
 def luksopen():
     """Runs the master.open method on a POST request containing the HashiCorp Vault informations to retrieve
-    the passphrase.
+    the passphrase. The volume can be selected with the optional cryptdev field, otherwise the default volume is opened.
+    Concurrent requests for the same volume are coalesced by the master.open_single_flight method: if too many
+    requests are already waiting, the request is rejected with 429 and a Retry-After header. If the open run by
+    another request doesn't complete within the wait timeout, the request fails with 503 and a Retry-After header.
+    If the async field (or query parameter) is true, the volume is opened by a background job and the request
+    returns 202 right away, with the job id and the URL at which its progress can be queried.
 
     :return: Output from the master.open method.
     :rtype: str
@@ -67,10 +184,56 @@ def luksopen():
     if wn_list != None:
         api_logger.debug(wn_list)
 
-    response = master_node.open(vault_url=request.json['vault_url'],
-                                wrapping_token=request.json['vault_token'],
-                                secret_root=request.json['secret_root'],
-                                secret_path=request.json['secret_path'],
-                                secret_key=request.json['secret_key'])
-    
+    if request.json.get('async') or request.args.get('async', '').lower() in ('1', 'true', 'yes'):
+        try:
+            job = master_node.submit_open(vault_url=request.json['vault_url'],
+                                          wrapping_token=request.json['vault_token'],
+                                          secret_root=request.json['secret_root'],
+                                          secret_path=request.json['secret_path'],
+                                          secret_key=request.json['secret_key'],
+                                          cryptdev=request.json.get('cryptdev'))
+        except JobQueueFull as e:
+            api_logger.warning(str(e))
+            return jsonify({'error': 'too many requests'}), 429, {'Retry-After': str(e.retry_after)}
+
+        job_url = url_for('get_job', job_id=job['id'])
+        return jsonify({'job_id': job['id'], 'state': job['state'], 'job_url': job_url}), 202, {'Location': job_url}
+
+    try:
+        response, shared = master_node.open_single_flight(vault_url=request.json['vault_url'],
+                                                          wrapping_token=request.json['vault_token'],
+                                                          secret_root=request.json['secret_root'],
+                                                          secret_path=request.json['secret_path'],
+                                                          secret_key=request.json['secret_key'],
+                                                          cryptdev=request.json.get('cryptdev'))
+    except TooManyWaiters as e:
+        api_logger.warning(str(e))
+        return jsonify({'error': 'too many requests'}), 429, {'Retry-After': str(e.retry_after)}
+    except WaitTimeout as e:
+        api_logger.warning(str(e))
+        return jsonify({'error': 'volume still being opened'}), 503, {'Retry-After': str(e.retry_after)}
+
+    if shared:
+        api_logger.debug('Open result shared with a concurrent request')
+
     return jsonify(response)
+
+
+@app.route('/luksctl_api/v1.0/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Returns the record of an asynchronous job, e.g. submitted by an asynchronous open request, with its
+    state, current phase, the duration of each phase and, once completed, the volume_state or the error.
+
+    :param job_id: Job id returned by the asynchronous request.
+    :type job_id: str
+    :return: Job record, refer to the jobs.JobManager class for its content.
+    :rtype: str
+    """
+
+    master_node = instantiate_master_node()
+
+    job = master_node.job_manager().get(job_id)
+    if job is None:
+        abort(404)
+
+    return jsonify(job)
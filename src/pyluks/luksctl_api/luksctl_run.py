@@ -1,11 +1,18 @@
 # Import dependencies
-import os, sys, distro
+import os, io, sys, distro
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 
 # Import internal dependencies
-from ..utilities import run_command, create_logger
+from ..utilities import LazyLogger, read_config, write_file_atomically
 from ..vault_support import read_secret
-from .ssl_certificate import generate_self_signed_cert
+from ..backends import get_backend
+from ..cryptdev_registry import CryptdevRegistry
+from .exports import update_exports, EXPORTS_FILE
+from .single_flight import SingleFlight, DEFAULT_MAX_WAITERS, default_state_dir
+from . import jobs
+from . import status_stream
+from . import cluster_status
 
 
 
@@ -14,6 +21,9 @@ from .ssl_certificate import generate_self_signed_cert
 
 __prefix__ = sys.prefix
 
+# Phases of master.open during which the daemons are stopped
+DAEMONS_STOPPED_PHASES = ('stop_daemons', 'read_passphrase', 'unlock', 'start_daemons')
+
 
 
 ################################################################################
@@ -21,10 +31,10 @@ __prefix__ = sys.prefix
 
 LOGGER_NAME = 'luksctl_api'
 
-# Instantiate the logger
-api_logger = create_logger(luks_cryptdev_file='/etc/luks/luks-cryptdev.ini',
-                           logger_name=LOGGER_NAME,
-                           loggers_section='logs')
+# The logger is created on first use, not at import time
+api_logger = LazyLogger(luks_cryptdev_file='/etc/luks/luks-cryptdev.ini',
+                        logger_name=LOGGER_NAME,
+                        loggers_section='logs')
 
 
 
@@ -32,11 +42,47 @@ api_logger = create_logger(luks_cryptdev_file='/etc/luks/luks-cryptdev.ini',
 # FUNCTIONS
 
 def write_api_config(luks_cryptdev_file, env_path, daemons=[], node_list='',
-                     exports_list='', sudo_path='/usr/bin/sudo'):
+                     exports_list='', sudo_path='/usr/bin/sudo',
+                     node_status_url=cluster_status.DEFAULT_NODE_STATUS_URL,
+                     probe_timeout=cluster_status.DEFAULT_PROBE_TIMEOUT,
+                     probe_workers=cluster_status.DEFAULT_PROBE_WORKERS,
+                     status_cache_ttl=cluster_status.DEFAULT_CACHE_TTL,
+                     open_max_waiters=DEFAULT_MAX_WAITERS, single_flight_dir='',
+                     job_workers=jobs.DEFAULT_JOB_WORKERS, job_queue_size=jobs.DEFAULT_JOB_QUEUE_SIZE,
+                     job_ttl=jobs.DEFAULT_JOB_TTL, jobs_dir='',
+                     status_watch_interval=status_stream.DEFAULT_WATCH_INTERVAL,
+                     max_streams=status_stream.DEFAULT_MAX_STREAMS,
+                     stream_lifetime=status_stream.DEFAULT_STREAM_LIFETIME):
     """Writes the API configuration to the cryptdev .ini file in the luksctl_api section.
 
     :param luks_cryptdev_file: Path to the cryptdev .ini file, defaults to '/etc/luks/luks-cryptdev.ini'
     :type luks_cryptdev_file: str, optional
+    :param node_status_url: URL template used to probe the status of each node, defaults to 'https://{node}:5000/luksctl_api/v1.0/status'
+    :type node_status_url: str, optional
+    :param probe_timeout: Timeout in seconds for each node status probe, defaults to 2.0
+    :type probe_timeout: float, optional
+    :param probe_workers: Maximum number of concurrent node status probes, defaults to 32
+    :type probe_workers: int, optional
+    :param status_cache_ttl: Seconds for which the cluster status is cached, defaults to 10.0
+    :type status_cache_ttl: float, optional
+    :param open_max_waiters: Maximum number of open requests waiting for the same volume to be opened, the following ones are rejected with 429, defaults to 16
+    :type open_max_waiters: int, optional
+    :param single_flight_dir: Directory of the files shared by the API workers to coalesce open requests, defaults to '/run/luksctl_api' if writable
+    :type single_flight_dir: str, optional
+    :param job_workers: Maximum number of asynchronous open jobs run concurrently by each API worker, defaults to 4
+    :type job_workers: int, optional
+    :param job_queue_size: Maximum number of queued and running asynchronous jobs in each API worker, defaults to 64
+    :type job_queue_size: int, optional
+    :param job_ttl: Seconds for which completed asynchronous jobs can be queried, defaults to 3600.0
+    :type job_ttl: float, optional
+    :param jobs_dir: Directory of the asynchronous job records, defaults to the jobs subdirectory of single_flight_dir
+    :type jobs_dir: str, optional
+    :param status_watch_interval: Seconds between volume status rescans of the status stream when no mount or device-mapper event is received, defaults to 30.0
+    :type status_watch_interval: float, optional
+    :param max_streams: Maximum number of status streams and waiting long polls served concurrently by each API worker, the following ones are rejected with 503, defaults to 2
+    :type max_streams: int, optional
+    :param stream_lifetime: Seconds after which a status event stream is closed, defaults to 600.0
+    :type stream_lifetime: float, optional
     """
     #arguments = locals()
     #arguments.pop('luks_cryptdev_file')
@@ -55,9 +101,24 @@ def write_api_config(luks_cryptdev_file, env_path, daemons=[], node_list='',
     api_config['node_list'] = ','.join(node_list)
     api_config['exports_list'] = ','.join(exports_list)
     api_config['sudo_path'] = sudo_path
-
-    with open(luks_cryptdev_file, 'w') as f:
-        config.write(f)
+    # Escape '%' since ConfigParser interpolation is applied when the configuration is read
+    api_config['node_status_url'] = node_status_url.replace('%', '%%')
+    api_config['probe_timeout'] = str(probe_timeout)
+    api_config['probe_workers'] = str(probe_workers)
+    api_config['status_cache_ttl'] = str(status_cache_ttl)
+    api_config['open_max_waiters'] = str(open_max_waiters)
+    api_config['single_flight_dir'] = single_flight_dir
+    api_config['job_workers'] = str(job_workers)
+    api_config['job_queue_size'] = str(job_queue_size)
+    api_config['job_ttl'] = str(job_ttl)
+    api_config['jobs_dir'] = jobs_dir
+    api_config['status_watch_interval'] = str(status_watch_interval)
+    api_config['max_streams'] = str(max_streams)
+    api_config['stream_lifetime'] = str(stream_lifetime)
+
+    content = io.StringIO()
+    config.write(content)
+    write_file_atomically(luks_cryptdev_file, content.getvalue())
 
 
 def read_api_config(luks_cryptdev_file, api_section):
@@ -73,9 +134,8 @@ def read_api_config(luks_cryptdev_file, api_section):
     """
     
     if os.path.exists(luks_cryptdev_file):
-        # Read cryptdev ini file
-        config = ConfigParser()
-        config.read(luks_cryptdev_file)
+        # Read cryptdev ini file, parsed once and shared until it changes
+        config = read_config(luks_cryptdev_file)
 
         # Get configuration dictionary
         api_config = dict(config[api_section].items())
@@ -127,6 +187,9 @@ def write_systemd_unit_file(working_directory, environment_prefix, user, group,
     config['Service']['Group'] = group
     config['Service']['WorkingDirectory'] = working_directory
     config['Service']['Environment'] = f'"PATH={environment_prefix}/bin"'
+    # /run/luksctl_api, shared by the gunicorn workers to coalesce open requests
+    config['Service']['RuntimeDirectory'] = 'luksctl_api'
+    config['Service']['RuntimeDirectoryMode'] = '0700'
     
     config['Service']['ExecStart'] = f'{environment_prefix}/bin/gunicorn --config {gunicorn_config_file} app:{app}'
     
@@ -137,21 +200,28 @@ def write_systemd_unit_file(working_directory, environment_prefix, user, group,
         config.write(sf)
 
 
-def write_exports_file(exports_list, node_list):
-    """Adds lines for each export directory and worker node to configure nfs exports.
+def write_exports_file(exports_list, node_list, exports_file=EXPORTS_FILE, reload=True):
+    """Adds lines for each export directory and worker node to configure nfs exports. The exports file is
+    parsed once, worker nodes are aggregated in CIDR blocks when possible and the file is atomically replaced.
+    'exportfs -ra' is run only if the file has changed.
 
     :param exports_list: List containing the directories to be exported with nfs.
     :type exports_list: list
     :param node_list: List containing IPs of the worker nodes.
     :type node_list: list
+    :param exports_file: Path to the exports file, defaults to '/etc/exports'
+    :type exports_file: str, optional
+    :param reload: If set to True, exports are reloaded with 'exportfs -ra' when changed, defaults to True
+    :type reload: bool, optional
+    :return: True if the exports file has been changed, otherwise False.
+    :rtype: bool
     """
-    
-    with open('/etc/exports','r+') as exports_file:
-        for export_dir in exports_list:
-            for node in node_list:
-                exports_line = f'{export_dir} {node}(rw,sync,no_root_squash)'
-                if exports_line not in exports_file.readlines():
-                    exports_file.write(f'{export_dir} {node}(rw,sync,no_root_squash)')
+
+    return update_exports(exports_list=exports_list,
+                          node_list=node_list,
+                          exports_file=exports_file,
+                          reload=reload,
+                          logger=api_logger)
 
 
 
@@ -163,7 +233,7 @@ class master:
     """
 
 
-    def __init__(self, luks_cryptdev_file, api_section='luksctl_api'):
+    def __init__(self, luks_cryptdev_file, api_section='luksctl_api', backend=None):
         """Instantiates the master class. If luks_cryptdev_file (and eventually also api_section) is defined, other arguments will be ignored and
         the object's attributes are read from the cryptdev .ini file.
 
@@ -171,7 +241,11 @@ class master:
         :type luks_cryptdev_file: str
         :param api_section: API section as defined in the cryptdev .ini file, defaults to 'luksctl_api'
         :type api_section: str, optional
+        :param backend: Execution backend used to run luksctl and systemctl, defaults to the backend returned by pyluks.backends.get_backend
+        :type backend: pyluks.backends.Backend, optional
         """
+
+        self.backend = backend if backend is not None else get_backend()
         
         api_configs = read_api_config(luks_cryptdev_file=luks_cryptdev_file, api_section=api_section)
         self.daemons = api_configs['daemons']
@@ -180,8 +254,36 @@ class master:
         self.sudo_path = api_configs['sudo_path']
         self.env_path = api_configs['env_path']
 
+        # Cluster status probing options, missing in configurations written by older versions
+        self.node_status_url = api_configs.get('node_status_url', cluster_status.DEFAULT_NODE_STATUS_URL)
+        self.probe_timeout = float(api_configs.get('probe_timeout', cluster_status.DEFAULT_PROBE_TIMEOUT))
+        self.probe_workers = int(api_configs.get('probe_workers', cluster_status.DEFAULT_PROBE_WORKERS))
+        self.status_cache_ttl = float(api_configs.get('status_cache_ttl', cluster_status.DEFAULT_CACHE_TTL))
+
+        # Open requests coalescing options, also missing in older configurations
+        self.open_max_waiters = int(api_configs.get('open_max_waiters', DEFAULT_MAX_WAITERS))
+        self.single_flight_dir = api_configs.get('single_flight_dir') or None
+
+        # Asynchronous jobs options, also missing in older configurations
+        self.job_workers = int(api_configs.get('job_workers', jobs.DEFAULT_JOB_WORKERS))
+        self.job_queue_size = int(api_configs.get('job_queue_size', jobs.DEFAULT_JOB_QUEUE_SIZE))
+        self.job_ttl = float(api_configs.get('job_ttl', jobs.DEFAULT_JOB_TTL))
+        self.jobs_dir = api_configs.get('jobs_dir') or None
+        self.status_watch_interval = float(api_configs.get('status_watch_interval', status_stream.DEFAULT_WATCH_INTERVAL))
+        self.max_streams = int(api_configs.get('max_streams', status_stream.DEFAULT_MAX_STREAMS))
+        self.stream_lifetime = float(api_configs.get('stream_lifetime', status_stream.DEFAULT_STREAM_LIFETIME))
+
+        self.luks_cryptdev_file = luks_cryptdev_file
         self.luksctl_cmd = f'{self.env_path}/bin/luksctl'
-        self.distro_id = distro.id()
+        self._distro_id = None
+
+
+    @property
+    def distro_id(self):
+        """Distribution id, read with distro.id() on first use."""
+        if self._distro_id is None:
+            self._distro_id = distro.id()
+        return self._distro_id
 
 
     def get_daemons(self): return self.daemons
@@ -190,19 +292,20 @@ class master:
     def get_env_path(self): return self.env_path
 
 
-    def get_status(self):
+    def get_status(self, cryptdev=None):
         """Gets cryptdevice status with the 'luksctl status' command and returns a json with the following structure:
         
         * {'volume_state' : 'mounted'} if the volume is mounted.
         * {'volume_state': 'unmounted'} if the volume is unmounted.
         * {'volume_state' : 'unavailable', 'output' : stdout, 'stderr' : stderr} if the luksctl status command returns a non-recognized exit code.
 
+        :param cryptdev: Cryptdev name, LUKS UUID, device or mountpoint of the volume, defaults to the volume in the 'luks' section of the cryptdev .ini file
+        :type cryptdev: str, optional
         :return: String containing the json-formatted message for the volume_state
         :rtype: str
         """
 
-        status_command = f'{self.sudo_path} {self.luksctl_cmd} status'
-        stdout, stderr, status = run_command(status_command)
+        stdout, stderr, status = self.backend.luksctl('status', self.luksctl_cmd, sudo_path=self.sudo_path, cryptdev=cryptdev)
 
         api_logger.debug(f'Volume status stdout: {stdout}')
         api_logger.debug(f'Volume status stderr: {stderr}')
@@ -216,9 +319,58 @@ class master:
             return {'volume_state': 'unavailable', 'output': stdout, 'stderr': stderr }
 
 
-    def open(self, vault_url, wrapping_token, secret_root, secret_path, secret_key):
+    def get_volume_states(self):
+        """Gets the volume_state of every volume in the cryptdev .ini file with the master.get_status method.
+
+        :return: Dictionary containing the volume_state of each volume, by cryptdev name ('default' on hosts without registered volumes).
+        :rtype: dict
+        """
+
+        cryptdevs = CryptdevRegistry(self.luks_cryptdev_file).names()
+        if not cryptdevs:
+            return {'default': self.get_status()['volume_state']}
+        return {cryptdev: self.get_status(cryptdev=cryptdev)['volume_state'] for cryptdev in cryptdevs}
+
+
+    def status_watcher(self):
+        """Returns the StatusWatcher shared by the status stream clients of the process, refer to the
+        status_stream.StatusWatcher class. Volume states are computed with a master object of its own.
+
+        :return: The started StatusWatcher of the process.
+        :rtype: pyluks.luksctl_api.status_stream.StatusWatcher
+        """
+
+        watcher_node = master(self.luks_cryptdev_file, backend=self.backend)
+        return status_stream.get_status_watcher(self.luks_cryptdev_file, watcher_node.get_volume_states,
+                                                interval=self.status_watch_interval)
+
+
+    def get_cluster_status(self):
+        """Probes the status endpoint of every node in the node list concurrently and returns a consolidated
+        document with the volume_state and probe latency of each node. Results are cached for status_cache_ttl
+        seconds, refer to the cluster_status.get_cluster_status function for its content.
+
+        :return: Dictionary containing the status of each node and a summary of the cluster status.
+        :rtype: dict
+        """
+
+        response = cluster_status.get_cluster_status(node_list=self.node_list,
+                                                     status_url=self.node_status_url,
+                                                     timeout=self.probe_timeout,
+                                                     max_workers=self.probe_workers,
+                                                     cache_ttl=self.status_cache_ttl)
+
+        api_logger.debug(f'Cluster status summary: {response["summary"]}')
+
+        return response
+
+
+    def open(self, vault_url, wrapping_token, secret_root, secret_path, secret_key, cryptdev=None, progress=None):
         """Reads the passphrase from HashiCorp Vault, opens and mount the cryptdevice. If the master node is
         in a cluster, it restarts the nfs using the master.nfs_restart method.
+        The passphrase is read from Vault only if the volume is not mounted, so that the single-use wrapping token
+        is not consumed otherwise, in background while the daemons are stopped. If the passphrase can't be read,
+        the daemons are started again and the error is raised.
         It returns a json-formatted string containing information about the cryptdevice status, refer to the
         master.get_status method for its content.
 
@@ -232,32 +384,59 @@ class master:
         :type secret_path: str
         :param secret_key: Vault key associated to the passphrase.
         :type user_key: str
+        :param cryptdev: Cryptdev name, LUKS UUID, device or mountpoint of the volume, defaults to the volume in the 'luks' section of the cryptdev .ini file
+        :type cryptdev: str, optional
+        :param progress: Function called with the name of each phase as it starts: 'status', 'stop_daemons', 'read_passphrase', 'unlock' and 'start_daemons', defaults to None
+        :type progress: function, optional
         :return: String containing the json-formatted message for the volume_state
         :rtype: str
         """
-        
-        status_command = f'{self.sudo_path} {self.luksctl_cmd} status'
-        stdout, stderr, status = run_command(status_command)
+
+        report = progress if progress is not None else lambda phase: None
+
+        report('status')
+        stdout, stderr, status = self.backend.luksctl('status', self.luksctl_cmd, sudo_path=self.sudo_path, cryptdev=cryptdev)
 
         if str(status) == '0':
             return {'volume_state': 'mounted'}
         
         else:
-            # Read passphrase from vault
-            secret = read_secret(vault_url=vault_url,
-                                 wrapping_token=wrapping_token,
-                                 secret_root=secret_root,
-                                 secret_path=secret_path,
-                                 secret_key=secret_key)
-            
+            # Read the passphrase from vault while the daemons are stopped
+            executor = ThreadPoolExecutor(max_workers=1)
+            secret_future = executor.submit(read_secret,
+                                            vault_url=vault_url,
+                                            wrapping_token=wrapping_token,
+                                            secret_root=secret_root,
+                                            secret_path=secret_path,
+                                            secret_key=secret_key)
+            executor.shutdown(wait=False)
+
             # Stop daemons before opening volume
             if self.daemons:
-                self.stop_daemons()
+                report('stop_daemons')
+                try:
+                    self.stop_daemons()
+                except Exception:
+                    # Don't leave the read behind: wait for it, so that its error, if any, is logged too
+                    if secret_future.exception() is not None:
+                        api_logger.error(f'Unable to read the passphrase from vault: {secret_future.exception()}')
+                    raise
+
+            # Wait for the passphrase, restarting the daemons if it can't be read
+            report('read_passphrase')
+            try:
+                secret = secret_future.result()
+            except Exception:
+                api_logger.exception('Unable to read the passphrase from vault')
+                if self.daemons:
+                    self.start_daemons()
+                raise
 
             # Open volume
+            report('unlock')
             api_logger.debug(f'Opening volume')
-            open_command = f'printf "{secret}\n" | {self.sudo_path} {self.luksctl_cmd} open' 
-            stdout, stderr, status = run_command(open_command)
+            stdout, stderr, status = self.backend.luksctl('open', self.luksctl_cmd, sudo_path=self.sudo_path, secret=secret,
+                                                          cryptdev=cryptdev)
 
             api_logger.debug(f'Volume status stdout: {stdout}')
             api_logger.debug(f'Volume status stderr: {stderr}')
@@ -265,6 +444,7 @@ class master:
 
             if str(status) == '0':
                 if self.daemons:
+                    report('start_daemons')
                     self.start_daemons()
                 return {'volume_state': 'mounted' }
 
@@ -275,15 +455,112 @@ class master:
                 return {'volume_state': 'unavailable', 'output': stdout, 'stderr': stderr}
 
 
+    def open_single_flight(self, vault_url, wrapping_token, secret_root, secret_path, secret_key, cryptdev=None,
+                           progress=None):
+        """Opens the volume with the master.open method, coalescing concurrent requests for the same volume
+        across the API workers: while the volume is being opened, other requests wait for the result and share
+        it instead of reading the passphrase and running 'luksctl open' again. Their wrapping tokens are left unused.
+
+        :param cryptdev: Cryptdev name, LUKS UUID, device or mountpoint of the volume, defaults to the volume in the 'luks' section of the cryptdev .ini file
+        :type cryptdev: str, optional
+        :param progress: Function called with the name of each phase as it starts, refer to master.open. Requests waiting for another one report the 'waiting' phase, defaults to None
+        :type progress: function, optional
+        :raises pyluks.luksctl_api.single_flight.TooManyWaiters: Raises an error if open_max_waiters requests are already waiting for the volume.
+        :return: Tuple containing the master.open output and a boolean, True if it was shared with another request.
+        :rtype: tuple
+        """
+
+        flight = SingleFlight(state_dir=self.single_flight_dir, max_waiters=self.open_max_waiters)
+        try:
+            return flight.run(self._open_key(cryptdev), lambda: self.open(vault_url=vault_url,
+                                                                wrapping_token=wrapping_token,
+                                                                secret_root=secret_root,
+                                                                secret_path=secret_path,
+                                                                secret_key=secret_key,
+                                                                cryptdev=cryptdev,
+                                                                progress=progress),
+                              on_wait=(lambda: progress('waiting')) if progress is not None else None)
+        finally:
+            # Status stream clients served by this process see the new state without waiting for the next rescan
+            status_stream.notify_status_change()
+
+
+    def _open_key(self, cryptdev):
+        # Requests naming the same volume by different identifiers share the same key
+        try:
+            key = CryptdevRegistry(self.luks_cryptdev_file).lookup(cryptdev).get('cryptdev') or cryptdev or 'default'
+        except KeyError:
+            key = cryptdev or 'default'
+        return f'open-{key}'
+
+
+    def job_manager(self):
+        """Returns the JobManager running the asynchronous jobs of the process.
+
+        :return: The JobManager of the process for the configured jobs directory.
+        :rtype: pyluks.luksctl_api.jobs.JobManager
+        """
+
+        jobs_dir = self.jobs_dir or os.path.join(self.single_flight_dir or default_state_dir(), 'jobs')
+        return jobs.get_job_manager(jobs_dir, max_workers=self.job_workers, max_pending=self.job_queue_size,
+                                    ttl=self.job_ttl)
+
+
+    def submit_open(self, vault_url, wrapping_token, secret_root, secret_path, secret_key, cryptdev=None):
+        """Submits the volume open as an asynchronous job and returns right away. The job runs the
+        master.open_single_flight method in background and records the progress of its phases.
+
+        :param cryptdev: Cryptdev name, LUKS UUID, device or mountpoint of the volume, defaults to the volume in the 'luks' section of the cryptdev .ini file
+        :type cryptdev: str, optional
+        :raises pyluks.luksctl_api.jobs.JobQueueFull: Raises an error if job_queue_size jobs are already queued or running in the process.
+        :return: Dictionary describing the job, refer to the JobManager class for its content.
+        :rtype: dict
+        """
+
+        def open_job(progress):
+            response, shared = self.open_single_flight(vault_url=vault_url,
+                                                       wrapping_token=wrapping_token,
+                                                       secret_root=secret_root,
+                                                       secret_path=secret_path,
+                                                       secret_key=secret_key,
+                                                       cryptdev=cryptdev,
+                                                       progress=progress)
+            return response
+
+        return self.job_manager().submit('open', open_job, cryptdev=cryptdev)
+
+
+    def recover_jobs(self):
+        """Records the asynchronous jobs left running by API workers that exited (e.g. recycled after max_requests)
+        as failed, see JobManager.recover. If one of them was opening a volume after the daemons were stopped,
+        the daemons are started again, unless the volume is being opened by another request.
+
+        :return: List of the recovered jobs.
+        :rtype: list
+        """
+
+        recovered = self.job_manager().recover()
+        flight = SingleFlight(state_dir=self.single_flight_dir, max_waiters=self.open_max_waiters)
+        restart = False
+        for job in recovered:
+            api_logger.error(f'Job {job["id"]} ({job["operation"]}) interrupted in phase {job.get("phase")}: {jobs.WORKER_EXITED}')
+            if job['operation'] == 'open' and job.get('phase') in DAEMONS_STOPPED_PHASES \
+               and not flight.busy(self._open_key(job.get('cryptdev'))):
+                restart = True
+        if restart and self.daemons:
+            api_logger.warning('Starting the daemons stopped by the interrupted open')
+            self.start_daemons()
+        return recovered
+
+
     def stop_daemons(self):
         "Stop daemons that have to be stopped before opening the volume"
 
         for daemon in self.daemons:
             api_logger.debug(f'Stopping {daemon}')
 
-            stop_command = f'{self.sudo_path} systemctl stop {daemon}'
-            api_logger.debug(stop_command)
-            stdout, stderr, status = run_command(stop_command)
+            api_logger.debug(f'{self.sudo_path} systemctl stop {daemon}')
+            stdout, stderr, status = self.backend.systemctl('stop', daemon, sudo_path=self.sudo_path)
 
             api_logger.debug(f'{daemon} status: {status}')
             api_logger.debug(f'{daemon} status stdout: {stdout}')
@@ -295,9 +572,8 @@ class master:
         for daemon in self.daemons:
             api_logger.debug(f'Starting {daemon}')
 
-            start_command = f'{self.sudo_path} systemctl start {daemon}'
-            api_logger.debug(start_command)
-            stdout, stderr, status = run_command(start_command)
+            api_logger.debug(f'{self.sudo_path} systemctl start {daemon}')
+            stdout, stderr, status = self.backend.systemctl('start', daemon, sudo_path=self.sudo_path)
 
             api_logger.debug(f'{daemon} status: {status}')
             api_logger.debug(f'{daemon} status stdout: {stdout}')
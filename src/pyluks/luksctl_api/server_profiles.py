@@ -0,0 +1,162 @@
+# Import dependencies
+import os
+import io
+
+# Import internal dependencies
+from ..utilities import write_file_atomically
+
+
+
+################################################################################
+# VARIABLES
+
+DEFAULT_PROFILE = 'balanced'
+DEFAULT_BIND = '0.0.0.0:5000'
+DEFAULT_CERT_FILE = '/etc/luks/gunicorn-cert.pem'
+DEFAULT_KEY_FILE = '/etc/luks/gunicorn-key.pem'
+
+# Gunicorn settings of each profile. Workers are computed from the number of usable CPUs with the workers function
+# and bounded by min_workers and max_workers. Threaded workers (gthread) are used by every profile, since the
+# status stream and the asynchronous jobs hold connections or threads while waiting.
+PROFILES = {
+    # Tiny VMs: a single worker process, a few threads for the status stream clients
+    'minimal': {
+        'worker_class': 'gthread',
+        'workers': lambda cpus: 1,
+        'min_workers': 1,
+        'max_workers': 1,
+        'threads': 4,
+        'keepalive': 2,
+        'preload_app': False,
+        'max_requests': 1000,
+        'max_requests_jitter': 100,
+        'timeout': 120,
+    },
+    # Single VMs and small clusters: one worker per CPU, up to 8
+    'balanced': {
+        'worker_class': 'gthread',
+        'workers': lambda cpus: cpus,
+        'min_workers': 2,
+        'max_workers': 8,
+        'threads': 4,
+        'keepalive': 5,
+        'preload_app': True,
+        'max_requests': 5000,
+        'max_requests_jitter': 500,
+        'timeout': 120,
+    },
+    # Master nodes of large clusters: one worker per CPU and many threads for the polling and streaming clients
+    'high-concurrency': {
+        'worker_class': 'gthread',
+        'workers': lambda cpus: cpus,
+        'min_workers': 2,
+        'max_workers': 32,
+        'threads': 16,
+        'keepalive': 30,
+        'preload_app': True,
+        'max_requests': 20000,
+        'max_requests_jitter': 2000,
+        'timeout': 120,
+    },
+}
+
+# Settings written to the gunicorn configuration file, in order
+SETTINGS = ('worker_class', 'workers', 'threads', 'keepalive', 'preload_app', 'max_requests', 'max_requests_jitter', 'timeout')
+
+
+
+################################################################################
+# FUNCTIONS
+
+def usable_cpu_count():
+    """Returns the number of CPUs the process can run on, i.e. the CPU affinity mask when available,
+    which accounts for cpusets and taskset, otherwise the number of CPUs of the system."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def resolve_profile(profile=DEFAULT_PROFILE, cpu_count=None, **overrides):
+    """Returns the gunicorn settings of a profile, sized to the number of CPUs.
+
+    :param profile: Profile name, one of 'minimal', 'balanced' or 'high-concurrency', defaults to 'balanced'
+    :type profile: str, optional
+    :param cpu_count: Number of CPUs used to size the workers, defaults to the number of usable CPUs
+    :type cpu_count: int, optional
+    :param overrides: Settings overriding the ones of the profile, e.g. workers=3. None values are ignored.
+    :raises ValueError: Raises an error if the profile or a setting is unknown.
+    :return: Dictionary containing the gunicorn settings, e.g. worker_class, workers, threads, keepalive.
+    :rtype: dict
+    """
+    if profile not in PROFILES:
+        raise ValueError(f'Unknown server profile {profile}, choose one of {", ".join(PROFILES)}.')
+    unknown = set(overrides) - set(SETTINGS)
+    if unknown:
+        raise ValueError(f'Unknown gunicorn settings: {", ".join(sorted(unknown))}.')
+
+    cpus = cpu_count if cpu_count is not None else usable_cpu_count()
+    definition = PROFILES[profile]
+    settings = {name: definition[name] for name in SETTINGS if name != 'workers'}
+    settings['workers'] = max(definition['min_workers'], min(definition['workers'](cpus), definition['max_workers']))
+    settings.update({name: value for name, value in overrides.items() if value is not None})
+    return {name: settings[name] for name in SETTINGS}
+
+
+def render_gunicorn_config(settings, profile=DEFAULT_PROFILE, bind=DEFAULT_BIND, cert_file=DEFAULT_CERT_FILE,
+                           key_file=DEFAULT_KEY_FILE, tls_session_resumption=True):
+    """Returns the content of the gunicorn configuration file for the given settings. As in the configuration
+    shipped with the package, the certificate and the key are used only if they exist. With TLS session
+    resumption, the ssl_context hook (gunicorn >= 21) serves the connections of all the workers with a
+    SharedServerContext, so that returning clients resume their session with any worker.
+
+    :param settings: Gunicorn settings, as returned by resolve_profile.
+    :type settings: dict
+    :param profile: Profile name, written as comment, defaults to 'balanced'
+    :type profile: str, optional
+    :param bind: Address and port the API listens on, defaults to '0.0.0.0:5000'
+    :type bind: str, optional
+    :param cert_file: SSL certificate file, defaults to '/etc/luks/gunicorn-cert.pem'
+    :type cert_file: str, optional
+    :param key_file: SSL key file, defaults to '/etc/luks/gunicorn-key.pem'
+    :type key_file: str, optional
+    :param tls_session_resumption: If set to True, the TLS session tickets are shared by the workers, defaults to True
+    :type tls_session_resumption: bool, optional
+    :return: Content of the gunicorn configuration file.
+    :rtype: str
+    """
+    content = io.StringIO()
+    content.write(f'# Generated by luksctl_api from the {profile} profile\n')
+    content.write('import os\n\n')
+    for name in SETTINGS:
+        content.write(f'{name} = {settings[name]!r}\n')
+    content.write(f'bind = {bind!r}\n')
+    content.write('umask = 0o007\n')
+    content.write(f'_certfile_path = {cert_file!r}\n')
+    content.write('certfile = _certfile_path if os.path.exists(_certfile_path) else None\n')
+    content.write(f'_keyfile_path = {key_file!r}\n')
+    content.write('keyfile = _keyfile_path if os.path.exists(_keyfile_path) else None\n')
+    if tls_session_resumption:
+        content.write('\n# TLS context created by the gunicorn master, the workers share its session ticket key\n')
+        content.write('from pyluks.luksctl_api.ssl_certificate import SharedServerContext\n')
+        content.write('_shared_ssl_context = SharedServerContext()\n\n')
+        content.write('def ssl_context(conf, default_ssl_context_factory):\n')
+        content.write('    return _shared_ssl_context.get(conf)\n')
+    return content.getvalue()
+
+
+def write_gunicorn_config(gunicorn_config_file, profile=DEFAULT_PROFILE, cpu_count=None, bind=DEFAULT_BIND,
+                          cert_file=DEFAULT_CERT_FILE, key_file=DEFAULT_KEY_FILE, tls_session_resumption=True, **overrides):
+    """Writes the gunicorn configuration file of the API from a profile, refer to resolve_profile.
+
+    :param gunicorn_config_file: Path of the gunicorn configuration file, e.g. '/etc/luks/gunicorn.conf.py'
+    :type gunicorn_config_file: str
+    :return: The gunicorn settings written to the file.
+    :rtype: dict
+    """
+    settings = resolve_profile(profile, cpu_count=cpu_count, **overrides)
+    write_file_atomically(gunicorn_config_file,
+                          render_gunicorn_config(settings, profile=profile, bind=bind, cert_file=cert_file, key_file=key_file,
+                                                 tls_session_resumption=tls_session_resumption),
+                          mode=0o644)
+    return settings
@@ -0,0 +1,247 @@
+# Import dependencies
+import os
+import json
+import math
+import time
+import uuid
+import fcntl
+import tempfile
+import threading
+
+# Import internal dependencies
+from ..utilities import write_file_atomically
+
+
+
+################################################################################
+# VARIABLES
+
+# Runtime directory of the luksctl-api service, created by systemd (RuntimeDirectory in the unit file)
+DEFAULT_STATE_DIR = '/run/luksctl_api'
+
+DEFAULT_MAX_WAITERS = 16
+DEFAULT_RESULT_TTL = 2.0       # Seconds for which a completed result is shared with late requests
+DEFAULT_WAIT_TIMEOUT = 600.0
+DEFAULT_RETRY_AFTER = 5        # Seconds suggested to rejected clients before the first run has been timed
+
+POLL_INTERVAL = 0.05
+
+
+
+################################################################################
+# EXCEPTIONS
+
+class TooManyWaiters(Exception):
+    """Raised when a request can't wait for the running operation, because too many requests are already waiting.
+    The retry_after attribute holds the seconds after which the request should be retried."""
+
+    def __init__(self, key, retry_after):
+        super().__init__(f'Too many requests waiting for {key}, retry after {retry_after} seconds.')
+        self.key = key
+        self.retry_after = retry_after
+
+
+class WaitTimeout(TimeoutError):
+    """Raised when the operation run by another caller doesn't complete within the wait timeout. The operation is
+    still running: the retry_after attribute holds the seconds after which the request should be retried."""
+
+    def __init__(self, key, retry_after):
+        super().__init__(f'Timed out waiting for {key}, retry after {retry_after} seconds.')
+        self.key = key
+        self.retry_after = retry_after
+
+
+
+################################################################################
+# FUNCTIONS
+
+def default_state_dir():
+    """Returns the service runtime directory if it's writable, otherwise a private directory in the temporary
+    directory of the system, e.g. when the API is run outside of its systemd unit."""
+    if os.access(DEFAULT_STATE_DIR, os.W_OK):
+        return DEFAULT_STATE_DIR
+    return os.path.join(tempfile.gettempdir(), f'luksctl_api-{os.getuid()}')
+
+
+def pid_alive(pid):
+    """Returns True if a process with the given pid exists."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+
+################################################################################
+# SINGLE FLIGHT CLASS
+
+class SingleFlight:
+    """Coalesces concurrent runs of the same operation across threads and processes, e.g. the gunicorn workers
+    serving the API. For each key, the first caller (the leader) runs the operation holding an exclusive flock
+    on a file in state_dir; the callers arriving while it runs wait for the lock and get the leader's result
+    instead of running the operation again. Results completed less than result_ttl seconds ago are also shared.
+    If the leader fails, the next waiter runs the operation itself.
+
+    Waiters are registered as files named after their process id, so the ones left by a killed worker are
+    ignored. When max_waiters callers are already waiting, new callers are rejected with TooManyWaiters.
+    """
+
+
+    def __init__(self, state_dir=None, max_waiters=DEFAULT_MAX_WAITERS, result_ttl=DEFAULT_RESULT_TTL,
+                 wait_timeout=DEFAULT_WAIT_TIMEOUT):
+        """Instantiate a SingleFlight object.
+
+        :param state_dir: Directory of the lock, state and waiter files, defaults to the directory returned by default_state_dir
+        :type state_dir: str, optional
+        :param max_waiters: Maximum number of callers waiting for a running operation, defaults to 16
+        :type max_waiters: int, optional
+        :param result_ttl: Seconds for which a completed result is shared with new callers, defaults to 2.0
+        :type result_ttl: float, optional
+        :param wait_timeout: Maximum seconds spent waiting for a running operation, defaults to 600.0
+        :type wait_timeout: float, optional
+        """
+        self.state_dir = state_dir if state_dir is not None else default_state_dir()
+        self.max_waiters = max_waiters
+        self.result_ttl = result_ttl
+        self.wait_timeout = wait_timeout
+        os.makedirs(self.state_dir, mode=0o700, exist_ok=True)
+
+
+    #____________________________________
+    # State files
+    def _path(self, key, suffix):
+        safe_key = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in key)
+        return os.path.join(self.state_dir, f'{safe_key}{suffix}')
+
+    def state(self, key):
+        """Returns the state of the last run for a key: generation, running, failed, result, finished and duration.
+        While running, duration is the one of the previous run."""
+        try:
+            with open(self._path(key, '.state')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'generation': 0, 'running': False}
+
+    def _write_state(self, key, state):
+        write_file_atomically(self._path(key, '.state'), json.dumps(state), mode=0o600)
+
+    def _retry_after(self, key):
+        duration = self.state(key).get('duration')
+        return max(1, math.ceil(duration)) if duration else DEFAULT_RETRY_AFTER
+
+    def busy(self, key):
+        """Returns True if the operation is being run by a caller, i.e. if its lock is held."""
+        with open(self._path(key, '.lock'), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return False
+
+    def waiters(self, key):
+        """Returns the number of callers waiting for the running operation, removing the entries of dead processes."""
+        waiters_dir = self._path(key, '.waiters')
+        count = 0
+        for entry in os.listdir(waiters_dir) if os.path.isdir(waiters_dir) else []:
+            if pid_alive(int(entry.split('-')[0])):
+                count += 1
+            else:
+                try:
+                    os.remove(os.path.join(waiters_dir, entry))
+                except FileNotFoundError:
+                    pass
+        return count
+
+
+    #____________________________________
+    # Run
+    def _lead(self, key, function):
+        """Runs the operation holding the lock and records its result."""
+        state = self.state(key)
+        generation = state.get('generation', 0) + 1
+        # The duration of the previous run is kept to compute the Retry-After delay while running
+        self._write_state(key, {'generation': generation, 'running': True, 'started': time.time(),
+                                'duration': state.get('duration')})
+        start = time.monotonic()
+        try:
+            result = function()
+        except BaseException:
+            self._write_state(key, {'generation': generation, 'running': False, 'failed': True, 'finished': time.time(),
+                                    'duration': time.monotonic() - start})
+            raise
+        self._write_state(key, {'generation': generation, 'running': False, 'failed': False, 'result': result,
+                                'finished': time.time(), 'duration': time.monotonic() - start})
+        return result
+
+    def _shareable(self, state, generation=None):
+        if state.get('running') or state.get('failed') or 'result' not in state:
+            return False
+        if generation is not None and state['generation'] >= generation:
+            return True # Completed while we were waiting for it
+        return time.time() - state.get('finished', 0) <= self.result_ttl
+
+    def run(self, key, function, on_wait=None):
+        """Runs the operation, or waits for the same operation run by another caller and returns its result.
+
+        :param key: Key identifying the operation, e.g. the name of the volume to open.
+        :type key: str
+        :param function: Operation, called without arguments. Its result must be JSON serializable.
+        :type function: function
+        :param on_wait: Function called without arguments when the caller starts waiting for another caller, defaults to None
+        :type on_wait: function, optional
+        :raises TooManyWaiters: Raises an error if max_waiters callers are already waiting for the operation.
+        :raises WaitTimeout: Raises an error if the operation doesn't complete within wait_timeout seconds.
+        :return: Tuple containing the result and a boolean, True if the result was computed by another caller.
+        :rtype: tuple
+        """
+        with open(self._path(key, '.lock'), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                pass
+            else:
+                try:
+                    state = self.state(key)
+                    if self._shareable(state):
+                        return state['result'], True
+                    return self._lead(key, function), False
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+            # Another caller is running the operation: wait for it, unless too many callers are waiting
+            # Generation whose result is awaited: the running one, or the next one if the lock holder hasn't started yet
+            observed = self.state(key)
+            waiting_for = observed.get('generation', 0) + (0 if observed.get('running') else 1)
+            waiters_dir = self._path(key, '.waiters')
+            os.makedirs(waiters_dir, mode=0o700, exist_ok=True)
+            waiter = os.path.join(waiters_dir, f'{os.getpid()}-{threading.get_ident()}-{uuid.uuid4().hex}')
+            open(waiter, 'w').close()
+            try:
+                if self.waiters(key) > self.max_waiters:
+                    raise TooManyWaiters(key, self._retry_after(key))
+                if on_wait is not None:
+                    on_wait()
+
+                deadline = time.monotonic() + self.wait_timeout
+                while True:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if time.monotonic() > deadline:
+                            raise WaitTimeout(key, self._retry_after(key))
+                        time.sleep(POLL_INTERVAL)
+            finally:
+                os.remove(waiter)
+
+            try:
+                state = self.state(key)
+                if self._shareable(state, generation=waiting_for):
+                    return state['result'], True
+                return self._lead(key, function), False # The leader failed or crashed
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -1,31 +1,130 @@
 # Import dependencies
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519
 from cryptography.hazmat.primitives import serialization
 from cryptography import x509
 from cryptography.hazmat.primitives import hashes
+import os
+import ssl
 import datetime
 
-def generate_private_key(key_size, key_file):
+# Import internal dependencies
+from ..utilities import write_file_atomically
+
+
+
+################################################################################
+# VARIABLES
+
+# ECDSA P-256 keys are generated in milliseconds and make the TLS handshakes much cheaper than RSA-4096 ones.
+# Ed25519 requires TLS 1.3 clients, RSA is kept for old clients.
+KEY_TYPES = ('ecdsa-p256', 'ed25519', 'rsa')
+DEFAULT_KEY_TYPE = 'ecdsa-p256'
+
+# Certificates expiring in less than these days are regenerated instead of reused
+DEFAULT_MIN_VALIDITY_DAYS = 30
+
+# Session tickets issued to TLS 1.3 clients after each full handshake
+TLS13_TICKETS = 2
+
+
+
+################################################################################
+# FUNCTIONS
+
+def generate_private_key(key_size, key_file, key_type='rsa'):
     """Generates a private key for the self signed certificate.
 
-    :param key_size: Key length in bits
+    :param key_size: Key length in bits, used only for RSA keys
     :type key_size: int
     :param key_file: Path where the private key is stored.
     :type key_file: str
-    :return: An instance of RSAPrivateKey containing the private key.
-    :rtype: RSAPrivateKey
+    :param key_type: Key type, one of 'ecdsa-p256', 'ed25519' or 'rsa', defaults to 'rsa'
+    :type key_type: str, optional
+    :raises ValueError: Raises an error if the key type is unknown.
+    :return: An instance of the private key, e.g. EllipticCurvePrivateKey.
+    :rtype: PrivateKeyTypes
     """
-    
-    key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
 
-    with open(key_file, 'wb') as f:
-        f.write(key.private_bytes(encoding=serialization.Encoding.PEM, format=serialization.PrivateFormat.TraditionalOpenSSL, encryption_algorithm=serialization.NoEncryption()))
+    if key_type == 'ecdsa-p256':
+        key = ec.generate_private_key(ec.SECP256R1())
+    elif key_type == 'ed25519':
+        key = ed25519.Ed25519PrivateKey.generate()
+    elif key_type == 'rsa':
+        key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+    else:
+        raise ValueError(f'Unknown key type {key_type}, choose one of {", ".join(KEY_TYPES)}.')
+
+    # The traditional format is kept for RSA keys, Ed25519 keys can only be stored as PKCS8
+    key_format = serialization.PrivateFormat.TraditionalOpenSSL if key_type == 'rsa' else serialization.PrivateFormat.PKCS8
+    if os.path.exists(key_file):
+        os.chmod(key_file, 0o600) # The permissions of an existing file are kept, e.g. a key written world-readable before
+    write_file_atomically(key_file,
+                          key.private_bytes(encoding=serialization.Encoding.PEM, format=key_format, encryption_algorithm=serialization.NoEncryption()),
+                          mode=0o600)
 
     return key
 
 
-def generate_self_signed_cert(CN='localhost', cert_file='/etc/luks/gunicorn-cert.pem', expiration_days=3650, key_size=4096, key_file='/etc/luks/gunicorn-key.pem'):
-    """Generates a self signed certificate used by the luksctl API for https.
+def key_type_of(key):
+    """Returns the key type of a private or public key, as in KEY_TYPES, or None for other key types."""
+    if isinstance(key, (ec.EllipticCurvePrivateKey, ec.EllipticCurvePublicKey)) and isinstance(key.curve, ec.SECP256R1):
+        return 'ecdsa-p256'
+    if isinstance(key, (ed25519.Ed25519PrivateKey, ed25519.Ed25519PublicKey)):
+        return 'ed25519'
+    if isinstance(key, (rsa.RSAPrivateKey, rsa.RSAPublicKey)):
+        return 'rsa'
+    return None
+
+
+def _not_valid_after(cert):
+    if hasattr(cert, 'not_valid_after_utc'):
+        return cert.not_valid_after_utc
+    return cert.not_valid_after.replace(tzinfo=datetime.timezone.utc)
+
+
+def reusable_certificate(cert_file, key_file, CN='localhost', key_type=None, min_validity_days=DEFAULT_MIN_VALIDITY_DAYS):
+    """Checks if an existing certificate and key can be reused instead of generating new ones: both files can be
+    read, the key matches the certificate, the certificate is issued for CN and is valid for at least
+    min_validity_days more days.
+
+    :param cert_file: Path to the certificate.
+    :type cert_file: str
+    :param key_file: Path to the private key.
+    :type key_file: str
+    :param CN: DNS name the certificate must be issued for, defaults to 'localhost'
+    :type CN: str, optional
+    :param key_type: Key type the key must have, defaults to any type
+    :type key_type: str, optional
+    :param min_validity_days: Minimum remaining validity in days, defaults to 30
+    :type min_validity_days: int, optional
+    :return: True if the certificate and the key can be reused, otherwise False.
+    :rtype: bool
+    """
+    try:
+        with open(cert_file, 'rb') as f:
+            cert = x509.load_pem_x509_certificate(f.read())
+        with open(key_file, 'rb') as f:
+            key = serialization.load_pem_private_key(f.read(), password=None)
+    except (OSError, ValueError, TypeError):
+        return False
+
+    public_format = (serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+    if key.public_key().public_bytes(*public_format) != cert.public_key().public_bytes(*public_format):
+        return False
+    if key_type is not None and key_type_of(key) != key_type:
+        return False
+    common_names = cert.subject.get_attributes_for_oid(x509.oid.NameOID.COMMON_NAME)
+    if not common_names or common_names[0].value != CN:
+        return False
+    remaining = _not_valid_after(cert) - datetime.datetime.now(datetime.timezone.utc)
+    return remaining >= datetime.timedelta(days=min_validity_days)
+
+
+def generate_self_signed_cert(CN='localhost', cert_file='/etc/luks/gunicorn-cert.pem', expiration_days=3650, key_size=4096,
+                              key_file='/etc/luks/gunicorn-key.pem', key_type=DEFAULT_KEY_TYPE, reuse=True,
+                              min_validity_days=DEFAULT_MIN_VALIDITY_DAYS):
+    """Generates a self signed certificate used by the luksctl API for https. If reuse is True and the existing
+    certificate and key are still valid, refer to reusable_certificate, they are kept as they are.
 
     :param CN: DNS name, defaults to 'localhost'
     :type CN: str, optional
@@ -33,14 +132,25 @@ def generate_self_signed_cert(CN='localhost', cert_file='/etc/luks/gunicorn-cert
     :type cert_file: str, optional
     :param expiration_days: Expiration of the self signed certificate, defaults to 3650
     :type expiration_days: int, optional
-    :param key_size: Private key length in bits, defaults to 4096
+    :param key_size: Private key length in bits, used only for RSA keys, defaults to 4096
     :type key_size: int, optional
     :param key_file: Path where the private key is stored, defaults to '/etc/luks/gunicorn-key.pem'
     :type key_file: str, optional
+    :param key_type: Key type, one of 'ecdsa-p256', 'ed25519' or 'rsa', defaults to 'ecdsa-p256'
+    :type key_type: str, optional
+    :param reuse: If set to True, a valid existing certificate of the same key type is reused, defaults to True
+    :type reuse: bool, optional
+    :param min_validity_days: Minimum remaining validity in days of a reused certificate, defaults to 30
+    :type min_validity_days: int, optional
+    :return: True if a new certificate has been generated, False if the existing one has been reused.
+    :rtype: bool
     """
+    if reuse and reusable_certificate(cert_file, key_file, CN=CN, key_type=key_type, min_validity_days=min_validity_days):
+        return False
+
     subject = issuer = x509.Name([x509.NameAttribute(x509.oid.NameOID.COMMON_NAME, CN)])
 
-    key = generate_private_key(key_size=key_size, key_file=key_file)
+    key = generate_private_key(key_size=key_size, key_file=key_file, key_type=key_type)
 
     cert = x509.CertificateBuilder().subject_name(
         subject
@@ -57,8 +167,54 @@ def generate_self_signed_cert(CN='localhost', cert_file='/etc/luks/gunicorn-cert
         datetime.datetime.utcnow() + datetime.timedelta(days=expiration_days)
     ).add_extension(
         x509.SubjectAlternativeName([x509.DNSName(CN)]), critical=False,
-    # Sign the certificate with private key
-    ).sign(key, hashes.SHA256())
+    # Sign the certificate with private key, Ed25519 signatures don't take a separate hash algorithm
+    ).sign(key, None if key_type == 'ed25519' else hashes.SHA256())
+
+    write_file_atomically(cert_file, cert.public_bytes(serialization.Encoding.PEM))
+
+    return True
+
+
+
+################################################################################
+# SERVER TLS CONTEXT
+
+class SharedServerContext:
+    """TLS context of the API server, used by the ssl_context hook of the generated gunicorn configuration.
+    The context is created when the configuration is loaded by the gunicorn master, so that the workers forked
+    from it share the key used to encrypt the session tickets: a client resumes its TLS session whichever worker
+    serves its next connection, skipping the full handshake. The certificate is loaded once per worker.
+    """
+
+
+    def __init__(self, tls13_tickets=TLS13_TICKETS):
+        """Instantiate a SharedServerContext object, creating the TLS context and its session ticket key.
+
+        :param tls13_tickets: Session tickets issued to TLS 1.3 clients after each full handshake, defaults to 2
+        :type tls13_tickets: int, optional
+        """
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.options |= ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1 # minimum_version needs Python 3.7
+        self.context.options &= ~ssl.OP_NO_TICKET
+        if hasattr(self.context, 'num_tickets'):
+            self.context.num_tickets = tls13_tickets
+        self._loaded = None
+
+
+    def get(self, conf):
+        """Returns the context with the certificate, key and ciphers of the gunicorn configuration loaded.
 
-    with open(cert_file, 'wb') as f:
-        f.write(cert.public_bytes(serialization.Encoding.PEM))
+        :param conf: Gunicorn configuration.
+        :type conf: gunicorn.config.Config
+        :return: The server TLS context.
+        :rtype: ssl.SSLContext
+        """
+        loaded = (os.getpid(), conf.certfile, conf.keyfile)
+        if self._loaded != loaded:
+            self.context.load_cert_chain(certfile=conf.certfile, keyfile=conf.keyfile)
+            if conf.ca_certs:
+                self.context.load_verify_locations(cafile=conf.ca_certs)
+            if conf.ciphers:
+                self.context.set_ciphers(conf.ciphers)
+            self._loaded = loaded
+        return self.context
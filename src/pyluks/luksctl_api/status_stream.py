@@ -0,0 +1,272 @@
+# Import dependencies
+import os
+import time
+import select
+import socket
+import threading
+
+# Import internal dependencies
+from ..inventory import MOUNTINFO_FILE
+
+
+
+################################################################################
+# VARIABLES
+
+DEFAULT_WATCH_INTERVAL = 30.0  # Seconds between full rescans, when no mount or device-mapper event is received
+DEFAULT_STREAM_TIMEOUT = 30.0  # Seconds a long-poll request waits for a change, or between SSE keep-alives
+MAX_STREAM_TIMEOUT = 300.0
+DEFAULT_STREAM_LIFETIME = 600.0  # Seconds after which an event stream is closed, the client reconnects with Last-Event-ID
+DEFAULT_MAX_STREAMS = 2        # Concurrent streams and waiting long polls per API worker, each one holds a worker thread
+DEBOUNCE = 0.1                 # Seconds waited after an event to coalesce bursts, e.g. the mounts of a volume open
+
+
+
+################################################################################
+# FUNCTIONS
+
+def _open_uevent_socket():
+    """Returns a netlink socket receiving the kernel uevents, used to detect device-mapper devices being created
+    or removed, or None if it can't be opened, e.g. in a container without netlink."""
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, socket.NETLINK_KOBJECT_UEVENT)
+        sock.bind((0, 1)) # Kernel uevents multicast group
+        sock.setblocking(False)
+        return sock
+    except (AttributeError, OSError):
+        return None
+
+
+def _is_dm_uevent(message):
+    fields = message.split(b'\0')
+    return b'SUBSYSTEM=block' in fields and any(f.startswith(b'DM_NAME=') or f.startswith(b'DEVNAME=dm-') for f in fields)
+
+
+
+################################################################################
+# STATUS WATCHER CLASS
+
+class StatusWatcher:
+    """Keeps the volume_state of the volumes of the host up to date in a single background thread, shared by
+    all the clients of the /status/stream endpoint served by the process. States are recomputed with the
+    compute function when the mount table changes (poll on mountinfo), when a device-mapper device is created
+    or removed (kernel uevents) and every interval seconds, since not every change raises an event.
+
+    Every change of a volume state increases the watcher version, which the clients use as cursor: waiting for
+    a version greater than the last one seen costs a wait on a shared condition, whatever the number of clients.
+    """
+
+
+    def __init__(self, compute, interval=DEFAULT_WATCH_INTERVAL, mountinfo_file=MOUNTINFO_FILE, uevents=True):
+        """Instantiate a StatusWatcher object. The watcher thread is started with StatusWatcher.start.
+
+        :param compute: Function returning a dictionary with the volume_state of each volume, by cryptdev name.
+        :type compute: function
+        :param interval: Seconds between rescans when no event is received, defaults to 30.0
+        :type interval: float, optional
+        :param mountinfo_file: File polled for mount table changes, defaults to '/proc/self/mountinfo'
+        :type mountinfo_file: str, optional
+        :param uevents: If set to True, kernel uevents are used to detect device-mapper changes, defaults to True
+        :type uevents: bool, optional
+        """
+        self.compute = compute
+        self.interval = interval
+        self.mountinfo_file = mountinfo_file
+        self.uevents = uevents
+        self.version = 0
+        self.volumes = {}       # cryptdev -> {'volume_state', 'version', 'changed'}
+        self.refreshes = 0
+        self._condition = threading.Condition()
+        self._wakeup = threading.Event()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+
+
+    #____________________________________
+    # State
+    def refresh(self):
+        """Recomputes the volume states and wakes up the clients if any of them changed.
+
+        :return: True if any volume state changed.
+        :rtype: bool
+        """
+        try:
+            states = self.compute()
+        except Exception:
+            states = {cryptdev: 'unavailable' for cryptdev in self.volumes}
+
+        with self._condition:
+            self.refreshes += 1
+            changed = [cryptdev for cryptdev, state in states.items()
+                       if self.volumes.get(cryptdev, {}).get('volume_state') != state]
+            removed = [cryptdev for cryptdev in self.volumes if cryptdev not in states]
+            if not changed and not removed:
+                return False
+            self.version += 1
+            for cryptdev in changed:
+                self.volumes[cryptdev] = {'volume_state': states[cryptdev], 'version': self.version, 'changed': time.time()}
+            for cryptdev in removed:
+                del self.volumes[cryptdev]
+            self._condition.notify_all()
+        return True
+
+    def snapshot(self, cryptdevs=None):
+        """Returns the current version and the state of the volumes.
+
+        :param cryptdevs: Cryptdev names of the volumes to return, defaults to all the volumes
+        :type cryptdevs: list, optional
+        :return: Dictionary with the version and the volumes, by cryptdev name.
+        :rtype: dict
+        """
+        with self._condition:
+            return {'version': self.version,
+                    'volumes': {cryptdev: dict(volume) for cryptdev, volume in self.volumes.items()
+                                if cryptdevs is None or cryptdev in cryptdevs}}
+
+    def _latest(self, cryptdevs):
+        if cryptdevs is None:
+            return self.version
+        return max((v['version'] for c, v in self.volumes.items() if c in cryptdevs), default=0)
+
+    def wait(self, cursor=None, timeout=DEFAULT_STREAM_TIMEOUT, cryptdevs=None):
+        """Waits until a volume changes after the cursor version, or the timeout expires, and returns the
+        snapshot of the volumes. Without cursor, the snapshot is returned right away.
+
+        :param cursor: Version of the last snapshot seen by the client, defaults to None
+        :type cursor: int, optional
+        :param timeout: Maximum seconds to wait, defaults to 30.0
+        :type timeout: float, optional
+        :param cryptdevs: Cryptdev names of the volumes to wait for, defaults to all the volumes
+        :type cryptdevs: list, optional
+        :return: Dictionary with the version and the volumes, refer to StatusWatcher.snapshot.
+        :rtype: dict
+        """
+        self.start()
+        with self._condition:
+            if cursor is not None:
+                self._condition.wait_for(lambda: self._latest(cryptdevs) > cursor or self._stopped, timeout=timeout)
+        return self.snapshot(cryptdevs)
+
+
+    #____________________________________
+    # Watcher thread
+    def start(self):
+        """Computes the first states and starts the watcher thread, if not running yet."""
+        with self._start_lock:
+            if self._thread is None:
+                self.refresh()
+                self._thread = threading.Thread(target=self._watch, name='luksctl_api-status-watcher', daemon=True)
+                self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+        with self._condition:
+            self._condition.notify_all()
+
+    def notify(self):
+        """Triggers a refresh from the watcher thread, e.g. after the API has opened a volume."""
+        self._wakeup.set()
+
+    def _watch(self):
+        poller = select.poll()
+        try:
+            # The kernel flags mountinfo with POLLPRI|POLLERR when the mount table changes, once it has been read
+            mountinfo = open(self.mountinfo_file)
+            mountinfo.read()
+            poller.register(mountinfo, select.POLLPRI | select.POLLERR)
+        except OSError:
+            mountinfo = None
+        uevent_socket = _open_uevent_socket() if self.uevents else None
+        if uevent_socket is not None:
+            poller.register(uevent_socket, select.POLLIN)
+
+        # The wakeup event is checked at least every second, so that notify and stop don't wait for an event
+        last_refresh = time.monotonic()
+        while not self._stopped:
+            events = poller.poll(min(self.interval, 1.0) * 1000)
+            triggered = self._wakeup.is_set()
+            for fd, _ in events:
+                if mountinfo is not None and fd == mountinfo.fileno():
+                    mountinfo.seek(0)
+                    mountinfo.read()
+                    triggered = True
+                elif uevent_socket is not None and fd == uevent_socket.fileno():
+                    while True:
+                        try:
+                            triggered |= _is_dm_uevent(uevent_socket.recv(65536))
+                        except BlockingIOError:
+                            break
+            if triggered or time.monotonic() - last_refresh >= self.interval:
+                if triggered:
+                    time.sleep(DEBOUNCE)
+                self._wakeup.clear()
+                self.refresh()
+                last_refresh = time.monotonic()
+
+        for source in (mountinfo, uevent_socket):
+            if source is not None:
+                source.close()
+
+
+
+################################################################################
+# PROCESS-WIDE WATCHERS
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+_streams = 0
+_streams_lock = threading.Lock()
+
+def get_status_watcher(key, compute, interval=DEFAULT_WATCH_INTERVAL):
+    """Returns the StatusWatcher of the process for key, e.g. the cryptdev .ini file, creating it on first use.
+    Watchers inherited from a parent process are not reused after fork, since their thread doesn't exist there.
+
+    :param key: Key identifying the watched host configuration.
+    :type key: str
+    :param compute: Function computing the volume states, used if the watcher is created.
+    :type compute: function
+    :param interval: Seconds between rescans when no event is received, defaults to 30.0
+    :type interval: float, optional
+    :return: The started StatusWatcher of the process.
+    :rtype: pyluks.luksctl_api.status_stream.StatusWatcher
+    """
+    with _watchers_lock:
+        watcher = _watchers.get((os.getpid(), key))
+        if watcher is None:
+            watcher = _watchers[(os.getpid(), key)] = StatusWatcher(compute, interval=interval)
+    return watcher.start()
+
+
+def acquire_stream(max_streams=DEFAULT_MAX_STREAMS):
+    """Reserves one of the max_streams stream slots of the process, released with release_stream. Each stream or
+    waiting long poll holds a thread of the API worker, so the slots keep threads free for the other requests.
+
+    :param max_streams: Maximum number of concurrent streams in the process, defaults to 2
+    :type max_streams: int, optional
+    :return: True if a slot was reserved, False if max_streams streams are already open.
+    :rtype: bool
+    """
+    global _streams
+    with _streams_lock:
+        if _streams >= max_streams:
+            return False
+        _streams += 1
+        return True
+
+
+def release_stream():
+    """Releases a stream slot reserved with acquire_stream."""
+    global _streams
+    with _streams_lock:
+        _streams = max(0, _streams - 1)
+
+
+def notify_status_change():
+    """Triggers a refresh of the watchers of the process, if any, e.g. after a volume has been opened."""
+    with _watchers_lock:
+        watchers = [w for (pid, _), w in _watchers.items() if pid == os.getpid()]
+    for watcher in watchers:
+        watcher.notify()
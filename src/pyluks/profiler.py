@@ -0,0 +1,313 @@
+# Import dependencies
+import os
+import sys
+import json
+import time
+import shlex
+import atexit
+import signal
+import threading
+from bisect import bisect_left
+
+# Import internal dependencies
+from .utilities import add_command_hook, remove_command_hook, write_file_atomically
+
+
+
+################################################################################
+# VARIABLES
+
+# Environment variable enabling the profiler of the pyluks entry points, see profile_from_environment
+PROFILE_ENV = 'PYLUKS_PROFILE'
+
+# Environment variable setting a file which dumps the report when it's created or touched, see watch_trigger
+PROFILE_TRIGGER_ENV = 'PYLUKS_PROFILE_TRIGGER'
+
+# Seconds between two checks of the trigger file
+TRIGGER_POLL_INTERVAL = 1.0
+
+# Upper bounds in seconds of the latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# Tools whose first positional argument is part of the verb, e.g. 'cryptsetup luksOpen' or 'systemctl stop'
+SUBCOMMAND_TOOLS = {'cryptsetup', 'systemctl', 'dmsetup', 'luksctl', 'exportfs'}
+
+# Options of these tools followed by a value, skipped when looking for the subcommand
+OPTIONS_WITH_VALUE = {'--cipher', '-c', '--key-size', '-s', '--hash', '-h', '--iter-time', '-i', '--key-slot', '-S',
+                      '--pbkdf-memory', '--header-backup-file', '--header', '--key-file', '-d', '--cryptdev'}
+
+# Shell operators separating the commands of a run_command pipeline
+SHELL_OPERATORS = {'|', '||', '&&', ';'}
+
+
+
+################################################################################
+# FUNCTIONS
+
+def command_verb(cmd):
+    """Returns the verb a command is profiled under: the tool name, followed by its subcommand for tools in
+    SUBCOMMAND_TOOLS, e.g. 'cryptsetup luksOpen', 'systemctl stop' or 'mount'. The sudo prefix is skipped and,
+    for shell pipelines, the last command is used, e.g. cryptsetup in 'printf ... | cryptsetup luksOpen ...'.
+    Only the verb is kept, never the arguments, which may contain device names or secrets.
+
+    :param cmd: Shell command line, as passed to run_command, or argument list, as passed to run_argv.
+    :type cmd: str or list
+    :return: The command verb.
+    :rtype: str
+    """
+    if isinstance(cmd, str):
+        try:
+            args = shlex.split(cmd)
+        except ValueError:
+            args = cmd.split()
+        for i in reversed(range(len(args))):
+            if args[i] in SHELL_OPERATORS:
+                args = args[i + 1:]
+                break
+    else:
+        args = list(cmd)
+
+    while args and (os.path.basename(args[0]) == 'sudo' or args[0].startswith('-')):
+        args = args[1:] # sudo and its options
+    if not args:
+        return '?'
+
+    tool = os.path.basename(args[0])
+    if tool not in SUBCOMMAND_TOOLS:
+        return tool
+    skip = False
+    for arg in args[1:]:
+        if skip:
+            skip = False
+        elif arg.startswith('-'):
+            skip = arg in OPTIONS_WITH_VALUE
+        else:
+            return f'{tool} {arg}'
+    return tool
+
+
+
+################################################################################
+# COMMAND PROFILER CLASS
+
+class CommandProfiler:
+    """Profiler of the external commands run by pyluks, registered as run_command and run_argv hook. For each command
+    verb (see command_verb) it counts the calls, their exit codes and output bytes, and keeps a latency histogram,
+    with the buckets in LATENCY_BUCKETS.
+    """
+
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """Instantiate a CommandProfiler object. Commands are recorded once it's enabled with CommandProfiler.enable.
+
+        :param buckets: Upper bounds in seconds of the latency histogram buckets, defaults to LATENCY_BUCKETS
+        :type buckets: tuple, optional
+        """
+        self.buckets = tuple(buckets)
+        self.stats = {} # verb -> statistics
+        self._lock = threading.Lock()
+        self._hook = None
+
+
+    def enable(self):
+        """Starts recording the commands."""
+        if self._hook is None:
+            self._hook = add_command_hook(post=self.record)
+        return self
+
+    def disable(self):
+        """Stops recording the commands, the recorded statistics are kept."""
+        if self._hook is not None:
+            remove_command_hook(self._hook)
+            self._hook = None
+
+    @property
+    def enabled(self): return self._hook is not None
+
+    def reset(self):
+        """Forgets the recorded statistics."""
+        with self._lock:
+            self.stats.clear()
+
+
+    def record(self, cmd, stdout, stderr, status, seconds):
+        """Records a command, with the arguments of an add_command_hook post callback."""
+        verb = command_verb(cmd)
+        stdout_bytes, stderr_bytes = len(stdout.encode('utf-8')), len(stderr.encode('utf-8'))
+        with self._lock:
+            stats = self.stats.get(verb)
+            if stats is None:
+                stats = self.stats[verb] = {'count': 0, 'total_seconds': 0.0, 'min_seconds': seconds, 'max_seconds': seconds,
+                                            'histogram': [0] * (len(self.buckets) + 1), 'exit_codes': {},
+                                            'stdout_bytes': 0, 'stderr_bytes': 0}
+            stats['count'] += 1
+            stats['total_seconds'] += seconds
+            stats['min_seconds'] = min(stats['min_seconds'], seconds)
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['histogram'][bisect_left(self.buckets, seconds)] += 1
+            stats['exit_codes'][status] = stats['exit_codes'].get(status, 0) + 1
+            stats['stdout_bytes'] += stdout_bytes
+            stats['stderr_bytes'] += stderr_bytes
+
+
+    def _percentile(self, histogram, count, p):
+        """Upper bound of the bucket containing the p-th percentile, None if it's the unbounded bucket."""
+        rank, seen = p / 100 * count, 0
+        for i, bucket_count in enumerate(histogram):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return self.buckets[i] if i < len(self.buckets) else None
+        return None
+
+    def report(self):
+        """Returns the recorded statistics, the verbs taking the most time first.
+
+        :return: Dictionary mapping each verb to its count, total, mean, min and max seconds, p50, p90 and p99
+            (upper bounds of the histogram buckets), histogram ({'<upper bound>': count}, '+Inf' for the last
+            bucket), exit_codes ({'<exit code>': count}), stdout_bytes and stderr_bytes.
+        :rtype: dict
+        """
+        with self._lock:
+            stats = {verb: dict(values, histogram=list(values['histogram']), exit_codes=dict(values['exit_codes']))
+                     for verb, values in self.stats.items()}
+
+        labels = [f'{bound:g}' for bound in self.buckets] + ['+Inf']
+        report = {}
+        for verb, values in sorted(stats.items(), key=lambda item: item[1]['total_seconds'], reverse=True):
+            count, histogram = values['count'], values['histogram']
+            report[verb] = {'count': count,
+                            'total_seconds': round(values['total_seconds'], 6),
+                            'mean_seconds': round(values['total_seconds'] / count, 6),
+                            'min_seconds': round(values['min_seconds'], 6),
+                            'max_seconds': round(values['max_seconds'], 6),
+                            **{f'p{p}': self._percentile(histogram, count, p) for p in (50, 90, 99)},
+                            'histogram': {label: n for label, n in zip(labels, histogram) if n},
+                            'exit_codes': {str(code): n for code, n in sorted(values['exit_codes'].items())},
+                            'stdout_bytes': values['stdout_bytes'],
+                            'stderr_bytes': values['stderr_bytes']}
+        return report
+
+    def format_report(self):
+        """Returns the report as a text table, one line per verb."""
+        lines = [f'{"command":<28} {"count":>6} {"total s":>10} {"mean s":>9} {"max s":>9} {"p90 s":>7}  exit codes']
+        for verb, values in self.report().items():
+            p90 = f'{values["p90"]:g}' if values['p90'] is not None else 'inf'
+            exit_codes = ','.join(f'{code}:{n}' for code, n in values['exit_codes'].items())
+            lines.append(f'{verb:<28} {values["count"]:>6} {values["total_seconds"]:>10.3f} {values["mean_seconds"]:>9.3f} '
+                         f'{values["max_seconds"]:>9.3f} {p90:>7}  {exit_codes}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path=None):
+        """Writes the report, as JSON to a file or as a table to stderr.
+
+        :param path: Destination file, '{pid}' is replaced by the process id. Defaults to None (stderr)
+        :type path: str, optional
+        """
+        if path is None or path == '-':
+            sys.stderr.write(self.format_report())
+            return
+        write_file_atomically(path.format(pid=os.getpid()),
+                              json.dumps({'pid': os.getpid(), 'commands': self.report()}, indent=2) + '\n')
+
+
+
+################################################################################
+# PROCESS PROFILER
+
+_profiler = None
+_profiler_lock = threading.Lock()
+
+
+def get_profiler():
+    """Returns the profiler of the process, created on first use and not enabled."""
+    global _profiler
+    with _profiler_lock:
+        if _profiler is None:
+            _profiler = CommandProfiler()
+    return _profiler
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def watch_trigger(profiler, trigger_file, dump_file=None, interval=TRIGGER_POLL_INTERVAL):
+    """Starts a daemon thread dumping the report of a profiler each time a trigger file is created or touched.
+    Unlike a signal handler, it works in gunicorn workers, where the signals are reserved by gunicorn: touching the
+    file makes every worker watching it dump its report, e.g. to a per-process '{pid}' dump file.
+
+    :param profiler: Profiler whose report is dumped.
+    :type profiler: pyluks.profiler.CommandProfiler
+    :param trigger_file: Path to the trigger file.
+    :type trigger_file: str
+    :param dump_file: File the report is dumped to, see CommandProfiler.dump, defaults to None (stderr)
+    :type dump_file: str, optional
+    :param interval: Seconds between two checks of the trigger file, defaults to 1.0
+    :type interval: float, optional
+    :return: The watching thread.
+    :rtype: threading.Thread
+    """
+    def watch():
+        last = _mtime(trigger_file)
+        while True:
+            time.sleep(interval)
+            current = _mtime(trigger_file)
+            if current is not None and current != last:
+                profiler.dump(dump_file)
+            last = current
+
+    thread = threading.Thread(target=watch, name='pyluks-profile-trigger', daemon=True)
+    thread.start()
+    return thread
+
+
+def enable_profiling(dump_file=None, at_exit=True, dump_signal=None, dump_trigger=None):
+    """Enables the profiler of the process, see get_profiler.
+
+    :param dump_file: File the report is dumped to, see CommandProfiler.dump, defaults to None (stderr)
+    :type dump_file: str, optional
+    :param at_exit: If set to True, the report is dumped when the process exits, defaults to True
+    :type at_exit: bool, optional
+    :param dump_signal: Signal dumping the report on demand, e.g. signal.SIGUSR2. Only installed from the main
+        thread, defaults to None
+    :type dump_signal: int, optional
+    :param dump_trigger: File dumping the report on demand when it's created or touched, see watch_trigger. The
+        watching thread is started again in forked children, e.g. gunicorn workers of a preloaded app, defaults to None
+    :type dump_trigger: str, optional
+    :return: The profiler of the process.
+    :rtype: pyluks.profiler.CommandProfiler
+    """
+    profiler = get_profiler()
+    if profiler.enabled:
+        return profiler # Already enabled, with its dumps
+    profiler.enable()
+    if at_exit:
+        atexit.register(profiler.dump, dump_file)
+    if dump_signal is not None and threading.current_thread() is threading.main_thread():
+        signal.signal(dump_signal, lambda signum, frame: profiler.dump(dump_file))
+    if dump_trigger is not None:
+        watch_trigger(profiler, dump_trigger, dump_file)
+        if hasattr(os, 'register_at_fork'): # Python 3.7+, threads don't survive a fork
+            os.register_at_fork(after_in_child=lambda: watch_trigger(profiler, dump_trigger, dump_file))
+    return profiler
+
+
+def profile_from_environment(dump_signal=signal.SIGUSR2):
+    """Enables the profiler of the process if the PYLUKS_PROFILE environment variable is set, with its value as
+    dump file ('-' for stderr). The report is dumped at exit, when the process receives dump_signal and, if the
+    PYLUKS_PROFILE_TRIGGER environment variable is set, when the file it names is created or touched. Called by
+    the fastluks, luksctl and luksctl_api entry points.
+
+    :param dump_signal: Signal dumping the report on demand, None for processes whose signals are managed by
+        another program, e.g. gunicorn workers, defaults to signal.SIGUSR2
+    :type dump_signal: int, optional
+    :return: The profiler of the process if it's enabled, otherwise None.
+    :rtype: pyluks.profiler.CommandProfiler
+    """
+    dump_file = os.environ.get(PROFILE_ENV)
+    if not dump_file:
+        return None
+    return enable_profiling(dump_file=dump_file, dump_signal=dump_signal, dump_trigger=os.environ.get(PROFILE_TRIGGER_ENV) or None)
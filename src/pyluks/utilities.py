@@ -1,9 +1,13 @@
 # Import dependencies
 import subprocess
+import shlex
 import os
 from configparser import ConfigParser
 import logging
 import sys
+import tempfile
+import threading
+import time
 
 
 
@@ -16,11 +20,60 @@ DEFAULT_LOGFILES = {
     'luksctl_api':'/tmp/luksctl-api.log'
 }
 
+DEFAULT_CRYPTDEV_FILE = '/etc/luks/luks-cryptdev.ini'
+
+# Parsed cryptdev .ini files, shared by all the readers of the process: path -> (file signature, ConfigParser)
+_config_cache = {}
+_config_lock = threading.Lock()
+
+# Callbacks run before and after every command started by run_command and run_argv, see add_command_hook
+_command_hooks = []
+_hooks_lock = threading.Lock()
+
 
 
 ################################################################################
 # FUNCTIONS
 
+#__________________________________
+# Command hooks
+def add_command_hook(pre=None, post=None):
+    """Registers callbacks run around every command started by run_command and run_argv, in the thread running
+    the command. The pre callback is called as pre(cmd) before the command starts, the post callback as
+    post(cmd, stdout, stderr, status, seconds) once it exits. cmd is the shell command line passed to run_command
+    or the argument list passed to run_argv. As with the logger, it can contain secrets when a shell pipeline passes
+    them, while the stdin of run_argv is never passed. Errors raised by the callbacks are ignored.
+
+    :param pre: Callback run before each command, defaults to None
+    :type pre: callable, optional
+    :param post: Callback run after each command, defaults to None
+    :type post: callable, optional
+    :return: Hook handle, to be passed to remove_command_hook.
+    :rtype: tuple
+    """
+    hook = (pre, post)
+    with _hooks_lock:
+        _command_hooks.append(hook)
+    return hook
+
+
+def remove_command_hook(hook):
+    """Unregisters a hook returned by add_command_hook. Unknown hooks are ignored."""
+    with _hooks_lock:
+        if hook in _command_hooks:
+            _command_hooks.remove(hook)
+
+
+def _run_hooks(position, *args):
+    for hook in list(_command_hooks):
+        callback = hook[position]
+        if callback is not None:
+            try:
+                callback(*args)
+            except Exception:
+                pass # A failing hook never fails the command
+
+
 #__________________________________
 # Function to run bash commands
 def run_command(cmd, logger=None):
@@ -33,11 +86,19 @@ def run_command(cmd, logger=None):
     :return: Returns tuple containing stdout, stderr and exit code.
     :rtype: tuple
     """
+    hooks = bool(_command_hooks)
+    if hooks:
+        _run_hooks(0, cmd)
+        start = time.monotonic()
+
     proc = subprocess.Popen(args=cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     communicateRes = proc.communicate()
     stdout, stderr = [x.decode('utf-8') for x in communicateRes]
     status = proc.wait()
 
+    if hooks:
+        _run_hooks(1, cmd, stdout, stderr, status, time.monotonic() - start)
+
     # Functionality to replicate cmd >> "$LOGFILE" 2>&1
     if logger != None:
         logger.debug(f'Command: {cmd}\nStdout: {stdout}\nStderr: {stderr}')
@@ -45,6 +106,130 @@ def run_command(cmd, logger=None):
     return stdout, stderr, status
 
 
+# Exit code returned by run_argv when the command is killed after the timeout, as with timeout(1)
+TIMEOUT_STATUS = 124
+
+
+def run_argv(args, logger=None, input=None, timeout=None, env=None):
+    """Run a command without a shell, redirecting stdout, stderr and the command exit code.
+    Secrets are written to the stdin pipe of the command, so they don't appear in the command line
+    and no shell, printf or other helper process is spawned.
+
+    :param args: Command and its arguments, e.g. ['cryptsetup', 'luksOpen', '/dev/vdb', 'crypt']
+    :type args: list
+    :param logger: logging.Logger object used to log the command, stdout, stderr and exit code, defaults to None
+    :type logger: logging.Logger, optional
+    :param input: Data written to the stdin of the command, which is never logged. If None, stdin is inherited, defaults to None
+    :type input: str, optional
+    :param timeout: Seconds after which the command is killed, defaults to None (no timeout)
+    :type timeout: float, optional
+    :param env: Environment variables added to the ones of the current process, defaults to None
+    :type env: dict, optional
+    :return: Returns tuple containing stdout, stderr and exit code. The exit code is 124 if the command timed out,
+        127 if it wasn't found.
+    :rtype: tuple
+    """
+    args = [str(arg) for arg in args]
+    hooks = bool(_command_hooks)
+    if hooks:
+        _run_hooks(0, args)
+        start = time.monotonic()
+
+    try:
+        proc = subprocess.run(args,
+                              input=input.encode('utf-8') if input is not None else None,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE,
+                              timeout=timeout,
+                              env={**os.environ, **env} if env is not None else None)
+        stdout, stderr = proc.stdout.decode('utf-8'), proc.stderr.decode('utf-8')
+        status = proc.returncode
+    except subprocess.TimeoutExpired as e:
+        stdout = (e.stdout or b'').decode('utf-8')
+        stderr = (e.stderr or b'').decode('utf-8') + f'Command timed out after {timeout} seconds.'
+        status = TIMEOUT_STATUS
+    except FileNotFoundError:
+        stdout, stderr, status = '', f'Command not found: {args[0]}', 127
+
+    if hooks:
+        _run_hooks(1, args, stdout, stderr, status, time.monotonic() - start)
+
+    if logger != None:
+        command = ' '.join(shlex.quote(arg) for arg in args) # shlex.join needs Python 3.8
+        logger.debug(f'Command: {command}\nStdout: {stdout}\nStderr: {stderr}\nStatus: {status}')
+
+    return stdout, stderr, status
+
+
+#__________________________________
+# Atomic file writes
+def write_file_atomically(path, content, mode=0o644):
+    """Writes a file through a temporary file in the same directory, renamed over the destination path.
+    Readers see either the old or the new content, never a partially written file.
+
+    :param path: Destination path.
+    :type path: str
+    :param content: Content of the file, written in binary mode if it's a bytes object.
+    :type content: str or bytes
+    :param mode: Permissions used if the file doesn't exist yet, otherwise the current ones are kept, defaults to 0o644
+    :type mode: int, optional
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    if os.path.exists(path):
+        mode = os.stat(path).st_mode & 0o7777
+
+    fd, tmp_path = tempfile.mkstemp(prefix=f'.{os.path.basename(path)}.', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(content, bytes) else 'w') as tmp_file:
+            tmp_file.write(content)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+#__________________________________
+# Cached configuration
+def read_config(luks_cryptdev_file=DEFAULT_CRYPTDEV_FILE):
+    """Returns the parsed cryptdev .ini file. The file is parsed on first use and the parsed configuration
+    is shared by all the callers until the file changes (different inode, size or modification time),
+    e.g. when it's atomically replaced. A missing file gives an empty configuration.
+    The returned object is shared and must not be modified.
+
+    :param luks_cryptdev_file: Path to the cryptdev .ini file, defaults to '/etc/luks/luks-cryptdev.ini'
+    :type luks_cryptdev_file: str, optional
+    :return: Parsed configuration.
+    :rtype: configparser.ConfigParser
+    """
+    try:
+        stat = os.stat(luks_cryptdev_file)
+        signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    except FileNotFoundError:
+        signature = None
+
+    with _config_lock:
+        cached = _config_cache.get(luks_cryptdev_file)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+    config = ConfigParser()
+    if signature is not None:
+        config.read(luks_cryptdev_file)
+    with _config_lock:
+        _config_cache[luks_cryptdev_file] = (signature, config)
+    return config
+
+
+def clear_config_cache():
+    """Drops the parsed cryptdev .ini files, so they are parsed again on next use."""
+    with _config_lock:
+        _config_cache.clear()
+
+
 #__________________________________
 # Create logging facility
 def create_logger(luks_cryptdev_file, logger_name, loggers_section='logs'):
@@ -90,6 +275,48 @@ def create_logger(luks_cryptdev_file, logger_name, loggers_section='logs'):
     return logger
 
 
+class LazyLogger:
+    """Proxy to the logging.Logger object returned by create_logger, created on first use. Module-level loggers
+    are defined with this class, so that importing pyluks doesn't read the cryptdev .ini file, create the log file
+    or open file handlers: this happens the first time a message is logged.
+    """
+
+
+    def __init__(self, luks_cryptdev_file, logger_name, loggers_section='logs'):
+        """Instantiate a LazyLogger object. Arguments are the ones of create_logger.
+
+        :param luks_cryptdev_file: Path to the cryptdev .ini file containing the path to the log file.
+        :type luks_cryptdev_file: str
+        :param logger_name: Logger name assigned to the logging.Logger object.
+        :type logger_name: str
+        :param loggers_section: Loggers section as defined in the cryptdev .ini file, defaults to 'logs'
+        :type loggers_section: str, optional
+        """
+        self.luks_cryptdev_file = luks_cryptdev_file
+        self.logger_name = logger_name
+        self.loggers_section = loggers_section
+        self._logger = None
+        self._lock = threading.Lock()
+
+    def get_logger(self):
+        """Returns the logging.Logger object, creating it on the first call."""
+        if self._logger is None:
+            with self._lock:
+                if self._logger is None:
+                    self._logger = create_logger(luks_cryptdev_file=self.luks_cryptdev_file,
+                                                 logger_name=self.logger_name,
+                                                 loggers_section=self.loggers_section)
+        return self._logger
+
+    def __getattr__(self, name):
+        # Only called for attributes not defined by LazyLogger, e.g. debug, info, exception and handlers
+        return getattr(self.get_logger(), name)
+
+    def __repr__(self):
+        state = 'created' if self._logger is not None else 'not created'
+        return f'<LazyLogger {self.logger_name} ({state})>'
+
+
 def get_logfile(luks_cryptdev_file, logger_name, loggers_section='logs'):
     """Returns the path to the log file as defined in the cryptdev .ini file. If the log file is not defined
     in the .ini file, a default value is returned for the logger_name (possible values for logger_name
@@ -105,13 +332,11 @@ def get_logfile(luks_cryptdev_file, logger_name, loggers_section='logs'):
     :rtype: str
     """
     # Read logger file from cryptdev file
-    if os.path.exists(luks_cryptdev_file):
-        config = ConfigParser()
-        config.read(luks_cryptdev_file)
-        if loggers_section in config.sections():
-            if logger_name in config[loggers_section]:
-                logfile = config[loggers_section][logger_name]
-                return logfile
+    config = read_config(luks_cryptdev_file)
+    if loggers_section in config.sections():
+        if logger_name in config[loggers_section]:
+            logfile = config[loggers_section][logger_name]
+            return logfile
     
     # cryptdev file or logger section/value missing, return default logger
     return DEFAULT_LOGFILES[logger_name]
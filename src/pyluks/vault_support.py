@@ -1,5 +1,5 @@
-# Import dependencies
-import hvac
+# hvac, and requests with it, is imported by the functions using it: importing it takes longer than
+# importing the rest of pyluks, and most pyluks commands never talk to Vault.
 
 
 #____________________________________
@@ -17,6 +17,8 @@ def write_secret_to_vault(vault_url, wrapping_token, secret_path, key, value, se
     :param value: Passphrase to be stored in Vault
     :type value: str
     """
+    import hvac
+
     # Instantiate the hvac.Client class
     vault_client = hvac.Client(vault_url, verify=False)
 
@@ -50,6 +52,8 @@ def read_secret(vault_url, wrapping_token, secret_root, secret_path, secret_key)
     :rtype: str
     """
     
+    import hvac
+
     # Instantiate the hvac.Client class
     vault_client = hvac.Client(vault_url, verify=False)
 
@@ -65,3 +69,52 @@ def read_secret(vault_url, wrapping_token, secret_root, secret_path, secret_key)
     vault_client.logout(revoke_token=True)
 
     return secret
+
+
+#____________________________________
+def read_secret_version(vault_url, vault_token, secret_root, secret_path):
+    """Reads a secret and its current version from HashiCorp Vault with a token, e.g. to update it with check-and-set.
+
+    :param vault_url: URL to Vault server
+    :type vault_url: str
+    :param vault_token: Vault token allowed to read the secret.
+    :type vault_token: str
+    :param secret_root: Vault root in which secrets are stored, e.g. 'secrets'
+    :type secret_root: str
+    :param secret_path: Vault path in which the passphrase is stored.
+    :type secret_path: str
+    :return: Tuple containing the secret data, as a dictionary, and its version.
+    :rtype: tuple
+    """
+    import hvac
+
+    vault_client = hvac.Client(vault_url, token=vault_token, verify=False)
+    read_response = vault_client.secrets.kv.v2.read_secret_version(path=secret_path, mount_point=secret_root)
+    return read_response['data']['data'], read_response['data']['metadata']['version']
+
+
+#____________________________________
+def update_secret(vault_url, vault_token, secret_root, secret_path, data, cas):
+    """Writes a secret to HashiCorp Vault with check-and-set: the write fails if the secret has been changed
+    since the version given in cas was read.
+
+    :param vault_url: URL to Vault server
+    :type vault_url: str
+    :param vault_token: Vault token allowed to update the secret.
+    :type vault_token: str
+    :param secret_root: Vault root in which secrets are stored, e.g. 'secrets'
+    :type secret_root: str
+    :param secret_path: Vault path in which the passphrase is stored.
+    :type secret_path: str
+    :param data: Secret data, i.e. the keys and values of the secret.
+    :type data: dict
+    :param cas: Version of the secret the update is based on, 0 if the secret must not exist.
+    :type cas: int
+    :return: New version of the secret.
+    :rtype: int
+    """
+    import hvac
+
+    vault_client = hvac.Client(vault_url, token=vault_token, verify=False)
+    response = vault_client.secrets.kv.v2.create_or_update_secret(path=secret_path, secret=data, mount_point=secret_root, cas=cas)
+    return response['data']['version']